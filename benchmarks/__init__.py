@@ -0,0 +1,20 @@
+""" Offline benchmarks for the physaCI function app.
+
+    Run from the repository root, e.g.::
+
+        python -m benchmarks.bench_dispatch --nodes 1 4 16
+
+    Importing this package makes the function app importable as
+    ``__app__``, the same as the Azure Functions host does.
+"""
+
+import pathlib
+import sys
+import types
+
+APP_DIR = pathlib.Path(__file__).resolve().parent.parent / 'physa-ci-app'
+
+if '__app__' not in sys.modules:
+    app_package = types.ModuleType('__app__')
+    app_package.__path__ = [str(APP_DIR)]
+    sys.modules['__app__'] = app_package
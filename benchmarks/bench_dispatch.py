@@ -0,0 +1,348 @@
+""" Webhook-to-dispatch benchmark.
+
+    Runs the real ``github-hook``, ``queue-new-check`` and
+    ``testnode-hook`` entry points against ``benchmarks.fakes``: nodes
+    register through ``testnode-hook``, then each check run goes from a
+    ``check_run`` ``created`` webhook, through the check queue, to a
+    simulated node's ``/run-test``.
+
+    Usage::
+
+        python -m benchmarks.bench_dispatch --nodes 1 4 16 --checks 50
+"""
+
+import argparse
+import functools
+import importlib
+import json
+import logging
+import os
+import statistics
+import tempfile
+import time
+
+import azure.functions as func
+
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+
+from benchmarks import fakes
+
+
+def app_settings(github_url):
+    """ App settings pointing the function app at the fakes.
+
+    :return: dict: The settings, to update ``os.environ`` with.
+    """
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    pem = key.private_bytes(
+        encoding=serialization.Encoding.PEM,
+        format=serialization.PrivateFormat.TraditionalOpenSSL,
+        encryption_algorithm=serialization.NoEncryption(),
+    )
+
+    return {
+        'APP_STORAGE_CONN_STR': fakes.FAKE_CONN_STR,
+        'GITHUB_APP_ID': '1',
+        'GITHUB_APP_KEY': pem.decode(),
+        'GITHUB_API_URL': github_url,
+    }
+
+def load_function(name):
+    """ Imports a function's module from the app.
+    """
+    return importlib.import_module(f'__app__.{name}')
+
+def node_request(route_func, route_action, body, forwarded_for=None, method='POST'):
+    """ Builds a ``testnode-hook`` request, as sent by a node.
+
+    :param: str forwarded_for: The ``x-forwarded-for`` header, which
+                               supplies the node's IP address.
+    """
+    headers = {'content-type': 'application/json'}
+    if forwarded_for is not None:
+        headers['x-forwarded-for'] = forwarded_for
+
+    return func.HttpRequest(
+        method,
+        f'/api/testnode-hook/{route_func}/{route_action}',
+        headers=headers,
+        route_params={'func': route_func, 'action': route_action},
+        body=json.dumps(body).encode(),
+    )
+
+def register_node(testnode_hook, node):
+    """ Registers a simulated node through ``testnode-hook``.
+
+    :return: func.HttpResponse
+    """
+    body = {
+        'node_name': node.name,
+        'node_sig_key': f'{node.name}-key',
+        'listen_port': node.port,
+    }
+
+    return testnode_hook.main(
+        node_request('registrar', 'add', body, f'127.0.0.1:{node.port}')
+    )
+
+def report_completed(testnode_hook, node, message):
+    """ Posts a node's completed ``testresult/update`` for a finished
+        job, which frees its slot in the node ledger.
+
+    :return: func.HttpResponse
+    """
+    body = {
+        'node_name': node.name,
+        'check_run_id': message.get('check_run_id'),
+        'github_data': {
+            'status': 'completed',
+            'conclusion': 'success',
+            'output': {'title': 'RosiePi', 'summary': 'success'},
+        },
+        'node_test_data': {'board_tests': []},
+    }
+
+    return testnode_hook.main(node_request('testresult', 'update', body))
+
+def check_run_webhook(check_run, repo_name='physaCI/bench', installation_id=1):
+    """ Builds a ``check_run`` ``created`` webhook request for a check
+        run created on the fake GitHub.
+    """
+    payload = {
+        'action': 'created',
+        'check_run': {
+            'id': check_run['id'],
+            'node_id': check_run.get('node_id'),
+            'head_sha': check_run['head_sha'],
+            'status': check_run['status'],
+            'app': {'id': 1},
+            'check_suite': check_run.get('check_suite', {}),
+            'pull_requests': check_run.get('pull_requests', []),
+        },
+        'repository': {'full_name': repo_name, 'node_id': 'R_bench'},
+        'installation': {'id': installation_id},
+    }
+
+    return func.HttpRequest(
+        'POST',
+        '/api/github-hook',
+        headers={'x-github-event': 'check_run', 'content-type': 'application/json'},
+        body=json.dumps(payload).encode(),
+    )
+
+def drain_queue(queue_service, queue_name, handler):
+    """ Runs a queue-triggered function for every visible message, then
+        deletes the message, the same as the Functions host does on a
+        successful invocation.
+
+    :return: int: The number of messages processed.
+    """
+    queue_client = queue_service.get_queue_client(queue_name)
+    processed = 0
+    for message in queue_client.receive_messages(visibility_timeout=30):
+        content = message.content
+        if isinstance(content, str):
+            content = content.encode()
+        handler.main(func.QueueMessage(id=message.id, body=content))
+        queue_client.delete_message(message)
+        processed += 1
+
+    return processed
+
+def percentile(values, fraction):
+    """ Nearest-rank percentile.
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = max(int(round(fraction * len(ordered) + 0.5)) - 1, 0)
+
+    return ordered[min(index, len(ordered) - 1)]
+
+def stage_means(snapshot):
+    """ Mean duration, in ms, of each stage in a ``metrics.snapshot()``.
+    """
+    means = {}
+    for (name, labels), histogram in snapshot['histograms'].items():
+        if name != 'stage_duration_seconds' or not histogram.count:
+            continue
+        stage = dict(labels).get('stage')
+        if stage == 'invocation':
+            stage = f'invocation:{dict(labels).get("function")}'
+        means[stage] = round(histogram.sum / histogram.count * 1000, 3)
+
+    return dict(sorted(means.items()))
+
+def run(node_count, checks, node_latency=0.0, failure_rate=0.0,
+        github_latency=0.0, job_seconds=None, seed=0, storage_backend='azure'):
+    """ Runs one benchmark configuration.
+
+        With ``storage_backend`` ``memory`` or ``sqlite``, results and
+        the registrar use that backend rather than the Azure fakes.
+
+        Nodes report each job they finish, as real nodes do, so that
+        they can be given more. Without ``job_seconds`` jobs never
+        finish, and nodes may queue every check run
+        (``NODE_MAX_QUEUED``), so that only the dispatch path is
+        measured.
+
+    :return: dict: Latency percentiles (ms), throughput (checks/s),
+                   accepted counts per node, and mean stage durations.
+    """
+    from __app__.lib import metrics, storage
+
+    github = fakes.FakeGithub(latency=github_latency).start()
+    nodes = [
+        fakes.SimulatedNode(
+            f'bench-node-{index}',
+            latency=node_latency,
+            failure_rate=failure_rate,
+            job_seconds=job_seconds,
+            seed=seed + index,
+        ).start()
+        for index in range(node_count)
+    ]
+    queue_service = fakes.FakeQueueService()
+    table_service = fakes.FakeTableService()
+
+    saved_env = dict(os.environ)
+    os.environ.update(app_settings(github.url))
+    os.environ['APP_STORAGE_BACKEND'] = storage_backend
+    if job_seconds is None:
+        os.environ['NODE_MAX_QUEUED'] = str(checks)
+    storage_dir = tempfile.TemporaryDirectory()
+    os.environ['APP_STORAGE_SQLITE_PATH'] = os.path.join(storage_dir.name, 'bench.sqlite3')
+    storage.reset()
+
+    try:
+        with fakes.installed(queue_service, table_service):
+            github_hook = load_function('github-hook')
+            queue_new_check = load_function('queue-new-check')
+            testnode_hook = load_function('testnode-hook')
+
+            for node in nodes:
+                node.on_finish = functools.partial(report_completed, testnode_hook)
+                register_node(testnode_hook, node)
+
+            metrics.reset()
+            latencies = []
+            rejected = 0
+            started = time.perf_counter()
+            for index in range(checks):
+                check_run = github.create_check_run(
+                    'physaCI/bench', {'head_sha': f'{index:040x}', 'name': 'RosiePi'}
+                )
+                check_id = str(check_run['id'])
+
+                webhook_at = time.perf_counter()
+                github_hook.main(check_run_webhook(check_run))
+                drain_queue(queue_service, 'rosiepi-check-queue', queue_new_check)
+
+                accepted_at = [
+                    node.accepted[check_id] for node in nodes
+                    if check_id in node.accepted
+                ]
+                if accepted_at:
+                    latencies.append((min(accepted_at) - webhook_at) * 1000)
+                else:
+                    rejected += 1
+            elapsed = time.perf_counter() - started
+
+            for node in nodes:
+                node.wait_for_jobs()
+            snapshot = metrics.snapshot()
+    finally:
+        os.environ.clear()
+        os.environ.update(saved_env)
+        storage_dir.cleanup()
+        github.stop()
+        for node in nodes:
+            node.stop()
+
+    return {
+        'nodes': node_count,
+        'checks': checks,
+        'accepted': len(latencies),
+        'rejected': rejected,
+        'throughput_per_s': round(checks / elapsed, 2) if elapsed else None,
+        'latency_ms': {
+            'p50': percentile(latencies, 0.50),
+            'p90': percentile(latencies, 0.90),
+            'p99': percentile(latencies, 0.99),
+            'mean': statistics.mean(latencies) if latencies else None,
+        },
+        'accepted_by': {node.name: len(node.accepted) for node in nodes},
+        'github_requests': github.requests,
+        'stage_mean_ms': stage_means(snapshot),
+    }
+
+def format_report(report):
+    """ Formats a ``run()`` report for the console.
+    """
+    def fmt(value):
+        return '-' if value is None else f'{value:.1f}'
+
+    latency = report['latency_ms']
+    lines = [
+        f'nodes={report["nodes"]} checks={report["checks"]} '
+        f'accepted={report["accepted"]} rejected={report["rejected"]} '
+        f'throughput={report["throughput_per_s"]}/s',
+        f'  webhook-to-dispatch ms: p50={fmt(latency["p50"])} '
+        f'p90={fmt(latency["p90"])} p99={fmt(latency["p99"])} '
+        f'mean={fmt(latency["mean"])}',
+        f'  github requests: {report["github_requests"]}',
+        f'  accepted by: {report["accepted_by"]}',
+        '  stage means (ms):',
+    ]
+    for stage, mean in report['stage_mean_ms'].items():
+        lines.append(f'    {stage:<36} {mean:>10.3f}')
+
+    return '\n'.join(lines)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--nodes', type=int, nargs='+', default=[1, 4, 16],
+                        help='Node counts to benchmark.')
+    parser.add_argument('--checks', type=int, default=50,
+                        help='Check runs to dispatch per node count.')
+    parser.add_argument('--node-latency', type=float, default=0.0,
+                        help='Seconds added to every node response.')
+    parser.add_argument('--failure-rate', type=float, default=0.0,
+                        help='Fraction of /run-test requests that fail.')
+    parser.add_argument('--github-latency', type=float, default=0.0,
+                        help='Seconds added to every GitHub API response.')
+    parser.add_argument('--job-seconds', type=float, default=None,
+                        help='How long simulated jobs run for.')
+    parser.add_argument('--storage', default='azure',
+                        choices=('azure', 'memory', 'sqlite'),
+                        help='Storage backend for results and the registrar.')
+    parser.add_argument('--json', action='store_true',
+                        help='Print the reports as JSON.')
+    parser.add_argument('--log-level', default='WARNING')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=args.log_level)
+    logging.getLogger().setLevel(args.log_level)
+
+    reports = []
+    for node_count in args.nodes:
+        report = run(
+            node_count,
+            args.checks,
+            node_latency=args.node_latency,
+            failure_rate=args.failure_rate,
+            github_latency=args.github_latency,
+            job_seconds=args.job_seconds,
+            storage_backend=args.storage,
+        )
+        reports.append(report)
+        if not args.json:
+            print(format_report(report))
+
+    if args.json:
+        print(json.dumps(reports, indent=2))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,197 @@
+""" Cold-start benchmark.
+
+    For each function, starts a fresh interpreter and measures how long
+    importing the function's module takes, which heavy dependencies the
+    import pulls in, and the latency of the first and second invocation
+    against ``benchmarks.fakes``.
+
+    The harness has to load the queue and table SDKs to install the
+    fakes, so that load is reported separately (``sdk_preload_ms``) and
+    is not part of ``first_call_ms``.
+
+    Usage::
+
+        python -m benchmarks.bench_startup --runs 5
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+FUNCTIONS = ('github-hook', 'job-result', 'queue-new-check', 'testnode-hook')
+
+HEAVY_MODULES = (
+    'azure.storage.queue',
+    'azure.storage.file',
+    'azure.cosmosdb.table',
+    'cryptography',
+    'jwt',
+    'requests',
+)
+
+
+def _invocation(name, github, queue_service):
+    """ Builds a callable that invokes a function once.
+    """
+    from benchmarks import bench_dispatch
+
+    module = bench_dispatch.load_function(name)
+
+    if name == 'github-hook':
+        def invoke():
+            check_run = github.create_check_run(
+                'physaCI/bench', {'head_sha': '0' * 40, 'name': 'RosiePi'}
+            )
+            return module.main(bench_dispatch.check_run_webhook(check_run))
+
+    elif name == 'queue-new-check':
+        def invoke():
+            import azure.functions as func
+
+            check_run = github.create_check_run(
+                'physaCI/bench', {'head_sha': '0' * 40, 'name': 'RosiePi'}
+            )
+            message = {
+                'api_url': check_run['url'],
+                'installation_id': '1',
+                'check_run_id': str(check_run['id']),
+                'check_run_head_sha': check_run['head_sha'],
+            }
+            return module.main(func.QueueMessage(body=json.dumps(message).encode()))
+
+    elif name == 'testnode-hook':
+        def invoke():
+            body = {
+                'node_name': 'startup-node',
+                'node_sig_key': 'startup-key',
+                'listen_port': 4812,
+            }
+            queue_service.queues.clear()
+            return module.main(
+                bench_dispatch.node_request('registrar', 'add', body, '127.0.0.1')
+            )
+
+    elif name == 'job-result':
+        def invoke():
+            import azure.functions as func
+
+            return module.main(func.HttpRequest(
+                'GET', '/api/job-result',
+                params={'node': 'startup-node', 'job-id': '1'},
+                body=b'',
+            ))
+
+    return invoke
+
+def child(name):
+    """ Measures a single function in this (fresh) interpreter.
+
+    :return: dict
+    """
+    # the Functions host has already loaded this before importing the app
+    import azure.functions
+
+    import benchmarks
+
+    started = time.perf_counter()
+    __import__(f'__app__.{name}')
+    import_ms = (time.perf_counter() - started) * 1000
+    loaded_at_import = [
+        module for module in HEAVY_MODULES if module in sys.modules
+    ]
+
+    started = time.perf_counter()
+    from benchmarks import fakes
+    sdk_preload_ms = (time.perf_counter() - started) * 1000
+
+    github = fakes.FakeGithub().start()
+    queue_service = fakes.FakeQueueService()
+    os.environ['GITHUB_API_URL'] = github.url
+
+    try:
+        with fakes.installed(queue_service, fakes.FakeTableService()):
+            invoke = _invocation(name, github, queue_service)
+
+            started = time.perf_counter()
+            invoke()
+            first_call_ms = (time.perf_counter() - started) * 1000
+
+            started = time.perf_counter()
+            invoke()
+            second_call_ms = (time.perf_counter() - started) * 1000
+    finally:
+        github.stop()
+
+    return {
+        'function': name,
+        'import_ms': import_ms,
+        'loaded_at_import': loaded_at_import,
+        'sdk_preload_ms': sdk_preload_ms,
+        'first_call_ms': first_call_ms,
+        'second_call_ms': second_call_ms,
+    }
+
+def measure(name, runs, env):
+    """ Runs ``child()`` for a function in ``runs`` fresh interpreters.
+
+    :return: dict: Median timings across the runs.
+    """
+    samples = []
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, '-m', 'benchmarks.bench_startup', '--child', name],
+            env=env, capture_output=True, text=True, check=True,
+        )
+        samples.append(json.loads(output.stdout.strip().splitlines()[-1]))
+
+    report = {'function': name, 'runs': runs}
+    for key in ('import_ms', 'sdk_preload_ms', 'first_call_ms', 'second_call_ms'):
+        report[key] = round(statistics.median(sample[key] for sample in samples), 1)
+    report['loaded_at_import'] = samples[-1]['loaded_at_import']
+
+    return report
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--runs', type=int, default=5,
+                        help='Fresh interpreters to measure each function in.')
+    parser.add_argument('--functions', nargs='+', default=list(FUNCTIONS))
+    parser.add_argument('--json', action='store_true',
+                        help='Print the reports as JSON.')
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        import logging
+        logging.disable(logging.CRITICAL)
+        print(json.dumps(child(args.child)))
+        return
+
+    from benchmarks import bench_dispatch
+
+    env = dict(os.environ)
+    env.update(bench_dispatch.app_settings('http://127.0.0.1:1'))
+
+    reports = [measure(name, args.runs, env) for name in args.functions]
+
+    if args.json:
+        print(json.dumps(reports, indent=2))
+        return
+
+    print(f'{"function":<18}{"import":>10}{"sdk":>10}{"1st call":>10}'
+          f'{"2nd call":>10}  loaded at import')
+    for report in reports:
+        print(
+            f'{report["function"]:<18}{report["import_ms"]:>10}'
+            f'{report["sdk_preload_ms"]:>10}{report["first_call_ms"]:>10}'
+            f'{report["second_call_ms"]:>10}  '
+            f'{", ".join(report["loaded_at_import"]) or "-"}'
+        )
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,879 @@
+""" Local stand-ins for the services the function app talks to: the
+    GitHub API, Azure Storage queues and tables, and RosiePi test nodes.
+
+    The queue, table and file fakes implement the subset of
+    ``azure.storage.queue.QueueClient``,
+    ``azure.cosmosdb.table.TableService`` and
+    ``azure.storage.file.FileService`` that the app uses, including
+    visibility timeouts, message expiry, pop receipts and etags, so that
+    the app's real code paths run unchanged against them.
+"""
+
+import copy
+import itertools
+import json
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlsplit
+
+from azure.common import AzureHttpError, AzureMissingResourceHttpError
+from azure.core.exceptions import HttpResponseError, ResourceNotFoundError
+from azure.cosmosdb.table.models import Entity
+from azure.storage.file.models import File, FileProperties
+from azure.storage.queue import QueueMessage
+
+FAKE_CONN_STR = (
+    'DefaultEndpointsProtocol=https;AccountName=physacibench;'
+    'AccountKey=YmVuY2g=;EndpointSuffix=core.windows.net'
+)
+
+
+class Clock():
+    """ Wall clock. The simulator swaps in a virtual clock with the same
+        interface.
+    """
+
+    def now(self):
+        """ The current time, as an aware UTC ``datetime``.
+        """
+        return datetime.now(timezone.utc)
+
+    def time(self):
+        """ The current time, in seconds since the epoch.
+        """
+        return time.time()
+
+
+class QueueProperties(dict):
+    """ Minimal ``QueueProperties``.
+    """
+
+    @property
+    def approximate_message_count(self):
+        return self['approximate_message_count']
+
+
+class FakeQueue():
+    """ An in-memory Azure Storage queue.
+    """
+
+    def __init__(self, name, clock):
+        self.name = name
+        self.clock = clock
+        self.lock = threading.Lock()
+        self.messages = []
+
+    def _live(self):
+        now = self.clock.now()
+        self.messages = [
+            msg for msg in self.messages
+            if msg['expires_on'] is None or msg['expires_on'] > now
+        ]
+        return now
+
+    def _to_message(self, msg, pop_receipt=None):
+        return QueueMessage(
+            content=msg['content'],
+            id=msg['id'],
+            inserted_on=msg['inserted_on'],
+            expires_on=msg['expires_on'],
+            dequeue_count=msg['dequeue_count'],
+            pop_receipt=pop_receipt,
+            next_visible_on=msg['next_visible_on'],
+        )
+
+    def _find(self, message, pop_receipt):
+        message_id = getattr(message, 'id', message)
+        if pop_receipt is None:
+            pop_receipt = getattr(message, 'pop_receipt', None)
+        for msg in self.messages:
+            if msg['id'] == message_id:
+                if msg['pop_receipt'] != pop_receipt:
+                    raise HttpResponseError(
+                        message='The specified pop receipt did not match the '
+                                'pop receipt for a dequeued message.'
+                    )
+                return msg
+
+        raise ResourceNotFoundError(message='The specified message does not exist.')
+
+    def send(self, content, visibility_timeout=None, time_to_live=None):
+        with self.lock:
+            now = self._live()
+            if time_to_live is None:
+                time_to_live = 7 * 24 * 3600
+            msg = {
+                'id': str(uuid.uuid4()),
+                'content': content,
+                'inserted_on': now,
+                'expires_on': (
+                    None if time_to_live == -1
+                    else now + timedelta(seconds=time_to_live)
+                ),
+                'next_visible_on': now + timedelta(seconds=visibility_timeout or 0),
+                'dequeue_count': 0,
+                # like Put Message, return a receipt usable for updates
+                'pop_receipt': uuid.uuid4().hex,
+            }
+            self.messages.append(msg)
+
+            return self._to_message(msg, msg['pop_receipt'])
+
+    def receive(self, max_messages=None, visibility_timeout=None):
+        with self.lock:
+            now = self._live()
+            received = []
+            for msg in self.messages:
+                if max_messages is not None and len(received) >= max_messages:
+                    break
+                if msg['next_visible_on'] > now:
+                    continue
+                msg['dequeue_count'] += 1
+                msg['pop_receipt'] = uuid.uuid4().hex
+                msg['next_visible_on'] = now + timedelta(
+                    seconds=30 if visibility_timeout is None else visibility_timeout
+                )
+                received.append(self._to_message(msg, msg['pop_receipt']))
+
+            return received
+
+    def peek(self, max_messages=None):
+        with self.lock:
+            now = self._live()
+            visible = [
+                self._to_message(msg) for msg in self.messages
+                if msg['next_visible_on'] <= now
+            ]
+
+            return visible[:max_messages or 1]
+
+    def update(self, message, pop_receipt=None, content=None, visibility_timeout=None):
+        with self.lock:
+            now = self._live()
+            msg = self._find(message, pop_receipt)
+            if content is not None:
+                msg['content'] = content
+            msg['pop_receipt'] = uuid.uuid4().hex
+            msg['next_visible_on'] = now + timedelta(seconds=visibility_timeout or 0)
+
+            return self._to_message(msg, msg['pop_receipt'])
+
+    def delete(self, message, pop_receipt=None):
+        with self.lock:
+            self._live()
+            msg = self._find(message, pop_receipt)
+            self.messages.remove(msg)
+
+    def count(self):
+        with self.lock:
+            self._live()
+            return len(self.messages)
+
+
+class FakeQueueClient():
+    """ The subset of ``azure.storage.queue.QueueClient`` used by the app.
+    """
+
+    def __init__(self, fake_queue):
+        self.queue_name = fake_queue.name
+        self._queue = fake_queue
+
+    def send_message(self, content, *, visibility_timeout=None,
+                     time_to_live=None, **kwargs):
+        return self._queue.send(content, visibility_timeout, time_to_live)
+
+    def receive_messages(self, *, messages_per_page=None, visibility_timeout=None,
+                         max_messages=None, **kwargs):
+        return self._queue.receive(max_messages, visibility_timeout)
+
+    def receive_message(self, *, visibility_timeout=None, **kwargs):
+        received = self._queue.receive(1, visibility_timeout)
+        return received[0] if received else None
+
+    def peek_messages(self, max_messages=None, **kwargs):
+        return self._queue.peek(max_messages)
+
+    def update_message(self, message, pop_receipt=None, content=None, *,
+                       visibility_timeout=None, **kwargs):
+        return self._queue.update(message, pop_receipt, content, visibility_timeout)
+
+    def delete_message(self, message, pop_receipt=None, **kwargs):
+        self._queue.delete(message, pop_receipt)
+
+    def get_queue_properties(self, **kwargs):
+        return QueueProperties(
+            name=self.queue_name,
+            approximate_message_count=self._queue.count()
+        )
+
+
+class FakeQueueService():
+    """ A set of in-memory queues, created on first use.
+    """
+
+    def __init__(self, clock=None):
+        self.clock = clock or Clock()
+        self.queues = {}
+        self._lock = threading.Lock()
+
+    def get_queue_client(self, queue_name):
+        with self._lock:
+            if queue_name not in self.queues:
+                self.queues[queue_name] = FakeQueue(queue_name, self.clock)
+            return FakeQueueClient(self.queues[queue_name])
+
+
+_FILTER_CLAUSE = re.compile(
+    r"(\w+)\s+(eq|ne|gt|ge|lt|le)\s+('(?:[^']|'')*'|[^\s)]+)"
+)
+
+_FILTER_OPS = {
+    'eq': lambda left, right: left == right,
+    'ne': lambda left, right: left != right,
+    'gt': lambda left, right: left is not None and left > right,
+    'ge': lambda left, right: left is not None and left >= right,
+    'lt': lambda left, right: left is not None and left < right,
+    'le': lambda left, right: left is not None and left <= right,
+}
+
+def _filter_value(token):
+    if token.startswith("'"):
+        return token[1:-1].replace("''", "'")
+    if token in ('true', 'false'):
+        return token == 'true'
+    try:
+        return int(token.rstrip('L'))
+    except ValueError:
+        return float(token)
+
+def _parse_filter(query_filter):
+    """ Parses an OData filter made of comparisons joined with ``and``.
+    """
+    if not query_filter:
+        return []
+    if re.search(r'\bor\b', re.sub(r"'(?:[^']|'')*'", '', query_filter)):
+        raise ValueError(f'Fake table filters only support "and": {query_filter}')
+
+    return [
+        (name, _FILTER_OPS[op], _filter_value(value))
+        for name, op, value in _FILTER_CLAUSE.findall(query_filter)
+    ]
+
+
+class FakeTableService():
+    """ The subset of ``azure.cosmosdb.table.TableService`` used by the
+        app, backed by dicts.
+    """
+
+    def __init__(self, clock=None):
+        self.clock = clock or Clock()
+        self.tables = {}
+        self.retry = None
+        self._lock = threading.Lock()
+        self._etags = itertools.count(1)
+
+    def __call__(self, *args, **kwargs):
+        # stands in for the ``TableService`` constructor
+        return self
+
+    def _table(self, table_name):
+        return self.tables.setdefault(table_name, {})
+
+    def _store(self, table_name, entity):
+        stored = {
+            key: value for key, value in dict(entity).items()
+            if key not in ('etag', 'Timestamp')
+        }
+        etag = f'W/"datetime\'{next(self._etags)}\'"'
+        stored['etag'] = etag
+        stored['Timestamp'] = self.clock.now()
+        self._table(table_name)[(entity['PartitionKey'], entity['RowKey'])] = stored
+
+        return etag
+
+    def _check_etag(self, current, if_match):
+        if if_match not in (None, '*') and current['etag'] != if_match:
+            raise AzureHttpError('The update condition specified in the request was not satisfied.', 412)
+
+    @staticmethod
+    def _to_entity(stored, select=None):
+        entity = Entity()
+        for key, value in copy.deepcopy(stored).items():
+            if select and key not in select and key not in ('PartitionKey', 'RowKey', 'etag'):
+                continue
+            entity[key] = value
+        return entity
+
+    @staticmethod
+    def _select(select):
+        if isinstance(select, str):
+            return [item.strip() for item in select.split(',')]
+        return select
+
+    def create_table(self, table_name, fail_on_exist=False, **kwargs):
+        with self._lock:
+            exists = table_name in self.tables
+            self._table(table_name)
+            return not exists
+
+    def get_entity(self, table_name, partition_key, row_key, select=None, **kwargs):
+        with self._lock:
+            stored = self._table(table_name).get((partition_key, row_key))
+            if stored is None:
+                raise AzureHttpError('The specified resource does not exist.', 404)
+            return self._to_entity(stored, self._select(select))
+
+    def insert_entity(self, table_name, entity, **kwargs):
+        with self._lock:
+            if (entity['PartitionKey'], entity['RowKey']) in self._table(table_name):
+                raise AzureHttpError('The specified entity already exists.', 409)
+            return self._store(table_name, entity)
+
+    def update_entity(self, table_name, entity, if_match='*', **kwargs):
+        with self._lock:
+            current = self._table(table_name).get((entity['PartitionKey'], entity['RowKey']))
+            if current is None:
+                raise AzureHttpError('The specified resource does not exist.', 404)
+            self._check_etag(current, if_match)
+            return self._store(table_name, entity)
+
+    def merge_entity(self, table_name, entity, if_match='*', **kwargs):
+        with self._lock:
+            current = self._table(table_name).get((entity['PartitionKey'], entity['RowKey']))
+            if current is None:
+                raise AzureHttpError('The specified resource does not exist.', 404)
+            self._check_etag(current, if_match)
+            merged = dict(current)
+            merged.update(entity)
+            return self._store(table_name, merged)
+
+    def insert_or_replace_entity(self, table_name, entity, **kwargs):
+        with self._lock:
+            return self._store(table_name, entity)
+
+    def insert_or_merge_entity(self, table_name, entity, **kwargs):
+        with self._lock:
+            merged = dict(
+                self._table(table_name).get((entity['PartitionKey'], entity['RowKey']), {})
+            )
+            merged.update(entity)
+            return self._store(table_name, merged)
+
+    def delete_entity(self, table_name, partition_key, row_key, if_match='*', **kwargs):
+        with self._lock:
+            current = self._table(table_name).get((partition_key, row_key))
+            if current is None:
+                raise AzureHttpError('The specified resource does not exist.', 404)
+            self._check_etag(current, if_match)
+            del self._table(table_name)[(partition_key, row_key)]
+
+    @staticmethod
+    def _batch_entity(request):
+        body = json.loads(request.body)
+        entity = {}
+        for key, value in body.items():
+            if '@odata' in key:
+                continue
+            if body.get(f'{key}@odata.type') == 'Edm.Int64':
+                value = int(value)
+            entity[key] = value
+        return entity
+
+    def commit_batch(self, table_name, batch, **kwargs):
+        """ Commits a ``TableBatch``. Operations are applied one at a
+            time, so unlike the real service a failed batch isn't rolled
+            back.
+        """
+        etags = []
+        for row_key, request in batch._requests:
+            if request.method == 'DELETE':
+                self.delete_entity(
+                    table_name, batch._partition_key, row_key,
+                    if_match=request.headers.get('If-Match', '*')
+                )
+                etags.append(None)
+                continue
+
+            entity = self._batch_entity(request)
+            if_match = request.headers.get('If-Match')
+            if request.method == 'POST':
+                etags.append(self.insert_entity(table_name, entity))
+            elif request.method == 'PUT':
+                if if_match is None:
+                    etags.append(self.insert_or_replace_entity(table_name, entity))
+                else:
+                    etags.append(self.update_entity(table_name, entity, if_match=if_match))
+            elif request.method == 'MERGE':
+                if if_match is None:
+                    etags.append(self.insert_or_merge_entity(table_name, entity))
+                else:
+                    etags.append(self.merge_entity(table_name, entity, if_match=if_match))
+        return etags
+
+    def query_entities(self, table_name, filter=None, select=None, num_results=None,
+                       **kwargs):
+        clauses = _parse_filter(filter)
+        select = self._select(select)
+        with self._lock:
+            matches = []
+            for key in sorted(self._table(table_name)):
+                stored = self._table(table_name)[key]
+                if all(op(stored.get(name), value) for name, op, value in clauses):
+                    matches.append(self._to_entity(stored, select))
+                    if num_results is not None and len(matches) >= num_results:
+                        break
+            return matches
+
+
+class FakeFileService():
+    """ The subset of ``azure.storage.file.FileService`` used by the
+        app, backed by a dict of ``(share, directory, file)`` to bytes.
+    """
+
+    def __init__(self):
+        self.shares = {}
+        self.files = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, *args, **kwargs):
+        # stands in for the ``FileService`` constructor
+        return self
+
+    def create_share(self, share_name, fail_on_exist=False, **kwargs):
+        with self._lock:
+            exists = share_name in self.shares
+            self.shares.setdefault(share_name, set())
+            return not exists
+
+    def create_directory(self, share_name, directory_name, fail_on_exist=False, **kwargs):
+        with self._lock:
+            if share_name not in self.shares:
+                raise AzureMissingResourceHttpError('The specified share does not exist.', 404)
+            exists = directory_name in self.shares[share_name]
+            self.shares[share_name].add(directory_name)
+            return not exists
+
+    def create_file_from_bytes(self, share_name, directory_name, file_name, file,
+                               content_settings=None, **kwargs):
+        with self._lock:
+            if directory_name not in self.shares.get(share_name, ()):
+                raise AzureMissingResourceHttpError('The specified parent path does not exist.', 404)
+            self.files[(share_name, directory_name, file_name)] = (
+                bytes(file), content_settings
+            )
+
+    def _get(self, share_name, directory_name, file_name):
+        stored = self.files.get((share_name, directory_name, file_name))
+        if stored is None:
+            raise AzureMissingResourceHttpError('The specified resource does not exist.', 404)
+        return stored
+
+    def get_file_properties(self, share_name, directory_name, file_name, **kwargs):
+        with self._lock:
+            data, content_settings = self._get(share_name, directory_name, file_name)
+        properties = FileProperties()
+        properties.content_length = len(data)
+        if content_settings is not None:
+            properties.content_settings = content_settings
+        return File(file_name, props=properties)
+
+    def get_file_to_bytes(self, share_name, directory_name, file_name,
+                          start_range=None, end_range=None, **kwargs):
+        with self._lock:
+            data, _ = self._get(share_name, directory_name, file_name)
+        start = start_range or 0
+        end = len(data) - 1 if end_range is None else end_range
+        return File(file_name, content=data[start:end + 1])
+
+
+@contextmanager
+def installed(queue_service, table_service, file_service=None):
+    """ Routes the app's queue, table and file clients to the supplied
+        fakes for the duration of the context.
+    """
+    from azure.cosmosdb.table import tableservice
+    from azure.storage import queue
+    from azure.storage.file import fileservice
+
+    if file_service is None:
+        file_service = FakeFileService()
+
+    def from_connection_string(conn_str, queue_name, **kwargs):
+        return queue_service.get_queue_client(queue_name)
+
+    patched = [
+        (queue.QueueClient, 'from_connection_string',
+         queue.QueueClient.__dict__['from_connection_string']),
+        (tableservice, 'TableService', tableservice.TableService),
+    ]
+    patched.append((fileservice, 'FileService', fileservice.FileService))
+    queue.QueueClient.from_connection_string = staticmethod(from_connection_string)
+    tableservice.TableService = table_service
+    fileservice.FileService = file_service
+
+    for name, module in list(sys.modules.items()):
+        if name.startswith('__app__') and hasattr(module, 'TableService'):
+            patched.append((module, 'TableService', module.TableService))
+            module.TableService = table_service
+
+    try:
+        yield
+    finally:
+        for target, attr, original in reversed(patched):
+            setattr(target, attr, original)
+
+
+class _JsonHandler(BaseHTTPRequestHandler):
+    """ Request handler for the fake HTTP servers. Requests are passed to
+        the fake's ``handle()``.
+    """
+
+    def log_message(self, format, *args):
+        pass
+
+    def _dispatch(self, method):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        status, response = self.fake.handle(
+            method, self.path, json.loads(body) if body else None
+        )
+
+        payload = json.dumps(response).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        self._dispatch('GET')
+
+    def do_POST(self):
+        self._dispatch('POST')
+
+    def do_PATCH(self):
+        self._dispatch('PATCH')
+
+
+class _HttpFake():
+    """ Base for the fake HTTP services. ``start()`` serves the fake on
+        localhost in a daemon thread; unstarted fakes can be reached
+        through an ``InProcessTransport`` at ``url``.
+
+    :param: str host: The host name used in ``url`` when not serving.
+    """
+
+    def __init__(self, host):
+        self.host = host
+        self.server = None
+
+    @property
+    def url(self):
+        if self.server is not None:
+            return f'http://127.0.0.1:{self.port}'
+        return f'http://{self.host}'
+
+    @property
+    def port(self):
+        if self.server is not None:
+            return self.server.server_address[1]
+        return None
+
+    def handle(self, method, path, body):
+        """ Handles a request.
+
+        :return: tuple: ``(status_code, json_body)``
+        """
+        raise NotImplementedError
+
+    def start(self):
+        handler = type('Handler', (_JsonHandler,), {'fake': self})
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+        return self
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+
+class InProcessTransport():
+    """ Routes ``requests`` calls to unstarted fakes by host, without
+        sockets. Fakes signal an unreachable host by raising
+        ``requests.ConnectionError``.
+    """
+
+    def __init__(self):
+        self.routes = {}
+
+    def add(self, fake, host=None):
+        """ Routes requests for ``host`` (default: ``fake.host``) to
+            ``fake.handle()``.
+        """
+        self.routes[host or fake.host] = fake
+
+    def send(self, request):
+        import requests
+
+        url = urlsplit(request.url)
+        fake = self.routes.get(url.netloc)
+        if fake is None:
+            raise requests.ConnectionError(f'No route to {url.netloc}', request=request)
+
+        body = request.body
+        if isinstance(body, bytes):
+            body = body.decode()
+        path = url.path + (f'?{url.query}' if url.query else '')
+        status, response_body = fake.handle(
+            request.method, path, json.loads(body) if body else None
+        )
+
+        response = requests.Response()
+        response.status_code = status
+        response._content = json.dumps(response_body).encode()
+        response.headers['Content-Type'] = 'application/json'
+        response.url = request.url
+        response.request = request
+        response.encoding = 'utf-8'
+
+        return response
+
+@contextmanager
+def routed(transport):
+    """ Sends every ``requests`` call through ``transport`` for the
+        duration of the context.
+    """
+    import requests
+
+    original = requests.Session.request
+
+    def request(session, method, url, params=None, data=None, headers=None,
+                auth=None, json=None, **kwargs):
+        # skips the proxy and environment lookups of ``Session.request()``
+        prepared = session.prepare_request(requests.Request(
+            method=method.upper(), url=url, params=params, data=data,
+            headers=headers, auth=auth, json=json,
+        ))
+        return transport.send(prepared)
+
+    requests.Session.request = request
+    try:
+        yield transport
+    finally:
+        requests.Session.request = original
+
+
+class FakeGithub(_HttpFake):
+    """ A local stand-in for the parts of the GitHub API used by the app.
+
+    :param: float latency: Seconds added to every API response.
+    """
+
+    def __init__(self, latency=0.0, host='github.fake'):
+        super().__init__(host)
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.check_runs = {}
+        self.labels = {}
+        self.requests = 0
+        self.tokens_issued = 0
+        self._ids = itertools.count(1000)
+
+    def handle(self, method, path, body):
+        with self.lock:
+            self.requests += 1
+        if self.latency:
+            time.sleep(self.latency)
+        body = body or {}
+
+        if method == 'GET' and path == '/app':
+            return 200, {'id': 1, 'name': 'physaCI'}
+
+        match = re.fullmatch(r'/app/installations/(\d+)/access_tokens', path)
+        if method == 'POST' and match:
+            self.tokens_issued += 1
+            return 201, {'token': f'ghs_fake{match.group(1)}'}
+
+        match = re.fullmatch(r'/repos/([^/]+/[^/]+)/check-runs', path)
+        if method == 'POST' and match:
+            return 201, self.create_check_run(match.group(1), body)
+
+        match = re.fullmatch(r'/repos/([^/]+/[^/]+)/check-runs/(\d+)', path)
+        if method == 'PATCH' and match and int(match.group(2)) in self.check_runs:
+            return 200, self.update_check_run(int(match.group(2)), body)
+
+        match = re.fullmatch(r'/repos/([^/]+/[^/]+)/issues/(\d+)/labels', path)
+        if method == 'GET' and match:
+            names = self.labels.get((match.group(1), int(match.group(2))), [])
+            return 200, [{'name': name} for name in names]
+
+        if method == 'POST' and path == '/graphql':
+            return 200, self.graphql(body)
+
+        return 404, {'message': 'Not Found'}
+
+    def create_check_run(self, repo_name, params):
+        check_id = next(self._ids)
+        check_run = {
+            'id': check_id,
+            'node_id': f'CR_{check_id}',
+            'head_sha': params.get('head_sha'),
+            'name': params.get('name'),
+            'status': params.get('status', 'queued'),
+            'conclusion': params.get('conclusion'),
+            'output': params.get('output'),
+            'url': f'{self.url}/repos/{repo_name}/check-runs/{check_id}',
+            'html_url': f'https://github.com/{repo_name}/runs/{check_id}',
+            'check_suite': {
+                'id': check_id // 10,
+                'head_branch': params.get('head_branch', 'main'),
+            },
+            'pull_requests': params.get('pull_requests', []),
+            'updates': [],
+        }
+        with self.lock:
+            self.check_runs[check_id] = check_run
+
+        return copy.deepcopy(check_run)
+
+    def update_check_run(self, check_id, params):
+        with self.lock:
+            check_run = self.check_runs[check_id]
+            check_run.update(
+                {key: value for key, value in params.items()
+                 if key in ('status', 'conclusion', 'output', 'name')}
+            )
+            check_run['updates'].append(params)
+
+            return copy.deepcopy(check_run)
+
+    def graphql(self, body):
+        """ Handles ``updateCheckRun`` mutations, including several aliased
+            mutations in one request. Other queries are rejected.
+        """
+        mutations = re.findall(
+            r'(\w+): updateCheckRun\(input: \$(\w+)\)', body.get('query', '')
+        )
+        if not mutations:
+            return {'errors': [{'message': 'Only updateCheckRun is supported by this fake.'}]}
+
+        by_node_id = {
+            check_run['node_id']: check_id
+            for check_id, check_run in self.check_runs.items()
+        }
+        data = {}
+        errors = []
+        for alias, variable in mutations:
+            update = body.get('variables', {}).get(variable, {})
+            check_id = by_node_id.get(update.get('checkRunId'))
+            if check_id is None:
+                data[alias] = None
+                errors.append({
+                    'path': [alias],
+                    'message': f'Could not resolve to a node with the global id of '
+                               f'\'{update.get("checkRunId")}\'',
+                })
+                continue
+
+            params = {
+                key: update[key].lower() if key in ('status', 'conclusion') else update[key]
+                for key in ('status', 'conclusion', 'output', 'name')
+                if key in update
+            }
+            self.update_check_run(check_id, params)
+            data[alias] = {'checkRun': {'id': update['checkRunId']}}
+
+        response = {'data': data}
+        if errors:
+            response['errors'] = errors
+
+        return response
+
+
+class SimulatedNode(_HttpFake):
+    """ A RosiePi test node exposing ``/run-test`` and ``/status``.
+
+    :param: str name: The node's name.
+    :param: float latency: Seconds added to every response.
+    :param: float failure_rate: Fraction of ``/run-test`` requests
+                                answered with a 503.
+    :param: float job_seconds: How long each accepted job runs for.
+                               ``None`` leaves jobs running forever.
+    :param: int capacity: Jobs the node runs before reporting busy.
+    :param: on_finish: Called with the node and the check run message
+                       of each job that finishes, e.g. to post the node's completed
+                       ``testresult`` report.
+    """
+
+    def __init__(self, name, latency=0.0, failure_rate=0.0, job_seconds=None,
+                 capacity=1, seed=None, host=None, on_finish=None):
+        super().__init__(host or f'{name}.fake')
+        self.name = name
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.job_seconds = job_seconds
+        self.capacity = capacity
+        self.on_finish = on_finish
+        self.lock = threading.Lock()
+        self.job_count = 0
+        self.accepted = {}
+        self._timers = []
+        self._random = random.Random(seed)
+
+    def handle(self, method, path, body):
+        if self.latency:
+            time.sleep(self.latency)
+
+        if method == 'GET' and path == '/status':
+            return 200, self.status()
+
+        if method == 'POST' and path == '/run-test':
+            with self.lock:
+                failed = self._random.random() < self.failure_rate
+            if failed:
+                return 503, {'message': 'Simulated failure.'}
+            return 200, self.run_test(body or {})
+
+        return 404, {}
+
+    def status(self):
+        with self.lock:
+            return {
+                'busy': self.job_count >= self.capacity,
+                'job_count': self.job_count,
+            }
+
+    def run_test(self, message):
+        with self.lock:
+            self.accepted[message.get('check_run_id')] = time.perf_counter()
+            self.job_count += 1
+        if self.job_seconds is not None:
+            timer = threading.Timer(self.job_seconds, self._finish_job, (message,))
+            timer.daemon = True
+            timer.start()
+            self._timers.append(timer)
+
+        return self.status()
+
+    def _finish_job(self, message):
+        with self.lock:
+            self.job_count = max(self.job_count - 1, 0)
+        if self.on_finish is not None:
+            self.on_finish(self, message)
+
+    def wait_for_jobs(self):
+        """ Waits for the accepted jobs to finish, and be reported.
+        """
+        for timer in list(self._timers):
+            timer.join()
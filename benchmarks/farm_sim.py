@@ -0,0 +1,735 @@
+""" Farm-scale load simulator.
+
+    Replays a day of traffic against the real function entry points on a
+    virtual clock: nodes register and re-register through
+    ``testnode-hook`` with churn and registrar expiry, check runs arrive
+    through ``github-hook`` and are dispatched by ``queue-new-check``,
+    and nodes report results through ``testnode-hook``. Nodes and GitHub
+    are reached in-process, so hours of traffic take seconds.
+
+    GitHub App authentication is stubbed (``bench_dispatch`` covers its
+    cost), and the check queue trigger polls every 10 simulated seconds.
+
+    With ``--lanes``, check runs from pull requests go to the first
+    (highest priority) lane and everything else to the last, and are
+    dispatched by ``check-dispatcher``. ``--burst`` adds a batch of
+    release branch check runs, to see how a backlog affects pull request
+    turnaround.
+
+    With ``--pull``, nodes claim jobs through ``testnode-hook/jobs``
+    instead. An idle node's long poll is modelled by waking a waiting
+    node whenever a job may have become claimable, so idle nodes don't
+    cost a request every few seconds of simulated time.
+
+    Usage::
+
+        python -m benchmarks.farm_sim --nodes 200 --hours 24 --checks-per-day 3000
+"""
+
+import argparse
+import heapq
+import itertools
+import json
+import logging
+import math
+import os
+import random
+import statistics
+import sys
+import time
+
+from collections import Counter, deque
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
+
+import requests
+
+from benchmarks import fakes
+from benchmarks.bench_dispatch import (
+    check_run_webhook, drain_queue, load_function, node_request, percentile
+)
+
+_BOARDS = (
+    'metro_m0_express', 'metro_m4_express', 'feather_m4_express',
+    'itsybitsy_m4_express', 'circuitplayground_express', 'feather_nrf52840',
+    'pyportal', 'grandcentral_m4_express',
+)
+
+_NOT_ACCEPTED = 'Job not accepted by any RosiePi nodes.'
+
+# how often the simulated queue trigger, and the check dispatcher,
+# poll the check queues
+_QUEUE_POLL_SECONDS = 10
+
+
+class VirtualClock(fakes.Clock):
+    """ A clock that only moves when the simulator advances it.
+    """
+
+    def __init__(self, start):
+        self.start = start
+        self.elapsed = 0.0
+
+    def now(self):
+        return self.start + timedelta(seconds=self.elapsed)
+
+    def time(self):
+        return self.start.timestamp() + self.elapsed
+
+
+class _VirtualTime():
+    """ Stands in for the ``time`` module, with ``time()`` on the virtual
+        clock.
+    """
+
+    def __init__(self, clock):
+        self._clock = clock
+
+    def time(self):
+        return self._clock.time()
+
+    def __getattr__(self, name):
+        return getattr(time, name)
+
+@contextmanager
+def virtual_time(clock):
+    """ Points the app's ``datetime`` and ``time`` lookups at ``clock``.
+    """
+
+    class VirtualDatetime(datetime):
+        @classmethod
+        def now(cls, tz=None):
+            now = clock.now()
+            return now.astimezone(tz) if tz else now.replace(tzinfo=None)
+
+        @classmethod
+        def utcnow(cls):
+            return clock.now().replace(tzinfo=None)
+
+    patched = []
+    for name, module in list(sys.modules.items()):
+        if not name.startswith('__app__') or module is None:
+            continue
+        if getattr(module, 'datetime', None) is datetime:
+            patched.append((module, 'datetime', datetime))
+            module.datetime = VirtualDatetime
+        if getattr(module, 'time', None) is time:
+            patched.append((module, 'time', time))
+            module.time = _VirtualTime(clock)
+
+    try:
+        yield
+    finally:
+        for module, attr, original in patched:
+            setattr(module, attr, original)
+
+
+class SimNode(fakes.SimulatedNode):
+    """ A node that runs its accepted jobs one at a time, on the virtual
+        clock.
+    """
+
+    def __init__(self, sim, index, boards, minutes_per_board, max_queued=None):
+        self.ip = f'10.{index // 65536 % 256}.{index // 256 % 256}.{index % 256}'
+        super().__init__(f'farm-node-{index:04d}', host=f'{self.ip}:4812')
+        self.sim = sim
+        self.boards = boards
+        self.minutes_per_board = minutes_per_board
+        self.max_queued = max_queued
+        self.online = True
+        self.pending = deque()
+        self.running = None
+        self.busy_seconds = 0.0
+        self.online_seconds = 0.0
+        self._online_since = 0.0
+        self.jobs_finished = 0
+        self.generation = 0
+        self.claim = None
+        self.keys = set()
+
+    def handle(self, method, path, body):
+        if not self.online:
+            raise requests.ConnectionError(f'{self.name} is offline')
+        if method == 'POST' and path == '/run-test':
+            key = (body or {}).get('idempotency_key')
+            if key is not None and key in self.keys:
+                # a retry of an attempt the node already took
+                return 200, self.status()
+            if (self.max_queued is not None and
+                self.status()['job_count'] >= self.max_queued):
+                    return 429, {'message': 'Job queue is full.'}
+            status, response = super().handle(method, path, body)
+            if key is not None:
+                self.keys.add(key)
+            if status == 200 and self.sim.random.random() < self.sim.lost_replies:
+                # the node took the job, but its reply never arrived
+                raise requests.ReadTimeout(f'{self.name} did not reply')
+            return status, response
+        return super().handle(method, path, body)
+
+    def status(self):
+        job_count = len(self.pending) + (1 if self.running else 0)
+        return {'busy': self.running is not None, 'job_count': job_count}
+
+    def run_test(self, message):
+        self.pending.append(message)
+        self.sim.dispatched[message['check_run_id']] = self.sim.clock.elapsed
+        if self.running is None:
+            self._start_next()
+
+        return self.status()
+
+    def _start_next(self):
+        if not self.pending:
+            self.running = None
+            return
+
+        message = self.pending.popleft()
+        check_run_id = message['check_run_id']
+        # a shard only tests the boards it was given
+        boards = message.get('boards') or self.boards
+        now = self.sim.clock.elapsed
+        self.running = (check_run_id, now)
+        self.sim.started.setdefault(check_run_id, now)
+        self.sim.runs[(check_run_id, message.get('shard'))] += 1
+        # reported after the node's reply, as the job is only in the
+        # results table once the dispatch completes
+        self.sim.schedule(now, lambda: self._report_started(check_run_id))
+
+        mean = self.minutes_per_board * len(boards) * 60
+        duration = self.sim.random.lognormvariate(math.log(mean), 0.35)
+        generation = self.generation
+        self.sim.schedule(
+            now + duration, lambda: self._finish(check_run_id, boards, generation)
+        )
+
+    def _report_started(self, check_run_id):
+        if not self.sim.report_started(self, check_run_id):
+            return
+        # the job is owned by another node
+        self.sim.stopped_by_conflict += 1
+        if self.running is not None and self.running[0] == check_run_id:
+            self.generation += 1
+            self._start_next()
+
+    def _finish(self, check_run_id, boards, generation):
+        if not self.online or generation != self.generation:
+            return
+
+        started_at = self.running[1]
+        self.busy_seconds += self.sim.clock.elapsed - started_at
+        self.jobs_finished += 1
+        self.sim.report_result(self, check_run_id, boards)
+        if self.claim is not None:
+            self.sim.testnode_hook.main(
+                node_request('jobs', 'complete', {'claim': self.claim}, self.ip)
+            )
+            self.claim = None
+            self.running = None
+            self.claim_next()
+        else:
+            self._start_next()
+
+    def claim_next(self):
+        """ Pull mode: claims a job if the node is idle, otherwise waits
+            to be woken.
+        """
+        if not self.online or self.running is not None or self.pending:
+            return
+
+        body = {'node_name': self.name, 'boards': self.boards}
+        response = self.sim.testnode_hook.main(
+            node_request('jobs', 'claim', body, self.ip)
+        )
+        self.sim.claim_requests[response.status_code] += 1
+        if response.status_code != 200:
+            self.sim.waiting.append(self)
+            return
+
+        claimed = json.loads(response.get_body())
+        self.claim = claimed['claim']
+        self.run_test(claimed['job'])
+        self._schedule_renewal(claimed['job']['check_run_id'], claimed['lease_seconds'])
+
+    def _schedule_renewal(self, check_run_id, lease_seconds):
+        generation = self.generation
+        self.sim.schedule(
+            self.sim.clock.elapsed + lease_seconds / 2,
+            lambda: self._renew(check_run_id, generation)
+        )
+
+    def _renew(self, check_run_id, generation):
+        if (generation != self.generation or self.running is None or
+            self.running[0] != check_run_id):
+                return
+
+        response = self.sim.testnode_hook.main(
+            node_request('jobs', 'renew', {'claim': self.claim}, self.ip)
+        )
+        if response.status_code == 200:
+            renewed = json.loads(response.get_body())
+            self.claim = renewed['claim']
+            self._schedule_renewal(check_run_id, renewed['lease_seconds'])
+
+    def go_offline(self):
+        now = self.sim.clock.elapsed
+        if self.running is not None:
+            self.busy_seconds += now - self.running[1]
+            self.sim.orphaned += 1
+            self.sim.orphaned_ids.add(self.running[0])
+        self.sim.orphaned += len(self.pending)
+        self.sim.orphaned_ids.update(message['check_run_id'] for message in self.pending)
+        if self.claim is not None:
+            # the job can be claimed again once the claim runs out
+            self.sim.schedule(now + self.sim.claim_lease + 1, self.sim.wake)
+            self.claim = None
+        self.online_seconds += now - self._online_since
+        self.pending.clear()
+        self.running = None
+        self.online = False
+        self.generation += 1
+
+    def come_online(self):
+        self.online = True
+        self._online_since = self.sim.clock.elapsed
+
+    def close(self):
+        now = self.sim.clock.elapsed
+        if self.online:
+            self.online_seconds += now - self._online_since
+            if self.running is not None:
+                self.busy_seconds += now - self.running[1]
+
+
+class FarmSim():
+    """ Discrete-event simulation of a RosiePi farm.
+    """
+
+    def __init__(self, nodes=200, hours=24.0, checks_per_day=3000,
+                 minutes_per_board=3.0, uptime_hours=8.0, offline_minutes=30.0,
+                 reregister_minutes=56.0, pass_rate=0.85, max_queued=None,
+                 lanes=None, lane_policy='weighted', burst=0, burst_at_hours=2.0,
+                 pull=False, lost_replies=0.0, shards=1, sweep_minutes=5.0,
+                 speed_spread=1.0, seed=0):
+        self.random = random.Random(seed)
+        self.clock = VirtualClock(datetime(2020, 6, 1, tzinfo=timezone.utc))
+        self.duration = hours * 3600
+        self.checks_per_day = checks_per_day
+        self.uptime = uptime_hours * 3600
+        self.offline = offline_minutes * 60
+        self.reregister = reregister_minutes * 60
+        self.pass_rate = pass_rate
+        self.lanes = lanes
+        self.lane_policy = lane_policy
+        self.burst = burst
+        self.burst_at = burst_at_hours * 3600
+        self.pull = pull
+        self.lost_replies = lost_replies
+        self.shards = shards
+        self.sweep_interval = sweep_minutes * 60
+        self.claim_lease = 300
+        self.waiting = deque()
+        self.claim_requests = Counter()
+
+        self.github = fakes.FakeGithub(host='api.github.farm')
+        self.queue_service = fakes.FakeQueueService(self.clock)
+        self.table_service = fakes.FakeTableService(self.clock)
+        self.transport = fakes.InProcessTransport()
+        self.transport.add(self.github)
+
+        self.nodes = []
+        for index in range(nodes):
+            boards = self.random.sample(_BOARDS, self.random.randint(1, 4))
+            # some nodes (e.g. older hosts, slower boards) take longer
+            speed = self.random.uniform(1, speed_spread) if speed_spread > 1 else 1
+            node = SimNode(self, index, boards, minutes_per_board * speed, max_queued)
+            self.nodes.append(node)
+            self.transport.add(node)
+
+        self._events = []
+        self._sequence = itertools.count()
+        self.arrived = {}
+        self.kinds = {}
+        self.dispatched = {}
+        self.started = {}
+        self.finished = {}
+        self.orphaned = 0
+        self.orphaned_ids = set()
+        self.registrations = Counter()
+        self.runs = Counter()
+        self.stopped_by_conflict = 0
+        self.board_tests = 0
+
+    def schedule(self, at, callback):
+        heapq.heappush(self._events, (at, next(self._sequence), callback))
+
+    def arrival_rate(self, elapsed):
+        """ Check runs per second, following a daily cycle that peaks in
+            the afternoon (UTC).
+        """
+        hour = (elapsed / 3600) % 24
+        daily = 1 + 0.6 * math.sin(2 * math.pi * (hour - 9) / 24)
+
+        return self.checks_per_day / 86400 * daily
+
+    def _schedule_arrivals(self):
+        peak = self.checks_per_day / 86400 * 1.6
+        elapsed = 0.0
+        while True:
+            elapsed += self.random.expovariate(peak)
+            if elapsed >= self.duration:
+                break
+            if self.random.random() < self.arrival_rate(elapsed) / peak:
+                self.schedule(elapsed, self._check_arrival)
+
+    def register(self, node):
+        if not node.online:
+            return
+
+        body = {
+            'node_name': node.name,
+            'node_sig_key': f'{node.name}-key',
+            'listen_port': 4812,
+            'boards': node.boards,
+        }
+        response = self.testnode_hook.main(
+            node_request('registrar', 'add', body, node.ip)
+        )
+        self.registrations[response.status_code] += 1
+
+        generation = node.generation
+        jitter = self.random.uniform(0, 120)
+        self.schedule(
+            self.clock.elapsed + self.reregister + jitter,
+            lambda: self.register(node) if node.generation == generation else None
+        )
+
+    def _churn(self, node):
+        node.go_offline()
+        back_at = self.clock.elapsed + self.random.expovariate(1 / self.offline)
+        self.schedule(back_at, lambda: self._return(node))
+
+    def _return(self, node):
+        node.come_online()
+        self.register(node)
+        if self.pull:
+            node.claim_next()
+        self.schedule(
+            self.clock.elapsed + self.random.expovariate(1 / self.uptime),
+            lambda: self._churn(node)
+        )
+
+    def _check_arrival(self, kind='pull_request'):
+        params = {'head_sha': f'{self.random.getrandbits(160):040x}', 'name': 'RosiePi'}
+        repo_name = 'physaCI/farm'
+        if kind == 'pull_request':
+            number = self.random.randint(1, 5000)
+            params['pull_requests'] = [{
+                'number': number,
+                'url': f'{self.github.url}/repos/{repo_name}/pulls/{number}',
+            }]
+        else:
+            repo_name = 'physaCI/release'
+            params['head_branch'] = 'release/6.x'
+
+        check_run = self.github.create_check_run(repo_name, params)
+        self.arrived[str(check_run['id'])] = self.clock.elapsed
+        self.kinds[str(check_run['id'])] = kind
+        self.github_hook.main(check_run_webhook(check_run, repo_name=repo_name))
+        if self.pull:
+            self.wake()
+        else:
+            self.drain()
+
+    def wake(self):
+        """ Pull mode: a job may be claimable, so the next waiting node's
+            long poll returns.
+        """
+        while self.waiting:
+            node = self.waiting.popleft()
+            if node.online and node.running is None:
+                node.claim_next()
+                return
+
+    def _burst(self):
+        for _ in range(self.burst):
+            self._check_arrival(kind='release')
+
+    def drain(self):
+        drain_queue(self.queue_service, 'rosiepi-check-queue', self.queue_new_check)
+
+    def _poll(self):
+        # like the queue trigger, picks up messages whose visibility
+        # delay has passed (e.g. jobs requeued for a later retry)
+        self.drain()
+        self.check_dispatcher.main(None)
+        self.schedule(self.clock.elapsed + _QUEUE_POLL_SECONDS, self._poll)
+
+    def _sweep(self):
+        self.job_sweeper.main(None)
+        self.schedule(self.clock.elapsed + self.sweep_interval, self._sweep)
+
+    def report_started(self, node, check_run_id):
+        """ :return: bool: Whether the node was told to stop the job.
+        """
+        body = {
+            'node_name': node.name,
+            'check_run_id': check_run_id,
+            'github_data': {'status': 'in_progress'},
+        }
+        response = self.testnode_hook.main(node_request('testresult', 'update', body))
+
+        return response.status_code == 409
+
+    def report_result(self, node, check_run_id, boards):
+        # a sharded run finishes with its last shard
+        self.finished[check_run_id] = self.clock.elapsed
+        self.board_tests += len(boards)
+        conclusion = 'success' if self.random.random() < self.pass_rate else 'failure'
+        body = {
+            'node_name': node.name,
+            'check_run_id': check_run_id,
+            'github_data': {
+                'status': 'completed',
+                'conclusion': conclusion,
+                'completed_at': self.clock.now().strftime('%Y-%m-%dT%H:%M:%SZ'),
+                'output': {'title': 'RosiePi', 'summary': conclusion},
+            },
+            'node_test_data': {
+                'board_tests': [
+                    {'board_name': board, 'outcome': conclusion == 'success'}
+                    for board in boards
+                ],
+            },
+        }
+        self.testnode_hook.main(node_request('testresult', 'update', body))
+
+    def run(self):
+        """ Runs the simulation.
+
+        :return: dict: The simulation report.
+        """
+        saved_env = dict(os.environ)
+        os.environ.update({
+            'APP_STORAGE_CONN_STR': fakes.FAKE_CONN_STR,
+            'GITHUB_APP_ID': '1',
+            'GITHUB_APP_KEY': 'unused',
+            'GITHUB_API_URL': self.github.url,
+        })
+        if self.lanes:
+            os.environ.update({
+                'CHECK_LANES': self.lanes,
+                'CHECK_LANE_POLICY': self.lane_policy,
+                'CHECK_LANE_RULES': json.dumps(
+                    [{'lane': self.lanes.split(',')[0].split(':')[0],
+                      'event': 'pull_request'}]
+                ),
+            })
+        if self.pull:
+            os.environ.update({
+                'CHECK_DISPATCH_MODE': 'pull',
+                'CLAIM_LEASE_SECONDS': str(self.claim_lease),
+            })
+        if self.shards > 1:
+            os.environ['CHECK_SHARDS_MAX'] = str(self.shards)
+        wall_start = time.perf_counter()
+
+        try:
+            with fakes.installed(self.queue_service, self.table_service), \
+                 fakes.routed(self.transport):
+                self.github_hook = load_function('github-hook')
+                self.queue_new_check = load_function('queue-new-check')
+                self.testnode_hook = load_function('testnode-hook')
+                self.check_dispatcher = load_function('check-dispatcher')
+                self.job_sweeper = load_function('job-sweeper')
+
+                from __app__.lib import app_client
+                original_jwt = app_client.generate_jwt_token
+                app_client.generate_jwt_token = lambda: 'farm-sim-jwt'
+
+                try:
+                    with virtual_time(self.clock):
+                        self._run_events()
+                finally:
+                    app_client.generate_jwt_token = original_jwt
+        finally:
+            os.environ.clear()
+            os.environ.update(saved_env)
+
+        return self.report(time.perf_counter() - wall_start)
+
+    def _run_events(self):
+        for node in self.nodes:
+            self.schedule(self.random.uniform(0, 300), lambda node=node: self._return(node))
+        self._schedule_arrivals()
+        self.schedule(_QUEUE_POLL_SECONDS, self._poll)
+        if self.sweep_interval:
+            self.schedule(self.sweep_interval, self._sweep)
+        if self.burst:
+            self.schedule(self.burst_at, self._burst)
+
+        while self._events:
+            at, _, callback = heapq.heappop(self._events)
+            if at > self.duration:
+                break
+            self.clock.elapsed = at
+            callback()
+
+        self.clock.elapsed = self.duration
+        for node in self.nodes:
+            node.close()
+
+    def report(self, wall_seconds):
+        """ Summarises the simulation.
+        """
+        def minutes(values):
+            return {
+                'p50': _round(percentile(values, 0.50), 60),
+                'p90': _round(percentile(values, 0.90), 60),
+                'p99': _round(percentile(values, 0.99), 60),
+                'mean': _round(statistics.mean(values), 60) if values else None,
+            }
+
+        def waits(events, kind=None):
+            return [
+                events[check_id] - arrived
+                for check_id, arrived in self.arrived.items()
+                if check_id in events and kind in (None, self.kinds[check_id])
+            ]
+        cancelled = sum(
+            1 for check_run in self.github.check_runs.values()
+            if check_run.get('conclusion') == 'cancelled' and
+            (check_run.get('output') or {}).get('summary') == _NOT_ACCEPTED
+        )
+        utilisation = [
+            node.busy_seconds / node.online_seconds
+            for node in self.nodes if node.online_seconds
+        ]
+        jobs_per_node = [node.jobs_finished for node in self.nodes]
+
+        report = {
+            'simulated_hours': round(self.duration / 3600, 2),
+            'wall_seconds': round(wall_seconds, 2),
+            'nodes': len(self.nodes),
+            'checks': len(self.arrived),
+            'dispatched': len(self.dispatched),
+            'started': len(self.started),
+            'finished': len(self.finished),
+            'cancelled_not_accepted': cancelled,
+            'orphaned_by_churn': self.orphaned,
+            'orphans_finished': len(self.orphaned_ids & set(self.finished)),
+            'unfinished_check_runs': sum(
+                1 for check_run in self.github.check_runs.values()
+                if check_run.get('status') != 'completed'
+            ),
+            # jobs run again after their node went offline aren't counted
+            'double_runs': sum(
+                1 for (check_run_id, _), count in self.runs.items()
+                if count > 1 and check_run_id not in self.orphaned_ids
+            ),
+            'shards_per_check': _round(
+                len(self.runs) / len(self.started), 1
+            ) if self.started else None,
+            'stopped_by_conflict': self.stopped_by_conflict,
+            'boards_per_check': _round(
+                self.board_tests / len(self.finished), 1
+            ) if self.finished else None,
+            'github_requests': self.github.requests,
+            'registrations': dict(sorted(self.registrations.items())),
+            'claim_requests': dict(sorted(self.claim_requests.items())),
+            'queue_wait_minutes': minutes(waits(self.started)),
+            'turnaround_minutes': minutes(waits(self.finished)),
+            'node_utilisation': {
+                'mean': _round(statistics.mean(utilisation), 0.01) if utilisation else None,
+                'min': _round(min(utilisation), 0.01) if utilisation else None,
+                'max': _round(max(utilisation), 0.01) if utilisation else None,
+            },
+            'jobs_per_node': {
+                'min': min(jobs_per_node),
+                'median': statistics.median(jobs_per_node),
+                'max': max(jobs_per_node),
+            },
+        }
+        if self.burst:
+            for kind in ('pull_request', 'release'):
+                report[f'{kind}_wait_minutes'] = minutes(waits(self.started, kind))
+                report[f'{kind}_turnaround'] = minutes(waits(self.finished, kind))
+
+        return report
+
+def _round(value, unit):
+    """ Converts ``value`` to ``unit`` (e.g. seconds to minutes with 60,
+        a fraction to a percentage with 0.01), to one decimal place.
+    """
+    return None if value is None else round(value / unit, 1)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--nodes', type=int, default=200)
+    parser.add_argument('--hours', type=float, default=24.0)
+    parser.add_argument('--checks-per-day', type=int, default=3000)
+    parser.add_argument('--minutes-per-board', type=float, default=3.0,
+                        help='Mean test time per attached board.')
+    parser.add_argument('--uptime-hours', type=float, default=8.0,
+                        help='Mean time a node stays online.')
+    parser.add_argument('--offline-minutes', type=float, default=30.0,
+                        help='Mean time a node stays offline.')
+    parser.add_argument('--max-queued', type=int, default=None,
+                        help='Jobs a node queues before rejecting new ones.')
+    parser.add_argument('--lanes', default=None,
+                        help='CHECK_LANES setting, e.g. "interactive:6,bulk:1". '
+                             'Pull request check runs go to the first lane.')
+    parser.add_argument('--lane-policy', default='weighted',
+                        choices=('strict', 'weighted'))
+    parser.add_argument('--burst', type=int, default=0,
+                        help='Release branch check runs arriving at once.')
+    parser.add_argument('--burst-at-hours', type=float, default=2.0)
+    parser.add_argument('--pull', action='store_true',
+                        help='Nodes claim jobs, instead of jobs being pushed to nodes.')
+    parser.add_argument('--lost-replies', type=float, default=0.0,
+                        help='Fraction of accepted /run-test requests whose reply is lost.')
+    parser.add_argument('--shards', type=int, default=1,
+                        help='CHECK_SHARDS_MAX setting: most nodes a check run is split across.')
+    parser.add_argument('--speed-spread', type=float, default=1.0,
+                        help='Slowest node\'s time per board, as a multiple of the fastest\'s.')
+    parser.add_argument('--sweep-minutes', type=float, default=5.0,
+                        help='How often the job sweeper runs. 0 to disable it.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', action='store_true',
+                        help='Print the report as JSON.')
+    parser.add_argument('--log-level', default='ERROR')
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=args.log_level)
+    logging.getLogger().setLevel(args.log_level)
+
+    sim = FarmSim(
+        nodes=args.nodes,
+        hours=args.hours,
+        checks_per_day=args.checks_per_day,
+        minutes_per_board=args.minutes_per_board,
+        uptime_hours=args.uptime_hours,
+        offline_minutes=args.offline_minutes,
+        max_queued=args.max_queued,
+        lanes=args.lanes,
+        lane_policy=args.lane_policy,
+        burst=args.burst,
+        burst_at_hours=args.burst_at_hours,
+        pull=args.pull,
+        lost_replies=args.lost_replies,
+        shards=args.shards,
+        sweep_minutes=args.sweep_minutes,
+        speed_spread=args.speed_spread,
+        seed=args.seed,
+    )
+    report = sim.run()
+
+    if args.json:
+        print(json.dumps(report, indent=2))
+    else:
+        for key, value in report.items():
+            print(f'{key:<24} {value}')
+
+
+if __name__ == '__main__':
+    main()
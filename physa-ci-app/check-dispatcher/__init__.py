@@ -0,0 +1,22 @@
+import logging
+
+import azure.functions as func
+
+# pylint: disable=import-error
+from __app__.lib import check_dispatch, check_lanes, check_queue, metrics, storage
+
+storage.check_config()
+
+@metrics.invocation('check-dispatcher')
+def main(timer: func.TimerRequest) -> None:
+    if not check_lanes.lanes():
+        # without lanes, check runs are dispatched by queue-new-check
+        return
+    if check_queue.dispatch_mode() == check_queue.MODE_PULL:
+        # nodes claim jobs from the lanes themselves
+        return
+
+    if timer is not None and timer.past_due:
+        logging.info('Check dispatcher is running late.')
+
+    check_dispatch.run_dispatch_round()
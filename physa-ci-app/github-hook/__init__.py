@@ -4,8 +4,11 @@ import os
 import azure.functions as func
 
 # pylint: disable=import-error
-from __app__.lib import app_client
+from __app__.lib import app_client, metrics, profiling, result_memo, storage
 
+storage.check_config()
+
+@metrics.invocation('github-hook')
 def main(req: func.HttpRequest) -> func.HttpResponse:
     logging.info('Python HTTP trigger function processed a request.')
     
@@ -31,6 +34,10 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
             event = None
         
         logging.info(f'Payload received. event type: {event}, action: {action}')        
+        profiling.tag(
+            event=f'{event}.{action}' if action else event,
+            check_run_id=payload.get('check_run', {}).get('id') if payload else None
+        )
         
         if not event:
             event_status = 500        
@@ -46,11 +53,20 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
             logging.info('Processing check_run...')
             if str(payload['check_run']['app']['id']) == os.environ['GITHUB_APP_ID']:
                 if action == 'created':
-                    # initiate check_run
-                    event_status = event_client.initiate_check_run()
+                    if payload['check_run']['status'] == 'completed':
+                        # check_run was created with a memoized result
+                        logging.info('Check run already completed. Skipping.')
+                    else:
+                        # initiate check_run
+                        event_status = event_client.initiate_check_run()
                 elif action == 'rerequested':
-                    # create check_run
-                    event_status = event_client.create_check_run()
+                    # create check_run, reusing a prior result if allowed
+                    memoized_result = result_memo.find_memoized_result(
+                        payload['check_run']['head_sha']
+                    )
+                    event_status = event_client.create_check_run(
+                        memoized_result=memoized_result
+                    )
             else:
                 check_id = str(payload['check_run']['app']['id'])
                 os_id = os.environ['GITHUB_APP_ID']
@@ -3,14 +3,35 @@ import json
 import pathlib
 
 import azure.functions as func
-from azure.core.exceptions import AzureError
-from azure.common import AzureHttpError
-from azure.cosmosdb.table.common import no_retry
 
 # pylint: disable=import-error
-from __app__.lib import node_db
-
-
+from __app__.lib import http_encoding, metrics, node_db, profiling
+from __app__.lib import result_chunks, result_files, storage
+from __app__.lib.lazy_import import lazy_import
+
+azure_common = lazy_import('azure.common')
+azure_exceptions = lazy_import('azure.core.exceptions')
+table_common = lazy_import('azure.cosmosdb.table.common')
+
+storage.check_config()
+
+# the fields of a response, selectable with ``?fields=``
+_FIELDS = (
+    'commit_sha', 'check_run_url', 'check_run_date', 'outcome', 'node_name',
+    'node_results', 'board_count',
+)
+_DEFAULT_FIELDS = (
+    'commit_sha', 'check_run_url', 'check_run_date', 'outcome', 'node_name',
+    'node_results',
+)
+# ``?summary=true``: everything but the board tests
+_SUMMARY_FIELDS = (
+    'commit_sha', 'check_run_url', 'check_run_date', 'outcome', 'node_name',
+    'board_count',
+)
+
+
+@metrics.invocation('job-result')
 def main(req: func.HttpRequest) -> func.HttpResponse:
     logging.info('Python HTTP trigger function processed a request.')
 
@@ -25,13 +46,48 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
     partition_key = req.params.get('node')
     row_key = req.params.get('job-id')
 
+    file_path = req.params.get('file')
+
+    if req.params.get('fields'):
+        fields = [field.strip() for field in req.params['fields'].split(',') if field.strip()]
+    elif req.params.get('summary', '').lower() in ('1', 'true'):
+        fields = list(_SUMMARY_FIELDS)
+    else:
+        fields = list(_DEFAULT_FIELDS)
+
     logging.info(f'partition_key: {partition_key} | row_key: {row_key}')
+    profiling.tag(event='file' if file_path else 'result', check_run_id=row_key)
     
-    if partition_key and row_key:
+    if partition_key and row_key and file_path:
+        # offloaded logs are served as-is, in ranges, rather than
+        # wrapped in JSON.
+        try:
+            response_kwargs = result_files.read_file(
+                row_key, partition_key, file_path, req.headers.get('range')
+            )
+        except (azure_exceptions.AzureError, azure_common.AzureHttpError) as err:
+            logging.info(f"AzureError caught: {err}")
+            response_kwargs = {
+                'status_code': 404,
+                'body': b'File not found.',
+                'headers': {},
+            }
+
+        return func.HttpResponse(**response_kwargs)
+
+    unknown_fields = [field for field in fields if field not in _FIELDS]
+
+    if partition_key and row_key and not unknown_fields:
         job_data = None
         try:
-            job_data = node_db.get_result(partition_key, row_key, tbl_svc_retry=no_retry)
-        except (AzureError, AzureHttpError) as err:
+            # without the board tests, only the result's summary is read
+            job_data = node_db.get_result(
+                partition_key,
+                row_key,
+                tbl_svc_retry=table_common.no_retry,
+                summary='node_results' not in fields
+            )
+        except (azure_exceptions.AzureError, azure_common.AzureHttpError) as err:
             logging.info(f"AzureError caught: {err}")
             pass
 
@@ -44,15 +100,32 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
             outcome = job_data.get('check_run_conclusion')
             node_name = job_data.get('node_name', 'Unknown')
             node_results = job_data.get('node_results')
-
-            response_kwargs['body'] = {
+            board_count = job_data.get(
+                'node_results_count', job_data.get('node_results_chunked')
+            )
+            if board_count is None and isinstance(node_results, list):
+                board_count = len(node_results)
+            if node_results is None and 'node_results' in fields:
+                # results uploaded through ``testresult/append`` are
+                # kept in the chunk table, and can be read before the
+                # run is finalised.
+                try:
+                    node_results = list(
+                        result_chunks.iter_board_tests(row_key, partition_key)
+                    ) or None
+                except (azure_exceptions.AzureError, azure_common.AzureHttpError) as err:
+                    logging.info(f"AzureError caught: {err}")
+
+            job_info = {
                 'commit_sha': github_commit_sha,
                 'check_run_url': check_run_url,
                 'check_run_date': check_run_date,
                 'outcome': outcome,
                 'node_name': node_name,
-                'node_results': node_results
+                'node_results': node_results,
+                'board_count': board_count,
             }
+            response_kwargs['body'] = {field: job_info[field] for field in fields}
         
         else:
             logging.warning('Failed to retrieve job info.')
@@ -66,6 +139,18 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
                 body=failure_body
             )
 
+    elif unknown_fields:
+        logging.warning(f'Request for unknown fields: {unknown_fields}')
+
+        failure_body = {
+            'failure_reason': f'Unknown fields: {", ".join(unknown_fields)}'
+        }
+
+        response_kwargs.update(
+            status_code=400,
+            body=failure_body
+        )
+
     else:
         logging.warning('Request missing required parameters.')
 
@@ -90,5 +175,6 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
             headers={}
         )
 
+    http_encoding.encode_response(response_kwargs, req.headers.get('accept-encoding'))
 
     return func.HttpResponse(**response_kwargs)
@@ -0,0 +1,15 @@
+import logging
+
+import azure.functions as func
+
+# pylint: disable=import-error
+from __app__.lib import job_sweeper, metrics, storage
+
+storage.check_config()
+
+@metrics.invocation('job-sweeper')
+def main(timer: func.TimerRequest) -> None:
+    if timer is not None and timer.past_due:
+        logging.info('Job sweeper is running late.')
+
+    job_sweeper.sweep()
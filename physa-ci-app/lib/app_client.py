@@ -1,13 +1,15 @@
 import json
 import logging
 import os
-import requests
-
-import jwt
 
 from datetime import datetime, timedelta
 
-from azure.storage import queue
+# pylint: disable=import-error
+from __app__.lib import check_lanes, check_queue, metrics, node_db, result
+from __app__.lib.lazy_import import lazy_import
+
+jwt = lazy_import('jwt')
+requests = lazy_import('requests')
 
 _CHECK_RUN_UPDATE_PARAMS = [
     'name',
@@ -21,6 +23,14 @@ _CHECK_RUN_UPDATE_PARAMS = [
     'actions',
 ]
 
+def github_api_url():
+    """ The base URL of the GitHub API. Can be overridden with the
+        ``GITHUB_API_URL`` app setting (e.g. for a local stand-in when
+        benchmarking).
+    """
+    return os.environ.get('GITHUB_API_URL', 'https://api.github.com').rstrip('/')
+
+@metrics.timed('jwt_sign')
 def generate_jwt_token():
         """ Authenticate with GitHub as an App so that we can
             process API requests
@@ -37,6 +47,9 @@ def generate_jwt_token():
             'iss': os.environ['GITHUB_APP_ID']
         }
         jwt_auth = jwt.encode(payload, secret, algorithm='RS256')
+        # PyJWT < 2.0 returns bytes
+        if isinstance(jwt_auth, bytes):
+            jwt_auth = str(jwt_auth, encoding='utf-8')
 
         logging.info(f'JWT generation complete. Successful?: {bool(jwt_auth)}')        
 
@@ -48,7 +61,7 @@ class AppClient():
     """
     def __init__(self):
         self._payload = None
-        self.bearer_token = str(generate_jwt_token(), encoding='utf-8')
+        self.bearer_token = generate_jwt_token()
         self.installation_token = None
 
     @property
@@ -73,7 +86,7 @@ class AppClient():
             if self.authenticate_app():
                 inst_id = payload['installation']['id']
                 url = (
-                    'https://api.github.com/app/installations/'
+                    f'{github_api_url()}/app/installations/'
                     f'{inst_id}/access_tokens'
                 )
                 bearer_string = f'Bearer  {self.bearer_token}'
@@ -81,7 +94,8 @@ class AppClient():
                     'Authorization': bearer_string,
                     'Accept': 'application/vnd.github.machine-man-preview+json'
                 }
-                response = requests.post(url, headers=header)
+                with metrics.span('github_token'):
+                    response = requests.post(url, headers=header)
                 if response.ok:
                     logging.info('Token successfully created.')
                     install_token = response.json()['token']
@@ -98,13 +112,14 @@ class AppClient():
         """
         logging.info('Authenticating app...')
         if self.bearer_token:
-            url = 'https://api.github.com/app'
+            url = f'{github_api_url()}/app'
             bearer_string = f'Bearer {self.bearer_token}'
             header = {
                 'Authorization': bearer_string,
                 'Accept': 'application/vnd.github.machine-man-preview+json'
             }
-            response = requests.get(url, headers=header)
+            with metrics.span('github_authenticate'):
+                response = requests.get(url, headers=header)
             if response.ok:
                 return True
             else:
@@ -121,8 +136,14 @@ class GithubClient(AppClient):
     def __init__(self):
         super().__init__()
 
-    def create_check_run(self):
+    def create_check_run(self, memoized_result=None):
         """ Creates a check run through the API
+
+        :param: dict memoized_result: A prior result for the same commit
+                                      (from ``result_memo``). If supplied,
+                                      the check run is created already
+                                      completed with the prior conclusion,
+                                      instead of being queued for a node.
         """
         logging.info('Creating check run...')
         self.installation_token = self.create_installation_app_token(self.payload)
@@ -133,7 +154,7 @@ class GithubClient(AppClient):
             return 401
 
         repo_name = self.payload['repository']['full_name']
-        url = f'https://api.github.com/repos/{repo_name}/check-runs'
+        url = f'{github_api_url()}/repos/{repo_name}/check-runs'
         head_sha = None
         if 'check_run' in self.payload:
             head_sha = self.payload['check_run']['head_sha']
@@ -148,7 +169,24 @@ class GithubClient(AppClient):
             'name': 'RosiePi',
             'head_sha': head_sha,
         }
-        response = requests.post(url, headers=header, json=params)
+        if memoized_result:
+            prior_id = memoized_result.get('check_run_id')
+            params.update({
+                'status': 'completed',
+                'conclusion': memoized_result.get('check_run_conclusion'),
+                'completed_at': datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
+                'external_id': memoized_result.get('check_run_external_id', ''),
+                'output': {
+                    'title': 'RosiePi',
+                    'summary': (
+                        'Reused the result of a previous RosiePi run on this '
+                        f'commit (check run {prior_id}, node: '
+                        f'{memoized_result.get("node_name")}).'
+                    ),
+                }
+            })
+        with metrics.span('github_create_check_run'):
+            response = requests.post(url, headers=header, json=params)
         if not response.ok:
             logging.info(
                 'Failed to create check run.\n'
@@ -156,9 +194,32 @@ class GithubClient(AppClient):
                 f'URL: {response.url}\n'
                 f'Headers: {response.headers}'
             )
+        elif memoized_result:
+            self._add_memoized_result(memoized_result, response.json())
 
         return response.status_code
 
+    def _add_memoized_result(self, memoized_result, check_run):
+        """ Stores a copy of a memoized result under the new check run,
+            so that it is available through ``job-result``.
+        """
+        new_results = dict(memoized_result)
+        new_results.update({
+            'api_url': check_run['url'],
+            'check_run_id': str(check_run['id']),
+            'check_run_url': check_run['html_url'],
+            'check_run_completed_at': check_run.get('completed_at'),
+            'check_run_node_id': check_run.get('node_id'),
+            'memoized_from': memoized_result.get('check_run_id'),
+        })
+
+        new_result = result.Result(new_results)
+        if not node_db.add_result(new_result.results_to_table_entity()):
+            logging.info(
+                'Failed to add memoized result to table storage. '
+                f'check_run_id: {check_run["id"]}'
+            )
+
     def initiate_check_run(self):
         """ Initiates a previously created check run
         """
@@ -172,7 +233,7 @@ class GithubClient(AppClient):
 
         repo_name = self.payload['repository']['full_name']
         check_id = self.payload['check_run']['id']
-        api_url = f'https://api.github.com/repos/{repo_name}/check-runs/{check_id}'
+        api_url = f'{github_api_url()}/repos/{repo_name}/check-runs/{check_id}'
 
         header = {
             'Authorization': f'token {self.installation_token}',
@@ -183,7 +244,8 @@ class GithubClient(AppClient):
             'status': 'queued',
             'started_at': datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
         }
-        response = requests.patch(api_url, headers=header, json=params)
+        with metrics.span('github_patch_check_run'):
+            response = requests.patch(api_url, headers=header, json=params)
         final_status = response.status_code
         if not response.ok:
             logging.info(
@@ -211,27 +273,26 @@ class GithubClient(AppClient):
                 'check_run_head_sha': str(head_sha),
                 'check_run_url': str(check_run_url),
                 'check_run_pull_requests': check_run_pull_requests,
+                # GraphQL IDs, for batched updates (see ``check_updates``)
+                'check_run_node_id': new_payload.get('node_id'),
+                'repository_node_id': self.payload['repository'].get('node_id'),
                 'is_claimed': 'false',
             }
 
+            lane = check_lanes.classify(
+                self.payload,
+                lambda: self._pull_request_labels(
+                    repo_name, new_payload['pull_requests'], header
+                )
+            )
+            if lane:
+                queue_msg['lane'] = lane
+
             # using the python library/webapi here so that we can catch
             # any failures and update the check_run accoringly.
             # using binding in 'function.json' would not allow for that.
-            queue_url = os.environ['APP_STORAGE_CONN_STR']
-            queue_config = {
-                'message_encode_policy': queue.TextBase64EncodePolicy(),
-                'message_decode_policy': queue.TextBase64DecodePolicy(),
-            }
-            queue_client = queue.QueueClient.from_connection_string(
-                queue_url,
-                'rosiepi-check-queue',
-                **queue_config
-            )
-
             try:
-                encoded_msg = json.dumps(queue_msg)
-                sent_msg = queue_client.send_message(encoded_msg)
-                logging.info(f'Sent the following queue content: {sent_msg.content}')
+                check_queue.send_check(queue_msg)
             except Exception as err:
                 logging.info(f'Error sending node-queue message: {err}')
                 final_status = 500
@@ -253,12 +314,38 @@ class GithubClient(AppClient):
         
         return final_status
 
-    def update_check_run(self, message):
-        """ Updates a previously created check run
+    def _pull_request_labels(self, repo_name, pull_requests, header):
+        """ Retrieves the labels of a check run's pull requests, for
+            ``check_lanes.classify``.
+
+        :return: list: The label names.
         """
-        update_payload = {'installation': {'id': self.payload['installation_id']}}
+        labels = []
+        for pull_request in pull_requests:
+            labels_url = (
+                f'{github_api_url()}/repos/{repo_name}/issues/'
+                f'{pull_request["number"]}/labels'
+            )
+            with metrics.span('github_get_labels'):
+                response = requests.get(labels_url, headers=header)
+            if not response.ok:
+                logging.info(
+                    'Failed to retrieve pull request labels.\n'
+                    f'Response: {response.text}\n'
+                    f'URL: {response.url}'
+                )
+                continue
+            labels.extend(label['name'] for label in response.json())
 
-        self.installation_token = self.create_installation_app_token(update_payload)
+        return labels
+
+    def update_check_run(self, message):
+        """ Updates a previously created check run. An installation token
+            already held by the client is reused.
+        """
+        if not self.installation_token:
+            update_payload = {'installation': {'id': self.payload['installation_id']}}
+            self.installation_token = self.create_installation_app_token(update_payload)
         if not self.installation_token:
             logging.info(
                 'Check run not updated. No installation token available.'
@@ -273,7 +360,8 @@ class GithubClient(AppClient):
             'Accept': 'application/vnd.github.antiope-preview+json',
         }
         
-        response = requests.patch(api_url, headers=header, json=message)
+        with metrics.span('github_patch_check_run'):
+            response = requests.patch(api_url, headers=header, json=message)
         final_status = response.status_code
         if not response.ok:
             logging.info(
@@ -285,4 +373,24 @@ class GithubClient(AppClient):
         logging.info(f'Check run update status: {final_status}')
         logging.info(f'Check run update return message: {response.text}')
         
-        return final_status
\ No newline at end of file
+        return final_status
+
+    def graphql(self, query, variables):
+        """ Sends a GraphQL request, with the client's installation token.
+
+        :param: str query: The GraphQL query or mutation
+        :param: dict variables: The query's variables
+
+        :return: requests.Response
+        """
+        header = {
+            'Authorization': f'bearer {self.installation_token}',
+            'Accept': 'application/vnd.github.antiope-preview+json',
+        }
+
+        with metrics.span('github_graphql'):
+            return requests.post(
+                f'{github_api_url()}/graphql',
+                headers=header,
+                json={'query': query, 'variables': variables}
+            )
@@ -0,0 +1,444 @@
+import logging
+import os
+import time
+
+from datetime import datetime
+
+# pylint: disable=import-error
+from __app__.lib import check_lanes, check_queue, check_shards, check_updates
+from __app__.lib import dispatch_ledger, message_codec, metrics
+from __app__.lib import node_db, node_health, node_ledger, node_registrar, result
+
+DISPATCHED = 'dispatched'
+WAITING = 'waiting'
+CANCELLED = 'cancelled'
+
+# Upper bounds, in seconds, of the lane wait histogram buckets.
+WAIT_BUCKETS = (
+    1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600, 7200, 14400, 43200,
+)
+
+def try_dispatch(check_info):
+    """ Pushes a check run's job to the nodes. If a node accepts it, the
+        job is added to the results table and the check run is updated.
+
+        Each attempt is recorded in the dispatch ledger, and sent with
+        its idempotency key. A job whose last attempt may have reached a
+        node is only offered to that node again, with the same key,
+        until ``DISPATCH_UNCERTAIN_SECONDS`` pass.
+
+        With ``CHECK_SHARDS_MAX`` above 1, the job's boards are split
+        across idle nodes when it can be (see ``try_dispatch_shards``).
+
+    :param: dict check_info: The check run message
+
+    :return: bool: Whether a node accepted the job.
+    """
+    check_run_id = check_info['check_run_id']
+    dispatch = dispatch_ledger.begin(check_info)
+    if dispatch is None:
+        return False
+    if dispatch.state in (dispatch_ledger.STATE_OWNED, dispatch_ledger.STATE_SHARDED):
+        logging.info(f'Job {check_run_id} is already owned by {dispatch.node_name}.')
+        return True
+
+    registrar_entries = None
+    if dispatch.state == dispatch_ledger.STATE_PENDING and check_shards.enabled():
+        # read once; a read hides the registrar from the next for a second
+        registrar_entries = node_registrar.current_registrar()
+        sharded = try_dispatch_shards(check_info, dispatch, registrar_entries)
+        if sharded is not None:
+            return sharded
+
+    push_msg = {
+        'commit_sha': check_info['check_run_head_sha'],
+        'check_run_id': check_run_id,
+        'idempotency_key': dispatch.idempotency_key,
+    }
+
+    if dispatch.state == dispatch_ledger.STATE_UNCERTAIN:
+        push_result, node_name, unconfirmed_by = node_registrar.push_test_to_nodes(
+            push_msg, node_names=[dispatch.node_name]
+        )
+        if not (push_result or unconfirmed_by):
+            # the node answered without the job; any node can have it
+            dispatch = dispatch_ledger.retry(dispatch)
+            if dispatch is None:
+                return False
+            push_msg['idempotency_key'] = dispatch.idempotency_key
+    if dispatch.state != dispatch_ledger.STATE_UNCERTAIN:
+        push_result, node_name, unconfirmed_by = node_registrar.push_test_to_nodes(
+            push_msg, registrar_entries=registrar_entries
+        )
+
+    if unconfirmed_by and not push_result:
+        dispatch_ledger.mark_uncertain(dispatch, unconfirmed_by)
+        return False
+    if not push_result:
+        dispatch_ledger.mark_waiting(dispatch)
+        return False
+
+    if not dispatch_ledger.assign(check_run_id, node_name):
+        # a node that reported on an earlier attempt owns the job
+        # (see ``reconcile_report``)
+        return True
+
+    accept_job(check_info, node_name)
+
+    return True
+
+def _idle_nodes(registrar_entries):
+    """ The registered nodes that can start a job now, in dispatch
+        order: not busy, below their run limit in the node ledger, and
+        without an open circuit.
+    """
+    health = node_health.load_health()
+    ledger = node_ledger.load_ledger()
+    idle = []
+    for item in node_health.order_for_dispatch(registrar_entries, health):
+        node = item['node']
+        load = ledger.get(node.node_name, node_ledger.NodeLoad(node.node_name))
+        if not node.busy and load.in_flight < node_ledger.max_running():
+            idle.append(node)
+
+    return idle
+
+def try_dispatch_shards(check_info, dispatch, registrar_entries):
+    """ Splits a check run's boards across idle nodes (see
+        ``check_shards.plan``), and pushes each node its shard. The
+        boards of a shard its node declines are planned again across the
+        idle nodes not tried yet. The shards that are accepted make up
+        the run; boards that no node took aren't tested, and the run
+        can't pass (see ``check_shards.ShardedRun.conclusion``).
+
+        A shard whose node doesn't confirm it isn't part of the run, so
+        the node's reports on it are refused (see ``reconcile_report``).
+        Its boards aren't pushed to another node, as the node may be
+        testing them.
+
+    :param: dict check_info: The check run message
+    :param: Dispatch dispatch: The job's dispatch attempt
+    :param: list registrar_entries: Entries from
+                                    ``node_registrar.current_registrar()``
+
+    :return: bool: Whether any node accepted a shard, or None if fewer
+                   than two idle nodes can take the job.
+    """
+    check_run_id = check_info['check_run_id']
+    idle_nodes = _idle_nodes(registrar_entries)
+    shards = check_shards.plan(idle_nodes, boards=check_info.get('boards'))
+    if len(shards) < 2:
+        return None
+
+    shard_count = len(shards)
+    pending = list(enumerate(shards))
+    tried = set()
+    accepted = []
+    untested = []
+    unconfirmed = None
+    while pending:
+        declined = []
+        for index, shard in pending:
+            tried.add(shard['node_name'])
+            push_msg = {
+                'commit_sha': check_info['check_run_head_sha'],
+                'check_run_id': check_run_id,
+                'idempotency_key': dispatch.idempotency_key,
+                'boards': shard['boards'],
+                'shard': index,
+                'shard_count': shard_count,
+            }
+            push_result, _, unconfirmed_by = node_registrar.push_test_to_nodes(
+                push_msg,
+                node_names=[shard['node_name']],
+                registrar_entries=registrar_entries
+            )
+            if push_result:
+                accepted.append(shard)
+            elif unconfirmed_by:
+                untested.extend(shard['boards'])
+                unconfirmed = unconfirmed or unconfirmed_by
+            else:
+                declined.append((index, shard))
+
+        # declined shards keep their index, so that each replacement
+        # takes the place of one of them
+        boards = [board for _, shard in declined for board in shard['boards']]
+        spare = [node for node in idle_nodes if node.node_name not in tried]
+        replanned = []
+        if boards and spare:
+            replanned = check_shards.plan(spare, boards=boards, limit=len(declined))
+        placed = {board for shard in replanned for board in shard['boards']}
+        untested.extend(board for board in boards if board not in placed)
+        if replanned:
+            metrics.incr('shard_redispatch_total', len(replanned))
+        pending = list(zip((index for index, _ in declined), replanned))
+
+    if not accepted:
+        if unconfirmed:
+            dispatch_ledger.mark_uncertain(dispatch, unconfirmed)
+        else:
+            dispatch_ledger.mark_waiting(dispatch)
+        return False
+
+    node_names = [shard['node_name'] for shard in accepted]
+    if dispatch_ledger.assign_shards(check_run_id, node_names):
+        accept_shards(check_info, accepted, untested)
+
+    return True
+
+def _record_job(check_info, node_name):
+    """ Adds a node's job to the node ledger and the results table.
+    """
+    check_info['node_name'] = node_name
+    check_info['check_run_external_id'] = (
+        f'{node_name}:{check_info["check_run_head_sha"]}'
+    )
+    node_ledger.record_assigned(node_name, check_info['check_run_id'])
+
+    new_check = result.Result(check_info)
+    if new_check.results:
+        add_to_table = node_db.add_result(
+            new_check.results_to_table_entity()
+        )
+        if not add_to_table:
+            logging.info(
+                'Failed to add new check_run to table storage. '
+                f'Results Entity: {new_check.results_to_table_entity()}'
+            )
+
+    logging.info(f'check_info after adding to table: {check_info}')
+
+def accept_job(check_info, node_name):
+    """ Records that a node took a check run's job: the job is added to
+        the node ledger and the results table, and the check run is
+        updated.
+
+    :param: dict check_info: The check run message. Updated in place.
+    :param: str node_name: The node running the job
+    """
+    _record_job(check_info, node_name)
+
+    github_output_summary = (
+        'RosiePi job has been queued on the following node: '
+        f'{check_info.get("node_name")}'
+    )
+    check_updates.update_check_run(check_info, {
+        'status': 'queued',
+        'output': {
+            'title': 'RosiePi',
+            'summary': github_output_summary,
+        }
+    })
+
+def accept_shards(check_info, shards, untested=()):
+    """ Records that nodes took the shards of a check run's job: the
+        run is recorded with its shards (see ``check_shards.record``),
+        each shard is added to its node's ledger and the results table,
+        and the check run is updated.
+
+    :param: dict check_info: The check run message
+    :param: list shards: The accepted shards
+    :param: untested: The boards of the shards that weren't accepted
+    """
+    check_shards.record(check_info, shards, untested)
+    for shard in shards:
+        shard_info = dict(
+            check_info, shard_boards=shard['boards'], shard_count=len(shards)
+        )
+        _record_job(shard_info, shard['node_name'])
+
+    node_names = ', '.join(shard['node_name'] for shard in shards)
+    check_updates.update_check_run(check_info, {
+        'status': 'queued',
+        'output': {
+            'title': 'RosiePi',
+            'summary': (
+                'RosiePi job has been split across the following nodes: '
+                f'{node_names}'
+            ),
+        }
+    })
+
+def reconcile_report(result_json):
+    """ Checks that a node reporting results for a job owns it, per the
+        dispatch ledger. A node whose dispatch wasn't confirmed (e.g. it
+        timed out) takes the job if no other node owns it.
+
+    :param: dict result_json: The node's ``testresult`` report
+
+    :return: bool: Whether the report should be stored. False if another
+                   node owns the job.
+    """
+    outcome, dispatch = dispatch_ledger.reconcile(
+        result_json['check_run_id'], result_json['node_name']
+    )
+    if outcome == dispatch_ledger.CONFLICT:
+        return False
+    if outcome == dispatch_ledger.ADOPTED and dispatch.check_info:
+        accept_job(dict(dispatch.check_info), result_json['node_name'])
+
+    return True
+
+def notify_waiting(check_info):
+    """ Tells GitHub that a job is waiting for a node. Only the first
+        wait is sent, so that retries don't cost GitHub API calls.
+    """
+    if check_info.get('dispatch_attempts') != 1:
+        return
+
+    check_updates.update_check_run(check_info, {
+        'status': 'queued',
+        'output': {
+            'title': 'RosiePi',
+            'summary': (
+                'All RosiePi nodes are busy. The job will be retried when a '
+                'node is available.'
+            ),
+        }
+    })
+
+def cancel_check(check_info, summary='Job not accepted by any RosiePi nodes.'):
+    """ Completes a check run as ``cancelled``; by default, because no
+        node accepted its job. Callers keep the job's queue message until
+        the update is sent, so that a failed cancel is made again.
+
+    :return: check_updates.CheckRunUpdate
+    """
+    logging.info(f'Cancelling check run {check_info.get("check_run_id")}: {summary}')
+    metrics.incr('check_cancelled_total', lane=check_info.get('lane') or 'none')
+    return check_updates.update_check_run(check_info, {
+        'status': 'completed',
+        'conclusion': 'cancelled',
+        'completed_at': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'output': {
+            'title': 'RosiePi',
+            'summary': summary,
+        },
+    })
+
+def dispatch_check(check_info):
+    """ Dispatches a check run from the check queue. A job that no node
+        accepts is requeued with a backoff delay (see
+        ``check_queue.schedule_retry``), until its deadline.
+
+    :param: dict check_info: The check run message
+
+    :return: str: ``DISPATCHED``, ``WAITING`` or ``CANCELLED``
+    """
+    if try_dispatch(check_info):
+        return DISPATCHED
+
+    if check_queue.schedule_retry(check_info):
+        logging.info('Job not accepted by a node. Retrying later.')
+        notify_waiting(check_info)
+        return WAITING
+
+    if not cancel_check(check_info).ok:
+        # the queue trigger retries the message, which cancels it again
+        raise RuntimeError(
+            f'Failed to cancel check run {check_info.get("check_run_id")}.'
+        )
+
+    return CANCELLED
+
+def dispatch_visibility():
+    """ Seconds a message is hidden while the dispatcher works on it.
+    """
+    return int(os.environ.get('CHECK_DISPATCH_VISIBILITY', 120))
+
+def dispatch_batch():
+    """ Most jobs dispatched in one dispatcher run.
+    """
+    return int(os.environ.get('CHECK_DISPATCH_BATCH', 32))
+
+def run_dispatch_round(now=None):
+    """ Dispatches queued jobs from the lanes, in policy order, until the
+        lanes are empty, the farm stops accepting jobs, or
+        ``CHECK_DISPATCH_BATCH`` jobs have been dispatched.
+
+        A job that no node accepts stays in its lane, hidden for a
+        backoff delay (see ``check_queue.retry_visibility``), rather than
+        being requeued behind later jobs, so waiting doesn't cost a job
+        its priority. It is cancelled once past its dispatch deadline,
+        and its message deleted once the cancel is sent; a message whose
+        cancel failed shows again, to be cancelled by a later round.
+        The rest of its lane is left for the next round, and the round
+        goes on with the other lanes, whose jobs may need other boards.
+
+    :return: dict: The number of jobs dispatched from each lane.
+    """
+    dispatched = {name: 0 for name, _ in check_lanes.lanes()}
+    if not dispatched:
+        return dispatched
+
+    picker = check_lanes.picker()
+    # a failed depth read leaves the lane active
+    active = {
+        name for name, depth in check_lanes.lane_depths().items()
+        if depth is None or depth > 0
+    }
+
+    cancelled = []
+    # check run updates are sent together when the round ends
+    with check_updates.batched():
+        while active and sum(dispatched.values()) < dispatch_batch():
+            lane = picker.pick(active)
+            queue_client = check_queue.check_queue_client(lane)
+            with metrics.span('lane_receive', lane=lane):
+                message = queue_client.receive_message(
+                    visibility_timeout=dispatch_visibility()
+                )
+            if message is None:
+                active.discard(lane)
+                continue
+
+            try:
+                check_info = message_codec.decode(message.content)
+            except ValueError as err:
+                check_queue.drop_malformed(queue_client, message, err)
+                continue
+            check_info['lane'] = lane
+
+            if try_dispatch(check_info):
+                queue_client.delete_message(message)
+                dispatched[lane] += 1
+                metrics.incr('lane_dispatched_total', lane=lane)
+                enqueued_at = check_info.get('enqueued_at')
+                if enqueued_at is not None:
+                    metrics.observe(
+                        'lane_wait_seconds',
+                        (now or time.time()) - enqueued_at,
+                        buckets=WAIT_BUCKETS,
+                        lane=lane
+                    )
+                continue
+
+            attempted_at = now or time.time()
+            if check_queue.record_attempt(check_info, attempted_at):
+                queue_client.update_message(
+                    message,
+                    content=message_codec.encode(check_info, kind='check'),
+                    visibility_timeout=int(
+                        check_queue.retry_visibility(check_info, attempted_at)
+                    )
+                )
+                notify_waiting(check_info)
+            else:
+                cancelled.append((queue_client, message, cancel_check(check_info)))
+
+            # no node took the lane's job; try the lane again next round
+            active.discard(lane)
+
+    for queue_client, message, update in cancelled:
+        if update.ok:
+            queue_client.delete_message(message)
+        else:
+            logging.info(
+                f'Failed to cancel check run {update.check_info.get("check_run_id")}. '
+                'Retrying in a later round.'
+            )
+
+    logging.info(f'Dispatch round complete. Dispatched: {dispatched}')
+
+    return dispatched
@@ -0,0 +1,203 @@
+import fnmatch
+import json
+import logging
+import os
+import re
+
+# pylint: disable=import-error
+from __app__.lib import check_queue, metrics
+
+POLICY_STRICT = 'strict'
+POLICY_WEIGHTED = 'weighted'
+
+# lane names become part of a queue name
+_LANE_NAME = re.compile(r'^[a-z0-9]{1,20}$')
+
+def lanes():
+    """ The configured priority lanes, highest priority first, from the
+        ``CHECK_LANES`` app setting (e.g. ``interactive:6,default:3,bulk:1``).
+        A lane's weight defaults to 1.
+
+    :return: list: ``(lane, weight)`` tuples. Empty when lanes aren't
+                   configured, in which case every check run goes
+                   through ``rosiepi-check-queue``.
+    """
+    configured = []
+    for item in os.environ.get('CHECK_LANES', '').split(','):
+        name, _, weight = item.strip().partition(':')
+        if not name:
+            continue
+        if not _LANE_NAME.match(name):
+            logging.info(f'Invalid lane name in CHECK_LANES: {name}')
+            continue
+        try:
+            weight = max(int(weight or 1), 1)
+        except ValueError:
+            logging.info(f'Invalid weight for lane {name}. Using 1.')
+            weight = 1
+        configured.append((name, weight))
+
+    return configured
+
+def default_lane():
+    """ The lane for check runs that don't match a lane rule. Defaults
+        to the lowest priority lane.
+    """
+    names = [name for name, _ in lanes()]
+    lane = os.environ.get('CHECK_DEFAULT_LANE')
+    if lane in names:
+        return lane
+
+    return names[-1] if names else None
+
+def policy():
+    """ How the dispatcher chooses between lanes: ``strict`` always
+        takes the highest priority lane with work, ``weighted`` shares
+        dispatches between lanes by their weight.
+    """
+    configured = os.environ.get('CHECK_LANE_POLICY', POLICY_WEIGHTED)
+    if configured not in (POLICY_STRICT, POLICY_WEIGHTED):
+        logging.info(f'Invalid CHECK_LANE_POLICY: {configured}. Using weighted.')
+        configured = POLICY_WEIGHTED
+
+    return configured
+
+def lane_rules():
+    """ The rules that put check runs in lanes, from the
+        ``CHECK_LANE_RULES`` app setting: a JSON list, checked in order,
+        of objects with a ``lane`` and any of:
+
+        - ``repo``: glob for the repository's full name
+        - ``branch``: glob for the check suite's head branch
+        - ``event``: ``pull_request`` or ``push``
+        - ``label``: a label on one of the check run's pull requests
+
+    :return: list of dict
+    """
+    try:
+        rules = json.loads(os.environ.get('CHECK_LANE_RULES', '[]'))
+    except ValueError as err:
+        logging.info(f'Invalid CHECK_LANE_RULES: {err}')
+        return []
+
+    return [rule for rule in rules if isinstance(rule, dict) and 'lane' in rule]
+
+def classify(payload, fetch_labels=None):
+    """ Picks the lane for a check run.
+
+    :param: dict payload: The ``check_run`` webhook payload
+    :param: fetch_labels: Callable returning the labels of the check
+                          run's pull requests. Only called if a rule
+                          needs them.
+
+    :return: str: The lane, or None when lanes aren't configured.
+    """
+    names = [name for name, _ in lanes()]
+    if not names:
+        return None
+
+    check_run = payload.get('check_run', {})
+    facts = {
+        'repo': payload.get('repository', {}).get('full_name', ''),
+        'branch': check_run.get('check_suite', {}).get('head_branch') or '',
+        'event': 'pull_request' if check_run.get('pull_requests') else 'push',
+    }
+    labels = None
+
+    for rule in lane_rules():
+        if rule['lane'] not in names:
+            continue
+        if 'repo' in rule and not fnmatch.fnmatch(facts['repo'], rule['repo']):
+            continue
+        if 'branch' in rule and not fnmatch.fnmatch(facts['branch'], rule['branch']):
+            continue
+        if 'event' in rule and facts['event'] != rule['event']:
+            continue
+        if 'label' in rule:
+            if labels is None:
+                labels = set(fetch_labels() if fetch_labels else ())
+            if rule['label'] not in labels:
+                continue
+
+        return rule['lane']
+
+    return default_lane()
+
+
+class LanePicker():
+    """ Chooses which lane to dispatch from next.
+
+        The weighted policy uses smooth weighted round-robin: every pick,
+        each lane with work gains its weight in credit, and the lane with
+        the most credit is picked and pays back the total weight. Lanes
+        are picked in proportion to their weights, interleaved rather
+        than in runs.
+
+    :param: list configured_lanes: ``(lane, weight)`` tuples, highest
+                                   priority first.
+    :param: str lane_policy: ``strict`` or ``weighted``
+    """
+
+    def __init__(self, configured_lanes, lane_policy):
+        self.lanes = configured_lanes
+        self.policy = lane_policy
+        self.credit = {name: 0 for name, _ in configured_lanes}
+
+    def pick(self, active):
+        """ Picks a lane.
+
+        :param: set active: The lanes with work waiting.
+
+        :return: str: The lane, or None if no lane has work.
+        """
+        candidates = [(name, weight) for name, weight in self.lanes if name in active]
+        if not candidates:
+            return None
+
+        if self.policy == POLICY_STRICT:
+            return candidates[0][0]
+
+        total = 0
+        for name, weight in candidates:
+            self.credit[name] += weight
+            total += weight
+        # ``max`` keeps the first, highest priority, lane on ties
+        chosen = max(candidates, key=lambda candidate: self.credit[candidate[0]])[0]
+        self.credit[chosen] -= total
+
+        return chosen
+
+# kept between invocations, so the weighted policy stays fair when a
+# round only dispatches a few jobs
+_PICKER = None
+
+def picker():
+    """ The ``LanePicker`` for the configured lanes and policy.
+    """
+    global _PICKER
+
+    configured_lanes, lane_policy = lanes(), policy()
+    if (_PICKER is None or _PICKER.lanes != configured_lanes or
+        _PICKER.policy != lane_policy):
+            _PICKER = LanePicker(configured_lanes, lane_policy)
+
+    return _PICKER
+
+def lane_depths():
+    """ Records and returns the approximate number of messages in each
+        lane's queue.
+
+    :return: dict: Lane name to depth.
+    """
+    depths = {}
+    for name, _ in lanes():
+        try:
+            properties = check_queue.check_queue_client(name).get_queue_properties()
+            depths[name] = properties.approximate_message_count
+        except Exception as err:
+            logging.info(f'Failed to read the depth of lane {name}. Error: {err}')
+            depths[name] = None
+            continue
+        metrics.set_gauge('lane_depth', depths[name], lane=name)
+
+    return depths
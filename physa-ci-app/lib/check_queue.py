@@ -0,0 +1,221 @@
+import logging
+import os
+import random
+import time
+
+# pylint: disable=import-error
+from __app__.lib import message_codec, metrics, storage
+from __app__.lib.lazy_import import lazy_import
+
+queue = lazy_import('azure.storage.queue')
+
+CHECK_QUEUE = 'rosiepi-check-queue'
+# jobs waiting to be claimed by nodes (see ``job_claims``); unlike
+# ``rosiepi-check-queue``, it has no queue trigger.
+JOB_QUEUE = 'rosiepi-job-queue'
+
+MODE_PUSH = 'push'
+MODE_PULL = 'pull'
+
+# Azure Storage queues don't allow a visibility timeout past 7 days.
+_MAX_VISIBILITY = 7 * 24 * 3600
+
+def _config(name, default):
+    """ Reads a numeric check queue setting from the app settings.
+    """
+    try:
+        return float(os.environ.get(name, default))
+    except ValueError:
+        logging.info(f'Invalid value for {name}. Using default: {default}')
+        return default
+
+def retry_base_seconds():
+    """ Delay before the first retry of a job no node accepted. Each
+        further retry doubles it.
+    """
+    return _config('CHECK_RETRY_BASE_SECONDS', 30)
+
+def retry_max_seconds():
+    """ Longest delay between retries.
+    """
+    return _config('CHECK_RETRY_MAX_SECONDS', 600)
+
+def retry_deadline_seconds():
+    """ How long after the first failed dispatch a job is retried before
+        its check run is cancelled.
+    """
+    return _config('CHECK_RETRY_DEADLINE_SECONDS', 3600)
+
+def dispatch_mode():
+    """ How jobs get to nodes, from the ``CHECK_DISPATCH_MODE`` app
+        setting: ``push`` sends them to the nodes' ``/run-test``,
+        ``pull`` leaves them queued for nodes to claim.
+    """
+    mode = os.environ.get('CHECK_DISPATCH_MODE', MODE_PUSH)
+    if mode not in (MODE_PUSH, MODE_PULL):
+        logging.info(f'Invalid CHECK_DISPATCH_MODE: {mode}. Using push.')
+        mode = MODE_PUSH
+
+    return mode
+
+def queue_name(lane=None):
+    """ The check queue for a priority lane (see ``check_lanes``).
+        Without a lane, the ``rosiepi-check-queue`` is used, or the
+        ``rosiepi-job-queue`` in pull mode.
+    """
+    if not lane:
+        if dispatch_mode() == MODE_PULL:
+            return JOB_QUEUE
+        return CHECK_QUEUE
+
+    return f'{CHECK_QUEUE}-{lane}'
+
+def check_queue_client(lane=None):
+    """ Builds a ``QueueClient`` for the check queue, or a lane's
+        check queue. Message content is ``bytes`` (see
+        ``message_codec``).
+    """
+    queue_config = {
+        'message_encode_policy': queue.BinaryBase64EncodePolicy(),
+        'message_decode_policy': queue.BinaryBase64DecodePolicy(),
+    }
+
+    return queue.QueueClient.from_connection_string(
+        storage.connection_string(),
+        queue_name(lane),
+        **queue_config
+    )
+
+def send_check(check_info, delay=0):
+    """ Sends a check run message to the check queue of its lane. The
+        time it was first queued is recorded in ``enqueued_at``.
+
+    :param: dict check_info: The check run message
+    :param: int delay: Seconds before the message becomes visible
+
+    :return: queue.QueueMessage: The sent message.
+    """
+    check_info.setdefault('enqueued_at', time.time())
+
+    queue_client = check_queue_client(check_info.get('lane'))
+    with metrics.span('check_queue_send'):
+        sent_msg = queue_client.send_message(
+            message_codec.encode(check_info, kind='check'),
+            visibility_timeout=int(delay)
+        )
+    logging.info(f'Sent the following queue content: {check_info}')
+
+    return sent_msg
+
+def drop_malformed(queue_client, message, err):
+    """ Deletes a check queue message that can't be decoded, so that it
+        isn't received again by every dispatch round or claim. Its
+        content is logged, like malformed registrar entries.
+
+    :param: queue.QueueClient queue_client: The message's queue
+    :param: queue.QueueMessage message: The malformed message
+    :param: ValueError err: The error from ``message_codec.decode``
+    """
+    logging.info(
+        f'Removing malformed message from {queue_client.queue_name}. '
+        f'Error: {err}. Content: {message.content}'
+    )
+    metrics.incr('queue_malformed_total', queue=queue_client.queue_name)
+    try:
+        queue_client.delete_message(message)
+    except Exception as delete_err:
+        logging.info(f'Failed to remove malformed message {message.id}. Error: {delete_err}')
+
+def retry_delay(attempt):
+    """ The delay before a retry: exponential backoff, capped at
+        ``CHECK_RETRY_MAX_SECONDS``, with jitter so that jobs rejected
+        together aren't retried together.
+
+    :param: int attempt: The retry number, starting at 1
+    """
+    delay = min(
+        retry_base_seconds() * 2 ** (attempt - 1),
+        retry_max_seconds()
+    )
+
+    return random.uniform(delay / 2, delay)
+
+def record_attempt(check_info, now):
+    """ Records a failed dispatch in a check run message: increments
+        ``dispatch_attempts``, and sets ``dispatch_deadline`` on the
+        first failure.
+
+    :param: dict check_info: The check run message. Updated in place,
+                             unless the deadline has passed.
+    :param: float now: The current time, in seconds since the epoch.
+
+    :return: bool: Whether the job may still be retried.
+    """
+    attempt = int(check_info.get('dispatch_attempts', 0)) + 1
+    deadline = float(
+        check_info.get('dispatch_deadline', now + retry_deadline_seconds())
+    )
+    if now >= deadline:
+        logging.info(
+            f'Check run {check_info.get("check_run_id")} passed its dispatch '
+            f'deadline after {attempt - 1} retries.'
+        )
+        return False
+
+    check_info['dispatch_attempts'] = attempt
+    check_info['dispatch_deadline'] = deadline
+    metrics.incr('retries_total', operation='dispatch')
+
+    return True
+
+def retry_visibility(check_info, now):
+    """ How long a job is hidden before its next dispatch attempt,
+        once ``record_attempt`` has recorded the failed one. It is the
+        backoff delay, but no later than the dispatch deadline, so that a
+        last attempt is always made at the deadline.
+
+    :param: dict check_info: The check run message
+    :param: float now: The current time, in seconds since the epoch.
+
+    :return: float: Seconds
+    """
+    return min(
+        retry_delay(check_info['dispatch_attempts']),
+        check_info['dispatch_deadline'] - now,
+        _MAX_VISIBILITY
+    )
+
+def schedule_retry(check_info, now=None):
+    """ Puts a job that no node accepted back on the check queue, after
+        a backoff delay. ``check_info`` records the retry count
+        (``dispatch_attempts``) and when to stop retrying
+        (``dispatch_deadline``).
+
+    :param: dict check_info: The check run message. Updated in place.
+    :param: float now: The current time, in seconds since the epoch.
+
+    :return: bool: Whether the job was requeued. False once the deadline
+                   has passed, or if the queue couldn't be reached.
+    """
+    if now is None:
+        now = time.time()
+
+    if not record_attempt(check_info, now):
+        return False
+
+    attempt = check_info['dispatch_attempts']
+    delay = retry_visibility(check_info, now)
+
+    try:
+        send_check(check_info, delay=delay)
+    except Exception as err:
+        logging.info(f'Error requeueing check run message: {err}')
+        return False
+
+    metrics.incr('check_requeue_total', lane=check_info.get('lane') or 'none')
+    logging.info(
+        f'Requeued check run {check_info.get("check_run_id")} '
+        f'(attempt {attempt}, delay {delay:.0f}s)'
+    )
+
+    return True
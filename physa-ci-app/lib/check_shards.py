@@ -0,0 +1,360 @@
+import json
+import logging
+import os
+
+from dataclasses import dataclass
+from datetime import datetime
+
+# pylint: disable=import-error
+from __app__.lib import metrics, node_db, result, result_chunks, storage
+from __app__.lib.lazy_import import lazy_import
+
+azure_common = lazy_import('azure.common')
+table_models = lazy_import('azure.cosmosdb.table.models')
+tableservice = lazy_import('azure.cosmosdb.table.tableservice')
+
+_SHARD_TABLE = 'rosiepishards'
+_PARTITION = 'shards'
+
+# the ``node_name`` (and results table ``PartitionKey``) of a sharded
+# run's merged result
+MERGED_NODE_NAME = 'sharded'
+
+# most to least severe; a sharded run takes the most severe conclusion
+# of its shards
+_CONCLUSIONS = (
+    'failure', 'timed_out', 'action_required', 'cancelled', 'neutral',
+    'skipped', 'success',
+)
+
+# attempts at recording a report when another write wins the race
+_UPDATE_ATTEMPTS = 5
+
+def _config(name, default):
+    """ Reads a numeric sharding setting from the app settings.
+    """
+    try:
+        return int(os.environ.get(name, default))
+    except ValueError:
+        logging.info(f'Invalid value for {name}. Using default: {default}')
+        return default
+
+def max_shards():
+    """ Most nodes a check run's boards are split across. With 1 (the
+        default), each check run goes to a single node.
+    """
+    return max(1, _config('CHECK_SHARDS_MAX', 1))
+
+def enabled():
+    """ Whether check runs are split across nodes.
+    """
+    return max_shards() > 1
+
+def _table():
+    return tableservice.TableService(connection_string=storage.connection_string())
+
+def _row_key(check_run_id):
+    check_run_id = str(check_run_id)
+    padding = '0'*(50 - len(check_run_id))
+
+    return f'{padding}{check_run_id}'
+
+def plan(nodes, boards=None, limit=None):
+    """ Splits a check run's boards across nodes. Nodes are chosen by how
+        many of the boards still to be placed they have, ties going to
+        the earlier node; each board is then given to the chosen node
+        with the fewest boards so far, so that the shards finish at about
+        the same time.
+
+    :param: list nodes: ``NodeItem``, in dispatch order
+    :param: list boards: The boards to test. The boards of all ``nodes``,
+                         if None.
+    :param: int limit: Most shards. ``max_shards()``, if None.
+
+    :return: list: The shards, as dicts of ``node_name`` and ``boards``.
+             Boards that none of the chosen nodes have are left out.
+    """
+    if limit is None:
+        limit = max_shards()
+
+    candidates = [(node.node_name, set(node.boards or ())) for node in nodes]
+    if boards:
+        wanted = set(boards)
+    else:
+        wanted = set().union(*(held for _, held in candidates))
+
+    chosen = []
+    unplaced = set(wanted)
+    while unplaced and candidates and len(chosen) < limit:
+        best = max(candidates, key=lambda candidate: len(candidate[1] & unplaced))
+        if not best[1] & unplaced:
+            break
+        chosen.append(best)
+        candidates.remove(best)
+        unplaced -= best[1]
+
+    assigned = {node_name: [] for node_name, _ in chosen}
+    holders = {
+        board: [node_name for node_name, held in chosen if board in held]
+        for board in wanted - unplaced
+    }
+    # boards few nodes have are placed first, while those nodes have room
+    for board in sorted(holders, key=lambda board: (len(holders[board]), board)):
+        node_name = min(holders[board], key=lambda name: len(assigned[name]))
+        assigned[node_name].append(board)
+
+    return [
+        {'node_name': node_name, 'boards': sorted(assigned[node_name])}
+        for node_name, _ in chosen if assigned[node_name]
+    ]
+
+def merge_conclusion(conclusions):
+    """ The conclusion of a sharded run: the most severe of its shards'.
+        Unknown conclusions count as ``neutral``.
+    """
+    merged = None
+    for conclusion in conclusions:
+        if conclusion not in _CONCLUSIONS:
+            conclusion = 'neutral'
+        if merged is None or _CONCLUSIONS.index(conclusion) < _CONCLUSIONS.index(merged):
+            merged = conclusion
+
+    return merged or 'neutral'
+
+@dataclass
+class ShardedRun:
+    """ A check run split across nodes. Each shard is a dict of its
+        ``node_name``, ``boards``, ``status`` and, once completed, its
+        ``conclusion`` and ``summary``.
+    """
+    check_run_id: str
+    shards: list
+    check_info: dict = None
+    status: str = 'queued'
+    etag: str = None
+
+    def shard(self, node_name):
+        for shard in self.shards:
+            if shard['node_name'] == node_name:
+                return shard
+
+        return None
+
+    @property
+    def complete(self):
+        return all(shard.get('status') == 'completed' for shard in self.shards)
+
+    @property
+    def untested(self):
+        return (self.check_info or {}).get('shard_untested_boards') or []
+
+    @property
+    def conclusion(self):
+        """ The most severe conclusion of the shards. A run that left
+            boards untested is at best ``action_required``, so that it
+            can't pass without them.
+        """
+        conclusions = [shard.get('conclusion') for shard in self.shards]
+        if self.untested:
+            conclusions.append('action_required')
+
+        return merge_conclusion(conclusions)
+
+def _write(table, run):
+    entity = table_models.Entity()
+    entity.PartitionKey = _PARTITION
+    entity.RowKey = _row_key(run.check_run_id)
+    entity.status = run.status
+    entity.shards = json.dumps(run.shards)
+    entity.check_info = json.dumps(run.check_info or {})
+
+    with metrics.span('shard_write'):
+        if run.etag is None:
+            run.etag = table.insert_entity(_SHARD_TABLE, entity)
+        else:
+            run.etag = table.update_entity(_SHARD_TABLE, entity, if_match=run.etag)
+
+def get(check_run_id, table=None):
+    """ Reads a sharded run.
+
+    :return: ShardedRun, or None if the check run isn't sharded.
+    """
+    table = table or _table()
+    try:
+        with metrics.span('shard_read'):
+            entity = table.get_entity(_SHARD_TABLE, _PARTITION, _row_key(check_run_id))
+    except azure_common.AzureHttpError as err:
+        if err.status_code == 404:
+            return None
+        raise
+
+    return ShardedRun(
+        check_run_id=entity['RowKey'].lstrip('0'),
+        shards=json.loads(entity.get('shards', '[]')),
+        check_info=json.loads(entity.get('check_info', '{}')),
+        status=entity.get('status', 'queued'),
+        etag=entity.get('etag'),
+    )
+
+def record(check_info, shards, untested=()):
+    """ Records a check run's shards, once their nodes accepted them.
+
+    :param: dict check_info: The check run message
+    :param: list shards: The accepted shards (see ``plan``)
+    :param: untested: Boards left out of the run, e.g. because their
+                      shard's node didn't accept it.
+
+    :return: bool: Whether the run was recorded.
+    """
+    run = ShardedRun(
+        check_run_id=str(check_info['check_run_id']),
+        shards=[
+            {'node_name': shard['node_name'], 'boards': shard['boards'], 'status': 'queued'}
+            for shard in shards
+        ],
+        check_info=dict(check_info, shard_untested_boards=sorted(untested)),
+    )
+    try:
+        _write(_table(), run)
+    except Exception as err:
+        logging.info(f'Failed to record shards of job {run.check_run_id}. Error: {err}')
+        return False
+
+    metrics.observe('check_shards', len(shards), buckets=(1, 2, 3, 4, 6, 8, 12, 16))
+
+    return True
+
+def report(results, github_check_message):
+    """ Records a node's report on its shard of a check run, and returns
+        the check run update to send for it. The check run goes
+        ``in_progress`` with its first started shard, and is completed
+        once, with the merged results (see ``merge_results``), when its
+        last shard completes; other reports send nothing.
+
+    :param: dict results: The shard's stored result
+    :param: dict github_check_message: The update from the node's report
+
+    :return: dict: The check run update, or None. A check run that isn't
+                   sharded gets the node's own update back.
+    """
+    check_run_id = str(results['check_run_id'])
+    node_name = results['node_name']
+    status = github_check_message.get('status')
+
+    table = _table()
+    for _ in range(_UPDATE_ATTEMPTS):
+        try:
+            run = get(check_run_id, table)
+            if run is None:
+                return github_check_message
+            shard = run.shard(node_name)
+            if (shard is None or shard.get('status') == 'completed' or
+                    status not in ('in_progress', 'completed')):
+                return None
+
+            shard['status'] = status
+            if status == 'completed':
+                shard['conclusion'] = github_check_message.get('conclusion')
+                shard['summary'] = (github_check_message.get('output') or {}).get('summary')
+            previous_status = run.status
+            run.status = 'completed' if run.complete else 'in_progress'
+            _write(table, run)
+            break
+        except azure_common.AzureHttpError as err:
+            if err.status_code not in (409, 412):
+                logging.info(f'Failed to record shard report for job {check_run_id}. Error: {err}')
+                return None
+            metrics.incr('shard_update_conflicts_total')
+    else:
+        logging.info(f'Gave up recording shard report for job {check_run_id}.')
+        return None
+
+    if run.status == previous_status:
+        return None
+    if run.status == 'in_progress':
+        return {
+            'status': 'in_progress',
+            'output': {
+                'title': 'RosiePi',
+                'summary': f'RosiePi job is running on {len(run.shards)} nodes.',
+            },
+        }
+
+    merge_results(run)
+    metrics.incr('check_shards_completed_total', conclusion=run.conclusion)
+
+    return completed_message(run)
+
+def completed_message(run):
+    """ The check run update for a completed sharded run.
+    """
+    lines = [f'RosiePi job ran on {len(run.shards)} nodes.', '']
+    for shard in run.shards:
+        lines.append(
+            f'- {shard["node_name"]} ({", ".join(shard["boards"])}): '
+            f'{shard.get("conclusion")}'
+        )
+    if run.untested:
+        lines.extend(['', f'Not tested: {", ".join(run.untested)}'])
+
+    return {
+        'status': 'completed',
+        'conclusion': run.conclusion,
+        'completed_at': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'output': {
+            'title': 'RosiePi',
+            'summary': '\n'.join(lines),
+        },
+    }
+
+def merge_results(run):
+    """ Adds a completed sharded run's merged result to the results
+        table, under ``MERGED_NODE_NAME``. Its ``node_results`` are the
+        board tests of all shards, each with the ``node_name`` that ran
+        it.
+
+    :return: bool: Whether the merged result was stored.
+    """
+    board_tests = []
+    for shard in run.shards:
+        try:
+            entity = node_db.get_result(shard['node_name'], run.check_run_id)
+            shard_tests = entity.get('node_results')
+            if shard_tests is None and entity.get('node_results_chunked'):
+                shard_tests = result_chunks.iter_board_tests(
+                    run.check_run_id, shard['node_name']
+                )
+        except Exception as err:
+            logging.info(
+                f'Failed to read shard result of job {run.check_run_id} '
+                f'from {shard["node_name"]}. Error: {err}'
+            )
+            continue
+        for board_test in shard_tests or ():
+            board_tests.append(dict(board_test, node_name=shard['node_name']))
+
+    check_info = dict(run.check_info or {})
+    check_info.update({
+        'node_name': MERGED_NODE_NAME,
+        'check_run_external_id': (
+            f'{MERGED_NODE_NAME}:{check_info.get("check_run_head_sha")}'
+        ),
+        'check_run_status': 'completed',
+        'check_run_conclusion': run.conclusion,
+        'check_run_completed_at': datetime.utcnow().strftime('%Y-%m-%dT%H:%M:%SZ'),
+        'shards': [
+            {key: shard.get(key) for key in ('node_name', 'boards', 'conclusion')}
+            for shard in run.shards
+        ],
+        'node_results': board_tests,
+    })
+
+    merged = result.Result(check_info)
+    if not merged.results:
+        return False
+    entity = merged.results_to_table_entity()
+    stored = node_db.add_result(entity) or node_db.update_result(entity)
+    if not stored:
+        logging.info(f'Failed to store merged result of job {run.check_run_id}.')
+
+    return bool(stored)
@@ -0,0 +1,285 @@
+import logging
+import os
+import threading
+
+from contextlib import contextmanager
+
+# pylint: disable=import-error
+from __app__.lib import app_client, metrics
+
+# REST check run fields, and their ``UpdateCheckRunInput`` names
+_GRAPHQL_FIELDS = {
+    'name': 'name',
+    'details_url': 'detailsUrl',
+    'external_id': 'externalId',
+    'started_at': 'startedAt',
+    'completed_at': 'completedAt',
+    'actions': 'actions',
+}
+_GRAPHQL_ENUMS = {
+    'status': 'status',
+    'conclusion': 'conclusion',
+}
+_GRAPHQL_OUTPUT = ('title', 'summary', 'text')
+
+# the batch collecting updates in this thread, if any (see ``batched``)
+_ACTIVE = threading.local()
+
+def batch_size():
+    """ Most check run updates sent in one GraphQL request.
+    """
+    try:
+        return max(int(os.environ.get('GITHUB_GRAPHQL_BATCH', 20)), 1)
+    except ValueError:
+        logging.info('Invalid value for GITHUB_GRAPHQL_BATCH. Using default: 20')
+        return 20
+
+def graphql_input(check_info, message):
+    """ Translates a REST check run update into an ``UpdateCheckRunInput``.
+
+    :param: dict check_info: The check run message. Needs the check
+                             run's and repository's GraphQL IDs.
+    :param: dict message: The REST update
+
+    :return: dict: The input, or None if the update can only be sent
+                   through REST (e.g. it has annotations).
+    """
+    check_run_id = check_info.get('check_run_node_id')
+    repository_id = check_info.get('repository_node_id')
+    if not (check_run_id and repository_id):
+        return None
+
+    update = {'checkRunId': check_run_id, 'repositoryId': repository_id}
+    for key, value in message.items():
+        if key in _GRAPHQL_FIELDS:
+            update[_GRAPHQL_FIELDS[key]] = value
+        elif key in _GRAPHQL_ENUMS:
+            update[_GRAPHQL_ENUMS[key]] = str(value).upper()
+        elif key == 'output':
+            if set(value) - set(_GRAPHQL_OUTPUT):
+                return None
+            update['output'] = value
+        else:
+            return None
+
+    return update
+
+
+class CheckRunUpdate():
+    """ A check run update, sent now or in a ``CheckRunBatch``. Its
+        outcome is set when it is sent.
+
+    :param: dict check_info: The check run message
+    :param: dict message: The REST update
+    :param: on_error: Called with the update if it fails, once it is
+                      sent.
+    """
+
+    def __init__(self, check_info, message, on_error=None):
+        self.check_info = check_info
+        self.message = message
+        self.on_error = on_error
+        self.status_code = None
+        self.errors = []
+        self.transport = None
+
+    @property
+    def ok(self):
+        return self.status_code is not None and self.status_code < 400
+
+    def finish(self):
+        """ Handles the update's outcome, once it is sent: a failed
+            update is counted, and passed to its ``on_error``.
+        """
+        if self.ok:
+            return
+
+        metrics.incr('check_run_update_failures_total', transport=self.transport or 'none')
+        if self.on_error is not None:
+            try:
+                self.on_error(self)
+            except Exception as err:
+                logging.info(
+                    f'Failed to handle failed update of check run '
+                    f'{self.check_info.get("check_run_id")}. Error: {err}'
+                )
+
+
+class CheckRunBatch():
+    """ Collects check run updates, and sends the updates for each
+        installation as combined ``updateCheckRun`` GraphQL mutations.
+        Updates that GraphQL can't express, or batches GraphQL rejects
+        as a whole, are sent through REST.
+    """
+
+    def __init__(self):
+        self.updates = []
+
+    def add(self, check_info, message, on_error=None):
+        """ Adds an update to the batch. A full batch is sent straight
+            away, so that updates aren't held back long enough to land
+            after a node's own report on the check run.
+
+        :return: CheckRunUpdate
+        """
+        update = CheckRunUpdate(check_info, message, on_error)
+        self.updates.append(update)
+        if len(self.updates) >= batch_size():
+            self.send()
+
+        return update
+
+    def send(self):
+        """ Sends the batch's updates.
+
+        :return: list: The ``CheckRunUpdate``s, with their outcomes.
+        """
+        installations = {}
+        for update in self.updates:
+            installation_id = update.check_info.get('installation_id')
+            installations.setdefault(installation_id, []).append(update)
+
+        for installation_id, updates in installations.items():
+            self._send_installation(installation_id, updates)
+
+        sent, self.updates = self.updates, []
+        for update in sent:
+            update.finish()
+
+        return sent
+
+    def _send_installation(self, installation_id, updates):
+        client = app_client.GithubClient()
+        client.installation_token = client.create_installation_app_token(
+            {'installation': {'id': installation_id}}
+        )
+        if not client.installation_token:
+            logging.info(
+                f'Check runs not updated. No installation token available for '
+                f'installation {installation_id}.'
+            )
+            for update in updates:
+                update.status_code = 401
+            return
+
+        rest = []
+        graphql = []
+        for update in updates:
+            update_input = graphql_input(update.check_info, update.message)
+            if update_input is None:
+                rest.append(update)
+            else:
+                graphql.append((update, update_input))
+
+        size = batch_size()
+        for start in range(0, len(graphql), size):
+            chunk = graphql[start:start + size]
+            # a single update costs one call either way
+            if len(chunk) == 1 or not self._send_graphql(client, chunk):
+                rest.extend(update for update, _ in chunk)
+
+        for update in rest:
+            client.payload = update.check_info
+            update.status_code = client.update_check_run(update.message)
+            update.transport = 'rest'
+            metrics.incr('check_run_updates_total', transport='rest')
+
+    @staticmethod
+    def _send_graphql(client, chunk):
+        """ Sends a chunk of updates as one GraphQL request. Errors for
+            one update are recorded on that update.
+
+        :return: bool: False if the request failed as a whole.
+        """
+        variables = {}
+        declarations = []
+        fields = []
+        for index, (_, update_input) in enumerate(chunk):
+            variables[f'i{index}'] = update_input
+            declarations.append(f'$i{index}: UpdateCheckRunInput!')
+            fields.append(f'u{index}: updateCheckRun(input: $i{index}) {{ checkRun {{ id }} }}')
+        query = f'mutation({", ".join(declarations)}) {{ {" ".join(fields)} }}'
+
+        try:
+            response = client.graphql(query, variables)
+            body = response.json() if response.ok else {}
+        except Exception as err:
+            logging.info(f'GraphQL check run update failed. Error: {err}')
+            return False
+
+        data = body.get('data')
+        if not data:
+            logging.info(
+                f'GraphQL check run update failed. Status: {response.status_code} '
+                f'Response: {response.text}'
+            )
+            return False
+
+        errors = {}
+        for error in body.get('errors', []):
+            alias = (error.get('path') or [None])[0]
+            errors.setdefault(alias, []).append(error.get('message'))
+
+        for index, (update, _) in enumerate(chunk):
+            update.transport = 'graphql'
+            if data.get(f'u{index}'):
+                update.status_code = 200
+            else:
+                update.status_code = 422
+                update.errors = errors.get(f'u{index}', ['Check run not updated.'])
+                logging.info(
+                    f'Failed to update check run {update.check_info.get("check_run_id")}: '
+                    f'{update.errors}'
+                )
+
+        metrics.incr('check_run_updates_total', len(chunk), transport='graphql')
+        metrics.observe('check_run_update_batch_size', len(chunk), buckets=(1, 2, 5, 10, 20, 50, 100))
+
+        return True
+
+def update_check_run(check_info, message, on_error=None):
+    """ Updates a check run: added to the active batch, if any (see
+        ``batched``), otherwise sent now.
+
+    :param: dict check_info: The check run message
+    :param: dict message: The REST check run update
+    :param: on_error: Called with the ``CheckRunUpdate`` if it fails.
+                      In a batch, that is when the batch is sent.
+
+    :return: CheckRunUpdate: In a batch, its outcome is only set once
+                             the batch is sent.
+    """
+    batch = active_batch()
+    if batch is not None:
+        return batch.add(check_info, message, on_error)
+
+    update = CheckRunUpdate(check_info, message, on_error)
+    event_client = app_client.GithubClient()
+    event_client.payload = check_info
+    update.status_code = event_client.update_check_run(message)
+    update.transport = 'rest'
+    update.finish()
+
+    return update
+
+def active_batch():
+    """ The batch collecting this thread's check run updates, or None
+        outside of ``batched()``.
+    """
+    return getattr(_ACTIVE, 'batch', None)
+
+@contextmanager
+def batched():
+    """ Collects the check run updates made through ``update_check_run``
+        in the block, and sends them together when it exits.
+
+    :return: CheckRunBatch
+    """
+    batch = CheckRunBatch()
+    previous = active_batch()
+    _ACTIVE.batch = batch
+    try:
+        yield batch
+    finally:
+        _ACTIVE.batch = previous
+        batch.send()
@@ -0,0 +1,444 @@
+import json
+import logging
+import os
+import time
+
+from dataclasses import dataclass
+
+# pylint: disable=import-error
+from __app__.lib import metrics, storage
+from __app__.lib.lazy_import import lazy_import
+
+azure_common = lazy_import('azure.common')
+table_models = lazy_import('azure.cosmosdb.table.models')
+tableservice = lazy_import('azure.cosmosdb.table.tableservice')
+
+_DISPATCH_TABLE = 'rosiepidispatch'
+_PARTITION = 'dispatch'
+
+# a dispatch attempt is being made; no node has the job
+STATE_PENDING = 'pending'
+# the last attempt ended without a node taking the job, or the job was
+# taken back from its node; the next attempt can be made
+STATE_WAITING = 'waiting'
+# the last attempt's request to ``node_name`` failed after it was sent,
+# so the node may have taken the job
+STATE_UNCERTAIN = 'uncertain'
+# ``node_name`` owns the job
+STATE_OWNED = 'owned'
+# the job is split across nodes (see ``check_shards``); ``node_name``
+# lists them, comma separated, and each owns its shard
+STATE_SHARDED = 'sharded'
+
+# ``reconcile`` outcomes for a node's report
+OWNER = 'owner'
+ADOPTED = 'adopted'
+CONFLICT = 'conflict'
+UNKNOWN = 'unknown'
+
+# attempts at taking ownership when another write wins the race
+_ASSIGN_ATTEMPTS = 3
+
+def _config(name, default):
+    """ Reads a numeric dispatch ledger setting from the app settings.
+    """
+    try:
+        return float(os.environ.get(name, default))
+    except ValueError:
+        logging.info(f'Invalid value for {name}. Using default: {default}')
+        return default
+
+def uncertain_hold_seconds():
+    """ How long a job is held for a node that may have taken it (see
+        ``STATE_UNCERTAIN``). Until then, the job is only offered to that
+        node again; after it, the job is dispatched to any node.
+    """
+    return _config('DISPATCH_UNCERTAIN_SECONDS', 600)
+
+def pending_hold_seconds():
+    """ How long a job's pending attempt is left to the dispatcher
+        making it (see ``STATE_PENDING``). Until then, other dispatches
+        of the job wait; after it, the dispatcher is taken to have died
+        mid-attempt.
+    """
+    return _config('DISPATCH_PENDING_SECONDS', 120)
+
+def idempotency_key(check_run_id, attempt):
+    """ The key sent with a dispatch attempt. A node given the same key
+        twice is being asked for the same attempt, and should answer as
+        it did the first time rather than run the job again.
+    """
+    return f'rosiepi-{check_run_id}-{attempt}'
+
+def _table():
+    return tableservice.TableService(connection_string=storage.connection_string())
+
+def _row_key(check_run_id):
+    check_run_id = str(check_run_id)
+    padding = '0'*(50 - len(check_run_id))
+
+    return f'{padding}{check_run_id}'
+
+@dataclass
+class Dispatch:
+    """ A job's entry in the dispatch ledger.
+    """
+    check_run_id: str
+    attempt: int = 1
+    state: str = STATE_PENDING
+    node_name: str = None
+    updated_at: float = 0
+    check_info: dict = None
+    # the node the job was last given to, or that may have taken it;
+    # kept while the job is pending or waiting, so that the node can
+    # still adopt it (see ``ownership``)
+    dispatched_to: str = None
+    etag: str = None
+
+    @property
+    def idempotency_key(self):
+        return idempotency_key(self.check_run_id, self.attempt)
+
+    def holding(self, now=None):
+        """ Whether the job is held for the node of an uncertain attempt.
+        """
+        if self.state != STATE_UNCERTAIN:
+            return False
+        if now is None:
+            now = time.time()
+
+        return now < self.updated_at + uncertain_hold_seconds()
+
+    def in_flight(self, now=None):
+        """ Whether a dispatcher is making the job's current attempt.
+        """
+        if self.state != STATE_PENDING:
+            return False
+        if now is None:
+            now = time.time()
+
+        return now < self.updated_at + pending_hold_seconds()
+
+    def ownership(self, node_name):
+        """ How a report on the job from ``node_name`` is treated: from
+            its ``OWNER``; ``ADOPTED`` by the node the job was dispatched
+            to, if it wasn't confirmed (e.g. its dispatch timed out) and
+            no node owns the job; otherwise a ``CONFLICT``.
+        """
+        if self.state == STATE_OWNED:
+            return OWNER if self.node_name == node_name else CONFLICT
+        if self.state == STATE_SHARDED:
+            return OWNER if node_name in self.node_name.split(',') else CONFLICT
+        if self.state == STATE_UNCERTAIN:
+            return ADOPTED if self.node_name == node_name else CONFLICT
+
+        return ADOPTED if self.dispatched_to == node_name else CONFLICT
+
+def _to_dispatch(entity):
+    check_info = entity.get('check_info')
+    return Dispatch(
+        check_run_id=entity['RowKey'].lstrip('0'),
+        attempt=entity.get('attempt', 1),
+        state=entity.get('state', STATE_PENDING),
+        node_name=entity.get('node_name'),
+        updated_at=entity.get('updated_at', 0),
+        check_info=json.loads(check_info) if check_info else None,
+        dispatched_to=entity.get('dispatched_to'),
+        etag=entity.get('etag'),
+    )
+
+def _write(table, dispatch):
+    """ Stores a dispatch: inserted if it has no etag, otherwise updated
+        if it hasn't changed since it was read. Raises an
+        ``AzureHttpError`` with a 409 or 412 ``status_code`` if another
+        write got there first.
+    """
+    entity = table_models.Entity()
+    entity.PartitionKey = _PARTITION
+    entity.RowKey = _row_key(dispatch.check_run_id)
+    entity.attempt = dispatch.attempt
+    entity.state = dispatch.state
+    entity.node_name = dispatch.node_name
+    entity.updated_at = dispatch.updated_at
+    if dispatch.check_info is not None:
+        entity.check_info = json.dumps(dispatch.check_info)
+    if dispatch.dispatched_to is not None:
+        entity.dispatched_to = dispatch.dispatched_to
+
+    with metrics.span('dispatch_ledger_write'):
+        if dispatch.etag is None:
+            dispatch.etag = table.insert_entity(_DISPATCH_TABLE, entity)
+        else:
+            dispatch.etag = table.update_entity(_DISPATCH_TABLE, entity, if_match=dispatch.etag)
+
+def get(check_run_id, table=None):
+    """ Reads a job's entry in the dispatch ledger.
+
+    :return: Dispatch, or None if the job has no entry.
+    """
+    table = table or _table()
+    try:
+        with metrics.span('dispatch_ledger_read'):
+            entity = table.get_entity(_DISPATCH_TABLE, _PARTITION, _row_key(check_run_id))
+    except azure_common.AzureHttpError as err:
+        if err.status_code == 404:
+            return None
+        raise
+
+    return _to_dispatch(entity)
+
+def _next_attempt(dispatch, check_info, now):
+    dispatch.attempt += 1
+    dispatch.state = STATE_PENDING
+    dispatch.node_name = None
+    dispatch.updated_at = now
+    dispatch.check_info = check_info
+
+def begin(check_info, now=None):
+    """ Starts a dispatch attempt for a job. A job without a ledger entry
+        gets one. A job owned by a node, or held for a node (see
+        ``Dispatch.holding``), is returned as it is. A job whose attempt
+        another dispatcher is making (see ``Dispatch.in_flight``) isn't
+        dispatched. Otherwise a new attempt, with a new idempotency key,
+        is recorded.
+
+    :param: dict check_info: The check run message. Kept with the entry,
+                             so that a node's report can be reconciled
+                             (see ``reconcile``).
+
+    :return: Dispatch, or None if another dispatch of the job is in
+             flight, or wrote to the ledger first. If the ledger can't be
+             reached, the attempt is returned without being recorded.
+    """
+    if now is None:
+        now = time.time()
+    check_run_id = str(check_info['check_run_id'])
+
+    try:
+        table = _table()
+        dispatch = get(check_run_id, table)
+        if dispatch is None:
+            dispatch = Dispatch(check_run_id, updated_at=now, check_info=check_info)
+        elif dispatch.state in (STATE_OWNED, STATE_SHARDED) or dispatch.holding(now):
+            return dispatch
+        elif dispatch.in_flight(now):
+            logging.info(f'Job {check_run_id} is being dispatched elsewhere.')
+            metrics.incr('dispatch_in_flight_total')
+            return None
+        else:
+            if dispatch.state == STATE_UNCERTAIN:
+                metrics.incr('dispatch_uncertain_expired_total')
+            _next_attempt(dispatch, check_info, now)
+        _write(table, dispatch)
+    except azure_common.AzureHttpError as err:
+        if err.status_code in (409, 412):
+            logging.info(f'Job {check_run_id} is being dispatched elsewhere.')
+            metrics.incr('dispatch_ledger_conflicts_total')
+            return None
+        logging.info(f'Failed to record dispatch of job {check_run_id}. Error: {err}')
+        return Dispatch(check_run_id, updated_at=now, check_info=check_info)
+    except Exception as err:
+        logging.info(f'Failed to record dispatch of job {check_run_id}. Error: {err}')
+        return Dispatch(check_run_id, updated_at=now, check_info=check_info)
+
+    return dispatch
+
+def retry(dispatch, now=None):
+    """ Records a new attempt for a job that was held for a node, after
+        the node answered that it doesn't have it.
+
+    :return: Dispatch, or None if another dispatch of the job wrote to
+             the ledger first.
+    """
+    _next_attempt(dispatch, dispatch.check_info, time.time() if now is None else now)
+    dispatch.dispatched_to = None
+    if dispatch.etag is None:
+        return dispatch
+
+    try:
+        _write(_table(), dispatch)
+    except azure_common.AzureHttpError as err:
+        if err.status_code in (409, 412):
+            metrics.incr('dispatch_ledger_conflicts_total')
+            return None
+        logging.info(f'Failed to record dispatch of job {dispatch.check_run_id}. Error: {err}')
+    except Exception as err:
+        logging.info(f'Failed to record dispatch of job {dispatch.check_run_id}. Error: {err}')
+
+    return dispatch
+
+def mark_uncertain(dispatch, node_name, now=None):
+    """ Records that a dispatch attempt's request to a node failed after
+        it was sent, so the node may have taken the job.
+    """
+    if dispatch.etag is None:
+        return
+    if dispatch.state == STATE_UNCERTAIN and dispatch.node_name == node_name:
+        # still held from the first failure; the hold isn't extended
+        return
+
+    dispatch.state = STATE_UNCERTAIN
+    dispatch.node_name = node_name
+    dispatch.dispatched_to = node_name
+    dispatch.updated_at = time.time() if now is None else now
+    try:
+        _write(_table(), dispatch)
+    except Exception as err:
+        logging.info(
+            f'Failed to record uncertain dispatch of job {dispatch.check_run_id} '
+            f'to {node_name}. Error: {err}'
+        )
+    metrics.incr('dispatch_uncertain_total')
+
+def mark_waiting(dispatch, now=None):
+    """ Records that a dispatch attempt ended without a node taking the
+        job, so that its next attempt needn't wait for the pending hold.
+    """
+    if dispatch.etag is None or dispatch.state != STATE_PENDING:
+        return
+
+    dispatch.state = STATE_WAITING
+    dispatch.updated_at = time.time() if now is None else now
+    try:
+        _write(_table(), dispatch)
+    except Exception as err:
+        # another dispatch of the job wrote first, or the ledger can't be
+        # reached; the pending hold runs out on its own
+        logging.info(
+            f'Failed to record waiting dispatch of job {dispatch.check_run_id}. '
+            f'Error: {err}'
+        )
+
+def assign(check_run_id, node_name, takeover=False):
+    """ Records that a node owns a job.
+
+    :param: bool takeover: Take the job from the node that owns it, e.g.
+                           when its claim ran out (see ``job_claims``).
+
+    :return: bool: False if another node owns the job.
+    """
+    check_run_id = str(check_run_id)
+    table = _table()
+    for _ in range(_ASSIGN_ATTEMPTS):
+        try:
+            dispatch = get(check_run_id, table) or Dispatch(check_run_id)
+            if dispatch.ownership(node_name) == OWNER:
+                return True
+            if dispatch.state in (STATE_OWNED, STATE_SHARDED) and not takeover:
+                logging.info(f'Job {check_run_id} is owned by {dispatch.node_name}.')
+                return False
+
+            dispatch.state = STATE_OWNED
+            dispatch.node_name = node_name
+            dispatch.dispatched_to = node_name
+            dispatch.updated_at = time.time()
+            _write(table, dispatch)
+            return True
+        except azure_common.AzureHttpError as err:
+            if err.status_code not in (409, 412):
+                logging.info(f'Failed to record owner of job {check_run_id}. Error: {err}')
+                return True
+            metrics.incr('dispatch_ledger_conflicts_total')
+        except Exception as err:
+            logging.info(f'Failed to record owner of job {check_run_id}. Error: {err}')
+            return True
+
+    return False
+
+def assign_shards(check_run_id, node_names):
+    """ Records that a job was split across nodes, each owning its
+        shard.
+
+    :return: bool: False if a node owns the job.
+    """
+    check_run_id = str(check_run_id)
+    table = _table()
+    for _ in range(_ASSIGN_ATTEMPTS):
+        try:
+            dispatch = get(check_run_id, table) or Dispatch(check_run_id)
+            if dispatch.state == STATE_OWNED:
+                logging.info(f'Job {check_run_id} is owned by {dispatch.node_name}.')
+                return False
+
+            dispatch.state = STATE_SHARDED
+            dispatch.node_name = ','.join(node_names)
+            dispatch.updated_at = time.time()
+            _write(table, dispatch)
+            return True
+        except azure_common.AzureHttpError as err:
+            if err.status_code not in (409, 412):
+                logging.info(f'Failed to record shards of job {check_run_id}. Error: {err}')
+                return True
+            metrics.incr('dispatch_ledger_conflicts_total')
+        except Exception as err:
+            logging.info(f'Failed to record shards of job {check_run_id}. Error: {err}')
+            return True
+
+    return False
+
+def release(check_run_id, node_name, check_info=None, now=None):
+    """ Takes a job back from a node that stopped responding (see
+        ``job_sweeper``), so that the job's next attempt can be made.
+
+    :param: dict check_info: Kept with the entry in place of its check
+                             run message, if supplied.
+
+    :return: Dispatch, or None if the node doesn't own the job, or
+             another write to the ledger got there first.
+    """
+    check_run_id = str(check_run_id)
+    try:
+        table = _table()
+        dispatch = get(check_run_id, table)
+        if dispatch is None:
+            return Dispatch(check_run_id, check_info=check_info)
+        if dispatch.state != STATE_OWNED or dispatch.node_name != node_name:
+            return None
+
+        dispatch.state = STATE_WAITING
+        dispatch.dispatched_to = node_name
+        dispatch.node_name = None
+        dispatch.updated_at = time.time() if now is None else now
+        dispatch.check_info = check_info or dispatch.check_info
+        _write(table, dispatch)
+    except azure_common.AzureHttpError as err:
+        if err.status_code in (409, 412):
+            metrics.incr('dispatch_ledger_conflicts_total')
+        else:
+            logging.info(f'Failed to release job {check_run_id}. Error: {err}')
+        return None
+    except Exception as err:
+        logging.info(f'Failed to release job {check_run_id}. Error: {err}')
+        return None
+
+    return dispatch
+
+def reconcile(check_run_id, node_name):
+    """ Checks a node's report on a job against the ledger. A node that
+        reports on a job no node owns, and that it could have been given,
+        takes ownership of it.
+
+    :return: tuple: ``OWNER``, ``ADOPTED``, ``CONFLICT``, or ``UNKNOWN``
+                    for jobs without a ledger entry (or if the ledger
+                    can't be read); and the job's ``Dispatch``, or None.
+    """
+    try:
+        dispatch = get(check_run_id)
+    except Exception as err:
+        logging.info(f'Failed to read dispatch of job {check_run_id}. Error: {err}')
+        return UNKNOWN, None
+
+    if dispatch is None:
+        return UNKNOWN, None
+
+    outcome = dispatch.ownership(node_name)
+    if outcome == ADOPTED and not assign(check_run_id, node_name):
+        outcome = CONFLICT
+    if outcome != OWNER:
+        logging.info(
+            f'Report on job {check_run_id} from {node_name}: {outcome} '
+            f'(ledger: {dispatch.state} {dispatch.node_name})'
+        )
+        metrics.incr('dispatch_reconciled_total', outcome=outcome)
+
+    return outcome, dispatch
@@ -0,0 +1,154 @@
+import logging
+import os
+import time
+
+# pylint: disable=import-error
+from __app__.lib import metrics, node_ledger, result_aggregates
+
+# the estimates last loaded, and when (see ``load``)
+_LOADED = {'at': None, 'estimates': None}
+
+def _config(name, default):
+    """ Reads a numeric estimate setting from the app settings.
+    """
+    try:
+        return float(os.environ.get(name, default))
+    except ValueError:
+        logging.info(f'Invalid value for {name}. Using default: {default}')
+        return default
+
+def default_job_seconds():
+    """ The estimated duration of a job on a node without history, when
+        no node has any.
+    """
+    return _config('DURATION_DEFAULT_SECONDS', 1200)
+
+def min_samples():
+    """ Timed runs a node or board needs before its own mean is used.
+    """
+    return int(_config('DURATION_MIN_SAMPLES', 3))
+
+def cache_seconds():
+    """ How long loaded estimates are reused before the aggregates are
+        read again.
+    """
+    return _config('DURATION_CACHE_SECONDS', 300)
+
+def _means(rows):
+    """ Mean durations, keyed by name, from ``result_aggregates.query``
+        rows with enough timed runs.
+    """
+    return {
+        row['name']: row['duration']['mean'] for row in rows
+        if row['duration']['count'] >= min_samples() and row['duration']['mean']
+    }
+
+class Estimates():
+    """ Job duration estimates, learnt from the node and board duration
+        aggregates of completed runs (see ``result_aggregates``).
+
+    :param: dict node_means: Mean run seconds, keyed by node name
+    :param: dict board_means: Mean board test seconds, keyed by board
+    """
+
+    def __init__(self, node_means=None, board_means=None):
+        self.node_means = node_means or {}
+        self.board_means = board_means or {}
+        if self.node_means:
+            self.fallback = sum(self.node_means.values()) / len(self.node_means)
+        else:
+            self.fallback = default_job_seconds()
+
+    def job_seconds(self, node, boards=None):
+        """ The estimated duration of a job on a node. A job that only
+            tests some of the node's ``boards`` (e.g. a shard) takes
+            their board means if known, otherwise its share of the
+            node's mean.
+
+        :param: NodeItem node: The node
+        :param: list boards: The boards the job tests. All of the
+                             node's, if None.
+
+        :return: float: Seconds
+        """
+        node_boards = list(node.boards or ())
+        boards = list(boards) if boards else node_boards
+
+        node_mean = self.node_means.get(node.node_name)
+        if node_mean is not None:
+            if boards == node_boards or not node_boards:
+                return node_mean
+            if not all(board in self.board_means for board in boards):
+                return node_mean * len(boards) / len(node_boards)
+
+        if boards and all(board in self.board_means for board in boards):
+            return sum(self.board_means[board] for board in boards)
+
+        return self.fallback if node_mean is None else node_mean
+
+    def drain_seconds(self, node, load, now=None):
+        """ The predicted time until a node has finished its in-flight
+            jobs: the rest of its running jobs, and its queued jobs, run
+            ``NODE_MAX_RUNNING`` at a time.
+
+        :param: NodeItem node: The node
+        :param: NodeLoad load: The node's in-flight jobs, from the ledger
+
+        :return: float: Seconds
+        """
+        if now is None:
+            now = time.time()
+        job_seconds = self.job_seconds(node)
+
+        remaining = 0
+        for entity in load.running:
+            elapsed = now - entity.get('started_at', now)
+            # a job past its estimate is expected to end soon
+            remaining += max(job_seconds - elapsed, job_seconds * 0.1)
+        remaining += job_seconds * len(load.queued)
+
+        return remaining / max(node_ledger.max_running(), 1)
+
+    def expected_completion(self, node, load, boards=None, now=None):
+        """ The predicted time until a job given to the node now would
+            finish: once a run slot is free, plus the job's duration.
+
+        :return: float: Seconds
+        """
+        wait = 0
+        if load.in_flight >= node_ledger.max_running():
+            wait = self.drain_seconds(node, load, now)
+
+        return wait + self.job_seconds(node, boards)
+
+def load():
+    """ Loads the duration estimates. They are kept for
+        ``DURATION_CACHE_SECONDS``.
+
+    :return: Estimates: Without history if the aggregates couldn't be
+                        read.
+    """
+    now = time.time()
+    if (_LOADED['estimates'] is not None and
+        now - _LOADED['at'] < cache_seconds()):
+            return _LOADED['estimates']
+
+    try:
+        with metrics.span('estimates_load'):
+            estimates = Estimates(
+                node_means=_means(result_aggregates.query(result_aggregates.KIND_NODE)),
+                board_means=_means(result_aggregates.query(result_aggregates.KIND_BOARD)),
+            )
+    except Exception as err:
+        logging.info(f'Failed to load duration estimates. Error: {err}')
+        return Estimates()
+
+    _LOADED.update(at=now, estimates=estimates)
+
+    return estimates
+
+def reset():
+    """ Drops the loaded estimates, so that the next ``load`` reads the
+        aggregates.
+    """
+    _LOADED.update(at=None, estimates=None)
@@ -0,0 +1,77 @@
+import logging
+import zlib
+
+# pylint: disable=import-error
+from __app__.lib import metrics
+
+# Bodies smaller than this aren't worth compressing.
+_MIN_COMPRESS_BYTES = 512
+
+# in server preference order
+_ENCODINGS = ('gzip', 'deflate')
+
+def negotiate(accept_encoding):
+    """ Picks a content coding from an ``Accept-Encoding`` header.
+
+    :param: str accept_encoding: The header value, or None
+
+    :return: str: ``gzip``, ``deflate``, or None for no compression.
+    """
+    accepted = {}
+    for item in (accept_encoding or '').split(','):
+        coding, _, params = item.strip().partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        quality = 1.0
+        params = params.strip()
+        if params.startswith('q='):
+            try:
+                quality = float(params[2:])
+            except ValueError:
+                logging.info(f'Invalid Accept-Encoding quality: {item}')
+        accepted[coding] = quality
+
+    candidates = [
+        coding for coding in _ENCODINGS
+        if accepted.get(coding, accepted.get('*', 0)) > 0
+    ]
+    if not candidates:
+        return None
+
+    return max(
+        candidates,
+        key=lambda coding: accepted.get(coding, accepted.get('*', 0))
+    )
+
+def encode_response(response_kwargs, accept_encoding):
+    """ Compresses a response's body, if the client accepts it and the
+        body is large enough to benefit.
+
+    :param: dict response_kwargs: ``func.HttpResponse`` kwargs, with a
+                                  ``str`` or ``bytes`` body. Updated in
+                                  place.
+    :param: str accept_encoding: The request's ``Accept-Encoding`` header
+    """
+    headers = response_kwargs.setdefault('headers', {})
+    headers['Vary'] = 'Accept-Encoding'
+
+    body = response_kwargs.get('body')
+    if isinstance(body, str):
+        body = body.encode('utf-8')
+    if not body or len(body) < _MIN_COMPRESS_BYTES:
+        return
+
+    coding = negotiate(accept_encoding)
+    if coding is None:
+        return
+
+    if coding == 'gzip':
+        compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    else:
+        compressor = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS)
+    compressed = compressor.compress(body) + compressor.flush()
+
+    metrics.incr('response_bytes_saved_total', len(body) - len(compressed), coding=coding)
+    response_kwargs['body'] = compressed
+    headers['Content-Encoding'] = coding
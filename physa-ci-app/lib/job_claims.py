@@ -0,0 +1,325 @@
+import json
+import logging
+import math
+import os
+import time
+
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+
+# pylint: disable=import-error
+from __app__.lib import check_dispatch, check_lanes, check_queue, metrics, node_db
+from __app__.lib import dispatch_ledger, message_codec, node_ledger
+
+# most jobs looked at in a lane per claim attempt
+_CLAIM_BATCH = 8
+# longest a claim request can wait for a job, whatever the app settings
+_CLAIM_WAIT_LIMIT = 10
+
+def _config(name, default):
+    """ Reads a numeric job claim setting from the app settings.
+    """
+    try:
+        return float(os.environ.get(name, default))
+    except ValueError:
+        logging.info(f'Invalid value for {name}. Using default: {default}')
+        return default
+
+def claim_lease_seconds():
+    """ How long a claim keeps a job hidden from other nodes. A node
+        renews its claim while the job runs; a job whose claim runs out
+        can be claimed by another node.
+    """
+    return int(_config('CLAIM_LEASE_SECONDS', 300))
+
+def claim_wait_max_seconds():
+    """ Longest a claim request waits for a job. The wait holds one of
+        the function host's worker threads, so it can't be set past
+        ``_CLAIM_WAIT_LIMIT``; nodes should poll again instead.
+    """
+    return min(_config('CLAIM_WAIT_MAX_SECONDS', 5), _CLAIM_WAIT_LIMIT)
+
+def claim_poll_seconds():
+    """ How often a waiting claim request reads the job queues.
+    """
+    return _config('CLAIM_POLL_SECONDS', 2)
+
+def claim_max_attempts():
+    """ How many times a job can be claimed before its check run is
+        cancelled. A job is only claimed again when a node releases it,
+        or stops renewing its claim without completing the job.
+    """
+    return int(_config('CLAIM_MAX_ATTEMPTS', 3))
+
+def parse_wait(wait):
+    """ Reads the seconds a node asked to wait for a job.
+
+    :param: wait: The ``wait`` of a claim request
+
+    :return: float: The seconds to wait, or None if ``wait`` isn't a
+                    finite, non-negative number.
+    """
+    if isinstance(wait, bool):
+        return None
+    try:
+        wait = float(wait)
+    except (TypeError, ValueError):
+        return None
+    if not math.isfinite(wait) or wait < 0:
+        return None
+
+    return wait
+
+def make_claim(lane, message):
+    """ Builds the opaque claim token returned to a node. It holds the
+        job's lane, queue message id and pop receipt.
+
+    :param: str lane: The job's lane, or None
+    :param: queue.QueueMessage message: The job's queue message
+
+    :return: str
+    """
+    claim = json.dumps({'lane': lane, 'id': message.id, 'receipt': message.pop_receipt})
+
+    return urlsafe_b64encode(claim.encode()).decode()
+
+def parse_claim(claim):
+    """ Reads a claim token from ``make_claim()``.
+
+    :return: tuple: The lane, message id and pop receipt, or None if the
+                    token is malformed.
+    """
+    try:
+        claim = json.loads(urlsafe_b64decode(claim.encode()))
+        return claim['lane'], claim['id'], claim['receipt']
+    except Exception:
+        return None
+
+def _compatible(check_info, boards):
+    """ Whether a node with ``boards`` can run a job. Jobs that don't
+        list the boards they need can run on any node.
+    """
+    required = check_info.get('boards')
+    if not required:
+        return True
+
+    return bool(set(required) & set(boards or ()))
+
+def _already_completed(check_info):
+    """ Whether a reclaimed job's check run was completed by the node
+        that claimed it before, e.g. if the node didn't complete the
+        claim after reporting its results.
+    """
+    node_name = check_info.get('claimed_by')
+    if not node_name:
+        return False
+
+    try:
+        entity = node_db.get_result(
+            node_name, str(check_info['check_run_id']), summary=True
+        )
+    except Exception:
+        return False
+
+    return entity.get('check_run_status') == 'completed'
+
+def _release(queue_client, message):
+    try:
+        queue_client.update_message(message, visibility_timeout=0)
+    except Exception as err:
+        logging.info(f'Failed to release job message {message.id}. Error: {err}')
+
+def _claim_from_lane(lane, node_name, boards):
+    """ Claims the first job in a lane that the node can run. Jobs the
+        node can't run are handed back once a job is claimed, or
+        ``_CLAIM_BATCH`` jobs have been looked at.
+
+    :return: dict: The claim, None if the lane has no job for the node.
+    """
+    queue_client = check_queue.check_queue_client(lane)
+    skipped = []
+
+    try:
+        for _ in range(_CLAIM_BATCH):
+            with metrics.span('claim_receive', lane=lane or 'none'):
+                message = queue_client.receive_message(
+                    visibility_timeout=claim_lease_seconds()
+                )
+            if message is None:
+                return None
+
+            try:
+                check_info = message_codec.decode(message.content)
+            except ValueError as err:
+                check_queue.drop_malformed(queue_client, message, err)
+                continue
+
+            attempts = int(check_info.get('claim_attempts', 0))
+            if check_info.get('is_claimed') == 'true':
+                # the last claim ended without the job being completed
+                metrics.incr('claim_expired_total', lane=lane or 'none')
+                if _already_completed(check_info):
+                    queue_client.delete_message(message)
+                    continue
+                if attempts >= claim_max_attempts():
+                    cancelled = check_dispatch.cancel_check(
+                        check_info,
+                        summary='RosiePi nodes stopped responding while running the job.'
+                    )
+                    # a job whose cancel failed is cancelled again once
+                    # its claim lease runs out
+                    if cancelled.ok:
+                        queue_client.delete_message(message)
+                    continue
+
+            if not _compatible(check_info, boards):
+                skipped.append(message)
+                continue
+
+            check_info.update({
+                'is_claimed': 'true',
+                'claimed_by': node_name,
+                'claim_attempts': attempts + 1,
+            })
+            # the update's pop receipt is the one the node renews with
+            message = queue_client.update_message(
+                message,
+                content=message_codec.encode(check_info, kind='check'),
+                visibility_timeout=claim_lease_seconds()
+            )
+            # a node whose claim ran out loses the job
+            dispatch_ledger.assign(check_info['check_run_id'], node_name, takeover=True)
+            check_dispatch.accept_job(check_info, node_name)
+
+            metrics.incr('jobs_claimed_total', lane=lane or 'none')
+            enqueued_at = check_info.get('enqueued_at')
+            if enqueued_at is not None:
+                metrics.observe(
+                    'lane_wait_seconds',
+                    time.time() - enqueued_at,
+                    buckets=check_dispatch.WAIT_BUCKETS,
+                    lane=lane or 'none'
+                )
+
+            return {
+                'claim': make_claim(lane, message),
+                'lease_seconds': claim_lease_seconds(),
+                'job': {
+                    'commit_sha': check_info['check_run_head_sha'],
+                    'check_run_id': check_info['check_run_id'],
+                },
+            }
+    finally:
+        for message in skipped:
+            _release(queue_client, message)
+
+    return None
+
+def _claim_once(node_name, boards):
+    configured = check_lanes.lanes()
+    if not configured:
+        return _claim_from_lane(None, node_name, boards)
+
+    picker = check_lanes.picker()
+    active = {name for name, _ in configured}
+    while active:
+        lane = picker.pick(active)
+        claimed = _claim_from_lane(lane, node_name, boards)
+        if claimed is not None:
+            return claimed
+        active.discard(lane)
+
+    return None
+
+def claim_job(node_name, boards=None, wait=0):
+    """ Claims a queued job for a node. Lanes are read in the order the
+        dispatcher would use (see ``check_lanes.policy()``).
+
+        The job's queue message stays hidden from other nodes while the
+        claim is renewed (see ``renew_claim``), and is deleted when the
+        node completes the job. If the node goes away, the message
+        becomes visible again and the job is claimed by another node.
+
+    :param: str node_name: The node claiming a job
+    :param: list boards: The boards attached to the node
+    :param: float wait: Seconds to wait for a job, up to
+                        ``CLAIM_WAIT_MAX_SECONDS``.
+
+    :return: dict: ``claim`` token, ``lease_seconds`` and ``job``, or
+                   None if no job was found, or the node is at its
+                   limit in the node ledger.
+    """
+    if not node_ledger.node_load(node_name).admit():
+        logging.info(f'Node {node_name} is at its job limit. Not claiming.')
+        metrics.incr('claim_requests_total', outcome='full')
+        return None
+
+    deadline = time.monotonic() + min(max(wait, 0), claim_wait_max_seconds())
+
+    while True:
+        claimed = _claim_once(node_name, boards)
+        remaining = deadline - time.monotonic()
+        if claimed is not None or remaining <= 0:
+            break
+        time.sleep(min(claim_poll_seconds(), remaining))
+
+    metrics.incr('claim_requests_total', outcome='claimed' if claimed else 'empty')
+    if claimed is not None:
+        logging.info(f'Node {node_name} claimed job: {claimed["job"]}')
+
+    return claimed
+
+def renew_claim(claim):
+    """ Extends a claim's lease.
+
+    :param: str claim: The claim token
+
+    :return: str: The new claim token, or None if the claim was lost
+                  (e.g. it ran out and another node claimed the job).
+    """
+    parsed = parse_claim(claim)
+    if parsed is None:
+        return None
+
+    lane, message_id, pop_receipt = parsed
+    queue_client = check_queue.check_queue_client(lane)
+    try:
+        message = queue_client.update_message(
+            message_id,
+            pop_receipt=pop_receipt,
+            visibility_timeout=claim_lease_seconds()
+        )
+    except Exception as err:
+        logging.info(f'Failed to renew job claim. Error: {err}')
+        metrics.incr('claim_renewals_total', outcome='lost')
+        return None
+
+    metrics.incr('claim_renewals_total', outcome='renewed')
+
+    return make_claim(lane, message)
+
+def finish_claim(claim, release=False):
+    """ Ends a claim: the job is deleted, or with ``release``, handed
+        back for another node to claim.
+
+    :param: str claim: The claim token
+
+    :return: bool: Whether the claim was still held.
+    """
+    parsed = parse_claim(claim)
+    if parsed is None:
+        return False
+
+    lane, message_id, pop_receipt = parsed
+    queue_client = check_queue.check_queue_client(lane)
+    try:
+        if release:
+            queue_client.update_message(
+                message_id, pop_receipt=pop_receipt, visibility_timeout=0
+            )
+        else:
+            queue_client.delete_message(message_id, pop_receipt=pop_receipt)
+    except Exception as err:
+        logging.info(f'Failed to finish job claim. Error: {err}')
+        return False
+
+    return True
@@ -0,0 +1,243 @@
+import logging
+import os
+import time
+
+from collections import Counter
+
+# pylint: disable=import-error
+from __app__.lib import check_queue, check_shards, check_updates, dispatch_ledger
+from __app__.lib import metrics, node_db, node_github, node_ledger, node_registrar, result
+
+# ``recover_job`` outcomes
+REDISPATCHED = 'redispatched'
+CLOSED = 'closed'
+RELEASED = 'released'
+DEFERRED = 'deferred'
+
+# the fields of a result entity that belong to its node's run, left out
+# when the job is dispatched again
+_RUN_FIELDS = (
+    'node_name', 'check_run_external_id', 'check_run_status',
+    'check_run_conclusion', 'check_run_started_at', 'check_run_completed_at',
+    'check_run_output', 'node_results', 'node_results_chunked',
+    'node_results_count', 'shard_boards', 'shard_count',
+)
+
+def _config(name, default):
+    """ Reads a numeric sweeper setting from the app settings.
+    """
+    try:
+        return float(os.environ.get(name, default))
+    except ValueError:
+        logging.info(f'Invalid value for {name}. Using default: {default}')
+        return default
+
+def start_deadline_seconds():
+    """ How long a node has to start a job it was given.
+    """
+    return _config('JOB_START_DEADLINE_SECONDS', 3600)
+
+def run_deadline_seconds():
+    """ How long a node has to complete a job after starting it, or after
+        its last ``in_progress`` report.
+    """
+    return _config('JOB_RUN_DEADLINE_SECONDS', 7200)
+
+def max_redispatches():
+    """ Times a job is dispatched again after its node missed a deadline,
+        before its check run is closed as ``timed_out``.
+    """
+    return int(_config('JOB_MAX_REDISPATCHES', 1))
+
+def find_orphans(loads, now=None):
+    """ Finds the in-flight jobs whose node missed its start or run
+        deadline.
+
+    :param: dict loads: ``NodeLoad`` keyed by node name, from
+                        ``node_ledger.load_ledger()``
+
+    :return: list: ``(node_name, check_run_id)`` tuples
+    """
+    if now is None:
+        now = time.time()
+
+    orphans = []
+    for node_name, load in loads.items():
+        for entity in load.running:
+            if entity.get('started_at', now) + run_deadline_seconds() <= now:
+                orphans.append((node_name, entity['RowKey'].lstrip('0')))
+        for entity in load.queued:
+            if entity.get('assigned_at', now) + start_deadline_seconds() <= now:
+                orphans.append((node_name, entity['RowKey'].lstrip('0')))
+
+    return orphans
+
+def _close_result(node_name, check_run_id, message):
+    """ Stores a stopped job's check run update with its node's result.
+    """
+    try:
+        entity = node_db.get_result(node_name, check_run_id)
+    except Exception:
+        # the job was never added to the results table
+        return
+
+    for key, value in message.items():
+        entity[f'check_run_{key}'] = value
+    stopped = result.Result(entity)
+    if stopped.results:
+        node_db.update_result(stopped.results_to_table_entity())
+
+def _job_check_info(dispatch, node_name, check_run_id):
+    """ The check run message of a job: kept with its dispatch, or
+        rebuilt from its node's result.
+    """
+    if dispatch is not None and dispatch.check_info:
+        return dict(dispatch.check_info)
+
+    try:
+        entity = node_db.get_result(node_name, check_run_id)
+    except Exception:
+        return None
+
+    return {
+        key: value for key, value in entity.items()
+        if key not in _RUN_FIELDS and key not in ('PartitionKey', 'RowKey')
+    }
+
+def _recover(node_name, check_run_id, dispatch):
+    """ Decides what happens to a job taken from a node, and carries it
+        out (see ``recover_job``), except for closing its check run.
+
+    :return: tuple: The outcome, and the check run message and update
+                    that close the job, or None.
+    """
+    if dispatch is not None and dispatch.ownership(node_name) == dispatch_ledger.CONFLICT:
+        logging.info(f'Job {check_run_id} was given to another node since.')
+        return RELEASED, None
+
+    check_info = _job_check_info(dispatch, node_name, check_run_id)
+    if check_info is None:
+        logging.info(f'No check run message for job {check_run_id}.')
+        return RELEASED, None
+
+    stop = node_github.stop_message(
+        f'RosiePi node {node_name} stopped responding.', conclusion='timed_out'
+    )
+    _close_result(node_name, check_run_id, stop)
+
+    if dispatch is not None and dispatch.state == dispatch_ledger.STATE_SHARDED:
+        message = check_shards.report(
+            {'check_run_id': check_run_id, 'node_name': node_name}, stop
+        )
+        if message:
+            # the shard is recorded as completed, so the report isn't
+            # made again; a failed update is only counted.
+            check_updates.update_check_run(check_info, message)
+        return CLOSED, None
+
+    redispatches = int(check_info.get('redispatches', 0))
+    if redispatches < max_redispatches():
+        check_info['redispatches'] = redispatches + 1
+        # a new dispatch gets a new retry deadline
+        check_info.pop('dispatch_attempts', None)
+        check_info.pop('dispatch_deadline', None)
+        if dispatch_ledger.release(check_run_id, node_name, check_info) is None:
+            # the job was given to another node since
+            return RELEASED, None
+        try:
+            check_queue.send_check(check_info)
+        except Exception as err:
+            logging.info(f'Failed to requeue job {check_run_id}. Error: {err}')
+        else:
+            check_updates.update_check_run(check_info, {
+                'status': 'queued',
+                'output': {
+                    'title': 'RosiePi',
+                    'summary': (
+                        f'RosiePi node {node_name} stopped responding. The job '
+                        'has been queued again.'
+                    ),
+                }
+            })
+            return REDISPATCHED, None
+
+    return CLOSED, (check_info, stop)
+
+def _close_failed(node_name, check_run_id):
+    """ The ``on_error`` of the update that closes a job's check run:
+        the job is put back in its node's ledger, so that a later sweep
+        closes it again.
+    """
+    def on_error(update):
+        logging.info(
+            f'Failed to close check run of job {check_run_id}. '
+            'It will be closed by a later sweep.'
+        )
+        node_ledger.record_assigned(node_name, check_run_id)
+
+    return on_error
+
+def recover_job(node_name, check_run_id):
+    """ Takes a job from a node that missed its deadline. The job is
+        dispatched again, up to ``JOB_MAX_REDISPATCHES`` times, after
+        which its check run is closed as ``timed_out``. A shard of a
+        sharded run is closed, and the run completes with its other
+        shards (see ``check_shards.report``). A job the dispatch ledger
+        shows was given to another node since is left to that node.
+
+        In pull mode, only the node's ledger entry is removed; the job
+        can be claimed again once the node's claim runs out.
+
+        The job stays in the node's ledger until its recovery has been
+        decided, so that a sweep that fails part way is retried by the
+        next one. A job whose check run couldn't be closed is put back
+        in the ledger for the same reason.
+
+    :return: str: ``REDISPATCHED``, ``CLOSED``, ``RELEASED`` when the
+                  job was only removed from the node's ledger, or
+                  ``DEFERRED`` when its dispatch couldn't be read.
+    """
+    logging.info(f'Node {node_name} missed its deadline for job {check_run_id}.')
+    if check_queue.dispatch_mode() == check_queue.MODE_PULL:
+        node_ledger.record_finished(node_name, check_run_id)
+        return RELEASED
+
+    try:
+        dispatch = dispatch_ledger.get(check_run_id)
+    except Exception as err:
+        logging.info(f'Failed to read dispatch of job {check_run_id}. Error: {err}')
+        return DEFERRED
+
+    outcome, closing = _recover(node_name, check_run_id, dispatch)
+    node_ledger.record_finished(node_name, check_run_id)
+
+    if closing is not None:
+        check_info, stop = closing
+        check_updates.update_check_run(
+            check_info, stop, on_error=_close_failed(node_name, check_run_id)
+        )
+
+    return outcome
+
+def sweep(now=None):
+    """ Removes dead entries from the registrar (see
+        ``node_registrar.sweep_registrar``), and recovers the jobs of
+        nodes that missed their deadline (see ``recover_job``).
+
+    :return: dict: The number of registrar entries removed, and of jobs
+                   recovered by outcome.
+    """
+    _, removed = node_registrar.sweep_registrar(now)
+
+    recovered = Counter()
+    # check run updates are sent together when the sweep ends
+    with check_updates.batched():
+        for node_name, check_run_id in find_orphans(node_ledger.load_ledger(), now):
+            outcome = recover_job(node_name, check_run_id)
+            recovered[outcome] += 1
+            metrics.incr('sweeper_jobs_total', outcome=outcome)
+
+    summary = {'registrar_removed': removed, **recovered}
+    logging.info(f'Sweep complete: {summary}')
+
+    return summary
@@ -0,0 +1,31 @@
+import importlib
+
+
+class LazyModule():
+    """ Stand-in for a module that is only imported when one of its
+        attributes is first used. Keeps heavy SDKs out of a function's
+        cold start until an invocation actually needs them.
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+
+        return getattr(self._module, attr)
+
+    def __repr__(self):
+        state = 'loaded' if self._module is not None else 'not loaded'
+        return f'<LazyModule {self._name} ({state})>'
+
+def lazy_import(name):
+    """ Import a module on first use.
+
+    :param: str name: The full module name (e.g. ``azure.storage.queue``)
+
+    :return: ``LazyModule``
+    """
+    return LazyModule(name)
@@ -0,0 +1,176 @@
+import json
+import logging
+import os
+import zlib
+
+from importlib import util as importlib_util
+
+# pylint: disable=import-error
+from __app__.lib import metrics
+from __app__.lib.lazy_import import lazy_import
+
+# optional; messages are encoded as compact JSON without it. Looked up
+# without importing it, so that it stays out of the cold start.
+msgpack = lazy_import('msgpack')
+_HAS_MSGPACK = importlib_util.find_spec('msgpack') is not None
+
+ENCODING_COMPACT = 'compact'
+ENCODING_JSON = 'json'
+
+# the first byte of a compact message. Plain JSON messages start with
+# ``{``, so the two can be told apart.
+_VERSION = 1
+
+_FLAG_MSGPACK = 0x01
+_FLAG_ZLIB = 0x02
+# a JSON body is a pair of objects: the tagged fields, then the fields
+# that kept their name. JSON keys are strings, so a tag can't otherwise
+# be told apart from an all-digit field name.
+_FLAG_TAG_MAP = 0x04
+
+# Bodies smaller than this aren't worth compressing.
+_MIN_COMPRESS_BYTES = 256
+
+# Upper bounds, in bytes, of the message size histogram buckets.
+_SIZE_BUCKETS = (128, 256, 512, 1024, 2048, 4096, 8192, 16384, 65536)
+
+# Short tags for the fields of check run and registrar messages; a
+# field's tag is its index. Only append: messages already queued are
+# decoded with the same table.
+_TAGS = (
+    # check run messages (``check_queue``)
+    'api_url',
+    'installation_id',
+    'check_run_id',
+    'check_run_suite_id',
+    'check_run_head_sha',
+    'check_run_url',
+    'check_run_pull_requests',
+    'check_run_node_id',
+    'repository_node_id',
+    'is_claimed',
+    'lane',
+    'enqueued_at',
+    'dispatch_attempts',
+    'dispatch_deadline',
+    'claim_attempts',
+    'claimed_by',
+    'boards',
+    # registrar messages (``node_registrar``)
+    'node_name',
+    'node_ip',
+    'node_sig_key',
+    'listen_port',
+    'busy',
+    'lease_expires',
+)
+_TAG_FOR = {name: tag for tag, name in enumerate(_TAGS)}
+
+def encoding():
+    """ How queue messages are written, from the
+        ``QUEUE_MESSAGE_ENCODING`` app setting: ``compact`` (default), or
+        ``json`` for plain JSON that older releases can read. Both are
+        always read.
+    """
+    name = os.environ.get('QUEUE_MESSAGE_ENCODING', ENCODING_COMPACT)
+    if name not in (ENCODING_COMPACT, ENCODING_JSON):
+        logging.info(f'Invalid QUEUE_MESSAGE_ENCODING: {name}. Using compact.')
+        name = ENCODING_COMPACT
+
+    return name
+
+def encode(fields, kind='message'):
+    """ Encodes a queue message. Compact messages are a version byte, a
+        flags byte and the body: the fields keyed by their tags, as
+        msgpack if it is installed or JSON otherwise, and compressed
+        with zlib when that makes them smaller. A JSON body keeps the
+        tagged fields apart from the others (see ``_FLAG_TAG_MAP``).
+
+    :param: dict fields: The message. Fields without a tag keep their
+                         name.
+    :param: str kind: Labels the message size metric.
+
+    :return: bytes
+    """
+    if encoding() == ENCODING_JSON:
+        data = json.dumps(fields).encode()
+        metrics.observe('queue_message_bytes', len(data), buckets=_SIZE_BUCKETS, kind=kind)
+        return data
+
+    flags = 0
+    if _HAS_MSGPACK:
+        tagged = {_TAG_FOR.get(key, key): value for key, value in fields.items()}
+        body = msgpack.packb(tagged, use_bin_type=True)
+        flags |= _FLAG_MSGPACK
+    else:
+        tagged = {}
+        named = {}
+        for key, value in fields.items():
+            if key in _TAG_FOR:
+                tagged[_TAG_FOR[key]] = value
+            else:
+                named[key] = value
+        body = json.dumps([tagged, named], separators=(',', ':')).encode()
+        flags |= _FLAG_TAG_MAP
+
+    if len(body) >= _MIN_COMPRESS_BYTES:
+        compressed = zlib.compress(body, 6)
+        if len(compressed) < len(body):
+            body = compressed
+            flags |= _FLAG_ZLIB
+
+    data = bytes((_VERSION, flags)) + body
+    metrics.observe('queue_message_bytes', len(data), buckets=_SIZE_BUCKETS, kind=kind)
+
+    return data
+
+def _untag(key):
+    if isinstance(key, int):
+        return _TAGS[key]
+
+    return key
+
+def _untag_json(body):
+    """ Reads the fields of a JSON body without ``_FLAG_TAG_MAP``,
+        written before tagged fields were kept apart: every all-digit
+        key is a tag.
+    """
+    return {
+        _TAGS[int(key)] if key.isdigit() else key: value
+        for key, value in json.loads(body).items()
+    }
+
+def decode(data):
+    """ Decodes a queue message from ``encode()``, or a plain JSON
+        message.
+
+    :param: data: The message content, as ``bytes`` or ``str``
+
+    :return: dict
+    """
+    if isinstance(data, str):
+        data = data.encode()
+    if not data or data[0] != _VERSION:
+        return json.loads(data)
+
+    flags = data[1] if len(data) > 1 else 0
+    body = data[2:]
+    try:
+        if flags & _FLAG_ZLIB:
+            body = zlib.decompress(body)
+        if flags & _FLAG_MSGPACK:
+            if not _HAS_MSGPACK:
+                raise ValueError('msgpack is not installed.')
+            tagged = msgpack.unpackb(body, raw=False, strict_map_key=False)
+            return {_untag(key): value for key, value in tagged.items()}
+        if not flags & _FLAG_TAG_MAP:
+            return _untag_json(body)
+
+        tagged, named = json.loads(body)
+        fields = {_TAGS[int(tag)]: value for tag, value in tagged.items()}
+        fields.update(named)
+        return fields
+    except ValueError:
+        raise
+    except Exception as err:
+        raise ValueError(f'Malformed queue message: {err}') from err
@@ -0,0 +1,265 @@
+import bisect
+import functools
+import json
+import logging
+import threading
+import time
+
+from contextlib import contextmanager
+
+# pylint: disable=import-error
+from __app__.lib import profiling
+
+# Upper bounds, in seconds, of the duration histogram buckets.
+_BUCKETS = (
+    0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60,
+)
+
+_LOCK = threading.Lock()
+_COUNTERS = {}
+_GAUGES = {}
+_HISTOGRAMS = {}
+
+# Spans recorded during the current function invocation.
+_INVOCATION = threading.local()
+
+class Histogram():
+    """ Cumulative histogram of observed values.
+    """
+
+    def __init__(self, buckets=_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        """ Adds a value to the histogram.
+        """
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, fraction):
+        """ Estimates a quantile from the bucket bounds.
+
+        :param: float fraction: The quantile (e.g. ``0.99``)
+
+        :return: float: The upper bound of the bucket containing the
+                        quantile, or None if empty.
+        """
+        if not self.count:
+            return None
+
+        target = fraction * self.count
+        running = 0
+        for index, count in enumerate(self.counts):
+            running += count
+            if running >= target:
+                if index < len(self.buckets):
+                    return self.buckets[index]
+                break
+
+        return float('inf')
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+def incr(name, value=1, **labels):
+    """ Increments a counter.
+
+    :param: str name: The counter name (e.g. ``dispatch_attempts_total``)
+    :param: int value: The amount to increment by.
+    :param: **labels: Labels to distinguish the counter by.
+    """
+    key = _key(name, labels)
+    with _LOCK:
+        _COUNTERS[key] = _COUNTERS.get(key, 0) + value
+
+def count_retries(operation):
+    """ Builds a ``retry_callback`` for an Azure Storage client, which
+        counts the retries its retry policy makes in ``retries_total``.
+
+    :param: str operation: The label for the client's retries (e.g.
+                           ``results_table``)
+    """
+    def callback(retry_context):
+        incr('retries_total', operation=operation)
+
+    return callback
+
+def set_gauge(name, value, **labels):
+    """ Sets a gauge to its current value.
+
+    :param: str name: The gauge name (e.g. ``lane_depth``)
+    :param: float value: The current value.
+    :param: **labels: Labels to distinguish the gauge by.
+    """
+    key = _key(name, labels)
+    with _LOCK:
+        _GAUGES[key] = value
+
+def observe(name, value, buckets=_BUCKETS, **labels):
+    """ Records a value in a histogram.
+
+    :param: str name: The histogram name (e.g. ``stage_duration_seconds``)
+    :param: float value: The observed value.
+    :param: tuple buckets: The histogram's bucket bounds. Only used when
+                           the histogram is first created.
+    :param: **labels: Labels to distinguish the histogram by.
+    """
+    key = _key(name, labels)
+    with _LOCK:
+        histogram = _HISTOGRAMS.get(key)
+        if histogram is None:
+            histogram = _HISTOGRAMS[key] = Histogram(buckets)
+        histogram.observe(value)
+
+@contextmanager
+def span(stage, **labels):
+    """ Times a stage of processing. The duration is recorded in the
+        ``stage_duration_seconds`` histogram, and in the current
+        invocation's structured log line.
+
+    :param: str stage: The name of the stage (e.g. ``github_token``)
+    :param: **labels: Additional labels for the stage.
+    """
+    outcome = 'ok'
+    start = time.perf_counter()
+    try:
+        yield
+    except Exception:
+        outcome = 'error'
+        raise
+    finally:
+        duration = time.perf_counter() - start
+        observe('stage_duration_seconds', duration, stage=stage, **labels)
+        if outcome == 'error':
+            incr('stage_errors_total', stage=stage, **labels)
+
+        spans = getattr(_INVOCATION, 'spans', None)
+        if spans is not None:
+            spans.append({
+                'stage': stage,
+                'duration_ms': round(duration * 1000, 3),
+                'outcome': outcome,
+                **labels,
+            })
+
+def timed(stage, **labels):
+    """ Decorator to time a function as a ``span``.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(stage, **labels):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def invocation(function_name):
+    """ Decorator for a function's ``main()``. Times the whole
+        invocation, and logs a structured line with every span
+        recorded during it. Invocations picked for profiling are
+        profiled (see ``profiling.profiled``).
+
+    :param: str function_name: The name of the Azure Function
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            _INVOCATION.spans = []
+            incr('invocations_total', function=function_name)
+            try:
+                with profiling.profiled(function_name):
+                    with span('invocation', function=function_name):
+                        return func(*args, **kwargs)
+            finally:
+                spans = _INVOCATION.spans
+                _INVOCATION.spans = None
+                log_invocation(function_name, spans)
+        return wrapper
+    return decorator
+
+def log_invocation(function_name, spans):
+    """ Logs the spans of an invocation as a single JSON line, prefixed
+        with ``physaci.metrics`` for log queries.
+    """
+    record = {
+        'function': function_name,
+        'spans': spans,
+    }
+    logging.info(f'physaci.metrics {json.dumps(record, default=str)}')
+
+def snapshot():
+    """ A copy of the current counters, gauges and histograms.
+
+    :return: dict: ``{'counters': {...}, 'gauges': {...},
+                   'histograms': {...}}``, keyed by ``(name, labels)``.
+    """
+    with _LOCK:
+        counters = dict(_COUNTERS)
+        gauges = dict(_GAUGES)
+        histograms = {}
+        for key, histogram in _HISTOGRAMS.items():
+            copy = Histogram(histogram.buckets)
+            copy.counts = list(histogram.counts)
+            copy.sum = histogram.sum
+            copy.count = histogram.count
+            histograms[key] = copy
+
+    return {'counters': counters, 'gauges': gauges, 'histograms': histograms}
+
+def reset():
+    """ Clears all counters, gauges and histograms.
+    """
+    with _LOCK:
+        _COUNTERS.clear()
+        _GAUGES.clear()
+        _HISTOGRAMS.clear()
+
+def _escape_label(value):
+    value = str(value).replace('\\', '\\\\').replace('"', '\\"')
+
+    return value.replace('\n', '\\n')
+
+def _format_labels(labels, **extra):
+    items = list(labels) + list(extra.items())
+    if not items:
+        return ''
+    rendered = ','.join(
+        f'{name}="{_escape_label(value)}"' for name, value in items
+    )
+    return f'{{{rendered}}}'
+
+def render_text(prefix='physaci_'):
+    """ Renders the counters, gauges and histograms in the Prometheus
+        text exposition format.
+
+    :return: str
+    """
+    current = snapshot()
+    lines = []
+
+    for (name, labels), value in sorted(current['counters'].items()):
+        lines.append(f'{prefix}{name}{_format_labels(labels)} {value}')
+
+    for (name, labels), value in sorted(current['gauges'].items()):
+        lines.append(f'{prefix}{name}{_format_labels(labels)} {value}')
+
+    for (name, labels), histogram in sorted(current['histograms'].items()):
+        running = 0
+        for bound, count in zip(histogram.buckets, histogram.counts):
+            running += count
+            bucket_labels = _format_labels(labels, le=bound)
+            lines.append(f'{prefix}{name}_bucket{bucket_labels} {running}')
+        inf_labels = _format_labels(labels, le='+Inf')
+        lines.append(f'{prefix}{name}_bucket{inf_labels} {histogram.count}')
+        lines.append(
+            f'{prefix}{name}_sum{_format_labels(labels)} {histogram.sum}'
+        )
+        lines.append(
+            f'{prefix}{name}_count{_format_labels(labels)} {histogram.count}'
+        )
+
+    return '\n'.join(lines) + '\n'
@@ -1,9 +1,11 @@
 import json
 import logging
-import os
 
-from azure.cosmosdb.table.tableservice import TableService
-from azure.cosmosdb.table.models import Entity
+# pylint: disable=import-error
+from __app__.lib import metrics, storage
+from __app__.lib.lazy_import import lazy_import
+
+table_models = lazy_import('azure.cosmosdb.table.models')
 
 IGNORED_ITEMS = [
     # Timestamps are returned as datetime objects and are not JSONable.
@@ -15,13 +17,22 @@ IGNORED_ITEMS = [
     'etag',
 ]
 
-def get_result(partition_key, row_key, tbl_svc_retry=None, **kwargs):
-    """ Retirieves a result from the ``rosiepi`` storage table.
+# the properties read for a summary (see ``get_result``)
+_SUMMARY_SELECT = ('PartitionKey', 'RowKey', 'check_run_head_sha', 'summary_json')
+
+def get_result(partition_key, row_key, tbl_svc_retry=None, summary=False, **kwargs):
+    """ Retirieves a result from the ``rosiepi`` storage table, or the
+        configured storage backend (see ``storage.backend()``).
 
     :param: partition_key: The ``PartitionKey`` of the entity
     :param: row_key: The ``RowKey`` of the entity
+    :param: bool summary: Only read the result's summary, which leaves
+                          out ``node_results`` and adds a
+                          ``node_results_count``. Results stored without
+                          a summary are read in full.
     :param: **kwargs: Any additional kwargs to pass onto the
-                      ``TableService.get_entity()`` function.
+                      ``TableService.get_entity()`` function. Ignored
+                      by the other backends.
 
     :return: The ``TableService.Entity``, or None if the Entity
              isn't found.
@@ -29,23 +40,63 @@ def get_result(partition_key, row_key, tbl_svc_retry=None, **kwargs):
 
     response = None
 
-    table = TableService(connection_string=os.environ['APP_STORAGE_CONN_STR'])
-    if tbl_svc_retry is not None:
-        table.retry = tbl_svc_retry
+    table = storage.results(tbl_svc_retry)
 
     # ensure RowKey is properly padded
     padding = '0'*(50 - len(row_key))
     row_key = f'{padding}{row_key}'
 
     try:
-        response = table.get_entity('rosiepi', partition_key, row_key, **kwargs)
+        with metrics.span('table_get'):
+            if summary:
+                response = table.get(
+                    partition_key, row_key, select=_SUMMARY_SELECT, **kwargs
+                )
+                if 'summary_json' not in response:
+                    # stored before summaries were kept
+                    response = table.get(partition_key, row_key, **kwargs)
+            else:
+                response = table.get(partition_key, row_key, **kwargs)
     except Exception as err:
         logging.info(f'Failed to get result from rosiepi table. Error: {err}')
         raise
 
     logging.info(f'TableService.Entity retrieved: {response}')
 
-    # Flatten the entity
+    return _flatten_entity(response)
+
+def find_results(head_sha, **kwargs):
+    """ Retrieves all results in the ``rosiepi`` storage table for a
+        commit.
+
+    :param: head_sha: The commit SHA the check runs were made against
+    :param: **kwargs: Any additional kwargs to pass onto the
+                      ``TableService.query_entities()`` function.
+                      Ignored by the other backends.
+
+    :return: list: The flattened ``TableService.Entity`` objects. Only
+                   entities stored with a ``check_run_head_sha``
+                   property are found.
+    """
+
+    try:
+        with metrics.span('table_query'):
+            response = storage.results().find_by_commit(head_sha, **kwargs)
+    except Exception as err:
+        logging.info(f'Failed to query results from rosiepi table. Error: {err}')
+        raise
+
+    return [_flatten_entity(entity) for entity in response]
+
+def _flatten_entity(response):
+    """ Flattens the ``json_data`` of a ``TableService.Entity`` into the
+        entity itself, and drops any ``IGNORED_ITEMS``. Without
+        ``json_data``, its ``summary_json`` is flattened instead.
+    """
+    summary_json = response.pop('summary_json', None)
+    if summary_json and not response.get('json_data'):
+        response['json_data'] = summary_json
+
     json_data_copy = response.get('json_data')
     if json_data_copy:
         del response['json_data']
@@ -74,11 +125,10 @@ def add_result(results_entity):
     """
 
     response = None
-    if isinstance(results_entity, Entity):
-        table = TableService(connection_string=os.environ['APP_STORAGE_CONN_STR'])
-
+    if isinstance(results_entity, table_models.Entity):
         try:
-            response = table.insert_entity('rosiepi', results_entity)
+            with metrics.span('table_insert'):
+                response = storage.results().insert(results_entity)
         except Exception as err:
             logging.info(f'Failed to add result to rosiepi table. Error: {err}\nEntity: {results_entity}')
     else:
@@ -102,11 +152,10 @@ def update_result(results_entity):
     """
 
     response = None
-    if isinstance(results_entity, Entity):
-        table = TableService(connection_string=os.environ['APP_STORAGE_CONN_STR'])
-
+    if isinstance(results_entity, table_models.Entity):
         try:
-            response = table.update_entity('rosiepi', results_entity)
+            with metrics.span('table_update'):
+                response = storage.results().update(results_entity)
         except Exception as err:
             logging.info(f'Failed to update result in rosiepi table. Error: {err}')
     else:
@@ -0,0 +1,294 @@
+import logging
+import os
+import time
+
+from dataclasses import asdict, dataclass, fields
+
+# pylint: disable=import-error
+from __app__.lib import metrics, storage
+from __app__.lib.lazy_import import lazy_import
+
+azure_common = lazy_import('azure.common')
+table_models = lazy_import('azure.cosmosdb.table.models')
+tableservice = lazy_import('azure.cosmosdb.table.tableservice')
+
+_HEALTH_TABLE = 'rosiepinodehealth'
+_HEALTH_PARTITION = 'nodes'
+
+CIRCUIT_CLOSED = 'closed'
+CIRCUIT_OPEN = 'open'
+CIRCUIT_HALF_OPEN = 'half-open'
+
+def _config(name, default):
+    """ Reads a numeric health setting from the app settings.
+    """
+    try:
+        return float(os.environ.get(name, default))
+    except ValueError:
+        logging.info(f'Invalid value for {name}. Using default: {default}')
+        return default
+
+def ewma_alpha():
+    """ Smoothing factor for the error rate and latency averages.
+    """
+    return _config('NODE_HEALTH_ALPHA', 0.3)
+
+def failure_threshold():
+    """ Consecutive failures that open a node's circuit.
+    """
+    return _config('NODE_CIRCUIT_FAILURES', 3)
+
+def error_rate_threshold():
+    """ Error rate that opens a node's circuit, once the node has
+        enough samples (``NODE_CIRCUIT_MIN_SAMPLES``).
+    """
+    return _config('NODE_CIRCUIT_ERROR_RATE', 0.5)
+
+def min_samples():
+    """ Samples required before the error rate can open a circuit.
+    """
+    return _config('NODE_CIRCUIT_MIN_SAMPLES', 5)
+
+def cooldown():
+    """ Seconds an open circuit waits before allowing a trial request.
+    """
+    return _config('NODE_CIRCUIT_COOLDOWN', 300)
+
+def trial_timeout():
+    """ Seconds a half-open circuit's trial request is given to resolve
+        before another caller may start a new trial (e.g. if the caller
+        making it died).
+    """
+    return _config('NODE_CIRCUIT_TRIAL_SECONDS', 60)
+
+def request_timeout():
+    """ Seconds to wait on a node's HTTP server before counting the
+        request as failed.
+    """
+    return _config('NODE_REQUEST_TIMEOUT', 10)
+
+@dataclass
+class NodeHealth:
+    """ Health of a node, as seen by dispatch.
+    """
+    node_name: str
+    error_rate: float = 0.0
+    latency_ewma: float = None
+    circuit: str = CIRCUIT_CLOSED
+    consecutive_failures: int = 0
+    opened_at: float = None
+    samples: int = 0
+    trial_started_at: float = None
+    etag: str = None
+
+    def record(self, success, latency):
+        """ Records the outcome of a request to the node, and updates
+            the circuit state.
+
+        :param: bool success: If the node responded without a
+                              connection error, timeout or 5xx.
+        :param: float latency: Seconds the request took.
+        """
+        alpha = ewma_alpha()
+        failed = 0.0 if success else 1.0
+        if self.samples:
+            self.error_rate = alpha * failed + (1 - alpha) * self.error_rate
+        else:
+            self.error_rate = failed
+        if self.latency_ewma is None:
+            self.latency_ewma = latency
+        else:
+            self.latency_ewma = alpha * latency + (1 - alpha) * self.latency_ewma
+        self.samples += 1
+
+        if success:
+            self.consecutive_failures = 0
+            if self.circuit != CIRCUIT_CLOSED:
+                logging.info(f'Closing circuit for node: {self.node_name}')
+            self.circuit = CIRCUIT_CLOSED
+            self.opened_at = None
+            self.trial_started_at = None
+        else:
+            self.consecutive_failures += 1
+            too_many_errors = (
+                self.samples >= min_samples() and
+                self.error_rate >= error_rate_threshold()
+            )
+            if (self.circuit == CIRCUIT_HALF_OPEN or
+                self.consecutive_failures >= failure_threshold() or
+                too_many_errors):
+                    if self.circuit != CIRCUIT_OPEN:
+                        logging.info(f'Opening circuit for node: {self.node_name}')
+                    self.circuit = CIRCUIT_OPEN
+                    self.opened_at = time.time()
+                    self.trial_started_at = None
+
+    def allow_dispatch(self, now=None):
+        """ If the node should be sent requests. Open circuits move to
+            half-open once their cooldown has passed, which allows a
+            single trial request: a half-open node isn't sent requests
+            while another caller's trial is in flight, and the trial
+            itself must be claimed with ``start_trial()``.
+
+        :return: bool
+        """
+        now = now if now is not None else time.time()
+        if self.circuit == CIRCUIT_OPEN:
+            if self.opened_at is None or now - self.opened_at >= cooldown():
+                self.circuit = CIRCUIT_HALF_OPEN
+            else:
+                return False
+
+        if self.circuit == CIRCUIT_HALF_OPEN:
+            return not self.trial_in_flight(now)
+
+        return True
+
+    def trial_in_flight(self, now=None):
+        """ Whether a trial request to a half-open node hasn't resolved
+            yet, and hasn't run past ``trial_timeout()``.
+        """
+        if self.trial_started_at is None:
+            return False
+        now = now if now is not None else time.time()
+
+        return now - self.trial_started_at < trial_timeout()
+
+    def score(self):
+        """ Dispatch preference score; lower is better. Expected latency,
+            inflated by the error rate.
+        """
+        latency = self.latency_ewma if self.latency_ewma is not None else 1.0
+        penalty = 2 if self.circuit == CIRCUIT_HALF_OPEN else 1
+
+        return penalty * latency / max(1 - self.error_rate, 0.05)
+
+    def to_entity(self):
+        """ Format the health into an Azure Storage Table entity.
+        """
+        entity = table_models.Entity()
+        entity.PartitionKey = _HEALTH_PARTITION
+        entity.RowKey = self.node_name
+        entity.update(
+            {key: value for key, value in asdict(self).items()
+             if value is not None and key not in ('node_name', 'etag')}
+        )
+
+        return entity
+
+    @classmethod
+    def from_entity(cls, entity):
+        """ Build from an Azure Storage Table entity.
+        """
+        known = [field.name for field in fields(cls)]
+        kwargs = {key: entity[key] for key in known if key in entity}
+        kwargs['node_name'] = entity['RowKey']
+        kwargs['etag'] = entity.get('etag')
+
+        return cls(**kwargs)
+
+@metrics.timed('health_load')
+def load_health():
+    """ Retrieves the health of all nodes.
+
+    :return: dict: ``NodeHealth`` keyed by node name. Empty if the
+                   health table couldn't be read.
+    """
+    health = {}
+    table = tableservice.TableService(connection_string=storage.connection_string())
+    try:
+        entities = table.query_entities(
+            _HEALTH_TABLE,
+            filter=f"PartitionKey eq '{_HEALTH_PARTITION}'"
+        )
+        for entity in entities:
+            node_health = NodeHealth.from_entity(entity)
+            health[node_health.node_name] = node_health
+    except Exception as err:
+        logging.info(f'Failed to load node health. Error: {err}')
+
+    return health
+
+@metrics.timed('health_save')
+def save_health(node_healths):
+    """ Stores the health of the supplied nodes.
+
+    :param: node_healths: An iterable of ``NodeHealth``
+    """
+    table = tableservice.TableService(connection_string=storage.connection_string())
+    for node_health in node_healths:
+        try:
+            table.insert_or_replace_entity(_HEALTH_TABLE, node_health.to_entity())
+        except Exception as err:
+            logging.info(
+                f'Failed to save node health for {node_health.node_name}. '
+                f'Error: {err}'
+            )
+
+def start_trial(node_health, now=None):
+    """ Claims the single trial request of a half-open node. The claim
+        is an etag-conditional write of ``trial_started_at``, so that of
+        the callers that read the node as half-open, only one sends it a
+        request; the others skip the node until ``record()`` resolves
+        the trial, or it runs past ``trial_timeout()``.
+
+    :param: NodeHealth node_health: The node's health, as loaded by
+                                    ``load_health()``. Updated in place.
+
+    :return: bool: Whether this caller may send the trial request.
+    """
+    now = now if now is not None else time.time()
+    if node_health.circuit != CIRCUIT_HALF_OPEN:
+        return True
+    if node_health.trial_in_flight(now):
+        return False
+
+    node_health.trial_started_at = now
+    entity = node_health.to_entity()
+    table = tableservice.TableService(connection_string=storage.connection_string())
+    try:
+        if node_health.etag is None:
+            node_health.etag = table.insert_entity(_HEALTH_TABLE, entity)
+        else:
+            node_health.etag = table.update_entity(
+                _HEALTH_TABLE, entity, if_match=node_health.etag
+            )
+    except azure_common.AzureHttpError as err:
+        if err.status_code not in (409, 412):
+            logging.info(
+                f'Failed to start trial for {node_health.node_name}. Error: {err}'
+            )
+        # another caller's trial, or a write that may have resolved it;
+        # either way, not ours to send.
+        metrics.incr('circuit_trials_total', outcome='lost')
+        return False
+
+    logging.info(f'Starting trial request to half-open node: {node_health.node_name}')
+    metrics.incr('circuit_trials_total', outcome='started')
+
+    return True
+
+def order_for_dispatch(registrar_entries, health):
+    """ Orders registrar entries for dispatch. Nodes with an open circuit
+        are skipped, and the rest are sorted fastest and healthiest first.
+        Nodes without any health history are scored as a 1 second
+        response, and ties keep registrar order.
+
+    :param: list registrar_entries: Entries from ``current_registrar()``
+    :param: dict health: ``NodeHealth`` keyed by node name, from
+                         ``load_health()``. Missing nodes are added.
+
+    :return: list: The registrar entries to try, in order.
+    """
+    ordered = []
+    for position, entry in enumerate(registrar_entries):
+        node_name = entry['node'].node_name
+        node_health = health.setdefault(node_name, NodeHealth(node_name))
+        if not node_health.allow_dispatch():
+            logging.info(f'Skipping node with open circuit: {node_name}')
+            continue
+        ordered.append((node_health.score(), position, entry))
+
+    ordered.sort(key=lambda item: (item[0], item[1]))
+
+    return [entry for _, _, entry in ordered]
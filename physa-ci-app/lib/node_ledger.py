@@ -0,0 +1,186 @@
+import logging
+import os
+import time
+
+from dataclasses import dataclass, field
+
+# pylint: disable=import-error
+from __app__.lib import metrics, storage
+from __app__.lib.lazy_import import lazy_import
+
+table_models = lazy_import('azure.cosmosdb.table.models')
+tableservice = lazy_import('azure.cosmosdb.table.tableservice')
+
+_LEDGER_TABLE = 'rosiepiledger'
+
+STATE_ASSIGNED = 'assigned'
+STATE_STARTED = 'started'
+
+def _config(name, default):
+    """ Reads a numeric ledger setting from the app settings.
+    """
+    try:
+        return float(os.environ.get(name, default))
+    except ValueError:
+        logging.info(f'Invalid value for {name}. Using default: {default}')
+        return default
+
+def max_running():
+    """ Jobs a node runs at once.
+    """
+    return int(_config('NODE_MAX_RUNNING', 1))
+
+def max_queued():
+    """ Jobs a node may have waiting behind its running jobs.
+    """
+    return int(_config('NODE_MAX_QUEUED', 2))
+
+def stale_seconds():
+    """ Age after which an in-flight job that was never reported as
+        finished is dropped from the ledger, e.g. when its node went
+        offline mid-run.
+    """
+    return _config('NODE_LEDGER_STALE_SECONDS', 6 * 3600)
+
+def _table():
+    return tableservice.TableService(connection_string=storage.connection_string())
+
+def _row_key(check_run_id):
+    check_run_id = str(check_run_id)
+    padding = '0'*(50 - len(check_run_id))
+
+    return f'{padding}{check_run_id}'
+
+@dataclass
+class NodeLoad:
+    """ The in-flight jobs of a node, from the ledger.
+    """
+    node_name: str
+    running: list = field(default_factory=list)
+    queued: list = field(default_factory=list)
+
+    @property
+    def in_flight(self):
+        return len(self.running) + len(self.queued)
+
+    def admit(self):
+        """ Whether the node can take another job: it has a free run
+            slot, or room in its queue.
+
+        :return: bool
+        """
+        return self.in_flight < max_running() + max_queued()
+
+def _record(node_name, check_run_id, state, **timestamps):
+    entity = table_models.Entity()
+    entity.PartitionKey = node_name
+    entity.RowKey = _row_key(check_run_id)
+    entity.state = state
+    entity.update(timestamps)
+
+    try:
+        with metrics.span('ledger_write'):
+            _table().insert_or_merge_entity(_LEDGER_TABLE, entity)
+    except Exception as err:
+        logging.info(
+            f'Failed to record {state} job {check_run_id} for {node_name} '
+            f'in the ledger. Error: {err}'
+        )
+
+def record_assigned(node_name, check_run_id):
+    """ Records a job given to a node.
+    """
+    _record(node_name, check_run_id, STATE_ASSIGNED, assigned_at=time.time())
+
+def record_started(node_name, check_run_id):
+    """ Records that a node started running a job.
+    """
+    _record(node_name, check_run_id, STATE_STARTED, started_at=time.time())
+
+def record_finished(node_name, check_run_id):
+    """ Removes a finished, or handed back, job from the ledger.
+
+    :return: float: Seconds since the job started, or since it was
+                    assigned if its start wasn't reported. None if the
+                    job wasn't in the ledger.
+    """
+    table = _table()
+    elapsed = None
+    try:
+        with metrics.span('ledger_write'):
+            entity = table.get_entity(_LEDGER_TABLE, node_name, _row_key(check_run_id))
+            since = entity.get('started_at', entity.get('assigned_at'))
+            if since is not None:
+                elapsed = max(time.time() - since, 0)
+            table.delete_entity(_LEDGER_TABLE, node_name, _row_key(check_run_id))
+    except Exception as err:
+        # the job may have already been removed, or never recorded
+        logging.info(
+            f'Failed to remove job {check_run_id} for {node_name} from the '
+            f'ledger. Error: {err}'
+        )
+
+    return elapsed
+
+def record_report(node_name, check_run_id, status):
+    """ Updates the ledger from a node's ``testresult`` report.
+
+    :param: str status: The reported check run status
+
+    :return: float: For a completed job, its run time in seconds (see
+                    ``record_finished``). Otherwise None.
+    """
+    if status == 'in_progress':
+        record_started(node_name, check_run_id)
+    elif status == 'completed':
+        return record_finished(node_name, check_run_id)
+
+    return None
+
+def _load(filter_string):
+    loads = {}
+    table = _table()
+    cutoff = time.time() - stale_seconds()
+    try:
+        with metrics.span('ledger_read'):
+            entities = list(table.query_entities(_LEDGER_TABLE, filter=filter_string))
+    except Exception as err:
+        logging.info(f'Failed to load the node ledger. Error: {err}')
+        return loads
+
+    for entity in entities:
+        node_name = entity['PartitionKey']
+        check_run_id = entity['RowKey'].lstrip('0')
+        if max(entity.get('assigned_at', 0), entity.get('started_at', 0)) < cutoff:
+            logging.info(f'Dropping stale ledger job {check_run_id} for {node_name}')
+            metrics.incr('ledger_stale_total')
+            record_finished(node_name, check_run_id)
+            continue
+
+        load = loads.setdefault(node_name, NodeLoad(node_name))
+        if entity.get('state') == STATE_STARTED:
+            load.running.append(entity)
+        else:
+            load.queued.append(entity)
+
+    return loads
+
+def load_ledger():
+    """ Retrieves the in-flight jobs of all nodes. Stale jobs are
+        dropped.
+
+    :return: dict: ``NodeLoad`` keyed by node name, for nodes with
+                   in-flight jobs. Empty if the ledger couldn't be read.
+    """
+    return _load(None)
+
+def node_load(node_name):
+    """ Retrieves the in-flight jobs of one node.
+
+    :return: NodeLoad
+    """
+    # node names come from the node's request; quotes are escaped
+    escaped = node_name.replace("'", "''")
+    loads = _load(f"PartitionKey eq '{escaped}'")
+
+    return loads.get(node_name, NodeLoad(node_name))
@@ -2,24 +2,46 @@ import hmac
 import json
 import logging
 import os
-import requests
+import time
 
-from base64 import b64encode
+from base64 import b64encode, urlsafe_b64decode, urlsafe_b64encode
 from dataclasses import dataclass
 from datetime import datetime, timedelta, timezone
 from hashlib import sha256
 from socket import gethostname
 from sys import exc_info
 
-from azure.storage import queue
+# pylint: disable=import-error
+from __app__.lib import duration_estimates, message_codec, metrics
+from __app__.lib import node_health, node_ledger, storage
+from __app__.lib.lazy_import import lazy_import
 
-_AZURE_QUEUE_PEEK_MAX = 32
+requests = lazy_import('requests')
 
-_QUEUE_URL = os.environ['APP_STORAGE_CONN_STR']
-_QUEUE_CONFIG = {
-    'message_encode_policy': queue.TextBase64EncodePolicy(),
-    'message_decode_policy': queue.TextBase64DecodePolicy(),
-}
+def _sent_errors():
+    # a request that failed with one of these reached the node
+    return (requests.ReadTimeout, requests.exceptions.ChunkedEncodingError)
+
+def _config(name, default):
+    """ Reads a numeric registrar setting from the app settings.
+    """
+    try:
+        return float(os.environ.get(name, default))
+    except ValueError:
+        logging.info(f'Invalid value for {name}. Using default: {default}')
+        return default
+
+def lease_seconds():
+    """ How long a registration, or its last renewal, keeps a node in
+        the registrar.
+    """
+    return _config('REGISTRAR_LEASE_SECONDS', 3600)
+
+def lease_grace_seconds():
+    """ How long past its lease an entry is kept, so that a renewal
+        that is slightly late doesn't drop the node.
+    """
+    return _config('REGISTRAR_LEASE_GRACE_SECONDS', 300)
 
 @dataclass(eq=False)
 class NodeItem:
@@ -30,6 +52,108 @@ class NodeItem:
     node_name: str = 'Unnamed'
     listen_port: int = 4812
     busy: bool = False
+    boards: list = None
+    lease_expires: float = None
+
+    def lease_expired(self, now=None):
+        """ Whether the node's lease, plus the grace period, has run
+            out. Entries without a lease rely on their message TTL.
+        """
+        if self.lease_expires is None:
+            return False
+        if now is None:
+            now = time.time()
+
+        return self.lease_expires + lease_grace_seconds() < now
+
+def _node_content(node, renew=True):
+    """ The registrar message content for a node.
+
+    :param: NodeItem node: The node
+    :param: bool renew: Whether to start a new lease. Otherwise, the
+                        node's current lease is kept.
+
+    :return: bytes: From ``message_codec.encode()``
+    """
+    if renew or node.lease_expires is None:
+        node.lease_expires = time.time() + lease_seconds()
+
+    return message_codec.encode({
+        'node_name': node.node_name,
+        'node_ip': node.node_ip,
+        'node_sig_key': node.node_sig_key,
+        'listen_port': node.listen_port,
+        'busy': node.busy,
+        'boards': node.boards,
+        'lease_expires': node.lease_expires,
+    }, kind='registrar')
+
+def make_handle(message, node):
+    """ Builds the opaque registration handle returned to a node. It
+        holds the node's name and its registrar entry's id and pop
+        receipt, so that the entry can be updated without reading the
+        whole registrar (see ``update_registered_node``).
+
+    :param: message: The node's registrar message
+    :param: NodeItem node: The node
+
+    :return: str
+    """
+    handle = json.dumps({
+        'id': message.id, 'receipt': message.pop_receipt, 'node': node.node_name
+    })
+
+    return urlsafe_b64encode(handle.encode()).decode()
+
+def parse_handle(handle):
+    """ Reads a registration handle from ``make_handle()``.
+
+    :return: tuple: The message id, pop receipt and node name, or None if
+                    the handle is malformed.
+    """
+    try:
+        handle = json.loads(urlsafe_b64decode(handle.encode()))
+        return handle['id'], handle['receipt'], handle['node']
+    except Exception:
+        return None
+
+def _handle_entry(handle, node):
+    """ The registrar entry a node's handle points at.
+
+        Table backends read the entry by its id, so the handle stays
+        valid however often the registrar is read, and the entry is
+        checked to be the node's, with a live lease. Queues can't read one entry, so the
+        handle's pop receipt is used as it is; it goes stale when the
+        registrar is next read, and the update then fails.
+
+    :return: dict: ``message`` and ``node`` (None if the entry wasn't
+                   read), or None if the handle isn't the node's.
+    """
+    parsed = parse_handle(handle)
+    if parsed is None or parsed[2] != node.node_name:
+        return None
+    message_id, pop_receipt, _ = parsed
+
+    try:
+        with metrics.span('registrar_get'):
+            message = storage.registrar().get(message_id)
+    except NotImplementedError:
+        return {'message': storage.RegistrarMessage(message_id, pop_receipt, None), 'node': None}
+    except Exception as err:
+        logging.info(f'Failed to read registrar entry {message_id}. Error: {err}')
+        return None
+
+    try:
+        entry_node = NodeItem(**message_codec.decode(message.content))
+    except Exception:
+        return None
+    if (entry_node.node_name, entry_node.node_ip) != (node.node_name, node.node_ip):
+        return None
+    if entry_node.lease_expired():
+        # left for ``sweep_registrar``, like in ``current_registrar``
+        return None
+
+    return {'message': message, 'node': entry_node}
 
 def node_in_registrar(node_ip, node_name, registrar_entries):
     """ Checks if a node already exists in the registrar
@@ -59,10 +183,13 @@ def process_dup_node(node, current_entries):
 
     :return: status_code, body: The result of processing the new node,
                                 as updates to the HTTP response
-                                
+    :return: dict renew_entry: The node's leased entry, to renew in place
+                               of adding a new one. ``None`` if there
+                               isn't one.
     """
     status_code = 200
     body = 'OK'
+    renew_entry = None
     for entry in current_entries:
         entry_node_ip = entry['node'].node_ip
         entry_node_name = entry['node'].node_name
@@ -70,6 +197,11 @@ def process_dup_node(node, current_entries):
         if node.node_name == entry_node_name:
             if node.node_ip == entry_node_ip:
                 logging.info(f'Node exists in queue: {entry}')
+                if entry['node'].lease_expires is not None:
+                    renew_entry = entry
+                    break
+
+                # entries from before leases expire with their message
                 entry_expires = entry['message'].expires_on
                 expire_window = datetime.now(timezone.utc) + timedelta(minutes=5)
                 if entry_expires < expire_window:
@@ -91,59 +223,101 @@ def process_dup_node(node, current_entries):
                 logging.info(body + f'\nnode info: {entry["node"]}')
                 break
 
-    return status_code, body
+    return status_code, body, renew_entry
+
+def _read_registrar():
+    """ Reads every entry in the registrar.
+
+    :return: tuple: The parsed entries, as dicts of ``message`` and
+                    ``node``; and the messages that couldn't be parsed.
+    """
+    with metrics.span('registrar_read'):
+        results = storage.registrar().receive(visibility_timeout=1)
+
+    entries = []
+    malformed = []
+    for message in results:
+        try:
+            kwargs = message_codec.decode(message.content)
+            node = NodeItem(**kwargs)
+        except:
+            malformed.append(message)
+            continue
+
+        entries.append({'message': message, 'node': node})
+
+    return entries, malformed
 
 def current_registrar():
-    """ Retrieve the nodes currently in the registrar.
+    """ Retrieve the nodes currently in the registrar. Entries with an
+        expired lease, and malformed entries, are skipped; they're
+        removed by ``sweep_registrar``.
         
         
     :return: list: list of dicts 
-                   {'message': queue.QueueMessage,
+                   {'message': queue.QueueMessage, or the storage
+                               backend's equivalent,
                     'node': ``nodeItem``}.
     """
-    queue_client = queue.QueueClient.from_connection_string(
-        _QUEUE_URL,
-        'rosiepi-node-registrar',
-        **_QUEUE_CONFIG
-    )
-    msg_kwargs = {
-        'messages_per_page': _AZURE_QUEUE_PEEK_MAX,
-        'visibility_timeout': 1
-    }
-    #results = queue_client.peek_messages(max_messages=_AZURE_QUEUE_PEEK_MAX)
-    results = queue_client.receive_messages(**msg_kwargs)
+    entries, malformed = _read_registrar()
+    if malformed:
+        metrics.incr('registrar_malformed_skipped_total', len(malformed))
 
+    now = time.time()
     node_items = []
-    for message in results:
-        try:
-            kwargs = json.loads(message.content)
-            node_items.append(
-                {
-                    'message': message,
-                    'node': NodeItem(**kwargs),
-                }
-            )
-        except:
-            logging.info(
-                'Failed to process node in registrar. '
-                f'Entry malformed: {message.content}'
-            )
+    for entry in entries:
+        if entry['node'].lease_expired(now):
+            metrics.incr('registrar_expired_skipped_total')
+            continue
+        node_items.append(entry)
 
     return node_items
 
+def sweep_registrar(now=None):
+    """ Removes entries with an expired lease, and malformed entries,
+        from the registrar.
+
+    :return: tuple: The live entries (see ``current_registrar``), and
+                    the number of entries removed.
+    """
+    entries, malformed = _read_registrar()
+    if now is None:
+        now = time.time()
+
+    removed = 0
+    for message in malformed:
+        logging.info(f'Removing malformed registrar entry: {message.content}')
+        if remove_node(message):
+            removed += 1
+            metrics.incr('registrar_swept_total', reason='malformed')
+
+    node_items = []
+    for entry in entries:
+        if not entry['node'].lease_expired(now):
+            node_items.append(entry)
+            continue
+        logging.info(f'Removing node with an expired lease: {entry["node"].node_name}')
+        if remove_node(entry['message']):
+            removed += 1
+            metrics.incr('registrar_swept_total', reason='expired')
+
+    return node_items, removed
 
-def add_node(node_params, response):
-    """ Adds a node to the registrar queue. Each node entry in the 
-        registrar will expire an hour after it is added. If supplied
-        node is already in the registrar queue and set to expire within
-        5 minutes, it will be removed from the queue before adding the
-        new entry.
+
+def add_node(node_params, response, handle=None):
+    """ Adds a node to the registrar queue. Each node entry in the
+        registrar holds a lease (``REGISTRAR_LEASE_SECONDS``), which is
+        renewed by ``update_node``. If the supplied node is already in the
+        registrar, its lease is renewed in place instead of adding a new
+        entry; with the node's handle, without reading the registrar.
 
     :param: node: The ``nodeItem`` to add to the queue.
     :param: dict response: A dict to hold the results for sending
                            the response message
+    :param: str handle: The node's handle (see ``make_handle``)
 
-    :returns: dict response: The HTTP response message
+    :returns: dict response: The HTTP response message. Its body holds
+                             the node's handle (see ``make_handle``).
     """
 
     node = NodeItem(**node_params)
@@ -154,32 +328,37 @@ def add_node(node_params, response):
         response['status_code'] = 400
         response['body'] = 'Could not parse requesting node\'s signature key.'
     else:
+        if handle:
+            result = _update_by_handle(node, handle, response)
+            if result is not None:
+                metrics.incr('registrar_updates_total', path='handle')
+                return result
+            metrics.incr('registrar_stale_handles_total')
+
         current_entries = current_registrar()
+        renew_entry = None
         if node_in_registrar(node.node_ip, node.node_name, current_entries):
-            response['status_code'], response['body'] = (
+            response['status_code'], response['body'], renew_entry = (
                 process_dup_node(node, current_entries)
             )
 
-        if response['status_code'] < 400:
-            queue_msg = {
-                'node_name': node.node_name,
-                'node_ip': node.node_ip,
-                'node_sig_key': node.node_sig_key,
-                'listen_port': node.listen_port,
-                'busy': node.busy,
-            }
-
-            queue_client = queue.QueueClient.from_connection_string(
-                _QUEUE_URL,
-                'rosiepi-node-registrar',
-                **_QUEUE_CONFIG
+        if response['status_code'] < 400 and renew_entry is not None:
+            metrics.incr('registrar_updates_total', path='add')
+            response = update_node(
+                renew_entry['message'],
+                node,
+                response,
+                pop_receipt=renew_entry['message'].pop_receipt
             )
-            expiration = 3600 # 1 hour
-            ttl = {'time_to_live': expiration}
+
+        elif response['status_code'] < 400:
+            # entries are removed when their lease runs out, rather
+            # than by the queue, so that leases can be renewed.
             try:
-                sent_msg = queue_client.send_message(json.dumps(queue_msg),
-                                                     **ttl)
-                logging.info(f'Sent the following queue content: {sent_msg.content}')
+                with metrics.span('registrar_add'):
+                    sent_msg = storage.registrar().send(_node_content(node))
+                logging.info(f'Added node to the registrar: {node.node_name}')
+                _set_handle(response, sent_msg, node)
             except Exception as err:
                 response['status_code'] = 500
                 response['body'] = (
@@ -189,36 +368,29 @@ def add_node(node_params, response):
 
     return response
 
-def update_node(message, node, response, *, pop_receipt=None):
-    """ Update a node that is currently in the registrar.
+def update_node(message, node, response, *, pop_receipt=None, renew=True):
+    """ Update a node that is currently in the registrar, renewing its
+        lease.
 
     :param: str message: The id of the message in the registrar queue
     :param: nodeItem: The ``NodeItem`` with the information to update
     :param: dict response: A dict to hold the results for sending
                            the response message
+    :param: str pop_receipt: The message's current pop receipt
+    :param: bool renew: Whether to renew the node's lease. When False,
+                        the lease in ``node`` is kept.
 
-    :return: dict response: The HTTP response message
+    :return: dict response: The HTTP response message. Its body holds
+                            the node's new handle (see ``make_handle``).
     """
 
-    queue_msg = {
-        'node_name': node.node_name,
-        'node_ip': node.node_ip,
-        'node_sig_key': node.node_sig_key,
-        'listen_port': node.listen_port,
-        'busy': node.busy,
-    }
-
-    queue_client = queue.QueueClient.from_connection_string(
-        _QUEUE_URL,
-        'rosiepi-node-registrar',
-        **_QUEUE_CONFIG
-    )
     try:
-        sent_msg = queue_client.update_message(message,
-                                               pop_receipt,
-                                               json.dumps(queue_msg))
-        logging.info('Sent the following updated queue content: '
-                     f'{sent_msg.content}')
+        with metrics.span('registrar_update'):
+            message = storage.registrar().update(
+                message, pop_receipt, _node_content(node, renew)
+            )
+        logging.info(f'Updated node in the registrar: {node.node_name}')
+        _set_handle(response, message, node)
     except Exception as err:
         response['status_code'] = 500
         response['body'] = (
@@ -229,39 +401,121 @@ def update_node(message, node, response, *, pop_receipt=None):
 
     return response
 
+def _set_handle(response, message, node):
+    """ Returns a node's handle in the body of a registrar response.
+    """
+    response['body'] = json.dumps({'handle': make_handle(message, node)})
+    response.setdefault('headers', {})['Content-Type'] = 'application/json'
+
+def _update_by_handle(node, handle, response):
+    """ Updates the registrar entry a node's handle points at, without
+        reading the registrar.
+
+    :return: dict response: The HTTP response message, or None if the
+                            handle is stale or isn't the node's.
+    """
+    entry = _handle_entry(handle, node)
+    if entry is None:
+        return None
+
+    result = update_node(
+        entry['message'],
+        node,
+        dict(response),
+        pop_receipt=entry['message'].pop_receipt
+    )
+    if result['status_code'] >= 400:
+        return None
+
+    return result
+
+def update_registered_node(node, response, handle=None):
+    """ Updates a node's registrar entry for a ``registrar/update`` or
+        ``registrar/heartbeat`` request. Only the entry with the node's
+        name and IP address is updated.
+
+        With the handle from the node's last registrar response, the
+        entry is updated directly. Otherwise, or if the handle is stale,
+        the registrar is read to find it.
+
+    :param: NodeItem node: The node's current information
+    :param: dict response: A dict to hold the results for sending
+                           the response message
+    :param: str handle: The node's handle (see ``make_handle``)
+
+    :return: dict response: The HTTP response message. A 404 if the node
+                            isn't in the registrar.
+    """
+    if handle:
+        result = _update_by_handle(node, handle, response)
+        if result is not None:
+            metrics.incr('registrar_updates_total', path='handle')
+            return result
+        metrics.incr('registrar_stale_handles_total')
+
+    for entry in current_registrar():
+        if (entry['node'].node_name == node.node_name and
+            entry['node'].node_ip == node.node_ip):
+                metrics.incr('registrar_updates_total', path='update')
+                return update_node(
+                    entry['message'],
+                    node,
+                    response,
+                    pop_receipt=entry['message'].pop_receipt
+                )
+
+    response['status_code'] = 404
+    response['body'] = 'Node not found in physaCI registrar. Please re-register.'
+
+    return response
+
 def remove_node(message):
     """ Remove a node from the queue.
 
-    :param: queue.QueueMessage message: The message in the registrar queue
+    :param: message: The message in the registrar queue
 
     :return: bool: Result of the removal.
     """
     result = True
 
-    queue_client = queue.QueueClient.from_connection_string(
-        _QUEUE_URL,
-        'rosiepi-node-registrar',
-        **_QUEUE_CONFIG
-    )
     try:
-        delete_msg = queue_client.delete_message(message)
-        logging.info('Sent the following message to delete: '
-                     f'{delete_msg}')
+        with metrics.span('registrar_remove'):
+            storage.registrar().delete(message)
+        logging.info(f'Removed the following message: {message.id}')
     except Exception as err:
         logging.info(f'Error sending remove_node queue message: {err}')
         result = False
 
     return result
 
-def push_test_to_nodes(message):
+@metrics.timed('dispatch')
+def push_test_to_nodes(message, node_names=None, registrar_entries=None):
     """ Push a test request to all nodes in the node registrar.
         (Reminder: entries in the registrar queue expire after 1 hour.)
+        Nodes at their in-flight job limit in the node ledger are
+        skipped. Idle nodes are tried before busy ones, each in order
+        of when they're expected to finish the job (see
+        ``duration_estimates``).
+
+        A request that fails after it was sent (e.g. it timed out
+        waiting for the node's answer) may have been accepted, so no
+        other node is tried; the job could otherwise run twice.
     
-    :param: dict message: The JSON message to send.
+    :param: dict message: The JSON message to send. Its
+                          ``idempotency_key`` is also sent as the
+                          ``Idempotency-Key`` header.
+    :param: list node_names: Only push to these nodes. All, if None.
+    :param: list registrar_entries: Entries from ``current_registrar()``,
+                                    when already read. Read here, if
+                                    None; a read hides the entries from
+                                    other reads for a second.
 
     :return: bool job_accepted: If the job was successfully accepted
     :return: str accepted_by: The name of the node that accepted the job.
                               Returns ``None`` if not accepted.
+    :return: str unconfirmed_by: The name of the node that may have
+                                 accepted the job. Returns ``None`` if
+                                 every node answered.
     """
 
     def _send_run_test_request(item, message):
@@ -271,15 +525,23 @@ def push_test_to_nodes(message):
         response = None
 
         node = item.get('node')
+        if not node_health.start_trial(health[node.node_name]):
+            logging.info(f'Skipping node with a trial request in flight: {node.node_name}')
+            return response
         
         header = {'media': 'application/json'}
+        if message.get('idempotency_key'):
+            header['Idempotency-Key'] = message['idempotency_key']
         
+        metrics.incr('dispatch_attempts_total', busy=str(node.busy).lower())
+        start = time.monotonic()
         try:
             response = requests.post(
                 f'http://{node.node_ip}:{node.listen_port}/run-test',
                 auth=SigAuth(node),
                 headers=header,
                 json=message,
+                timeout=node_health.request_timeout(),
             )
         except Exception as err:
             traceback = exc_info()[2]
@@ -289,6 +551,9 @@ def push_test_to_nodes(message):
                 f'\tNode IP: {node.node_ip}\n'
                 f'\tException: {err.with_traceback(traceback)}'
             )
+            if isinstance(err, _sent_errors()):
+                unconfirmed.append(node.node_name)
+        _record_health(node, response, start)
 
         if response is not None:
             logging.info(f'_send_run_test request not None. response: {response}')
@@ -300,7 +565,8 @@ def push_test_to_nodes(message):
                     item['message'],
                     node,
                     {'status_code': 200, 'body': 'OK'},
-                    pop_receipt=item['message']['pop_receipt'],
+                    pop_receipt=item['message'].pop_receipt,
+                    renew=False,
                 )
                 if not result['status_code'] < 400:
                     logging.info(
@@ -325,6 +591,17 @@ def push_test_to_nodes(message):
 
         return response
 
+    def _record_health(node, response, start):
+        """ Private function to record a node request in its health.
+        """
+        success = response is not None and response.status_code < 500
+        latency = time.monotonic() - start
+        health[node.node_name].record(success, latency)
+        metrics.observe('node_request_seconds', latency)
+        if not success:
+            metrics.incr('node_request_failures_total')
+        touched.add(node.node_name)
+
     
     try:
         json_str = json.dumps(message)
@@ -335,22 +612,50 @@ def push_test_to_nodes(message):
             f'Message: {message}\n'
             f'Exception: {err}'
         )
-        return False
-
-    active_nodes = current_registrar()
-
+        return False, None, None
+
+    health = node_health.load_health()
+    ledger = node_ledger.load_ledger()
+    touched = set()
+    unconfirmed = []
+    if registrar_entries is None:
+        registrar_entries = current_registrar()
+    active_nodes = node_health.order_for_dispatch(registrar_entries, health)
+    if node_names is not None:
+        active_nodes = [
+            item for item in active_nodes if item['node'].node_name in node_names
+        ]
+
+    estimates = duration_estimates.load()
+    now = time.time()
+    idle_nodes = []
     busy_nodes = []
     job_accepted = False
     accepted_by = None
 
     for item in active_nodes:
         node = item['node']
+        load = ledger.get(node.node_name, node_ledger.NodeLoad(node.node_name))
+        if not load.admit():
+            logging.info(f'Skipping node at its job limit: {node.node_name}')
+            metrics.incr('dispatch_admission_rejected_total')
+            continue
+        item['expected_completion'] = estimates.expected_completion(
+            node, load, message.get('boards'), now
+        )
         # prefer non-busy nodes, but stash busy nodes to fallback on
-        if node.busy:
+        if node.busy or load.in_flight >= node_ledger.max_running():
             busy_nodes.append(item)
-            continue
-        
+        else:
+            idle_nodes.append(item)
+
+    # the node expected to finish the job first; ties keep health order
+    idle_nodes.sort(key=lambda item: item['expected_completion'])
+    for item in idle_nodes:
+        node = item['node']
         response = _send_run_test_request(item, message)
+        if unconfirmed:
+            break
         if not response:
             continue
         else:
@@ -366,28 +671,19 @@ def push_test_to_nodes(message):
                     f'response message: {response.text}'
                 )
 
-    # fallback to adding a test request to a busy node's queue
-    # starting with the node with the fewest queued jobs
-    if not job_accepted:
+    # fallback to adding a test request to a busy node's queue,
+    # starting with the node expected to finish the job first, once its
+    # in-flight jobs per the ledger have run (see
+    # ``duration_estimates``). nodes at their limit were skipped above.
+    if not job_accepted and not unconfirmed:
+        busy_nodes.sort(key=lambda item: item['expected_completion'])
         for item in busy_nodes:
             node = item['node']
-                        
-            try:
-                response = requests.get(
-                    f'http://{node.node_ip}:{node.listen_port}/status',
-                    auth=SigAuth(node)
-                )
-            except requests.ConnectionError:
+            if not health[node.node_name].allow_dispatch():
                 continue
-
-            if response.ok:
-                status = response.json()
-                item['node_job_count'] = status.get('job_count', 999)
-
-        busy_nodes.sort(key=lambda count: count.get('node_job_count', 999))
-        for item in busy_nodes:
-            node = item['node']
             response = _send_run_test_request(item, message)
+            if unconfirmed:
+                break
             if not response:
                 continue
             else:
@@ -403,9 +699,19 @@ def push_test_to_nodes(message):
                         f'response message: {response.text}'
                     )
 
-    return job_accepted, accepted_by
+    node_health.save_health(health[name] for name in touched)
 
-class SigAuth(requests.auth.AuthBase):
+    outcome = 'accepted' if job_accepted else 'rejected'
+    if unconfirmed:
+        outcome = 'unconfirmed'
+    metrics.incr('dispatch_total', outcome=outcome)
+
+    return job_accepted, accepted_by, unconfirmed[0] if unconfirmed else None
+
+class SigAuth():
+    """ ``requests`` authentication handler that signs requests to a
+        node's server with the node's signature key.
+    """
     def __init__(self, node):
         self.node = node
 
@@ -0,0 +1,317 @@
+import cProfile
+import json
+import logging
+import marshal
+import os
+import pstats
+import random
+import re
+import sys
+import tempfile
+import threading
+import time
+
+from collections import Counter
+from contextlib import contextmanager
+from datetime import datetime
+
+# pylint: disable=import-error
+from __app__.lib.lazy_import import lazy_import
+
+file_models = lazy_import('azure.storage.file.models')
+fileservice = lazy_import('azure.storage.file.fileservice')
+
+MODE_CPROFILE = 'cprofile'
+MODE_SAMPLING = 'sampling'
+
+OUTPUT_LOCAL = 'local'
+OUTPUT_FILES = 'files'
+
+_PROFILE_SHARE = 'rosiepi-profiles'
+
+# the profile of the invocation running in this thread, if any
+_ACTIVE = threading.local()
+
+def _config(name, default):
+    """ Reads a numeric profiling setting from the app settings.
+    """
+    try:
+        return float(os.environ.get(name, default))
+    except ValueError:
+        logging.info(f'Invalid value for {name}. Using default: {default}')
+        return default
+
+def profiled_functions():
+    """ The functions that may be profiled, from the comma separated
+        ``PROFILE_FUNCTIONS`` app setting; ``*`` for all of them. None,
+        by default.
+    """
+    names = os.environ.get('PROFILE_FUNCTIONS', '')
+
+    return {name.strip() for name in names.split(',') if name.strip()}
+
+def sample_rate():
+    """ Fraction of a profiled function's invocations that are profiled.
+    """
+    return min(max(_config('PROFILE_SAMPLE_RATE', 1), 0), 1)
+
+def mode():
+    """ How invocations are profiled, from the ``PROFILE_MODE`` app
+        setting: ``cprofile`` traces every call; ``sampling`` records
+        the stack every ``PROFILE_INTERVAL_SECONDS``, which costs less
+        on long invocations.
+    """
+    value = os.environ.get('PROFILE_MODE', MODE_CPROFILE)
+    if value not in (MODE_CPROFILE, MODE_SAMPLING):
+        logging.info(f'Invalid PROFILE_MODE: {value}. Using cprofile.')
+        value = MODE_CPROFILE
+
+    return value
+
+def sample_interval():
+    """ Seconds between stack samples in ``sampling`` mode.
+    """
+    return max(_config('PROFILE_INTERVAL_SECONDS', 0.005), 0.001)
+
+def output():
+    """ Where profiles are written, from the ``PROFILE_OUTPUT`` app
+        setting: ``local`` writes to ``PROFILE_DIR``; ``files`` to the
+        ``rosiepi-profiles`` file share.
+    """
+    value = os.environ.get('PROFILE_OUTPUT', OUTPUT_LOCAL)
+    if value not in (OUTPUT_LOCAL, OUTPUT_FILES):
+        logging.info(f'Invalid PROFILE_OUTPUT: {value}. Using local.')
+        value = OUTPUT_LOCAL
+
+    return value
+
+def profile_dir():
+    """ The local directory profiles are written to.
+    """
+    return os.environ.get(
+        'PROFILE_DIR', os.path.join(tempfile.gettempdir(), 'physaci-profiles')
+    )
+
+def top_frames():
+    """ Frames listed in a profile's summary.
+    """
+    return int(_config('PROFILE_TOP_FRAMES', 25))
+
+def should_profile(function_name):
+    """ Whether to profile an invocation of a function.
+    """
+    functions = profiled_functions()
+    if function_name not in functions and '*' not in functions:
+        return False
+
+    return random.random() < sample_rate()
+
+def tag(**tags):
+    """ Tags the profile of the current invocation, if it's being
+        profiled (e.g. with its ``event`` and ``check_run_id``). Tags
+        with a None value are ignored.
+    """
+    profile = getattr(_ACTIVE, 'profile', None)
+    if profile is not None:
+        profile.tags.update(
+            {key: str(value) for key, value in tags.items() if value is not None}
+        )
+
+def _frame_name(filename, line, function):
+    return f'{function} ({os.path.basename(filename)}:{line})'
+
+
+class CProfileProfile():
+    """ Profiles an invocation with ``cProfile``. The raw profile is
+        saved in ``pstats`` format.
+    """
+
+    extension = 'prof'
+
+    def __init__(self):
+        self.tags = {}
+        self.profiler = cProfile.Profile()
+
+    def start(self):
+        self.profiler.enable()
+
+    def stop(self):
+        self.profiler.disable()
+
+    def data(self):
+        self.profiler.create_stats()
+        return marshal.dumps(self.profiler.stats)
+
+    def summary(self):
+        """ The ``top_frames()`` frames with the most cumulative time.
+        """
+        stats = pstats.Stats(self.profiler)
+        rows = []
+        for (filename, line, function), (_, calls, own, cumulative, _) in stats.stats.items():
+            rows.append({
+                'frame': _frame_name(filename, line, function),
+                'calls': calls,
+                'self_ms': round(own * 1000, 3),
+                'cumulative_ms': round(cumulative * 1000, 3),
+            })
+        rows.sort(key=lambda row: row['cumulative_ms'], reverse=True)
+
+        return rows[:top_frames()]
+
+
+class SamplingProfile():
+    """ Profiles an invocation by sampling its thread's stack from a
+        background thread. The raw profile is saved as folded stacks
+        (``frame;frame;frame count``), the input of most flame graph
+        tools.
+    """
+
+    extension = 'folded'
+
+    def __init__(self, interval=None):
+        self.tags = {}
+        self.interval = interval or sample_interval()
+        self.stacks = Counter()
+        self.samples = 0
+        self._thread_id = threading.get_ident()
+        self._stopped = threading.Event()
+        self._sampler = threading.Thread(target=self._sample, daemon=True)
+
+    def start(self):
+        self._sampler.start()
+
+    def stop(self):
+        self._stopped.set()
+        self._sampler.join()
+
+    def _sample(self):
+        while not self._stopped.wait(self.interval):
+            frame = sys._current_frames().get(self._thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(_frame_name(code.co_filename, frame.f_lineno, code.co_name))
+                frame = frame.f_back
+            if stack:
+                self.stacks[';'.join(reversed(stack))] += 1
+                self.samples += 1
+
+    def data(self):
+        lines = [f'{stack} {count}' for stack, count in self.stacks.most_common()]
+        return '\n'.join(lines).encode('utf-8')
+
+    def summary(self):
+        """ The ``top_frames()`` frames seen in the most samples, with
+            the samples they were running in (``self``) and on the stack
+            of (``inclusive``).
+        """
+        own = Counter()
+        inclusive = Counter()
+        for stack, count in self.stacks.items():
+            frames = stack.split(';')
+            own[frames[-1]] += count
+            for frame in set(frames):
+                inclusive[frame] += count
+
+        ms_per_sample = self.interval * 1000
+        return [
+            {
+                'frame': frame,
+                'self_ms': round(own[frame] * ms_per_sample, 3),
+                'cumulative_ms': round(count * ms_per_sample, 3),
+            }
+            for frame, count in inclusive.most_common(top_frames())
+        ]
+
+
+def _file_name(function_name, started, tags):
+    parts = [function_name, started.strftime('%Y%m%dT%H%M%S%fZ')]
+    parts.extend(tags[key] for key in ('event', 'check_run_id') if key in tags)
+
+    return re.sub(r'[^\w.-]', '_', '-'.join(parts))
+
+def save(function_name, profile, record):
+    """ Writes a profile, and its summary as JSON, to the configured
+        output.
+
+    :return: str: Where the profile was written.
+    """
+    started = datetime.utcfromtimestamp(record['started_at'])
+    name = _file_name(function_name, started, profile.tags)
+    files = {
+        f'{name}.{profile.extension}': profile.data(),
+        f'{name}.json': json.dumps(record, indent=2).encode('utf-8'),
+    }
+
+    if output() == OUTPUT_FILES:
+        file_service = fileservice.FileService(
+            connection_string=os.environ['APP_STORAGE_CONN_STR']
+        )
+        file_service.create_share(_PROFILE_SHARE, fail_on_exist=False)
+        file_service.create_directory(_PROFILE_SHARE, function_name, fail_on_exist=False)
+        for file_name, data in files.items():
+            file_service.create_file_from_bytes(
+                _PROFILE_SHARE,
+                function_name,
+                file_name,
+                data,
+                content_settings=file_models.ContentSettings(
+                    content_type='application/octet-stream'
+                )
+            )
+        return f'{_PROFILE_SHARE}/{function_name}/{name}'
+
+    directory = os.path.join(profile_dir(), function_name)
+    os.makedirs(directory, exist_ok=True)
+    for file_name, data in files.items():
+        with open(os.path.join(directory, file_name), 'wb') as profile_file:
+            profile_file.write(data)
+
+    return os.path.join(directory, name)
+
+@contextmanager
+def profiled(function_name):
+    """ Profiles the block, if the invocation is picked to be (see
+        ``should_profile``), and saves the profile when it exits. A
+        summary of the profile is logged as a JSON line, prefixed with
+        ``physaci.profile`` for log queries.
+
+    :param: str function_name: The name of the Azure Function
+    """
+    if not should_profile(function_name) or getattr(_ACTIVE, 'profile', None):
+        yield
+        return
+
+    if mode() == MODE_SAMPLING:
+        profile = SamplingProfile()
+    else:
+        profile = CProfileProfile()
+    try:
+        profile.start()
+    except ValueError as err:
+        # e.g. another profiler is already running in this thread
+        logging.info(f'Failed to start profiler. Error: {err}')
+        yield
+        return
+
+    _ACTIVE.profile = profile
+    started_at = time.time()
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.stop()
+        _ACTIVE.profile = None
+        record = {
+            'function': function_name,
+            'mode': mode(),
+            'tags': profile.tags,
+            'started_at': started_at,
+            'duration_ms': round((time.perf_counter() - start) * 1000, 3),
+            'top_frames': profile.summary(),
+        }
+        try:
+            record['path'] = save(function_name, profile, record)
+        except Exception as err:
+            logging.info(f'Failed to save profile of {function_name}. Error: {err}')
+        logging.info(f'physaci.profile {json.dumps(record, default=str)}')
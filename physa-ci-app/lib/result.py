@@ -1,8 +1,14 @@
-import copy
 import json
 import logging
 import re
-from azure.cosmosdb.table.models import Entity
+
+# pylint: disable=import-error
+from __app__.lib.lazy_import import lazy_import
+
+table_models = lazy_import('azure.cosmosdb.table.models')
+
+# Table string properties hold at most 64KiB of UTF-16.
+_SUMMARY_MAX_CHARS = 32000
 
 
 class Result():
@@ -18,14 +24,21 @@ class Result():
         :return: azure.cosmodb.table.models.Entity or None
         """
         if self.results:
-            temp_results = copy.deepcopy(self.results)
-            entity = Entity()
+            # only top-level keys are removed, so a shallow copy is enough
+            temp_results = dict(self.results)
+            entity = table_models.Entity()
             entity.PartitionKey = temp_results.get('node_name')
             
             run_id = temp_results.get('check_run_id')
             padding = '0'*(50 - len(run_id))
             padded_id = f'{padding}{run_id}'
             entity.RowKey = padded_id
+
+            # stored outside of ``json_data`` so that results can be
+            # queried by commit (see ``node_db.find_results``).
+            head_sha = temp_results.get('check_run_head_sha')
+            if head_sha:
+                entity.check_run_head_sha = head_sha
  
             for item in ('PartitionKey', 'RowKey'):
                 if item in temp_results:
@@ -41,6 +54,19 @@ class Result():
                 )
                 raise
 
+            # the results without the board tests, so that a summary can
+            # be read without loading ``json_data`` (see
+            # ``node_db.get_result``).
+            summary = {
+                key: value for key, value in temp_results.items()
+                if key != 'node_results'
+            }
+            if isinstance(temp_results.get('node_results'), list):
+                summary['node_results_count'] = len(temp_results['node_results'])
+            summary_json = json.dumps(summary)
+            if len(summary_json) <= _SUMMARY_MAX_CHARS:
+                entity.update({'summary_json': summary_json})
+
             return entity
 
     def results_to_github(self, key_prefix='check_run_'):
@@ -0,0 +1,211 @@
+import logging
+import re
+import time
+
+# pylint: disable=import-error
+from __app__.lib import metrics, storage
+from __app__.lib.lazy_import import lazy_import
+
+azure_common = lazy_import('azure.common')
+table_models = lazy_import('azure.cosmosdb.table.models')
+tablebatch = lazy_import('azure.cosmosdb.table.tablebatch')
+tableservice = lazy_import('azure.cosmosdb.table.tableservice')
+
+_AGGREGATE_TABLE = 'rosiepiaggregates'
+
+KIND_BOARD = 'board'
+KIND_NODE = 'node'
+
+# Upper bounds, in seconds, of the duration histogram buckets.
+_DURATION_BUCKETS = (60, 120, 300, 600, 900, 1200, 1800, 2700, 3600, 7200)
+
+# A batch is limited to 100 entities.
+_BATCH_ENTITIES = 100
+
+# attempts at updating aggregates when another write wins the race
+_UPDATE_ATTEMPTS = 5
+
+_PASSED_OUTCOMES = ('pass', 'passed', 'success', 'true')
+
+
+def _table():
+    return tableservice.TableService(connection_string=storage.connection_string())
+
+def _safe_key(value):
+    # ``/``, ``\\``, ``#`` and ``?`` aren't allowed in a ``RowKey``
+    return re.sub(r'[^\w.-]', '_', str(value))
+
+def _bucket_key(duration):
+    for bound in _DURATION_BUCKETS:
+        if duration <= bound:
+            return f'duration_le_{bound}'
+
+    return 'duration_le_inf'
+
+def board_passed(board_test):
+    """ Whether a board test passed. Nodes report ``outcome`` as a bool
+        or a string such as ``Passed``.
+
+    :return: bool, or None if the board test has no outcome.
+    """
+    outcome = board_test.get('outcome')
+    if outcome is None:
+        return None
+    if isinstance(outcome, bool):
+        return outcome
+
+    return str(outcome).lower() in _PASSED_OUTCOMES
+
+def add_run(entity, passed, duration, now):
+    """ Adds a run to an aggregate entity.
+
+    :param: dict entity: The aggregate. Updated in place.
+    :param: bool passed: The run's outcome; None if it has none.
+    :param: float duration: The run's duration in seconds, if known.
+    :param: float now: The current time, in seconds since the epoch.
+    """
+    entity['runs'] = entity.get('runs', 0) + 1
+    if passed is not None:
+        outcome = 'passed' if passed else 'failed'
+        entity[outcome] = entity.get(outcome, 0) + 1
+        if not passed:
+            entity['last_failed_at'] = now
+    if duration is not None:
+        bucket = _bucket_key(duration)
+        entity[bucket] = entity.get(bucket, 0) + 1
+        entity['duration_count'] = entity.get('duration_count', 0) + 1
+        entity['duration_sum'] = float(entity.get('duration_sum', 0)) + duration
+    entity['last_run_at'] = now
+
+def _update(table, kind, runs, now):
+    """ Adds runs to the aggregates of one kind, in batches. A batch is
+        retried, from a fresh read, if another write updated one of its
+        entities first.
+
+    :param: dict runs: ``(passed, duration)`` lists keyed by name
+    """
+    names = sorted(runs)
+    for start in range(0, len(names), _BATCH_ENTITIES):
+        batch_names = names[start:start + _BATCH_ENTITIES]
+        for _ in range(_UPDATE_ATTEMPTS):
+            batch = tablebatch.TableBatch()
+            for name in batch_names:
+                row_key = _safe_key(name)
+                try:
+                    entity = table.get_entity(_AGGREGATE_TABLE, kind, row_key)
+                    etag = entity.pop('etag', None)
+                    entity.pop('Timestamp', None)
+                except azure_common.AzureHttpError as err:
+                    if err.status_code != 404:
+                        raise
+                    entity = table_models.Entity()
+                    entity.PartitionKey = kind
+                    entity.RowKey = row_key
+                    entity.name = str(name)
+                    etag = None
+
+                for passed, duration in runs[name]:
+                    add_run(entity, passed, duration, now)
+
+                if etag is None:
+                    batch.insert_entity(entity)
+                else:
+                    batch.update_entity(entity, if_match=etag)
+
+            try:
+                with metrics.span('aggregate_update', kind=kind):
+                    table.commit_batch(_AGGREGATE_TABLE, batch)
+                break
+            except azure_common.AzureHttpError as err:
+                # 409: inserted, 412: updated by a concurrent result
+                if err.status_code not in (409, 412):
+                    raise
+                metrics.incr('aggregate_conflicts_total', kind=kind)
+        else:
+            logging.info(
+                f'Failed to update {kind} aggregates for {batch_names}; too '
+                'many concurrent updates.'
+            )
+
+def record_run(node_name, conclusion, board_tests, duration=None):
+    """ Adds a completed check run to the node and board aggregates.
+        Call once per check run.
+
+    :param: str node_name: The node that ran the tests
+    :param: str conclusion: The check run's conclusion
+    :param: list board_tests: The run's board tests. A board test's
+                              optional ``duration`` (seconds) is added
+                              to the board's duration histogram.
+    :param: float duration: The run's duration in seconds, if known.
+    """
+    now = time.time()
+    table = _table()
+
+    passed = {'success': True, 'failure': False}.get(conclusion)
+    _update(table, KIND_NODE, {node_name: [(passed, duration)]}, now)
+
+    boards = {}
+    for board_test in board_tests or []:
+        if not isinstance(board_test, dict) or not board_test.get('board_name'):
+            continue
+        board_duration = board_test.get('duration')
+        if not isinstance(board_duration, (int, float)) or isinstance(board_duration, bool):
+            board_duration = None
+        boards.setdefault(board_test['board_name'], []).append(
+            (board_passed(board_test), board_duration)
+        )
+    if boards:
+        _update(table, KIND_BOARD, boards, now)
+
+    metrics.incr('aggregate_runs_total')
+
+def summarise(entity):
+    """ Formats an aggregate entity for the query endpoint.
+
+    :return: dict
+    """
+    runs = entity.get('runs', 0)
+    passed = entity.get('passed', 0)
+    failed = entity.get('failed', 0)
+    duration_count = entity.get('duration_count', 0)
+
+    buckets = {
+        str(bound): entity.get(f'duration_le_{bound}', 0)
+        for bound in _DURATION_BUCKETS
+    }
+    buckets['+Inf'] = entity.get('duration_le_inf', 0)
+
+    return {
+        'name': entity.get('name', entity.get('RowKey')),
+        'runs': runs,
+        'passed': passed,
+        'failed': failed,
+        'pass_rate': round(passed / (passed + failed), 4) if passed + failed else None,
+        'duration': {
+            'count': duration_count,
+            'mean': (
+                round(entity.get('duration_sum', 0) / duration_count, 1)
+                if duration_count else None
+            ),
+            'buckets': buckets,
+        },
+        'last_run_at': entity.get('last_run_at'),
+        'last_failed_at': entity.get('last_failed_at'),
+    }
+
+def query(kind, name=None):
+    """ Reads aggregates.
+
+    :param: str kind: ``board`` or ``node``
+    :param: str name: A single board or node. All of them, if None.
+
+    :return: list of dict: From ``summarise()``.
+    """
+    filter_string = f"PartitionKey eq '{kind}'"
+    if name is not None:
+        filter_string += f" and RowKey eq '{_safe_key(name)}'"
+
+    with metrics.span('aggregate_query', kind=kind):
+        entities = list(_table().query_entities(_AGGREGATE_TABLE, filter=filter_string))
+
+    return [summarise(entity) for entity in entities]
@@ -0,0 +1,328 @@
+import io
+import json
+import logging
+import re
+
+# pylint: disable=import-error
+from __app__.lib import metrics, result_files, storage
+from __app__.lib.lazy_import import lazy_import
+
+azure_common = lazy_import('azure.common')
+tablebatch = lazy_import('azure.cosmosdb.table.tablebatch')
+tableservice = lazy_import('azure.cosmosdb.table.tableservice')
+
+_CHUNK_TABLE = 'rosiepichunks'
+
+# Table string properties hold at most 64KiB of UTF-16, and an entity
+# at most 1MiB, so board tests are split across ``data_<n>`` properties.
+_PART_CHARS = 32000
+_MAX_PARTS = 15
+
+# A batch is limited to 100 entities and a 4MiB payload.
+_BATCH_ENTITIES = 100
+_BATCH_CHARS = 1500000
+
+# attempts at merging a board delta when another write wins the race
+_MERGE_ATTEMPTS = 5
+
+
+class ChunkError(ValueError):
+    """ Raised when an appended chunk can't be stored.
+    """
+
+
+def padded_id(check_run_id):
+    """ Pads a check run ID the same way as the ``rosiepi`` table's
+        ``RowKey``.
+    """
+    check_run_id = str(check_run_id)
+    padding = '0'*(50 - len(check_run_id))
+
+    return f'{padding}{check_run_id}'
+
+def _row_key(node_name, chunk, line):
+    return f'{node_name}|{chunk:08d}|{line:05d}'
+
+def _board_row_key(node_name, board_name):
+    # sorts after the chunk rows of the same node
+    board_name = re.sub(r'[^\w.-]', '_', board_name)
+    return f'{node_name}|board|{board_name}'
+
+def _node_filter(check_run_id, node_name):
+    """ Query filter for every stored board test of a node's check run.
+        ``}`` sorts directly after the ``|`` separator.
+    """
+    node_name = node_name.replace("'", "''")
+    return (
+        f"PartitionKey eq '{padded_id(check_run_id)}' and "
+        f"RowKey ge '{node_name}|' and RowKey lt '{node_name}}}'"
+    )
+
+def iter_ndjson(body):
+    """ Iterates the lines of an NDJSON body, without decoding the whole
+        body at once.
+
+    :param: bytes body: The NDJSON body
+
+    :return: generator of (line number, str line). Blank lines are
+             skipped.
+    """
+    for line_number, line in enumerate(io.BytesIO(body), start=1):
+        line = line.strip()
+        if line:
+            yield line_number, line.decode('utf-8')
+
+def verify_chunk(body):
+    """ Verifies that every line of a chunk is a JSON object small
+        enough to store.
+
+    :param: bytes body: The NDJSON body
+
+    :return: int: The number of board tests in the chunk.
+    """
+    count = 0
+    for line_number, line in iter_ndjson(body):
+        if len(line) > _PART_CHARS * _MAX_PARTS and not result_files.offload_bytes():
+            raise ChunkError(f'Line {line_number} is too large to store.')
+        try:
+            board_test = json.loads(line)
+        except ValueError as err:
+            raise ChunkError(f'Line {line_number} is not valid JSON: {err}')
+        if not isinstance(board_test, dict):
+            raise ChunkError(f'Line {line_number} is not a JSON object.')
+        count += 1
+
+    return count
+
+def _chunk_entity(check_run_id, node_name, row_key, line):
+    entity = {
+        'PartitionKey': padded_id(check_run_id),
+        'RowKey': row_key,
+        'node_name': node_name,
+        'parts': 0,
+    }
+    for start in range(0, len(line), _PART_CHARS):
+        entity[f'data_{entity["parts"]}'] = line[start:start + _PART_CHARS]
+        entity['parts'] += 1
+
+    return entity
+
+def _entity_line(entity):
+    return ''.join(entity[f'data_{part}'] for part in range(entity['parts']))
+
+def append_chunk(check_run_id, node_name, chunk, body):
+    """ Stores a chunk of board tests for a node's check run. Each line is
+        stored as its own entity, so a run's results are never held in
+        memory in full. Large strings are moved to the file share (see
+        ``result_files``). Re-sending a chunk number replaces its lines.
+
+    :param: check_run_id: The check run the results belong to
+    :param: str node_name: The node running the tests
+    :param: int chunk: The chunk's sequence number. Board tests are
+                       returned in chunk, then line, order.
+    :param: bytes body: The NDJSON body; one board test per line.
+
+    :return: int: The number of board tests stored.
+    """
+    if not 0 <= chunk < 10**8:
+        raise ChunkError(f'Chunk number out of range: {chunk}')
+    verify_chunk(body)
+
+    # every line is checked before anything is written, so that a chunk
+    # that can't be stored doesn't leave files behind
+    lines = []
+    for line_number, line in iter_ndjson(body):
+        board_test = json.loads(line)
+        files = result_files.plan_offload(check_run_id, node_name, [board_test],
+                                          name_prefix=f'{chunk}-{line_number}')
+        if files:
+            line = json.dumps(board_test)
+        if len(line) > _PART_CHARS * _MAX_PARTS:
+            raise ChunkError(f'Line {line_number} is too large to store.')
+        lines.append((line_number, line, files))
+
+    table = tableservice.TableService(connection_string=storage.connection_string())
+
+    stored = 0
+    batch = tablebatch.TableBatch()
+    batch_entities = batch_chars = 0
+    batch_files = []
+
+    def commit():
+        # a batch's files are written right before its lines are stored
+        result_files.write_offloaded(check_run_id, batch_files)
+        with metrics.span('chunk_commit'):
+            table.commit_batch(_CHUNK_TABLE, batch)
+
+    for line_number, line, files in lines:
+        if (batch_entities >= _BATCH_ENTITIES or
+            batch_chars + len(line) > _BATCH_CHARS):
+                commit()
+                batch = tablebatch.TableBatch()
+                batch_entities = batch_chars = 0
+                batch_files = []
+
+        batch.insert_or_replace_entity(
+            _chunk_entity(
+                check_run_id, node_name, _row_key(node_name, chunk, line_number), line
+            )
+        )
+        batch_files.extend(files)
+        batch_entities += 1
+        batch_chars += len(line)
+        stored += 1
+
+    if batch_entities:
+        commit()
+
+    metrics.incr('chunk_board_tests_total', stored)
+    logging.info(
+        f'Stored {stored} board tests for check run {check_run_id} '
+        f'(node: {node_name}, chunk: {chunk})'
+    )
+
+    return stored
+
+def count_board_tests(check_run_id, node_name):
+    """ Counts the board tests stored for a node's check run.
+
+    :return: int
+    """
+    table = tableservice.TableService(connection_string=storage.connection_string())
+    with metrics.span('chunk_query'):
+        entities = table.query_entities(
+            _CHUNK_TABLE,
+            filter=_node_filter(check_run_id, node_name),
+            select='RowKey'
+        )
+        return sum(1 for _ in entities)
+
+def iter_board_tests(check_run_id, node_name):
+    """ Iterates the board tests stored for a node's check run, in the
+        order they were appended.
+
+    :return: generator of dict
+    """
+    table = tableservice.TableService(connection_string=storage.connection_string())
+    entities = table.query_entities(
+        _CHUNK_TABLE,
+        filter=_node_filter(check_run_id, node_name)
+    )
+    for entity in entities:
+        board_test = json.loads(_entity_line(entity))
+        board_test.pop('_seq', None)
+        yield board_test
+
+def merge_board(stored, delta, seq):
+    """ Merges a board delta into a stored board test. Each field keeps
+        the sequence number it was last set by (in ``_seq``), and is only
+        changed by a delta with a higher one. Replayed and out of order
+        deltas therefore leave the board as if every delta was applied
+        once, in order.
+
+    :param: dict stored: The stored board test. Updated in place.
+    :param: dict delta: The changed fields of the board test
+    :param: int seq: The delta's sequence number
+
+    :return: bool: Whether any field was changed.
+    """
+    field_seqs = stored.setdefault('_seq', {})
+    changed = False
+    for key, value in delta.items():
+        if key == '_seq' or seq <= field_seqs.get(key, -1):
+            continue
+        stored[key] = value
+        field_seqs[key] = seq
+        changed = True
+
+    return changed
+
+def apply_delta(check_run_id, node_name, seq, board_tests):
+    """ Merges board test deltas into the stored results of a node's
+        check run (see ``merge_board``). Each board is stored as its own
+        entity, so a delta costs one read and one write per board in it,
+        however many results are already stored.
+
+    :param: check_run_id: The check run the results belong to
+    :param: str node_name: The node running the tests
+    :param: int seq: The delta's sequence number. Must increase with each
+                     delta a node sends for a check run.
+    :param: list board_tests: The new or changed board tests; each needs
+                              a ``board_name``.
+
+    :return: int: The number of boards changed.
+    """
+    if not isinstance(seq, int) or seq < 0:
+        raise ChunkError(f'Invalid delta sequence number: {seq}')
+    if not isinstance(board_tests, list):
+        raise ChunkError('Delta board_tests must be a list.')
+    for board_test in board_tests:
+        if not (isinstance(board_test, dict) and
+                isinstance(board_test.get('board_name'), str)):
+            raise ChunkError('Each delta board test needs a board_name.')
+
+    # named by board, so that a board's files in a delta don't depend
+    # on where the node put it in the list
+    board_files = [
+        result_files.plan_offload(
+            check_run_id, node_name, [board_test], name_prefix=f'delta-{seq}',
+            name_key='board_name'
+        )
+        for board_test in board_tests
+    ]
+
+    table = tableservice.TableService(connection_string=storage.connection_string())
+
+    changed = 0
+    for board_test, files in zip(board_tests, board_files):
+        row_key = _board_row_key(node_name, board_test['board_name'])
+        for _ in range(_MERGE_ATTEMPTS):
+            try:
+                with metrics.span('delta_merge'):
+                    try:
+                        entity = table.get_entity(
+                            _CHUNK_TABLE, padded_id(check_run_id), row_key
+                        )
+                        stored, etag = json.loads(_entity_line(entity)), entity['etag']
+                    except azure_common.AzureHttpError as err:
+                        if err.status_code != 404:
+                            raise
+                        stored, etag = {}, None
+
+                    if not merge_board(stored, board_test, seq):
+                        break
+
+                    line = json.dumps(stored)
+                    if len(line) > _PART_CHARS * _MAX_PARTS:
+                        raise ChunkError(
+                            f'Board {board_test["board_name"]} is too large to store.'
+                        )
+                    new_entity = _chunk_entity(check_run_id, node_name, row_key, line)
+                    # a board's files are written once its merge is known
+                    # to change it, right before it is stored
+                    result_files.write_offloaded(check_run_id, files)
+                    files = []
+                    if etag is None:
+                        table.insert_entity(_CHUNK_TABLE, new_entity)
+                    else:
+                        table.update_entity(_CHUNK_TABLE, new_entity, if_match=etag)
+                changed += 1
+                break
+            except azure_common.AzureHttpError as err:
+                # 409: inserted, 412: updated by a concurrent delta
+                if err.status_code not in (409, 412):
+                    raise
+                metrics.incr('delta_conflicts_total')
+        else:
+            raise ChunkError(
+                f'Board {board_test["board_name"]} could not be merged; too many '
+                'concurrent updates.'
+            )
+
+    metrics.incr('delta_boards_total', changed)
+    logging.info(
+        f'Merged delta {seq} for check run {check_run_id} (node: {node_name}). '
+        f'Boards changed: {changed}/{len(board_tests)}'
+    )
+
+    return changed
@@ -0,0 +1,250 @@
+import logging
+import os
+import re
+
+# pylint: disable=import-error
+from __app__.lib import metrics, storage
+from __app__.lib.lazy_import import lazy_import
+
+file_models = lazy_import('azure.storage.file.models')
+fileservice = lazy_import('azure.storage.file.fileservice')
+
+_RESULT_SHARE = 'rosiepi-results'
+
+_TEXT_CONTENT_TYPE = 'text/plain; charset=utf-8'
+
+_RANGE_HEADER = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+# directories already created by this worker
+_DIRECTORIES = set()
+
+
+class RangeNotSatisfiable(ValueError):
+    """ Raised when a requested byte range is outside of a file.
+    """
+
+
+def _config(name, default):
+    """ Reads a numeric file storage setting from the app settings.
+    """
+    try:
+        return int(os.environ.get(name, default))
+    except ValueError:
+        logging.info(f'Invalid value for {name}. Using default: {default}')
+        return default
+
+def offload_bytes():
+    """ Size, in bytes, above which a string in a board test is moved to
+        the file share. ``0`` disables offloading.
+    """
+    return _config('RESULT_OFFLOAD_BYTES', 8192)
+
+def max_range():
+    """ Largest number of bytes served from a file in one response.
+    """
+    return _config('RESULT_FILE_MAX_RANGE', 4 * 1024 * 1024)
+
+def _file_service():
+    return fileservice.FileService(connection_string=storage.connection_string())
+
+def _directory(check_run_id):
+    check_run_id = str(check_run_id)
+    padding = '0'*(50 - len(check_run_id))
+
+    return f'{padding}{check_run_id}'
+
+def _safe_name(value):
+    return re.sub(r'[^\w.-]', '_', str(value))
+
+def _ensure_directory(file_service, directory):
+    if directory in _DIRECTORIES:
+        return
+    if not _DIRECTORIES:
+        file_service.create_share(_RESULT_SHARE, fail_on_exist=False)
+    file_service.create_directory(_RESULT_SHARE, directory, fail_on_exist=False)
+    _DIRECTORIES.add(directory)
+
+def plan_offload(check_run_id, node_name, board_tests, name_prefix='',
+                 name_key=None):
+    """ Replaces large strings (e.g. test logs) in board tests with
+        pointers to the files they are to be moved to:
+        ``{'file': <path>, 'size': <bytes>, 'content_type': <type>}``.
+        Nothing is written; the files are written by ``write_offloaded``,
+        once the board tests are known to be stored.
+
+    :param: check_run_id: The check run the results belong to
+    :param: str node_name: The node that ran the tests
+    :param: list board_tests: The board tests. Updated in place.
+    :param: str name_prefix: Prefix for the file names, to keep files
+                             from different uploads apart.
+    :param: str name_key: A board test key (e.g. ``board_name``) to name
+                          its files by, instead of its position in
+                          ``board_tests``.
+
+    :return: list: ``(file name, bytes)`` of the files to write.
+    """
+    threshold = offload_bytes()
+    if not threshold or not board_tests:
+        return []
+
+    directory = _directory(check_run_id)
+    files = []
+
+    def offload(value, path):
+        if isinstance(value, dict):
+            for key, item in value.items():
+                value[key] = offload(item, path + [key])
+        elif isinstance(value, list):
+            for index, item in enumerate(value):
+                value[index] = offload(item, path + [index])
+        elif isinstance(value, str) and len(value) > threshold // 4:
+            data = value.encode('utf-8')
+            if len(data) > threshold:
+                parts = [name_prefix] if name_prefix else []
+                parts.extend(str(part) for part in path)
+                file_name = _safe_name(f'{node_name}-{".".join(parts)}.txt')
+                files.append((file_name, data))
+
+                return {
+                    'file': f'{directory}/{file_name}',
+                    'size': len(data),
+                    'content_type': _TEXT_CONTENT_TYPE,
+                }
+
+        return value
+
+    for index, board_test in enumerate(board_tests):
+        offload(board_test, [board_test[name_key] if name_key else index])
+
+    return files
+
+def write_offloaded(check_run_id, files):
+    """ Writes the files planned by ``plan_offload`` to the
+        ``rosiepi-results`` file share.
+
+    :param: check_run_id: The check run the results belong to
+    :param: list files: ``(file name, bytes)`` from ``plan_offload``
+
+    :return: int: The number of files written.
+    """
+    if not files:
+        return 0
+
+    file_service = _file_service()
+    directory = _directory(check_run_id)
+    _ensure_directory(file_service, directory)
+    for file_name, data in files:
+        with metrics.span('file_write'):
+            file_service.create_file_from_bytes(
+                _RESULT_SHARE,
+                directory,
+                file_name,
+                data,
+                content_settings=file_models.ContentSettings(
+                    content_type=_TEXT_CONTENT_TYPE
+                )
+            )
+        metrics.incr('result_file_bytes_total', len(data))
+
+    return len(files)
+
+def offload_board_tests(check_run_id, node_name, board_tests, name_prefix='',
+                        name_key=None):
+    """ Moves large strings (e.g. test logs) out of board tests and into
+        the ``rosiepi-results`` file share, replacing each with a pointer
+        (see ``plan_offload``). The pointer's ``file`` is passed to
+        ``job-result`` to read it.
+
+    :return: int: The number of files written.
+    """
+    files = plan_offload(check_run_id, node_name, board_tests, name_prefix, name_key)
+
+    return write_offloaded(check_run_id, files)
+
+def parse_range(range_header, size, limit):
+    """ Parses a single ``Range: bytes=`` request header.
+
+    :param: str range_header: The header value, or None
+    :param: int size: The size of the file
+    :param: int limit: The most bytes to return; longer ranges are
+                       shortened.
+
+    :return: tuple: The first and last (inclusive) byte to return, and
+                    whether the response is partial.
+    """
+    start, end, partial = 0, size - 1, False
+
+    match = _RANGE_HEADER.match((range_header or '').strip())
+    if match and any(match.groups()):
+        first, last = match.groups()
+        if first:
+            start = int(first)
+            if last:
+                end = min(int(last), size - 1)
+        else:
+            # suffix range: the last ``n`` bytes
+            start = max(size - int(last), 0)
+        if start >= size or start > end:
+            raise RangeNotSatisfiable(f'bytes */{size}')
+        partial = True
+
+    if end - start + 1 > limit:
+        end = start + limit - 1
+        partial = True
+
+    return start, end, partial
+
+def read_file(check_run_id, node_name, file_path, range_header=None):
+    """ Reads (part of) an offloaded file for ``job-result``.
+
+    :param: check_run_id: The check run the file belongs to
+    :param: str node_name: The node that ran the tests
+    :param: str file_path: The ``file`` from the file pointer
+    :param: str range_header: The request's ``Range`` header, if any
+
+    :return: dict: ``func.HttpResponse`` kwargs. Files larger than
+             ``RESULT_FILE_MAX_RANGE`` are always returned in part, with
+             a ``206`` status, so that a response never holds the whole
+             file.
+    """
+    response_kwargs = {
+        'status_code': 200,
+        'body': b'',
+        'headers': {'Accept-Ranges': 'bytes'},
+    }
+
+    directory, _, file_name = file_path.partition('/')
+    if (directory != _directory(check_run_id) or
+        not file_name.startswith(f'{_safe_name(node_name)}-') or
+        _safe_name(file_name) != file_name):
+            response_kwargs.update(status_code=404, body=b'File not found.')
+            return response_kwargs
+
+    file_service = _file_service()
+    with metrics.span('file_read'):
+        properties = file_service.get_file_properties(
+            _RESULT_SHARE, directory, file_name
+        ).properties
+        size = properties.content_length
+
+        try:
+            start, end, partial = parse_range(range_header, size, max_range())
+        except RangeNotSatisfiable as err:
+            response_kwargs['status_code'] = 416
+            response_kwargs['headers']['Content-Range'] = str(err)
+            return response_kwargs
+
+        if size:
+            response_kwargs['body'] = file_service.get_file_to_bytes(
+                _RESULT_SHARE, directory, file_name,
+                start_range=start, end_range=end
+            ).content
+
+    response_kwargs['headers']['Content-Type'] = (
+        properties.content_settings.content_type or _TEXT_CONTENT_TYPE
+    )
+    if partial:
+        response_kwargs['status_code'] = 206
+        response_kwargs['headers']['Content-Range'] = f'bytes {start}-{end}/{size}'
+
+    return response_kwargs
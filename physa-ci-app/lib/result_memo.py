@@ -0,0 +1,115 @@
+import logging
+import os
+
+# pylint: disable=import-error
+from __app__.lib import check_shards, metrics, node_db, node_registrar
+
+# Which prior conclusions may be copied into a re-requested check run,
+# selected with the ``RESULT_MEMO_POLICY`` app setting.
+_MEMO_POLICIES = {
+    'off': (),
+    'success': ('success',),
+    'conclusive': ('success', 'failure'),
+}
+
+def memo_policy():
+    """ The current memoization policy. Unknown policies are treated
+        as ``off``.
+
+    :return: str: The policy name.
+    """
+    policy = os.environ.get('RESULT_MEMO_POLICY', 'off').lower()
+    if policy not in _MEMO_POLICIES:
+        logging.info(f'Unknown RESULT_MEMO_POLICY: {policy}. Using "off".')
+        policy = 'off'
+
+    return policy
+
+def board_set(node_results):
+    """ The set of boards tested in a result.
+
+    :param: list node_results: The ``node_results`` of a stored result
+
+    :return: frozenset: The board names.
+    """
+    boards = []
+    for board in node_results or []:
+        if isinstance(board, dict) and board.get('board_name'):
+            boards.append(board['board_name'])
+
+    return frozenset(boards)
+
+def _shard_result(entity):
+    """ Whether a result is one shard's part of a sharded run, rather
+        than the run's merged result (see ``check_shards.merge_results``).
+    """
+    if entity.get('node_name') == check_shards.MERGED_NODE_NAME:
+        return False
+
+    return bool(entity.get('shard_count') or entity.get('shard_boards'))
+
+def find_memoized_result(head_sha):
+    """ Finds a completed result for a commit that can be reused instead
+        of dispatching a new test run, according to ``memo_policy()``.
+
+        A result is only reused when the node that produced it either
+        isn't in the registrar, or still advertises the same set of
+        boards that were tested. A sharded run is only reused through
+        its merged result; each shard's result only tested some of the
+        boards.
+
+    :param: str head_sha: The commit SHA of the re-requested check run
+
+    :return: dict: The flattened result entity, or None if no result
+                   can be reused.
+    """
+    conclusions = _MEMO_POLICIES[memo_policy()]
+    if not conclusions or not head_sha:
+        return None
+
+    try:
+        prior_results = node_db.find_results(head_sha)
+    except Exception as err:
+        logging.info(f'Result memoization lookup failed: {err}')
+        return None
+
+    candidates = [
+        entity for entity in prior_results
+        if (entity.get('check_run_status') == 'completed' and
+            entity.get('check_run_conclusion') in conclusions and
+            not entity.get('memoized_from') and
+            not _shard_result(entity))
+    ]
+    if not candidates:
+        logging.info(f'No memoized result available for: {head_sha}')
+        metrics.incr('memo_cache_total', outcome='miss')
+        return None
+
+    candidates.sort(
+        key=lambda entity: entity.get('check_run_completed_at', ''),
+        reverse=True
+    )
+
+    node_boards = {
+        entry['node'].node_name: frozenset(entry['node'].boards)
+        for entry in node_registrar.current_registrar()
+        if entry['node'].boards
+    }
+
+    for entity in candidates:
+        tested_boards = board_set(entity.get('node_results'))
+        current_boards = node_boards.get(entity.get('node_name'))
+        if current_boards is not None and current_boards != tested_boards:
+            continue
+
+        logging.info(
+            'Found memoized result. '
+            f'check_run_id: {entity.get("check_run_id")}, '
+            f'node: {entity.get("node_name")}, '
+            f'conclusion: {entity.get("check_run_conclusion")}'
+        )
+        metrics.incr('memo_cache_total', outcome='hit')
+        return entity
+
+    metrics.incr('memo_cache_total', outcome='miss')
+    return None
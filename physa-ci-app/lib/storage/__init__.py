@@ -0,0 +1,131 @@
+import logging
+import os
+import threading
+
+# pylint: disable=import-error
+from __app__.lib.storage.base import RegistrarMessage, RegistrarStore, ResultStore
+
+BACKEND_AZURE = 'azure'
+BACKEND_MEMORY = 'memory'
+BACKEND_SQLITE = 'sqlite'
+
+_BACKENDS = (BACKEND_AZURE, BACKEND_MEMORY, BACKEND_SQLITE)
+
+# kept in Azure Storage whatever the backend: the check queues, the
+# dispatch, node, shard, health, chunk and aggregate tables, and
+# offloaded result files.
+_AZURE_ONLY = 'check queues, job tables and result files'
+
+# memory and SQLite stores, kept for the life of the process
+_stores = {}
+_stores_lock = threading.Lock()
+
+def backend():
+    """ The storage backend for results and the node registrar, from
+        the ``APP_STORAGE_BACKEND`` app setting:
+
+        - ``azure`` (default): Azure Storage tables and queues, through
+          ``APP_STORAGE_CONN_STR``.
+        - ``memory``: process memory. For local runs, tests and
+          profiling; nothing is persisted, or shared between worker
+          processes.
+        - ``sqlite``: a SQLite database at ``APP_STORAGE_SQLITE_PATH``,
+          for small deployments without cloud storage.
+
+    :return: str
+    """
+    name = os.environ.get('APP_STORAGE_BACKEND', BACKEND_AZURE).lower()
+    if name not in _BACKENDS:
+        logging.info(f'Invalid value for APP_STORAGE_BACKEND. Using default: {BACKEND_AZURE}')
+        name = BACKEND_AZURE
+
+    return name
+
+class StorageConfigError(RuntimeError):
+    """ The storage app settings can't be used.
+    """
+
+def connection_string():
+    """ The Azure Storage connection string, from the
+        ``APP_STORAGE_CONN_STR`` app setting. It is needed with every
+        backend; ``memory`` and ``sqlite`` only hold results and the
+        registrar.
+
+    :return: str
+
+    :raises StorageConfigError: If the app setting isn't set.
+    """
+    conn_str = os.environ.get('APP_STORAGE_CONN_STR')
+    if not conn_str:
+        raise StorageConfigError(
+            f'APP_STORAGE_CONN_STR is not set. With APP_STORAGE_BACKEND '
+            f'"{backend()}", it is still needed for the {_AZURE_ONLY}.'
+        )
+
+    return conn_str
+
+def check_config():
+    """ Checks the storage app settings when a function is loaded, so
+        that a ``memory`` or ``sqlite`` backend without
+        ``APP_STORAGE_CONN_STR`` fails at startup, rather than in each
+        table read and write.
+
+    :raises StorageConfigError: If the settings can't be used.
+    """
+    if backend() != BACKEND_AZURE:
+        connection_string()
+
+def sqlite_path():
+    """ The SQLite database used by the ``sqlite`` backend.
+    """
+    return os.environ.get('APP_STORAGE_SQLITE_PATH', 'physaci.sqlite3')
+
+def _shared(kind, factory):
+    key = (kind, backend(), sqlite_path())
+    with _stores_lock:
+        if key not in _stores:
+            _stores[key] = factory()
+
+        return _stores[key]
+
+def results(tbl_svc_retry=None):
+    """ The result store for the configured backend.
+
+    :param: tbl_svc_retry: For the ``azure`` backend, a ``TableService``
+                           retry policy in place of the default.
+
+    :return: ResultStore
+    """
+    name = backend()
+    if name == BACKEND_MEMORY:
+        from __app__.lib.storage import memory_store
+        return _shared('results', memory_store.MemoryResultStore)
+    if name == BACKEND_SQLITE:
+        from __app__.lib.storage import sqlite_store
+        return _shared('results', lambda: sqlite_store.SqliteResultStore(sqlite_path()))
+
+    from __app__.lib.storage import azure_store
+    return azure_store.AzureResultStore(tbl_svc_retry)
+
+def registrar():
+    """ The registrar store for the configured backend.
+
+    :return: RegistrarStore
+    """
+    name = backend()
+    if name == BACKEND_MEMORY:
+        from __app__.lib.storage import memory_store
+        return _shared('registrar', memory_store.MemoryRegistrarStore)
+    if name == BACKEND_SQLITE:
+        from __app__.lib.storage import sqlite_store
+        return _shared('registrar', lambda: sqlite_store.SqliteRegistrarStore(sqlite_path()))
+
+    from __app__.lib.storage import azure_store
+    return azure_store.AzureRegistrarStore()
+
+def reset():
+    """ Drops the memory and SQLite stores, e.g. between tests. SQLite
+        databases are left on disk.
+    """
+    with _stores_lock:
+        _stores.clear()
@@ -0,0 +1,82 @@
+import os
+
+# pylint: disable=import-error
+from __app__.lib import metrics
+from __app__.lib.lazy_import import lazy_import
+from __app__.lib.storage.base import RegistrarStore, ResultStore
+
+queue = lazy_import('azure.storage.queue')
+tableservice = lazy_import('azure.cosmosdb.table.tableservice')
+
+_RESULTS_TABLE = 'rosiepi'
+_REGISTRAR_QUEUE = 'rosiepi-node-registrar'
+
+_AZURE_QUEUE_PEEK_MAX = 32
+
+
+class AzureResultStore(ResultStore):
+    """ Results in the ``rosiepi`` storage table.
+
+    :param: tbl_svc_retry: A ``TableService`` retry policy, in place of
+                           the default.
+    """
+
+    def __init__(self, tbl_svc_retry=None):
+        self.table = tableservice.TableService(
+            connection_string=os.environ['APP_STORAGE_CONN_STR']
+        )
+        if tbl_svc_retry is not None:
+            self.table.retry = tbl_svc_retry
+        self.table.retry_callback = metrics.count_retries('results_table')
+
+    def get(self, partition_key, row_key, select=None, **kwargs):
+        if select is not None:
+            kwargs['select'] = ','.join(select)
+
+        return self.table.get_entity(_RESULTS_TABLE, partition_key, row_key, **kwargs)
+
+    def find_by_commit(self, head_sha, **kwargs):
+        head_sha = head_sha.replace("'", "''")
+        query_filter = f"check_run_head_sha eq '{head_sha}'"
+
+        return list(
+            self.table.query_entities(_RESULTS_TABLE, filter=query_filter, **kwargs)
+        )
+
+    def insert(self, entity):
+        return self.table.insert_entity(_RESULTS_TABLE, entity)
+
+    def update(self, entity):
+        return self.table.update_entity(_RESULTS_TABLE, entity)
+
+
+class AzureRegistrarStore(RegistrarStore):
+    """ The registrar in the ``rosiepi-node-registrar`` storage queue.
+        Message content is ``bytes`` (see ``message_codec``).
+    """
+
+    def __init__(self):
+        queue_config = {
+            'message_encode_policy': queue.BinaryBase64EncodePolicy(),
+            'message_decode_policy': queue.BinaryBase64DecodePolicy(),
+        }
+        self.queue_client = queue.QueueClient.from_connection_string(
+            os.environ['APP_STORAGE_CONN_STR'],
+            _REGISTRAR_QUEUE,
+            **queue_config
+        )
+
+    def receive(self, visibility_timeout):
+        return list(self.queue_client.receive_messages(
+            messages_per_page=_AZURE_QUEUE_PEEK_MAX,
+            visibility_timeout=visibility_timeout
+        ))
+
+    def send(self, content):
+        return self.queue_client.send_message(content, time_to_live=-1)
+
+    def update(self, message, pop_receipt, content):
+        return self.queue_client.update_message(message, pop_receipt, content)
+
+    def delete(self, message, pop_receipt=None):
+        self.queue_client.delete_message(message, pop_receipt=pop_receipt)
@@ -0,0 +1,110 @@
+from dataclasses import dataclass
+from datetime import datetime, timezone
+
+# registrar entries are removed when their lease runs out, rather than
+# by the store (see ``node_registrar.add_node``).
+NEVER_EXPIRES = datetime.max.replace(tzinfo=timezone.utc)
+
+
+@dataclass
+class RegistrarMessage:
+    """ A registrar entry from the in-memory and SQLite stores, with the
+        ``azure.storage.queue.QueueMessage`` attributes the registrar
+        uses.
+    """
+    id: str
+    pop_receipt: str
+    content: str
+    expires_on: datetime = NEVER_EXPIRES
+
+
+class ResultStore():
+    """ Storage for check run results, as entities with a
+        ``PartitionKey`` (the node name) and ``RowKey`` (the padded
+        check run id). Lookups of missing entities raise an
+        ``AzureHttpError`` with a 404 ``status_code``, whichever the
+        backend, so callers handle them the same way.
+    """
+
+    def get(self, partition_key, row_key, select=None, **kwargs):
+        """ Retrieves a result.
+
+        :param: list select: The properties to read. All, if None.
+        :param: **kwargs: Backend specific options; ignored by backends
+                          that don't support them.
+
+        :return: dict: The entity, with its ``etag``.
+        """
+        raise NotImplementedError
+
+    def find_by_commit(self, head_sha, **kwargs):
+        """ Retrieves the results stored with a ``check_run_head_sha``.
+
+        :return: list of dict
+        """
+        raise NotImplementedError
+
+    def insert(self, entity):
+        """ Adds a result. Raises if it already exists.
+
+        :return: str: The entity's etag
+        """
+        raise NotImplementedError
+
+    def update(self, entity):
+        """ Replaces a result. Raises if it doesn't exist.
+
+        :return: str: The entity's etag
+        """
+        raise NotImplementedError
+
+
+class RegistrarStore():
+    """ Storage for the node registrar, as a queue of entries. Reading
+        an entry hides it for a visibility timeout and gives it a new
+        pop receipt, which is needed to update or remove it.
+    """
+
+    def receive(self, visibility_timeout):
+        """ Reads the visible entries.
+
+        :return: list: Messages with ``id``, ``pop_receipt``,
+                       ``content`` and ``expires_on``.
+        """
+        raise NotImplementedError
+
+    def get(self, message_id):
+        """ Reads an entry by its id, without hiding it or replacing its
+            pop receipt. Raises a 404 ``AzureHttpError`` if there's no
+            such entry.
+
+            Queues can only read entries in order, so backends on a
+            queue raise ``NotImplementedError``.
+
+        :return: The entry's message, with its current pop receipt.
+        """
+        raise NotImplementedError
+
+    def send(self, content):
+        """ Adds an entry, that is kept until it is removed.
+
+        :return: The entry's message
+        """
+        raise NotImplementedError
+
+    def update(self, message, pop_receipt, content):
+        """ Replaces an entry's content. The entry becomes visible.
+
+        :param: message: The entry's message, or its id
+
+        :return: The entry's message, with a new pop receipt.
+        """
+        raise NotImplementedError
+
+    def delete(self, message, pop_receipt=None):
+        """ Removes an entry.
+
+        :param: message: The entry's message, or its id. Without a
+                         ``pop_receipt``, the message's own is used.
+        """
+        raise NotImplementedError
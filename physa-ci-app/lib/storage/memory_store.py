@@ -0,0 +1,134 @@
+import copy
+import threading
+import time
+import uuid
+
+# pylint: disable=import-error
+from __app__.lib.lazy_import import lazy_import
+from __app__.lib.storage.base import RegistrarMessage, RegistrarStore, ResultStore
+
+azure_common = lazy_import('azure.common')
+
+
+def _new_etag():
+    return f'W/"{uuid.uuid4().hex}"'
+
+def _not_found():
+    return azure_common.AzureHttpError('The specified resource does not exist.', 404)
+
+
+class MemoryResultStore(ResultStore):
+    """ Results held in process memory. Nothing is persisted; results
+        last as long as the worker process.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.entities = {}
+
+    def get(self, partition_key, row_key, select=None, **kwargs):
+        with self.lock:
+            entity = self.entities.get((partition_key, row_key))
+            if entity is None:
+                raise _not_found()
+            entity = copy.deepcopy(entity)
+
+        if select is not None:
+            entity = {
+                key: value for key, value in entity.items()
+                if key in select or key == 'etag'
+            }
+
+        return entity
+
+    def find_by_commit(self, head_sha, **kwargs):
+        with self.lock:
+            return [
+                copy.deepcopy(entity) for entity in self.entities.values()
+                if entity.get('check_run_head_sha') == head_sha
+            ]
+
+    def insert(self, entity):
+        key = (entity['PartitionKey'], entity['RowKey'])
+        with self.lock:
+            if key in self.entities:
+                raise azure_common.AzureHttpError('The specified entity already exists.', 409)
+            return self._put(key, entity)
+
+    def update(self, entity):
+        key = (entity['PartitionKey'], entity['RowKey'])
+        with self.lock:
+            if key not in self.entities:
+                raise _not_found()
+            return self._put(key, entity)
+
+    def _put(self, key, entity):
+        stored = copy.deepcopy(dict(entity))
+        stored['etag'] = _new_etag()
+        self.entities[key] = stored
+
+        return stored['etag']
+
+
+class MemoryRegistrarStore(RegistrarStore):
+    """ The registrar held in process memory. Nothing is persisted;
+        nodes re-register when their heartbeat is refused.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # message id: [message, visible at]
+        self.entries = {}
+
+    def _find(self, message, pop_receipt):
+        message_id = getattr(message, 'id', message)
+        if pop_receipt is None:
+            pop_receipt = getattr(message, 'pop_receipt', None)
+
+        entry = self.entries.get(message_id)
+        if entry is None or entry[0].pop_receipt != pop_receipt:
+            raise _not_found()
+
+        return entry
+
+    def receive(self, visibility_timeout):
+        now = time.time()
+        received = []
+        with self.lock:
+            for entry in self.entries.values():
+                if entry[1] > now:
+                    continue
+                entry[0].pop_receipt = uuid.uuid4().hex
+                entry[1] = now + visibility_timeout
+                received.append(copy.copy(entry[0]))
+
+        return received
+
+    def get(self, message_id):
+        with self.lock:
+            entry = self.entries.get(message_id)
+            if entry is None:
+                raise _not_found()
+
+            return copy.copy(entry[0])
+
+    def send(self, content):
+        message = RegistrarMessage(uuid.uuid4().hex, uuid.uuid4().hex, content)
+        with self.lock:
+            self.entries[message.id] = [message, 0]
+
+        return copy.copy(message)
+
+    def update(self, message, pop_receipt, content):
+        with self.lock:
+            entry = self._find(message, pop_receipt)
+            entry[0].content = content
+            entry[0].pop_receipt = uuid.uuid4().hex
+            entry[1] = 0
+
+            return copy.copy(entry[0])
+
+    def delete(self, message, pop_receipt=None):
+        with self.lock:
+            entry = self._find(message, pop_receipt)
+            del self.entries[entry[0].id]
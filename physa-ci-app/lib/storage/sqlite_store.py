@@ -0,0 +1,230 @@
+import json
+import sqlite3
+import time
+import uuid
+
+from contextlib import closing, contextmanager
+
+# pylint: disable=import-error
+from __app__.lib.lazy_import import lazy_import
+from __app__.lib.storage.base import RegistrarMessage, RegistrarStore, ResultStore
+
+azure_common = lazy_import('azure.common')
+
+_SCHEMA = (
+    'CREATE TABLE IF NOT EXISTS results ('
+    ' partition_key TEXT NOT NULL,'
+    ' row_key TEXT NOT NULL,'
+    ' head_sha TEXT,'
+    ' properties TEXT NOT NULL,'
+    ' etag TEXT NOT NULL,'
+    ' PRIMARY KEY (partition_key, row_key))',
+    'CREATE INDEX IF NOT EXISTS results_head_sha ON results (head_sha)',
+    'CREATE TABLE IF NOT EXISTS registrar ('
+    ' id TEXT PRIMARY KEY,'
+    ' pop_receipt TEXT NOT NULL,'
+    ' content TEXT NOT NULL,'
+    ' visible_at REAL NOT NULL,'
+    ' inserted_at REAL NOT NULL)',
+)
+
+# seconds a write waits for another process's lock
+_BUSY_TIMEOUT = 30
+
+
+def _not_found():
+    return azure_common.AzureHttpError('The specified resource does not exist.', 404)
+
+
+class _SqliteStore():
+    """ Base for the SQLite stores. A connection is opened for each
+        operation, so a store can be shared between threads, and the
+        database between worker processes.
+
+    :param: str path: The database file. Created if it doesn't exist.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with self._transaction() as conn:
+            for statement in _SCHEMA:
+                conn.execute(statement)
+
+    @contextmanager
+    def _transaction(self):
+        """ Runs the block in a write transaction, committed when the
+            block exits.
+        """
+        with closing(sqlite3.connect(self.path, timeout=_BUSY_TIMEOUT)) as conn:
+            conn.isolation_level = None
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield conn
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+
+    def _read(self, sql, params=()):
+        with closing(sqlite3.connect(self.path, timeout=_BUSY_TIMEOUT)) as conn:
+            return conn.execute(sql, params).fetchall()
+
+
+class SqliteResultStore(_SqliteStore, ResultStore):
+    """ Results in a SQLite database, for deployments without Azure
+        Storage.
+    """
+
+    @staticmethod
+    def _entity(row):
+        partition_key, row_key, properties, etag = row
+        entity = json.loads(properties)
+        entity.update({'PartitionKey': partition_key, 'RowKey': row_key, 'etag': etag})
+
+        return entity
+
+    def get(self, partition_key, row_key, select=None, **kwargs):
+        rows = self._read(
+            'SELECT partition_key, row_key, properties, etag FROM results '
+            'WHERE partition_key = ? AND row_key = ?',
+            (partition_key, row_key)
+        )
+        if not rows:
+            raise _not_found()
+
+        entity = self._entity(rows[0])
+        if select is not None:
+            entity = {
+                key: value for key, value in entity.items()
+                if key in select or key == 'etag'
+            }
+
+        return entity
+
+    def find_by_commit(self, head_sha, **kwargs):
+        rows = self._read(
+            'SELECT partition_key, row_key, properties, etag FROM results '
+            'WHERE head_sha = ?',
+            (head_sha,)
+        )
+
+        return [self._entity(row) for row in rows]
+
+    @staticmethod
+    def _values(entity):
+        properties = {
+            key: value for key, value in entity.items()
+            if key not in ('PartitionKey', 'RowKey', 'etag', 'Timestamp')
+        }
+
+        return (
+            entity.get('check_run_head_sha'),
+            json.dumps(properties),
+            f'W/"{uuid.uuid4().hex}"',
+            entity['PartitionKey'],
+            entity['RowKey'],
+        )
+
+    def insert(self, entity):
+        values = self._values(entity)
+        try:
+            with self._transaction() as conn:
+                conn.execute(
+                    'INSERT INTO results (head_sha, properties, etag, partition_key, row_key) '
+                    'VALUES (?, ?, ?, ?, ?)',
+                    values
+                )
+        except sqlite3.IntegrityError:
+            raise azure_common.AzureHttpError('The specified entity already exists.', 409)
+
+        return values[2]
+
+    def update(self, entity):
+        values = self._values(entity)
+        with self._transaction() as conn:
+            updated = conn.execute(
+                'UPDATE results SET head_sha = ?, properties = ?, etag = ? '
+                'WHERE partition_key = ? AND row_key = ?',
+                values
+            ).rowcount
+        if not updated:
+            raise _not_found()
+
+        return values[2]
+
+
+class SqliteRegistrarStore(_SqliteStore, RegistrarStore):
+    """ The registrar in a SQLite database, for deployments without
+        Azure Storage.
+    """
+
+    def receive(self, visibility_timeout):
+        now = time.time()
+        received = []
+        with self._transaction() as conn:
+            rows = conn.execute(
+                'SELECT id, content FROM registrar WHERE visible_at <= ? '
+                'ORDER BY inserted_at',
+                (now,)
+            ).fetchall()
+            for message_id, content in rows:
+                message = RegistrarMessage(message_id, uuid.uuid4().hex, content)
+                conn.execute(
+                    'UPDATE registrar SET pop_receipt = ?, visible_at = ? WHERE id = ?',
+                    (message.pop_receipt, now + visibility_timeout, message_id)
+                )
+                received.append(message)
+
+        return received
+
+    def get(self, message_id):
+        rows = self._read(
+            'SELECT id, pop_receipt, content FROM registrar WHERE id = ?',
+            (message_id,)
+        )
+        if not rows:
+            raise _not_found()
+
+        return RegistrarMessage(*rows[0])
+
+    def send(self, content):
+        message = RegistrarMessage(uuid.uuid4().hex, uuid.uuid4().hex, content)
+        with self._transaction() as conn:
+            conn.execute(
+                'INSERT INTO registrar (id, pop_receipt, content, visible_at, inserted_at) '
+                'VALUES (?, ?, ?, 0, ?)',
+                (message.id, message.pop_receipt, content, time.time())
+            )
+
+        return message
+
+    @staticmethod
+    def _key(message, pop_receipt):
+        if pop_receipt is None:
+            pop_receipt = getattr(message, 'pop_receipt', None)
+
+        return getattr(message, 'id', message), pop_receipt
+
+    def update(self, message, pop_receipt, content):
+        message_id, pop_receipt = self._key(message, pop_receipt)
+        updated = RegistrarMessage(message_id, uuid.uuid4().hex, content)
+        with self._transaction() as conn:
+            count = conn.execute(
+                'UPDATE registrar SET pop_receipt = ?, content = ?, visible_at = 0 '
+                'WHERE id = ? AND pop_receipt = ?',
+                (updated.pop_receipt, content, message_id, pop_receipt)
+            ).rowcount
+        if not count:
+            raise _not_found()
+
+        return updated
+
+    def delete(self, message, pop_receipt=None):
+        message_id, pop_receipt = self._key(message, pop_receipt)
+        with self._transaction() as conn:
+            count = conn.execute(
+                'DELETE FROM registrar WHERE id = ? AND pop_receipt = ?',
+                (message_id, pop_receipt)
+            ).rowcount
+        if not count:
+            raise _not_found()
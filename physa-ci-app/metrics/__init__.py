@@ -0,0 +1,21 @@
+import logging
+
+import azure.functions as func
+
+# pylint: disable=import-error
+from __app__.lib import metrics
+
+
+def main(req: func.HttpRequest) -> func.HttpResponse:
+    """ Serves the counters and histograms collected by this worker
+        process, in the Prometheus text format. Each scale-out instance
+        keeps its own metrics; the ``physaci.metrics`` log lines cover
+        every instance.
+    """
+    logging.info('Python HTTP trigger function processed a request.')
+
+    return func.HttpResponse(
+        metrics.render_text(),
+        status_code=200,
+        headers={'Content-Type': 'text/plain; version=0.0.4'}
+    )
@@ -0,0 +1,48 @@
+import logging
+import json
+
+from dataclasses import asdict
+
+import azure.functions as func
+
+# pylint: disable=import-error
+from __app__.lib import duration_estimates, metrics, node_health, node_ledger
+from __app__.lib import node_registrar, storage
+
+storage.check_config()
+
+
+@metrics.invocation('node-health')
+def main(req: func.HttpRequest) -> func.HttpResponse:
+    logging.info('Python HTTP trigger function processed a request.')
+
+    health = node_health.load_health()
+
+    node_name = req.params.get('node')
+    if node_name:
+        health = {
+            name: value for name, value in health.items() if name == node_name
+        }
+
+    # the predicted time until each node has finished its in-flight jobs
+    estimates = duration_estimates.load()
+    ledger = node_ledger.load_ledger()
+    nodes = []
+    for name, value in health.items():
+        node = asdict(value)
+        del node['etag']
+        node['expected_drain_seconds'] = round(estimates.drain_seconds(
+            node_registrar.NodeItem(node_name=name),
+            ledger.get(name, node_ledger.NodeLoad(name))
+        ), 1)
+        nodes.append(node)
+
+    body = {
+        'nodes': nodes
+    }
+
+    return func.HttpResponse(
+        json.dumps(body),
+        status_code=200,
+        headers={'Content-Type': 'application/json'}
+    )
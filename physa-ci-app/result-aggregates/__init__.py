@@ -0,0 +1,65 @@
+import logging
+import json
+
+import azure.functions as func
+
+# pylint: disable=import-error
+from __app__.lib import metrics, result_aggregates, storage
+from __app__.lib.lazy_import import lazy_import
+
+azure_common = lazy_import('azure.common')
+
+storage.check_config()
+
+_SORT_KEYS = {
+    'name': lambda row: row['name'],
+    'runs': lambda row: -row['runs'],
+    # flakiest first; rows without outcomes last
+    'pass_rate': lambda row: (row['pass_rate'] is None, row['pass_rate'] or 0),
+}
+
+@metrics.invocation('result-aggregates')
+def main(req: func.HttpRequest) -> func.HttpResponse:
+    """ Serves the board and node aggregates kept by ``testnode-hook``.
+
+        Query parameters:
+
+        - ``kind``: ``board`` or ``node``
+        - ``name``: a single board or node (optional)
+        - ``sort``: ``name`` (default), ``runs`` or ``pass_rate``
+        - ``min_runs``: leave out rows with fewer runs (optional)
+    """
+    logging.info('Python HTTP trigger function processed a request.')
+
+    response_kwargs = {
+        'status_code': 200,
+        'body': {},
+        'headers': {
+            'Content-Type': 'application/json'
+        },
+    }
+
+    kind = req.params.get('kind')
+    sort = req.params.get('sort', 'name')
+    min_runs = req.params.get('min_runs', '0')
+
+    if (kind not in (result_aggregates.KIND_BOARD, result_aggregates.KIND_NODE) or
+        sort not in _SORT_KEYS or not min_runs.isdigit()):
+            response_kwargs.update(
+                status_code=400,
+                body={'failure_reason': 'Missing or invalid paramaters.'}
+            )
+    else:
+        try:
+            rows = result_aggregates.query(kind, req.params.get('name'))
+        except azure_common.AzureHttpError as err:
+            logging.info(f"AzureError caught: {err}")
+            rows = []
+
+        rows = [row for row in rows if row['runs'] >= int(min_runs)]
+        rows.sort(key=_SORT_KEYS[sort])
+        response_kwargs['body'] = {'kind': kind, 'aggregates': rows}
+
+    response_kwargs['body'] = json.dumps(response_kwargs['body'])
+
+    return func.HttpResponse(**response_kwargs)
@@ -6,8 +6,30 @@ import re
 import azure.functions as func
 
 # pylint: disable=import-error
-from __app__.lib import app_client, result, node_github, node_registrar, node_db
+from __app__.lib import app_client, check_dispatch, check_shards, metrics, profiling
+from __app__.lib import result, node_github
+from __app__.lib import node_registrar, node_db
+from __app__.lib import node_ledger, result_aggregates
+from __app__.lib import job_claims, result_chunks, result_files, storage
 
+storage.check_config()
+
+def _job_report(req):
+    """ The JSON body of a node's report on a job.
+
+    :return: dict: The body, or None if it isn't a JSON object with the
+                   job's ``check_run_id`` and ``node_name``.
+    """
+    try:
+        body = req.get_json()
+    except ValueError:
+        return None
+    if not (isinstance(body, dict) and body.get('check_run_id') and body.get('node_name')):
+        return None
+
+    return body
+
+@metrics.invocation('testnode-hook')
 def main(req: func.HttpRequest) -> func.HttpResponse:
     logging.info('Python HTTP trigger function processed a request.')
 
@@ -19,6 +41,10 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
 
     req_func = req.route_params.get('func')
     req_action = req.route_params.get('action')
+    profiling.tag(
+        event=f'{req_func}.{req_action}',
+        check_run_id=req.params.get('check_run_id')
+    )
 
     if req_func == 'registrar':
         node_params = req.get_json()
@@ -30,23 +56,163 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
             logging.info(f'ip_extract: {ip_extract.group(1)}')
             node_params['node_ip'] = ip_extract.group(1)
 
+        handle = node_params.pop('handle', None)
         if req_action == 'add':
-                response_kwargs = node_registrar.add_node(node_params, response_kwargs)
-        elif req_action == 'update':
+                response_kwargs = node_registrar.add_node(
+                    node_params, response_kwargs, handle=handle
+                )
+        elif req_action in ('update', 'heartbeat'):
             req_node = node_registrar.NodeItem(**node_params)
-            nodes = node_registrar.current_registrar()
-            for node in nodes:
-                if (node['node_name'] == req_node.node_name and
-                    node['node_ip'] == req_node.node_ip):
-                        response_kwargs = node_registrar.update_node(
-                            node['message'], req_node, response_kwargs
-                        )
-                        break
+            response_kwargs = node_registrar.update_registered_node(
+                req_node, response_kwargs, handle=handle
+            )
+
+    elif req_func == 'jobs':
+        # pull mode: nodes claim queued jobs, rather than having them
+        # pushed to their ``/run-test``.
+        try:
+            claim_params = req.get_json()
+        except ValueError:
+            claim_params = None
+        if not isinstance(claim_params, dict):
+            response_kwargs['status_code'] = 400
+            response_kwargs['body'] = 'Bad Request. Expected a JSON object.'
+        elif req_action == 'claim':
+            wait = job_claims.parse_wait(claim_params.get('wait', 0))
+            if not claim_params.get('node_name'):
+                response_kwargs['status_code'] = 400
+                response_kwargs['body'] = 'Bad Request. Missing node_name.'
+            elif wait is None:
+                response_kwargs['status_code'] = 400
+                response_kwargs['body'] = 'Bad Request. Invalid wait.'
+            else:
+                claimed = job_claims.claim_job(
+                    claim_params['node_name'],
+                    boards=claim_params.get('boards'),
+                    wait=wait
+                )
+                if claimed is None:
+                    response_kwargs['status_code'] = 204
+                    response_kwargs['body'] = None
+                else:
+                    response_kwargs['body'] = json.dumps(claimed)
+                    response_kwargs['headers']['Content-Type'] = 'application/json'
+        elif req_action == 'renew':
+            renewed = job_claims.renew_claim(claim_params.get('claim', ''))
+            if renewed is None:
+                response_kwargs['status_code'] = 409
+                response_kwargs['body'] = 'Claim lost. The job may be claimed by another node.'
+            else:
+                response_kwargs['body'] = json.dumps({
+                    'claim': renewed,
+                    'lease_seconds': job_claims.claim_lease_seconds(),
+                })
+                response_kwargs['headers']['Content-Type'] = 'application/json'
+        elif req_action in ('complete', 'release'):
+            finished = job_claims.finish_claim(
+                claim_params.get('claim', ''),
+                release=req_action == 'release'
+            )
+            if not finished:
+                response_kwargs['status_code'] = 409
+                response_kwargs['body'] = 'Claim lost. The job may be claimed by another node.'
+            elif (req_action == 'release' and claim_params.get('node_name') and
+                  claim_params.get('check_run_id')):
+                    node_ledger.record_finished(
+                        claim_params['node_name'], claim_params['check_run_id']
+                    )
+        else:
+            response_kwargs['status_code'] = 404
+            response_kwargs['body'] = 'Not Found.'
+
+    elif req_func == 'testresult' and req_action == 'append':
+        # board tests are streamed as NDJSON, so the body isn't parsed
+        # as a whole; the check run is identified by the query params.
+        check_run_id = req.params.get('check_run_id')
+        node_name = req.params.get('node_name')
+        chunk = req.params.get('chunk', '0')
+        if not (check_run_id and node_name and chunk.isdigit()):
+            response_kwargs['status_code'] = 400
+            response_kwargs['body'] = (
+                'Bad Request. Missing check_run_id, node_name or chunk parameter.'
+            )
+        elif not check_dispatch.reconcile_report(
+                {'check_run_id': check_run_id, 'node_name': node_name}):
+            # the job was given to another node; this node should stop it
+            response_kwargs['status_code'] = 409
+            response_kwargs['body'] = 'Conflict. The job is owned by another node.'
+        else:
+            try:
+                result_chunks.append_chunk(
+                    check_run_id, node_name, int(chunk), req.get_body()
+                )
+            except result_chunks.ChunkError as err:
+                response_kwargs['status_code'] = 400
+                response_kwargs['body'] = f'Bad Request. {err}'
+            except Exception as err:
+                logging.info(f'Failed to store result chunk. Error: {err}')
+                response_kwargs['status_code'] = 500
+                response_kwargs['body'] = (
+                    'Interal error. Failed to store test results in physaCI.'
+                )
+
+    elif req_func == 'testresult' and req_action == 'delta':
+        # only new or changed board tests are sent; they're merged into
+        # the stored board tests by sequence number.
+        delta_json = _job_report(req)
+        if delta_json is None:
+            response_kwargs['status_code'] = 400
+            response_kwargs['body'] = 'Bad Request. Missing check_run_id or node_name.'
+        elif not check_dispatch.reconcile_report(delta_json):
+            response_kwargs['status_code'] = 409
+            response_kwargs['body'] = 'Conflict. The job is owned by another node.'
+        else:
+            try:
+                result_chunks.apply_delta(
+                    delta_json['check_run_id'],
+                    delta_json['node_name'],
+                    delta_json.get('seq'),
+                    delta_json.get('board_tests', [])
+                )
+            except result_chunks.ChunkError as err:
+                response_kwargs['status_code'] = 400
+                response_kwargs['body'] = f'Bad Request. {err}'
+            except Exception as err:
+                logging.info(f'Failed to merge result delta. Error: {err}')
+                response_kwargs['status_code'] = 500
+                response_kwargs['body'] = (
+                    'Interal error. Failed to store test results in physaCI.'
+                )
+
+    elif (req_func == 'testresult' and req_action in ('add', 'update', 'finalize') and
+          _job_report(req) is None):
+        response_kwargs['status_code'] = 400
+        response_kwargs['body'] = (
+            'Bad Request. Request missing JSON payload.'
+        )
+
+    elif (req_func == 'testresult' and req_action in ('add', 'update', 'finalize') and
+          not check_dispatch.reconcile_report(_job_report(req))):
+        # the job was given to another node; this node should stop it
+        response_kwargs['status_code'] = 409
+        response_kwargs['body'] = 'Conflict. The job is owned by another node.'
 
     elif req_func == 'testresult':
         result_json = req.get_json()
+        profiling.tag(check_run_id=result_json.get('check_run_id'))
+        newly_completed = False
+        run_duration = None
+
+        if result_json.get('node_name') and result_json.get('check_run_id'):
+            # a completed report frees the node's ledger slot, whichever
+            # route it came through
+            run_duration = node_ledger.record_report(
+                result_json['node_name'],
+                result_json['check_run_id'],
+                result_json.get('github_data', {}).get('status')
+            )
 
-        if req_action == 'update':
+        if req_action in ('update', 'finalize'):
             find_entity = node_db.get_result(
                 result_json['node_name'],
                 result_json['check_run_id'],
@@ -59,13 +225,31 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
             logging.info(f'find_entity from table: {find_entity}')
 
             if find_entity is not None:
+                newly_completed = (
+                    find_entity.get('check_run_status') != 'completed' and
+                    result_json.get('github_data', {}).get('status') == 'completed'
+                )
                 for key, value in result_json.get('github_data', {}).items():
                     new_key = f'check_run_{key}'
                     find_entity.update({new_key: value})
 
-                find_entity.update(
-                    {'node_results': result_json.get('node_test_data', {}).get('board_tests')}
-                )
+                if req_action == 'finalize':
+                    # the board tests stay in the chunk table; only
+                    # their count is kept with the summary.
+                    find_entity.update({
+                        'node_results_chunked': result_chunks.count_board_tests(
+                            result_json['check_run_id'],
+                            result_json['node_name']
+                        )
+                    })
+                else:
+                    board_tests = result_json.get('node_test_data', {}).get('board_tests')
+                    result_files.offload_board_tests(
+                        result_json['check_run_id'],
+                        result_json['node_name'],
+                        board_tests
+                    )
+                    find_entity.update({'node_results': board_tests})
 
                 logging.info(f'find_entity after updates: {find_entity}')
 
@@ -84,7 +268,7 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
                 send_to_table = node_db.add_result(
                     check_result.results_to_table_entity()
                 )
-            elif req_action == 'update':
+            elif req_action in ('update', 'finalize'):
                 send_to_table = node_db.update_result(
                     check_result.results_to_table_entity()
                 )
@@ -94,6 +278,23 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
                 response_kwargs['body'] = (
                     'Interal error. Failed to update test results in physaCI.'
                 )
+            elif newly_completed:
+                # only a run's first completed report is aggregated
+                try:
+                    board_tests = check_result.results.get('node_results')
+                    if board_tests is None:
+                        board_tests = result_chunks.iter_board_tests(
+                            check_result.results['check_run_id'],
+                            check_result.results['node_name']
+                        )
+                    result_aggregates.record_run(
+                        check_result.results['node_name'],
+                        check_result.results.get('check_run_conclusion'),
+                        board_tests,
+                        duration=run_duration
+                    )
+                except Exception as err:
+                    logging.info(f'Failed to update result aggregates. Error: {err}')
 
             check_result_github = json.loads(check_result.results_to_github())
             github_check_message = {}
@@ -103,13 +304,21 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
                         {param: check_result_github[param]}
                     )
 
-            logging.info(
-                'Updating GitHub check run with the following: '
-                f'{github_check_message}'
-            )
+            if check_result.results.get('shard_count'):
+                # the check run of a sharded job is updated from all of
+                # its shards' reports, not from each node's.
+                github_check_message = check_shards.report(
+                    check_result.results, github_check_message
+                )
+
+            if github_check_message:
+                logging.info(
+                    'Updating GitHub check run with the following: '
+                    f'{github_check_message}'
+                )
 
-            event_client = app_client.GithubClient()
-            event_client.payload = check_result.results
-            event_client.update_check_run(github_check_message)
+                event_client = app_client.GithubClient()
+                event_client.payload = check_result.results
+                event_client.update_check_run(github_check_message)
 
     return func.HttpResponse(**response_kwargs)
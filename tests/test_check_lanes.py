@@ -0,0 +1,190 @@
+import json
+import os
+import unittest
+
+from unittest import mock
+
+import _app
+
+from __app__.lib import check_dispatch, check_lanes, check_queue, check_updates, message_codec
+from __app__.lib import metrics
+
+
+_LANES = {
+    'CHECK_LANES': 'interactive:3,bulk:1',
+    'CHECK_LANE_RULES': json.dumps([
+        {'lane': 'bulk', 'branch': 'release/*'},
+        {'lane': 'interactive', 'label': 'urgent'},
+        {'lane': 'interactive', 'event': 'pull_request'},
+    ]),
+}
+
+
+class TestCheckLanes(unittest.TestCase):
+    def test_weighted_picks_by_weight(self):
+        """ Test that the weighted policy shares picks by lane weight,
+            interleaving the lanes.
+        """
+
+        picker = check_lanes.LanePicker([('interactive', 3), ('bulk', 1)], 'weighted')
+        picks = [picker.pick({'interactive', 'bulk'}) for _ in range(8)]
+
+        self.assertEqual(picks.count('interactive'), 6)
+        self.assertEqual(picks.count('bulk'), 2)
+        self.assertNotEqual(picks[:4], ['interactive'] * 3 + ['bulk'])
+
+    def test_strict_prefers_highest_priority(self):
+        """ Test that the strict policy only picks a lower lane when the
+            higher lanes are empty.
+        """
+
+        picker = check_lanes.LanePicker([('interactive', 3), ('bulk', 1)], 'strict')
+
+        self.assertEqual(picker.pick({'interactive', 'bulk'}), 'interactive')
+        self.assertEqual(picker.pick({'bulk'}), 'bulk')
+        self.assertIsNone(picker.pick(set()))
+
+    @mock.patch.dict(os.environ, _LANES)
+    def test_classify(self):
+        """ Test that check runs go to the first matching rule's lane, and
+            labels are only fetched when a rule needs them.
+        """
+
+        def payload(branch, pull_requests):
+            return {
+                'repository': {'full_name': 'adafruit/circuitpython'},
+                'check_run': {
+                    'check_suite': {'head_branch': branch},
+                    'pull_requests': pull_requests,
+                },
+            }
+
+        fetch_labels = mock.Mock(return_value=['urgent'])
+        self.assertEqual(
+            check_lanes.classify(payload('release/6.x', []), fetch_labels),
+            'bulk'
+        )
+        fetch_labels.assert_not_called()
+
+        self.assertEqual(
+            check_lanes.classify(payload('main', []), fetch_labels),
+            'interactive'
+        )
+        fetch_labels.assert_called_once()
+
+        self.assertEqual(
+            check_lanes.classify(payload('main', [{'number': 1}]), lambda: []),
+            'interactive'
+        )
+        self.assertEqual(check_lanes.classify(payload('main', []), lambda: []), 'bulk')
+
+    @mock.patch.dict(os.environ, {'CHECK_LANES': 'Bad Lane,ok:x'})
+    def test_invalid_lanes(self):
+        """ Test that invalid lane names are dropped and invalid weights
+            default to 1.
+        """
+
+        self.assertEqual(check_lanes.lanes(), [('ok', 1)])
+
+    @mock.patch.dict(os.environ, {'CHECK_LANES': 'interactive'})
+    def test_dispatch_round_skips_malformed(self):
+        """ Test that a lane message that can't be decoded is removed,
+            and the dispatch round carries on with the next job.
+        """
+
+        metrics.reset()
+        self.addCleanup(metrics.reset)
+
+        malformed = mock.Mock(id='bad', content=b'not a job')
+        job = mock.Mock(id='good', content=message_codec.encode(
+            {'check_run_id': 1234}, kind='check'
+        ))
+        queue_client = mock.Mock(queue_name='rosiepi-check-queue-interactive')
+        queue_client.receive_message.side_effect = [malformed, job, None]
+
+        with mock.patch.object(check_lanes, 'lane_depths', return_value={'interactive': 2}), \
+             mock.patch.object(check_queue, 'check_queue_client', return_value=queue_client), \
+             mock.patch.object(check_dispatch, 'try_dispatch', return_value=True) as dispatch:
+            dispatched = check_dispatch.run_dispatch_round()
+
+        self.assertEqual(dispatched, {'interactive': 1})
+        self.assertEqual(dispatch.call_args[0][0]['check_run_id'], 1234)
+        self.assertEqual(
+            queue_client.delete_message.call_args_list, [mock.call(malformed), mock.call(job)]
+        )
+        self.assertEqual(
+            metrics.snapshot()['counters'][
+                ('queue_malformed_total', (('queue', 'rosiepi-check-queue-interactive'),))
+            ],
+            1
+        )
+
+    @mock.patch.dict(os.environ, dict(_LANES, CHECK_LANE_POLICY='strict'))
+    def test_dispatch_round_backs_off_rejected(self):
+        """ Test that a job no node accepts is hidden for a backoff delay,
+            and that the round goes on with the other lanes.
+        """
+
+        def job(check_run_id):
+            return mock.Mock(id=str(check_run_id), content=message_codec.encode(
+                {'check_run_id': check_run_id}, kind='check'
+            ))
+
+        clients = {
+            'interactive': mock.Mock(queue_name='rosiepi-check-queue-interactive'),
+            'bulk': mock.Mock(queue_name='rosiepi-check-queue-bulk'),
+        }
+        clients['interactive'].receive_message.side_effect = [job(1), job(2)]
+        clients['bulk'].receive_message.side_effect = [job(3), None]
+
+        with mock.patch.object(check_lanes, 'lane_depths',
+                               return_value={'interactive': 2, 'bulk': 1}), \
+             mock.patch.object(check_queue, 'check_queue_client', side_effect=clients.get), \
+             mock.patch.object(check_queue, 'retry_delay', return_value=45), \
+             mock.patch.object(check_dispatch, 'notify_waiting'), \
+             mock.patch.object(check_dispatch, 'try_dispatch',
+                               side_effect=lambda info: info['lane'] == 'bulk'):
+            dispatched = check_dispatch.run_dispatch_round(now=1000)
+
+        self.assertEqual(dispatched, {'interactive': 0, 'bulk': 1})
+        self.assertEqual(clients['interactive'].receive_message.call_count, 1)
+        _, kwargs = clients['interactive'].update_message.call_args
+        self.assertEqual(kwargs['visibility_timeout'], 45)
+        self.assertEqual(
+            message_codec.decode(kwargs['content'])['dispatch_attempts'], 1
+        )
+        clients['bulk'].delete_message.assert_called_once()
+
+    @mock.patch.dict(os.environ, _LANES)
+    def test_dispatch_round_keeps_failed_cancel(self):
+        """ Test that a job past its dispatch deadline is only removed
+            from its lane once its check run is cancelled.
+        """
+
+        def job(check_run_id):
+            return mock.Mock(id=str(check_run_id), content=message_codec.encode(
+                {'check_run_id': check_run_id, 'dispatch_deadline': 0}, kind='check'
+            ))
+
+        def cancel(check_info):
+            update = check_updates.CheckRunUpdate(check_info, {})
+            update.status_code = 200 if check_info['lane'] == 'bulk' else 502
+            return update
+
+        clients = {
+            'interactive': mock.Mock(queue_name='rosiepi-check-queue-interactive'),
+            'bulk': mock.Mock(queue_name='rosiepi-check-queue-bulk'),
+        }
+        clients['interactive'].receive_message.side_effect = [job(1)]
+        clients['bulk'].receive_message.side_effect = [job(2)]
+
+        with mock.patch.object(check_lanes, 'lane_depths',
+                               return_value={'interactive': 1, 'bulk': 1}), \
+             mock.patch.object(check_queue, 'check_queue_client', side_effect=clients.get), \
+             mock.patch.object(check_dispatch, 'try_dispatch', return_value=False), \
+             mock.patch.object(check_dispatch, 'cancel_check', side_effect=cancel):
+            dispatched = check_dispatch.run_dispatch_round(now=1000)
+
+        self.assertEqual(dispatched, {'interactive': 0, 'bulk': 0})
+        clients['interactive'].delete_message.assert_not_called()
+        clients['bulk'].delete_message.assert_called_once()
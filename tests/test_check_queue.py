@@ -0,0 +1,28 @@
+import unittest
+
+import _app
+
+from __app__.lib import check_queue
+
+
+class TestCheckQueueRetry(unittest.TestCase):
+    def test_retry_delay_backs_off(self):
+        """ Test that retry delays double, up to the maximum.
+        """
+
+        base = check_queue.retry_base_seconds()
+        for attempt in range(1, 4):
+            delay = check_queue.retry_delay(attempt)
+            self.assertGreaterEqual(delay, base * 2 ** (attempt - 1) / 2)
+            self.assertLessEqual(delay, base * 2 ** (attempt - 1))
+
+        self.assertLessEqual(check_queue.retry_delay(50), check_queue.retry_max_seconds())
+
+    def test_no_retry_after_deadline(self):
+        """ Test that a job past its deadline isn't requeued.
+        """
+
+        check_info = {'check_run_id': '1', 'dispatch_attempts': 3, 'dispatch_deadline': 100}
+
+        self.assertFalse(check_queue.schedule_retry(check_info, now=100))
+        self.assertEqual(check_info['dispatch_attempts'], 3)
@@ -0,0 +1,176 @@
+import os
+import unittest
+
+from unittest import mock
+
+import _app
+
+from __app__.lib import check_dispatch, check_shards, dispatch_ledger, node_registrar
+
+
+def _node(node_name, boards):
+    return node_registrar.NodeItem(
+        node_name=node_name, node_ip='127.0.0.1', node_sig_key='key',
+        listen_port=4812, boards=boards
+    )
+
+
+class TestCheckShards(unittest.TestCase):
+    @mock.patch.dict(os.environ, {'CHECK_SHARDS_MAX': '1'})
+    def test_disabled_by_default(self):
+        """ Test that check runs aren't sharded unless configured.
+        """
+
+        self.assertFalse(check_shards.enabled())
+
+    def test_plan(self):
+        """ Test that each board is tested once, and that boards are
+            spread over the nodes that have them.
+        """
+
+        nodes = [
+            _node('node1', ['metro_m0', 'metro_m4', 'feather_m4', 'pyportal']),
+            _node('node2', ['metro_m4', 'feather_m4', 'itsybitsy_m4']),
+            _node('node3', ['metro_m0']),
+        ]
+
+        shards = check_shards.plan(nodes, limit=4)
+        placed = [board for shard in shards for board in shard['boards']]
+
+        self.assertEqual(
+            sorted(placed),
+            ['feather_m4', 'itsybitsy_m4', 'metro_m0', 'metro_m4', 'pyportal']
+        )
+        self.assertEqual([shard['node_name'] for shard in shards], ['node1', 'node2'])
+        self.assertEqual(
+            [len(shard['boards']) for shard in shards], [3, 2]
+        )
+
+    def test_plan_limit(self):
+        """ Test that a run isn't split across more than ``limit`` nodes,
+            and that only the requested boards are placed.
+        """
+
+        nodes = [
+            _node('node1', ['metro_m0']),
+            _node('node2', ['metro_m4']),
+            _node('node3', ['pyportal']),
+        ]
+
+        shards = check_shards.plan(nodes, boards=['metro_m4', 'pyportal'], limit=4)
+        self.assertEqual(
+            shards,
+            [{'node_name': 'node2', 'boards': ['metro_m4']},
+             {'node_name': 'node3', 'boards': ['pyportal']}]
+        )
+
+        self.assertEqual(len(check_shards.plan(nodes, limit=2)), 2)
+
+    def test_merge_conclusion(self):
+        """ Test that a sharded run takes its most severe conclusion.
+        """
+
+        self.assertEqual(check_shards.merge_conclusion(['success', 'success']), 'success')
+        self.assertEqual(
+            check_shards.merge_conclusion(['success', 'failure', 'cancelled']), 'failure'
+        )
+        self.assertEqual(check_shards.merge_conclusion(['success', None]), 'neutral')
+
+    def test_complete(self):
+        """ Test that a run is complete once all of its shards are.
+        """
+
+        run = check_shards.ShardedRun('1234', shards=[
+            {'node_name': 'node1', 'boards': ['metro_m0'], 'status': 'completed'},
+            {'node_name': 'node2', 'boards': ['metro_m4'], 'status': 'in_progress'},
+        ])
+        self.assertFalse(run.complete)
+        self.assertIsNone(run.shard('node3'))
+
+        run.shard('node2')['status'] = 'completed'
+        self.assertTrue(run.complete)
+
+    def test_untested_boards_block_pass(self):
+        """ Test that a run that left boards untested can't pass.
+        """
+
+        shards = [{'node_name': 'node1', 'boards': ['metro_m0'], 'conclusion': 'success'}]
+        run = check_shards.ShardedRun('1234', shards=shards, check_info={})
+        self.assertEqual(run.conclusion, 'success')
+
+        run.check_info['shard_untested_boards'] = ['metro_m4']
+        self.assertEqual(run.conclusion, 'action_required')
+        self.assertIn('Not tested: metro_m4', check_shards.completed_message(run)['output']['summary'])
+
+        shards[0]['conclusion'] = 'failure'
+        self.assertEqual(run.conclusion, 'failure')
+
+
+class TestDispatchShards(unittest.TestCase):
+    def setUp(self):
+        self.nodes = [
+            _node('node1', ['metro_m0', 'metro_m4']),
+            _node('node2', ['pyportal']),
+            _node('node3', ['metro_m4']),
+        ]
+        self.check_info = {'check_run_id': '1234', 'check_run_head_sha': 'abc123'}
+        self.pushes = []
+
+        self.declined = set()
+        self.unconfirmed = set()
+
+        patchers = [
+            mock.patch.object(check_dispatch, '_idle_nodes', return_value=self.nodes),
+            mock.patch.object(dispatch_ledger, 'assign_shards', return_value=True),
+            mock.patch.object(node_registrar, 'push_test_to_nodes', self._push),
+        ]
+        for patcher in patchers:
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(check_dispatch, 'accept_shards')
+        self.accept_shards = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _push(self, message, node_names=None, registrar_entries=None):
+        node_name = node_names[0]
+        self.pushes.append((node_name, message['shard'], message['boards']))
+        if node_name in self.unconfirmed:
+            return False, None, node_name
+        if node_name in self.declined:
+            return False, None, None
+        return True, node_name, None
+
+    def _dispatch(self):
+        dispatch = dispatch_ledger.Dispatch('1234')
+        with mock.patch.dict(os.environ, {'CHECK_SHARDS_MAX': '2'}):
+            return check_dispatch.try_dispatch_shards(self.check_info, dispatch, [])
+
+    def test_declined_shard_redispatched(self):
+        """ Test that a declined shard's boards go to an idle node that
+            wasn't tried, in the declined shard's place.
+        """
+
+        self.declined.add('node1')
+
+        self.assertTrue(self._dispatch())
+        self.assertEqual(self.pushes, [
+            ('node1', 0, ['metro_m0', 'metro_m4']),
+            ('node2', 1, ['pyportal']),
+            ('node3', 0, ['metro_m4']),
+        ])
+        _, accepted, untested = self.accept_shards.call_args[0]
+        self.assertEqual([shard['node_name'] for shard in accepted], ['node2', 'node3'])
+        self.assertEqual(untested, ['metro_m0'])
+
+    def test_unconfirmed_shard_not_redispatched(self):
+        """ Test that a shard its node may have taken isn't pushed to
+            another node.
+        """
+
+        self.unconfirmed.add('node1')
+
+        self.assertTrue(self._dispatch())
+        self.assertEqual([push[0] for push in self.pushes], ['node1', 'node2'])
+        _, _, untested = self.accept_shards.call_args[0]
+        self.assertEqual(untested, ['metro_m0', 'metro_m4'])
+
@@ -0,0 +1,89 @@
+import unittest
+
+from unittest import mock
+
+import _app
+
+from __app__.lib import app_client, check_updates
+
+
+class TestCheckUpdates(unittest.TestCase):
+    def test_graphql_input(self):
+        """ Test that a REST check run update is translated into an
+            ``UpdateCheckRunInput``.
+        """
+
+        check_info = {'check_run_node_id': 'CR_1', 'repository_node_id': 'R_1'}
+        update = check_updates.graphql_input(check_info, {
+            'status': 'completed',
+            'conclusion': 'cancelled',
+            'completed_at': '2020-01-01T00:00:00Z',
+            'output': {'title': 'RosiePi', 'summary': 'Cancelled.'},
+        })
+
+        self.assertEqual(update, {
+            'checkRunId': 'CR_1',
+            'repositoryId': 'R_1',
+            'status': 'COMPLETED',
+            'conclusion': 'CANCELLED',
+            'completedAt': '2020-01-01T00:00:00Z',
+            'output': {'title': 'RosiePi', 'summary': 'Cancelled.'},
+        })
+
+    def test_graphql_input_rest_only(self):
+        """ Test that updates GraphQL can't express, and check runs
+            queued without GraphQL IDs, are left for REST.
+        """
+
+        check_info = {'check_run_node_id': 'CR_1', 'repository_node_id': 'R_1'}
+        annotated = {
+            'output': {
+                'title': 'RosiePi',
+                'summary': 'Failed.',
+                'annotations': [{'path': 'README.md'}],
+            },
+        }
+
+        self.assertIsNone(check_updates.graphql_input(check_info, annotated))
+        self.assertIsNone(check_updates.graphql_input(check_info, {'unknown': 1}))
+        self.assertIsNone(check_updates.graphql_input({}, {'status': 'queued'}))
+
+    def _client(self, status_code):
+        client = mock.Mock()
+        client.create_installation_app_token.return_value = 'token'
+        client.update_check_run.return_value = status_code
+        return mock.patch.object(app_client, 'GithubClient', return_value=client)
+
+    def test_update_check_run(self):
+        """ Test that an update sent now is returned with its outcome,
+            and that only a failed update is passed to its ``on_error``.
+        """
+
+        on_error = mock.Mock()
+        with self._client(200):
+            update = check_updates.update_check_run({}, {'status': 'queued'}, on_error)
+        self.assertTrue(update.ok)
+        self.assertEqual(update.transport, 'rest')
+        on_error.assert_not_called()
+
+        with self._client(404):
+            update = check_updates.update_check_run({}, {'status': 'queued'}, on_error)
+        self.assertFalse(update.ok)
+        on_error.assert_called_once_with(update)
+
+    def test_update_check_run_batched(self):
+        """ Test that a batched update is returned before it is sent, and
+            that its ``on_error`` is called when the batch is sent.
+        """
+
+        on_error = mock.Mock()
+        with self._client(422):
+            with check_updates.batched():
+                update = check_updates.update_check_run(
+                    {'installation_id': 1}, {'status': 'queued'}, on_error
+                )
+                self.assertIsNone(update.status_code)
+                on_error.assert_not_called()
+
+        self.assertEqual(update.status_code, 422)
+        on_error.assert_called_once_with(update)
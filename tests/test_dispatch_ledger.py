@@ -0,0 +1,127 @@
+import os
+import unittest
+
+from unittest import mock
+
+import _app
+
+from __app__.lib import dispatch_ledger
+
+
+class TestDispatchLedger(unittest.TestCase):
+    def test_idempotency_key(self):
+        """ Test that each attempt at dispatching a job has its own key.
+        """
+
+        dispatch = dispatch_ledger.Dispatch('1234', attempt=2)
+
+        self.assertEqual(dispatch.idempotency_key, 'rosiepi-1234-2')
+        self.assertNotEqual(
+            dispatch.idempotency_key, dispatch_ledger.idempotency_key('1234', 3)
+        )
+
+    @mock.patch.dict(os.environ, {'DISPATCH_UNCERTAIN_SECONDS': '600'})
+    def test_holding(self):
+        """ Test that a job is held for the node of an uncertain attempt
+            until the hold runs out.
+        """
+
+        dispatch = dispatch_ledger.Dispatch(
+            '1234', state=dispatch_ledger.STATE_UNCERTAIN, node_name='node1', updated_at=1000
+        )
+
+        self.assertTrue(dispatch.holding(now=1599))
+        self.assertFalse(dispatch.holding(now=1600))
+
+        dispatch.state = dispatch_ledger.STATE_PENDING
+        self.assertFalse(dispatch.holding(now=1000))
+
+    @mock.patch.dict(os.environ, {'DISPATCH_PENDING_SECONDS': '120'})
+    def test_in_flight(self):
+        """ Test that a pending attempt is left to its dispatcher until
+            the pending hold runs out.
+        """
+
+        dispatch = dispatch_ledger.Dispatch('1234', updated_at=1000)
+
+        self.assertTrue(dispatch.in_flight(now=1119))
+        self.assertFalse(dispatch.in_flight(now=1120))
+
+        dispatch.state = dispatch_ledger.STATE_WAITING
+        self.assertFalse(dispatch.in_flight(now=1000))
+
+    @mock.patch.dict(os.environ, {'DISPATCH_PENDING_SECONDS': '120'})
+    @mock.patch.object(dispatch_ledger, '_table')
+    @mock.patch.object(dispatch_ledger, '_write')
+    @mock.patch.object(dispatch_ledger, 'get')
+    def test_begin(self, get, write, _):
+        """ Test that a job isn't dispatched while another dispatcher's
+            attempt is in flight, and gets a new attempt once it isn't.
+        """
+
+        stored = dispatch_ledger.Dispatch('1234', updated_at=1000, etag='etag')
+        get.return_value = stored
+        check_info = {'check_run_id': '1234'}
+
+        self.assertIsNone(dispatch_ledger.begin(check_info, now=1060))
+        write.assert_not_called()
+
+        dispatch_ledger.mark_waiting(stored, now=1061)
+        self.assertEqual(stored.state, dispatch_ledger.STATE_WAITING)
+
+        dispatch = dispatch_ledger.begin(check_info, now=1062)
+        self.assertEqual(dispatch.state, dispatch_ledger.STATE_PENDING)
+        self.assertEqual(dispatch.attempt, 2)
+
+    @mock.patch.object(dispatch_ledger, '_table')
+    @mock.patch.object(dispatch_ledger, '_write')
+    @mock.patch.object(dispatch_ledger, 'get')
+    def test_release_keeps_dispatched_node(self, get, write, _):
+        """ Test that a job taken back from its node can only be adopted
+            by that node, until its next attempt is answered.
+        """
+
+        get.return_value = dispatch_ledger.Dispatch(
+            '1234', state=dispatch_ledger.STATE_OWNED, node_name='node1', etag='etag'
+        )
+
+        released = dispatch_ledger.release('1234', 'node1', now=1000)
+        self.assertEqual(released.state, dispatch_ledger.STATE_WAITING)
+        self.assertEqual(released.ownership('node1'), dispatch_ledger.ADOPTED)
+        self.assertEqual(released.ownership('node2'), dispatch_ledger.CONFLICT)
+
+        dispatch_ledger.mark_uncertain(released, 'node2', now=1001)
+        retried = dispatch_ledger.retry(released, now=1002)
+        self.assertEqual(retried.ownership('node2'), dispatch_ledger.CONFLICT)
+
+    def test_ownership(self):
+        """ Test that reports are accepted from the owner, adopted from
+            the unconfirmed node the job was dispatched to, and refused
+            from other nodes.
+        """
+
+        owned = dispatch_ledger.Dispatch(
+            '1234', state=dispatch_ledger.STATE_OWNED, node_name='node1'
+        )
+        self.assertEqual(owned.ownership('node1'), dispatch_ledger.OWNER)
+        self.assertEqual(owned.ownership('node2'), dispatch_ledger.CONFLICT)
+
+        uncertain = dispatch_ledger.Dispatch(
+            '1234', state=dispatch_ledger.STATE_UNCERTAIN, node_name='node1'
+        )
+        self.assertEqual(uncertain.ownership('node1'), dispatch_ledger.ADOPTED)
+        self.assertEqual(uncertain.ownership('node2'), dispatch_ledger.CONFLICT)
+
+        pending = dispatch_ledger.Dispatch('1234')
+        self.assertEqual(pending.ownership('node2'), dispatch_ledger.CONFLICT)
+
+        for state in (dispatch_ledger.STATE_PENDING, dispatch_ledger.STATE_WAITING):
+            dispatched = dispatch_ledger.Dispatch('1234', state=state, dispatched_to='node1')
+            self.assertEqual(dispatched.ownership('node1'), dispatch_ledger.ADOPTED)
+            self.assertEqual(dispatched.ownership('node2'), dispatch_ledger.CONFLICT)
+
+        sharded = dispatch_ledger.Dispatch(
+            '1234', state=dispatch_ledger.STATE_SHARDED, node_name='node1,node2'
+        )
+        self.assertEqual(sharded.ownership('node2'), dispatch_ledger.OWNER)
+        self.assertEqual(sharded.ownership('node3'), dispatch_ledger.CONFLICT)
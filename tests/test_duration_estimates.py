@@ -0,0 +1,90 @@
+import os
+import unittest
+
+from unittest import mock
+
+import _app
+
+from __app__.lib import duration_estimates, node_ledger, node_registrar
+
+
+def _node(node_name, boards=None):
+    return node_registrar.NodeItem(node_name=node_name, boards=boards)
+
+
+class TestDurationEstimates(unittest.TestCase):
+    def setUp(self):
+        self.estimates = duration_estimates.Estimates(
+            node_means={'slow': 2400, 'fast': 120},
+            board_means={'metro_m0': 60, 'metro_m4': 90},
+        )
+
+    def test_job_seconds(self):
+        """ Test that a node's own mean is used, and that nodes without
+            history fall back to their boards, then to the farm's mean.
+        """
+
+        self.assertEqual(self.estimates.job_seconds(_node('slow')), 2400)
+        self.assertEqual(
+            self.estimates.job_seconds(_node('new', ['metro_m0', 'metro_m4'])), 150
+        )
+        self.assertEqual(self.estimates.job_seconds(_node('new', ['pyportal'])), 1260)
+
+    def test_job_seconds_shard(self):
+        """ Test that a job testing some of a node's boards takes their
+            share of the node's mean.
+        """
+
+        node = _node('slow', ['metro_m0', 'pyportal', 'feather_m4'])
+
+        self.assertEqual(self.estimates.job_seconds(node, ['pyportal']), 800)
+        self.assertEqual(self.estimates.job_seconds(node, ['metro_m0']), 60)
+
+    @mock.patch.dict(os.environ, {'NODE_MAX_RUNNING': '1'})
+    def test_expected_completion(self):
+        """ Test that a busy fast node is preferred over a busy slow node
+            with fewer jobs, and that a free run slot means no wait.
+        """
+
+        now = 10000
+        fast = node_ledger.NodeLoad(
+            'fast',
+            running=[{'started_at': now - 60}],
+            queued=[{}, {}],
+        )
+        slow = node_ledger.NodeLoad('slow', running=[{'started_at': now - 600}])
+
+        fast_done = self.estimates.expected_completion(_node('fast'), fast, now=now)
+        slow_done = self.estimates.expected_completion(_node('slow'), slow, now=now)
+
+        self.assertEqual(fast_done, 60 + 2 * 120 + 120)
+        self.assertEqual(slow_done, 1800 + 2400)
+        self.assertLess(fast_done, slow_done)
+
+        self.assertEqual(
+            self.estimates.expected_completion(_node('slow'), node_ledger.NodeLoad('slow')),
+            2400
+        )
+
+    @mock.patch.object(duration_estimates.result_aggregates, 'query')
+    def test_load(self, query):
+        """ Test that rows with too few timed runs are ignored, and that
+            loaded estimates are reused.
+        """
+
+        def rows(kind, name=None):
+            if kind == 'node':
+                return [
+                    {'name': 'node1', 'duration': {'count': 5, 'mean': 300.0}},
+                    {'name': 'node2', 'duration': {'count': 1, 'mean': 30.0}},
+                ]
+            return []
+        query.side_effect = rows
+        duration_estimates.reset()
+        self.addCleanup(duration_estimates.reset)
+
+        estimates = duration_estimates.load()
+
+        self.assertEqual(estimates.node_means, {'node1': 300.0})
+        self.assertIs(duration_estimates.load(), estimates)
+        self.assertEqual(query.call_count, 2)
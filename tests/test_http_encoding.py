@@ -0,0 +1,38 @@
+import gzip
+import unittest
+
+import _app
+
+from __app__.lib import http_encoding
+
+
+class TestHttpEncoding(unittest.TestCase):
+    def test_negotiate(self):
+        """ Test that codings are picked by quality, then server
+            preference, and refused codings aren't used.
+        """
+
+        self.assertEqual(http_encoding.negotiate('gzip, deflate'), 'gzip')
+        self.assertEqual(http_encoding.negotiate('gzip;q=0.5, deflate'), 'deflate')
+        self.assertEqual(http_encoding.negotiate('deflate, gzip;q=0'), 'deflate')
+        self.assertEqual(http_encoding.negotiate('*'), 'gzip')
+        self.assertIsNone(http_encoding.negotiate('br'))
+        self.assertIsNone(http_encoding.negotiate(None))
+
+    def test_encode_response(self):
+        """ Test that large bodies are compressed, and small ones left
+            as they are.
+        """
+
+        body = '{"node_results": [' + ', '.join(['{"outcome": true}'] * 100) + ']}'
+        response_kwargs = {'status_code': 200, 'body': body, 'headers': {}}
+        http_encoding.encode_response(response_kwargs, 'gzip')
+
+        self.assertEqual(response_kwargs['headers']['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(response_kwargs['body']).decode(), body)
+
+        response_kwargs = {'status_code': 200, 'body': '{}', 'headers': {}}
+        http_encoding.encode_response(response_kwargs, 'gzip')
+
+        self.assertNotIn('Content-Encoding', response_kwargs['headers'])
+        self.assertEqual(response_kwargs['headers']['Vary'], 'Accept-Encoding')
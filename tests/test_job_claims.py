@@ -0,0 +1,82 @@
+import os
+import unittest
+
+from types import SimpleNamespace
+from unittest import mock
+
+import _app
+
+from __app__.lib import check_queue, job_claims, message_codec, metrics
+
+
+class TestJobClaims(unittest.TestCase):
+    def test_claim_token_round_trip(self):
+        """ Test that a claim token holds the lane, message id and pop
+            receipt.
+        """
+
+        message = SimpleNamespace(id='abc', pop_receipt='receipt')
+        claim = job_claims.make_claim('bulk', message)
+
+        self.assertEqual(job_claims.parse_claim(claim), ('bulk', 'abc', 'receipt'))
+        self.assertIsNone(job_claims.parse_claim('not-a-claim'))
+
+    def test_compatible_boards(self):
+        """ Test that a job listing boards is only claimed by a node with
+            one of them, and other jobs by any node.
+        """
+
+        job = {'boards': ['pyportal', 'metro_m4_express']}
+
+        self.assertTrue(job_claims._compatible(job, ['metro_m4_express']))
+        self.assertFalse(job_claims._compatible(job, ['feather_m4_express']))
+        self.assertFalse(job_claims._compatible(job, None))
+        self.assertTrue(job_claims._compatible({}, None))
+
+    def test_parse_wait(self):
+        """ Test that only finite, non-negative waits are accepted.
+        """
+
+        self.assertEqual(job_claims.parse_wait(3), 3.0)
+        self.assertEqual(job_claims.parse_wait('2.5'), 2.5)
+        for wait in ('soon', None, [], True, -1, 'nan', 'inf'):
+            self.assertIsNone(job_claims.parse_wait(wait), wait)
+
+    def test_wait_limit(self):
+        """ Test that claim requests can't be set to wait past the limit.
+        """
+
+        with mock.patch.dict(os.environ, {'CLAIM_WAIT_MAX_SECONDS': '60'}):
+            self.assertEqual(job_claims.claim_wait_max_seconds(), job_claims._CLAIM_WAIT_LIMIT)
+        with mock.patch.dict(os.environ, {'CLAIM_WAIT_MAX_SECONDS': '3'}):
+            self.assertEqual(job_claims.claim_wait_max_seconds(), 3)
+
+    def test_malformed_message_removed(self):
+        """ Test that a job message that can't be decoded is deleted, and
+            the next job is looked at.
+        """
+
+        metrics.reset()
+        self.addCleanup(metrics.reset)
+
+        malformed = SimpleNamespace(id='bad', pop_receipt='r1', content=b'not a job')
+        job = SimpleNamespace(id='good', pop_receipt='r2', content=message_codec.encode(
+            {'check_run_id': 1234, 'check_run_head_sha': 'abc123'}, kind='check'
+        ))
+        queue_client = mock.Mock(queue_name='rosiepi-job-queue')
+        queue_client.receive_message.side_effect = [malformed, job]
+        queue_client.update_message.side_effect = lambda message, **kwargs: message
+
+        with mock.patch.object(check_queue, 'check_queue_client', return_value=queue_client), \
+             mock.patch.object(job_claims.dispatch_ledger, 'assign'), \
+             mock.patch.object(job_claims.check_dispatch, 'accept_job'):
+            claimed = job_claims._claim_from_lane(None, 'node-1', None)
+
+        self.assertEqual(claimed['job'], {'commit_sha': 'abc123', 'check_run_id': 1234})
+        queue_client.delete_message.assert_called_once_with(malformed)
+        self.assertEqual(
+            metrics.snapshot()['counters'][
+                ('queue_malformed_total', (('queue', 'rosiepi-job-queue'),))
+            ],
+            1
+        )
@@ -0,0 +1,156 @@
+import os
+import unittest
+
+from unittest import mock
+
+import _app
+
+from __app__.lib import check_queue, check_updates, dispatch_ledger, job_sweeper
+from __app__.lib import node_db, node_github, node_ledger
+
+
+def _job(check_run_id, **timestamps):
+    padding = '0'*(50 - len(check_run_id))
+    return dict(RowKey=f'{padding}{check_run_id}', **timestamps)
+
+
+class TestJobSweeper(unittest.TestCase):
+    @mock.patch.dict(os.environ, {
+        'JOB_START_DEADLINE_SECONDS': '3600',
+        'JOB_RUN_DEADLINE_SECONDS': '7200',
+    })
+    def test_find_orphans(self):
+        """ Test that jobs are orphaned once their node misses the start
+            deadline for queued jobs, or the run deadline for running
+            jobs.
+        """
+
+        now = 100000
+        loads = {
+            'node1': node_ledger.NodeLoad(
+                'node1',
+                running=[_job('1', assigned_at=0, started_at=now - 7200)],
+                queued=[_job('2', assigned_at=now - 3599)],
+            ),
+            'node2': node_ledger.NodeLoad(
+                'node2',
+                running=[_job('3', assigned_at=0, started_at=now - 60)],
+                queued=[_job('4', assigned_at=now - 3600)],
+            ),
+        }
+
+        self.assertEqual(
+            sorted(job_sweeper.find_orphans(loads, now=now)),
+            [('node1', '1'), ('node2', '4')]
+        )
+
+    def test_stop_message(self):
+        """ Test that a stopped job's check run is completed.
+        """
+
+        message = node_github.stop_message('Node offline.', conclusion='timed_out')
+
+        self.assertEqual(message['status'], 'completed')
+        self.assertEqual(message['conclusion'], 'timed_out')
+        self.assertEqual(message['output']['summary'], 'Node offline.')
+
+    def _recover(self, dispatch):
+        """ Recovers job 1234 from node1, with ``dispatch`` as its entry
+            in the dispatch ledger.
+
+        :return: tuple: The outcome, and the mocks of the node ledger,
+                        the check queue and check run updates.
+        """
+        if isinstance(dispatch, Exception):
+            get = {'side_effect': dispatch}
+        else:
+            get = {'return_value': dispatch}
+        with mock.patch.dict(os.environ, {'CHECK_DISPATCH_MODE': 'push'}), \
+             mock.patch.object(dispatch_ledger, 'get', **get), \
+             mock.patch.object(dispatch_ledger, 'release', return_value=dispatch), \
+             mock.patch.object(node_db, 'get_result', side_effect=Exception()), \
+             mock.patch.object(node_ledger, 'record_finished') as record_finished, \
+             mock.patch.object(check_queue, 'send_check') as send_check, \
+             mock.patch.object(check_updates, 'update_check_run') as update_check_run:
+            outcome = job_sweeper.recover_job('node1', '1234')
+
+        return outcome, record_finished, send_check, update_check_run
+
+    def test_recover_job(self):
+        """ Test that an orphaned job is dispatched again, and only then
+            removed from its node's ledger.
+        """
+
+        dispatch = dispatch_ledger.Dispatch(
+            '1234', state=dispatch_ledger.STATE_OWNED, node_name='node1',
+            check_info={'check_run_id': '1234'}
+        )
+
+        outcome, record_finished, send_check, update_check_run = self._recover(dispatch)
+
+        self.assertEqual(outcome, job_sweeper.REDISPATCHED)
+        record_finished.assert_called_once_with('node1', '1234')
+        self.assertEqual(send_check.call_args[0][0]['redispatches'], 1)
+        self.assertEqual(update_check_run.call_args[0][1]['status'], 'queued')
+
+    def test_recover_job_unread_dispatch(self):
+        """ Test that a job whose dispatch can't be read is left in its
+            node's ledger for the next sweep.
+        """
+
+        outcome, record_finished, send_check, update_check_run = self._recover(
+            Exception('timed out')
+        )
+
+        self.assertEqual(outcome, job_sweeper.DEFERRED)
+        record_finished.assert_not_called()
+        send_check.assert_not_called()
+        update_check_run.assert_not_called()
+
+    def test_recover_job_owned_by_another_node(self):
+        """ Test that a job given to another node since is left to it,
+            and only removed from the orphaning node's ledger.
+        """
+
+        dispatch = dispatch_ledger.Dispatch(
+            '1234', state=dispatch_ledger.STATE_OWNED, node_name='node2',
+            check_info={'check_run_id': '1234'}
+        )
+
+        outcome, record_finished, send_check, update_check_run = self._recover(dispatch)
+
+        self.assertEqual(outcome, job_sweeper.RELEASED)
+        record_finished.assert_called_once_with('node1', '1234')
+        send_check.assert_not_called()
+        update_check_run.assert_not_called()
+
+    @mock.patch.dict(os.environ, {'CHECK_DISPATCH_MODE': 'push', 'JOB_MAX_REDISPATCHES': '0'})
+    def test_recover_job_close_failed(self):
+        """ Test that a job whose check run couldn't be closed is put
+            back in its node's ledger, once it was removed.
+        """
+
+        dispatch = dispatch_ledger.Dispatch(
+            '1234', state=dispatch_ledger.STATE_OWNED, node_name='node1',
+            check_info={'check_run_id': '1234'}
+        )
+
+        def failed_update(check_info, message, on_error=None):
+            update = check_updates.CheckRunUpdate(check_info, message, on_error)
+            update.status_code = 502
+            update.finish()
+            return update
+
+        ledger = mock.Mock()
+        with mock.patch.object(dispatch_ledger, 'get', return_value=dispatch), \
+             mock.patch.object(node_db, 'get_result', side_effect=Exception()), \
+             mock.patch.object(node_ledger, 'record_finished', ledger.record_finished), \
+             mock.patch.object(node_ledger, 'record_assigned', ledger.record_assigned), \
+             mock.patch.object(check_updates, 'update_check_run', side_effect=failed_update):
+            outcome = job_sweeper.recover_job('node1', '1234')
+
+        self.assertEqual(outcome, job_sweeper.CLOSED)
+        self.assertEqual(ledger.mock_calls, [
+            mock.call.record_finished('node1', '1234'),
+            mock.call.record_assigned('node1', '1234'),
+        ])
@@ -0,0 +1,76 @@
+import json
+import os
+import unittest
+
+from unittest import mock
+
+import _app
+
+from __app__.lib import message_codec
+
+
+CHECK_INFO = {
+    'api_url': 'https://api.github.com/repos/adafruit/circuitpython/check-runs/1',
+    'installation_id': '12345',
+    'check_run_id': '1',
+    'check_run_head_sha': '0123456789abcdef0123456789abcdef01234567',
+    'check_run_pull_requests': [
+        f'https://api.github.com/repos/adafruit/circuitpython/pulls/{number}'
+        for number in range(4000, 4020)
+    ],
+    'is_claimed': 'false',
+    'enqueued_at': 1600000000.5,
+    'unknown_field': {'kept': True},
+}
+
+
+class TestMessageCodec(unittest.TestCase):
+    def test_round_trip(self):
+        """ Test that a compact message decodes to the original fields,
+            and is smaller than the JSON message.
+        """
+
+        encoded = message_codec.encode(CHECK_INFO)
+
+        self.assertEqual(message_codec.decode(encoded), CHECK_INFO)
+        self.assertLess(len(encoded), len(json.dumps(CHECK_INFO)) / 2)
+
+    @mock.patch.object(message_codec, '_HAS_MSGPACK', False)
+    def test_digit_field_names(self):
+        """ Test that field names made of digits aren't read as tags in
+            a JSON body, and that JSON bodies written before tagged
+            fields were kept apart are still read.
+        """
+
+        fields = dict(CHECK_INFO, **{'2': 'two', '999': 'kept'})
+        self.assertEqual(message_codec.decode(message_codec.encode(fields)), fields)
+
+        legacy = json.dumps({'2': '1', 'unknown_field': 3}).encode()
+        self.assertEqual(
+            message_codec.decode(bytes((1, 0)) + legacy),
+            {'check_run_id': '1', 'unknown_field': 3}
+        )
+
+    def test_decode_json(self):
+        """ Test that plain JSON messages, queued before the compact
+            encoding, are still read.
+        """
+
+        self.assertEqual(message_codec.decode(json.dumps(CHECK_INFO)), CHECK_INFO)
+        self.assertEqual(
+            message_codec.decode(json.dumps(CHECK_INFO).encode()), CHECK_INFO
+        )
+
+    @mock.patch.dict(os.environ, {'QUEUE_MESSAGE_ENCODING': 'json'})
+    def test_json_encoding(self):
+        """ Test that the ``json`` setting writes plain JSON.
+        """
+
+        self.assertEqual(json.loads(message_codec.encode(CHECK_INFO)), CHECK_INFO)
+
+    def test_malformed(self):
+        """ Test that a corrupt compact message raises ``ValueError``.
+        """
+
+        with self.assertRaises(ValueError):
+            message_codec.decode(bytes((1, 2)) + b'not zlib')
@@ -0,0 +1,119 @@
+import json
+import unittest
+
+from unittest import mock
+
+import _app
+
+from __app__.lib import metrics
+
+
+class TestMetrics(unittest.TestCase):
+    def setUp(self):
+        metrics.reset()
+        self.addCleanup(metrics.reset)
+
+    def test_histogram(self):
+        """ Test that values are counted in the first bucket they fit,
+            and that quantiles are estimated from the bucket bounds.
+        """
+
+        histogram = metrics.Histogram(buckets=(1, 5, 10))
+        self.assertIsNone(histogram.quantile(0.5))
+
+        for value in (0.5, 1, 3, 7, 20):
+            histogram.observe(value)
+
+        self.assertEqual(histogram.counts, [2, 1, 1, 1])
+        self.assertEqual(histogram.count, 5)
+        self.assertEqual(histogram.sum, 31.5)
+        self.assertEqual(histogram.quantile(0.4), 1)
+        self.assertEqual(histogram.quantile(0.6), 5)
+        self.assertEqual(histogram.quantile(1), float('inf'))
+
+    def test_span(self):
+        """ Test that a span records its duration, and counts its errors.
+        """
+
+        with metrics.span('github_token'):
+            pass
+        with self.assertRaises(ValueError):
+            with metrics.span('github_token'):
+                raise ValueError()
+
+        current = metrics.snapshot()
+        key = ('stage_duration_seconds', (('stage', 'github_token'),))
+        self.assertEqual(current['histograms'][key].count, 2)
+        self.assertEqual(
+            current['counters'][('stage_errors_total', (('stage', 'github_token'),))], 1
+        )
+
+    def test_invocation(self):
+        """ Test that an invocation logs every span recorded during it.
+        """
+
+        @metrics.invocation('github-hook')
+        def main():
+            with metrics.span('registrar_read'):
+                pass
+
+        with mock.patch.object(metrics.logging, 'info') as log:
+            main()
+
+        line = log.call_args_list[-1][0][0]
+        self.assertTrue(line.startswith('physaci.metrics '))
+        record = json.loads(line[len('physaci.metrics '):])
+        self.assertEqual(record['function'], 'github-hook')
+        self.assertEqual(
+            [span['stage'] for span in record['spans']], ['registrar_read', 'invocation']
+        )
+        self.assertEqual(
+            metrics.snapshot()['counters'][
+                ('invocations_total', (('function', 'github-hook'),))
+            ],
+            1
+        )
+
+    def test_count_retries(self):
+        """ Test that a storage client's retries are counted.
+        """
+
+        callback = metrics.count_retries('results_table')
+        callback(mock.Mock())
+        callback(mock.Mock())
+
+        self.assertEqual(
+            metrics.snapshot()['counters'][
+                ('retries_total', (('operation', 'results_table'),))
+            ],
+            2
+        )
+
+    def test_render_text(self):
+        """ Test that counters, gauges and histograms are rendered in the
+            Prometheus text format.
+        """
+
+        metrics.incr('dispatch_total', outcome='accepted')
+        metrics.set_gauge('lane_depth', 3, lane='main')
+        metrics.observe('node_request_seconds', 0.3, buckets=(0.1, 0.5))
+        metrics.incr('registrar_updates_total', path='a "quoted"\nvalue')
+
+        lines = metrics.render_text().splitlines()
+
+        self.assertEqual(lines[:2], [
+            'physaci_dispatch_total{outcome="accepted"} 1',
+            'physaci_registrar_updates_total{path="a \\"quoted\\"\\nvalue"} 1',
+        ])
+        self.assertIn('physaci_lane_depth{lane="main"} 3', lines)
+        self.assertEqual(lines[-5:], [
+            'physaci_node_request_seconds_bucket{le="0.1"} 0',
+            'physaci_node_request_seconds_bucket{le="0.5"} 1',
+            'physaci_node_request_seconds_bucket{le="+Inf"} 1',
+            'physaci_node_request_seconds_sum 0.3',
+            'physaci_node_request_seconds_count 1',
+        ])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,122 @@
+
+import os
+import unittest
+
+from unittest import mock
+
+import _app
+
+from azure.common import AzureHttpError
+
+from __app__.lib import node_health
+from __app__.lib.node_registrar import NodeItem
+
+
+def registrar_entry(node_name):
+    return {'message': None, 'node': NodeItem(node_name=node_name)}
+
+class TestNodeHealth(unittest.TestCase):
+    def test_circuit_opens_after_failures(self):
+        """ Test that consecutive failures open the circuit.
+        """
+
+        health = node_health.NodeHealth('flappy')
+        for _ in range(int(node_health.failure_threshold())):
+            health.record(False, 10)
+
+        self.assertEqual(health.circuit, node_health.CIRCUIT_OPEN)
+        self.assertFalse(health.allow_dispatch(now=health.opened_at))
+
+    def test_half_open_after_cooldown(self):
+        """ Test that an open circuit allows a trial request after the
+            cooldown, and closes on success.
+        """
+
+        health = node_health.NodeHealth('flappy')
+        for _ in range(int(node_health.failure_threshold())):
+            health.record(False, 10)
+
+        later = health.opened_at + node_health.cooldown()
+        self.assertTrue(health.allow_dispatch(now=later))
+        self.assertEqual(health.circuit, node_health.CIRCUIT_HALF_OPEN)
+
+        health.record(True, 0.1)
+        self.assertEqual(health.circuit, node_health.CIRCUIT_CLOSED)
+
+    def test_half_open_failure_reopens(self):
+        """ Test that a failed trial request re-opens the circuit.
+        """
+
+        health = node_health.NodeHealth('flappy', circuit='half-open')
+        health.record(False, 10)
+        self.assertEqual(health.circuit, node_health.CIRCUIT_OPEN)
+
+    def test_order_for_dispatch(self):
+        """ Test that open circuits are skipped and faster nodes go first.
+        """
+
+        health = {
+            'slow': node_health.NodeHealth('slow', latency_ewma=5.0),
+            'fast': node_health.NodeHealth('fast', latency_ewma=0.2),
+            'down': node_health.NodeHealth(
+                'down', circuit='open', opened_at=float('inf')
+            ),
+        }
+        entries = [
+            registrar_entry(name) for name in ('slow', 'down', 'fast', 'new')
+        ]
+
+        ordered = node_health.order_for_dispatch(entries, health)
+        names = [entry['node'].node_name for entry in ordered]
+
+        self.assertEqual(names, ['fast', 'new', 'slow'])
+
+    @mock.patch.dict(os.environ, {'NODE_CIRCUIT_TRIAL_SECONDS': '60'})
+    def test_half_open_single_trial(self):
+        """ Test that a half-open node isn't sent requests while a trial
+            is in flight, unless the trial runs past its timeout.
+        """
+
+        health = node_health.NodeHealth(
+            'flappy', circuit='half-open', trial_started_at=1000
+        )
+
+        self.assertFalse(health.allow_dispatch(now=1059))
+        self.assertTrue(health.allow_dispatch(now=1060))
+
+        health.record(False, 10)
+        self.assertIsNone(health.trial_started_at)
+
+    @mock.patch.dict(os.environ, {'APP_STORAGE_CONN_STR': 'test'})
+    @mock.patch.object(node_health, 'tableservice')
+    def test_start_trial(self, tableservice):
+        """ Test that only the caller whose conditional write lands gets
+            the trial request.
+        """
+
+        table = tableservice.TableService.return_value
+        table.update_entity.side_effect = [
+            'etag-2', AzureHttpError('Precondition failed', 412)
+        ]
+
+        closed = node_health.NodeHealth('steady')
+        self.assertTrue(node_health.start_trial(closed, now=1000))
+        table.update_entity.assert_not_called()
+
+        first = node_health.NodeHealth('flappy', circuit='half-open', etag='etag-1')
+        second = node_health.NodeHealth('flappy', circuit='half-open', etag='etag-1')
+
+        self.assertTrue(node_health.start_trial(first, now=1000))
+        self.assertEqual(first.etag, 'etag-2')
+        entity = table.update_entity.call_args[0][1]
+        self.assertEqual(entity.trial_started_at, 1000)
+        self.assertNotIn('etag', entity)
+        self.assertEqual(table.update_entity.call_args[1], {'if_match': 'etag-1'})
+
+        self.assertFalse(node_health.start_trial(second, now=1001))
+        self.assertFalse(node_health.start_trial(second, now=1002))
+        self.assertEqual(table.update_entity.call_count, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
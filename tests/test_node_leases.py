@@ -0,0 +1,231 @@
+import json
+import os
+import unittest
+
+from unittest import mock
+
+import _app
+
+from __app__.lib import message_codec, node_registrar, storage
+
+
+_LEASES = {
+    'APP_STORAGE_BACKEND': storage.BACKEND_MEMORY,
+    'REGISTRAR_LEASE_SECONDS': '3600',
+    'REGISTRAR_LEASE_GRACE_SECONDS': '300',
+}
+
+_NODE = {
+    'node_name': 'node1',
+    'node_ip': '10.0.0.1',
+    'node_sig_key': 'key',
+}
+
+
+class TestNodeLeases(unittest.TestCase):
+    """ Tests of registrar leases, against the memory registrar store.
+    """
+
+    def setUp(self):
+        patcher = mock.patch.dict(os.environ, _LEASES)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(storage.reset)
+        storage.reset()
+
+        # registrar reads hide entries for a second, so each step of a
+        # test moves the clock on.
+        self.now = 100000.0
+        patcher = mock.patch('time.time', side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _advance(self, seconds):
+        self.now += seconds
+
+    def _entries(self):
+        self._advance(2)
+        return [
+            message_codec.decode(message.content)
+            for message in storage.registrar().receive(visibility_timeout=1)
+        ]
+
+    def _add(self, handle=None, **params):
+        self._advance(2)
+        return node_registrar.add_node(
+            dict(_NODE, **params), {'status_code': 200}, handle=handle
+        )
+
+    def _handle(self, response):
+        return json.loads(response['body'])['handle']
+
+    def _without_reads(self):
+        return mock.patch.object(
+            node_registrar, 'current_registrar', side_effect=AssertionError
+        )
+
+    def test_lease_expired(self):
+        """ Test that a lease expires once it and the grace period have
+            run out, and that entries without a lease don't expire.
+        """
+
+        node = node_registrar.NodeItem(lease_expires=1000)
+
+        self.assertFalse(node.lease_expired(now=999))
+        self.assertFalse(node.lease_expired(now=1300))
+        self.assertTrue(node.lease_expired(now=1301))
+        self.assertFalse(node_registrar.NodeItem().lease_expired(now=float('inf')))
+
+    def test_node_content_renew(self):
+        """ Test that a renewal starts a new lease, and that otherwise
+            the node's lease is kept, unless it has none.
+        """
+
+        node = node_registrar.NodeItem(**_NODE, lease_expires=1000)
+
+        content = message_codec.decode(node_registrar._node_content(node, renew=False))
+        self.assertEqual(content['lease_expires'], 1000)
+
+        content = message_codec.decode(node_registrar._node_content(node))
+        self.assertEqual(content['lease_expires'], self.now + 3600)
+        self.assertEqual(node.lease_expires, self.now + 3600)
+
+        node = node_registrar.NodeItem(**_NODE)
+        content = message_codec.decode(node_registrar._node_content(node, renew=False))
+        self.assertEqual(content['lease_expires'], self.now + 3600)
+
+    def test_add_renews_lease(self):
+        """ Test that registering a node that is already registered
+            renews its lease in place, rather than adding an entry.
+        """
+
+        self.assertEqual(self._add()['status_code'], 200)
+        first_lease = self._entries()[0]['lease_expires']
+
+        self._advance(1800)
+        self.assertEqual(self._add(busy=True)['status_code'], 200)
+
+        entries = self._entries()
+        self.assertEqual(len(entries), 1)
+        self.assertTrue(entries[0]['busy'])
+        self.assertGreater(entries[0]['lease_expires'], first_lease + 1800)
+
+    def test_renew_by_handle(self):
+        """ Test that registering again, or a heartbeat, with the
+            node's handle renews its lease without reading the registrar.
+        """
+
+        handle = self._handle(self._add())
+        first_lease = self._entries()[0]['lease_expires']
+
+        self._advance(1800)
+        with self._without_reads():
+            response = self._add(handle=handle, busy=True)
+        self.assertEqual(response['status_code'], 200)
+
+        entries = self._entries()
+        self.assertEqual(len(entries), 1)
+        self.assertTrue(entries[0]['busy'])
+        self.assertEqual(entries[0]['lease_expires'], self.now - 2 + 3600)
+        self.assertGreater(entries[0]['lease_expires'], first_lease)
+
+        self._advance(1800)
+        node = node_registrar.NodeItem(**_NODE)
+        with self._without_reads():
+            response = node_registrar.update_registered_node(
+                node, {'status_code': 200}, handle=self._handle(response)
+            )
+        self.assertEqual(response['status_code'], 200)
+
+        entries = self._entries()
+        self.assertEqual(len(entries), 1)
+        self.assertFalse(entries[0]['busy'])
+        self.assertEqual(entries[0]['lease_expires'], self.now - 2 + 3600)
+
+    def test_expired_handle(self):
+        """ Test that a handle to an entry whose grace period ran out
+            isn't renewed, and that the node is added again.
+        """
+
+        handle = self._handle(self._add())
+        self.now = self._entries()[0]['lease_expires'] + 301
+
+        self.assertEqual(self._add(handle=handle)['status_code'], 200)
+        entries = self._entries()
+        self.assertEqual(len(entries), 2)
+        self.assertEqual(
+            sorted(entry['lease_expires'] for entry in entries)[1], self.now - 2 + 3600
+        )
+
+    def test_renewal_in_grace_period(self):
+        """ Test that a node whose lease ran out is still renewed in
+            place during the grace period, and added again after it.
+        """
+
+        self._add()
+        lease = self._entries()[0]['lease_expires']
+
+        self.now = lease + 200
+        self.assertEqual(len(node_registrar.current_registrar()), 1)
+        self.assertEqual(self._add()['status_code'], 200)
+        entries = self._entries()
+        self.assertEqual(len(entries), 1)
+        self.assertEqual(entries[0]['lease_expires'], self.now - 2 + 3600)
+
+        self.now = entries[0]['lease_expires'] + 301
+        self.assertEqual(node_registrar.current_registrar(), [])
+        self.assertEqual(self._add()['status_code'], 200)
+        self.assertEqual(len(self._entries()), 2)
+
+        self._advance(2)
+        live, removed = node_registrar.sweep_registrar()
+        self.assertEqual(removed, 1)
+        self.assertEqual([entry['node'].node_name for entry in live], ['node1'])
+
+    def test_process_dup_node(self):
+        """ Test that a leased entry is returned for renewal, and that an
+            entry with another IP address is refused.
+        """
+
+        self._add()
+        self._advance(2)
+        entries = node_registrar.current_registrar()
+
+        node = node_registrar.NodeItem(**_NODE)
+        status_code, _, renew_entry = node_registrar.process_dup_node(node, entries)
+        self.assertEqual(status_code, 200)
+        self.assertIs(renew_entry, entries[0])
+
+        node.node_ip = '10.0.0.9'
+        status_code, _, renew_entry = node_registrar.process_dup_node(node, entries)
+        self.assertEqual(status_code, 409)
+        self.assertIsNone(renew_entry)
+
+    def test_update_without_renewal(self):
+        """ Test that an update made on the node's behalf (e.g. when it
+            accepts a job) doesn't renew its lease.
+        """
+
+        self._add()
+        self._advance(2)
+        entry = node_registrar.current_registrar()[0]
+        lease = entry['node'].lease_expires
+
+        self._advance(600)
+        entry['node'].busy = True
+        response = node_registrar.update_node(
+            entry['message'],
+            entry['node'],
+            {'status_code': 200},
+            pop_receipt=entry['message'].pop_receipt,
+            renew=False,
+        )
+        self.assertEqual(response['status_code'], 200)
+
+        entries = self._entries()
+        self.assertTrue(entries[0]['busy'])
+        self.assertEqual(entries[0]['lease_expires'], lease)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,43 @@
+import os
+import unittest
+
+from unittest import mock
+
+import _app
+
+from __app__.lib import node_ledger
+
+
+class TestNodeLedger(unittest.TestCase):
+    @mock.patch.dict(os.environ, {'NODE_MAX_RUNNING': '1', 'NODE_MAX_QUEUED': '2'})
+    def test_admit_up_to_limits(self):
+        """ Test that a node is admitted jobs until its run slots and
+            queue are full.
+        """
+
+        load = node_ledger.NodeLoad('node', running=[{}])
+        self.assertTrue(load.admit())
+
+        load.queued.extend([{}, {}])
+        self.assertEqual(load.in_flight, 3)
+        self.assertFalse(load.admit())
+
+    @mock.patch.dict(os.environ, {'NODE_MAX_RUNNING': '1', 'NODE_MAX_QUEUED': '0'})
+    def test_no_queue(self):
+        """ Test that with no queue, only idle nodes are admitted jobs.
+        """
+
+        self.assertTrue(node_ledger.NodeLoad('node').admit())
+        self.assertFalse(node_ledger.NodeLoad('node', queued=[{}]).admit())
+
+    def test_node_load_escapes_name(self):
+        """ Test that a node name with a quote can't change the ledger
+            query.
+        """
+
+        with mock.patch.object(node_ledger, '_load', return_value={}) as load:
+            node_ledger.node_load("node' or PartitionKey ne '")
+
+        load.assert_called_once_with(
+            "PartitionKey eq 'node'' or PartitionKey ne '''"
+        )
@@ -0,0 +1,135 @@
+import json
+import os
+import tempfile
+import time
+import unittest
+
+from unittest import mock
+
+import _app
+
+from __app__.lib import metrics, profiling
+
+
+def _busy(seconds):
+    end = time.perf_counter() + seconds
+    total = 0
+    while time.perf_counter() < end:
+        total += sum(range(100))
+
+    return total
+
+
+class TestProfiling(unittest.TestCase):
+    def setUp(self):
+        self.profile_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.profile_dir.cleanup)
+
+    def _env(self, **settings):
+        env = {'PROFILE_DIR': self.profile_dir.name, **settings}
+        return mock.patch.dict(os.environ, env)
+
+    def _summaries(self, function_name):
+        directory = os.path.join(self.profile_dir.name, function_name)
+        if not os.path.isdir(directory):
+            return []
+        summaries = []
+        for file_name in sorted(os.listdir(directory)):
+            if file_name.endswith('.json'):
+                with open(os.path.join(directory, file_name)) as summary:
+                    summaries.append((file_name, json.load(summary)))
+
+        return summaries
+
+    def test_off_by_default(self):
+        """ Test that nothing is profiled without ``PROFILE_FUNCTIONS``.
+        """
+
+        with self._env():
+            os.environ.pop('PROFILE_FUNCTIONS', None)
+            with profiling.profiled('github-hook'):
+                profiling.tag(event='check_run')
+                _busy(0.01)
+
+        self.assertEqual(self._summaries('github-hook'), [])
+
+    def test_should_profile(self):
+        """ Test that only the listed functions are profiled, at the
+            sample rate.
+        """
+
+        with self._env(PROFILE_FUNCTIONS='github-hook, job-result'):
+            self.assertTrue(profiling.should_profile('job-result'))
+            self.assertFalse(profiling.should_profile('testnode-hook'))
+        with self._env(PROFILE_FUNCTIONS='*', PROFILE_SAMPLE_RATE='0'):
+            self.assertFalse(profiling.should_profile('job-result'))
+        with self._env(PROFILE_FUNCTIONS='*', PROFILE_SAMPLE_RATE='0.25'):
+            with mock.patch('random.random', side_effect=(0.2, 0.3)):
+                self.assertTrue(profiling.should_profile('job-result'))
+                self.assertFalse(profiling.should_profile('job-result'))
+
+    def test_cprofile_invocation(self):
+        """ Test that a profiled invocation saves its profile and a
+            tagged summary of its top frames.
+        """
+
+        @metrics.invocation('job-result')
+        def main():
+            profiling.tag(event='result', check_run_id=1234, node=None)
+            return _busy(0.02)
+
+        with self._env(PROFILE_FUNCTIONS='job-result', PROFILE_TOP_FRAMES='5'):
+            main()
+
+        summaries = self._summaries('job-result')
+        self.assertEqual(len(summaries), 1)
+        file_name, summary = summaries[0]
+        self.assertTrue(file_name.endswith('-result-1234.json'))
+        self.assertEqual(summary['tags'], {'event': 'result', 'check_run_id': '1234'})
+        self.assertEqual(summary['mode'], profiling.MODE_CPROFILE)
+        self.assertEqual(len(summary['top_frames']), 5)
+        self.assertTrue(any('_busy' in row['frame'] for row in summary['top_frames']))
+        self.assertTrue(
+            os.path.exists(os.path.join(self.profile_dir.name, 'job-result',
+                                        file_name.replace('.json', '.prof')))
+        )
+
+    def test_sampling_invocation(self):
+        """ Test that sampling mode saves folded stacks of the invocation.
+        """
+
+        with self._env(PROFILE_FUNCTIONS='*', PROFILE_MODE='sampling',
+                       PROFILE_INTERVAL_SECONDS='0.001'):
+            with profiling.profiled('testnode-hook'):
+                _busy(0.05)
+
+        file_name, summary = self._summaries('testnode-hook')[0]
+        self.assertEqual(summary['mode'], profiling.MODE_SAMPLING)
+        self.assertTrue(any('_busy' in row['frame'] for row in summary['top_frames']))
+        folded = os.path.join(self.profile_dir.name, 'testnode-hook',
+                              file_name.replace('.json', '.folded'))
+        with open(folded) as stacks:
+            self.assertIn('_busy', stacks.read())
+
+    def test_tag_outside_profile(self):
+        """ Test that tagging an invocation that isn't profiled does
+            nothing.
+        """
+
+        profiling.tag(event='check_run')
+
+    def test_failed_invocation(self):
+        """ Test that an invocation that raises is still profiled, and
+            its error isn't swallowed.
+        """
+
+        with self._env(PROFILE_FUNCTIONS='*'):
+            with self.assertRaises(RuntimeError):
+                with profiling.profiled('queue-new-check'):
+                    raise RuntimeError('failed')
+
+        self.assertEqual(len(self._summaries('queue-new-check')), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,35 @@
+import unittest
+
+import _app
+
+from __app__.lib import result_aggregates
+
+
+class TestResultAggregates(unittest.TestCase):
+    def test_add_run_counts_outcomes_and_durations(self):
+        """ Test that runs are added to the outcome counts and duration
+            histogram, and summarised with a pass rate.
+        """
+
+        entity = {}
+        result_aggregates.add_run(entity, True, 90, now=1)
+        result_aggregates.add_run(entity, False, 90000, now=2)
+        result_aggregates.add_run(entity, None, None, now=3)
+
+        summary = result_aggregates.summarise(entity)
+        self.assertEqual(summary['runs'], 3)
+        self.assertEqual(summary['pass_rate'], 0.5)
+        self.assertEqual(summary['duration']['count'], 2)
+        self.assertEqual(summary['duration']['buckets']['120'], 1)
+        self.assertEqual(summary['duration']['buckets']['+Inf'], 1)
+        self.assertEqual(summary['last_run_at'], 3)
+        self.assertEqual(summary['last_failed_at'], 2)
+
+    def test_board_passed(self):
+        """ Test that bool and string board outcomes are understood.
+        """
+
+        self.assertTrue(result_aggregates.board_passed({'outcome': True}))
+        self.assertTrue(result_aggregates.board_passed({'outcome': 'Passed'}))
+        self.assertFalse(result_aggregates.board_passed({'outcome': 'Failed'}))
+        self.assertIsNone(result_aggregates.board_passed({}))
@@ -0,0 +1,148 @@
+import json
+import os
+import unittest
+
+from unittest import mock
+
+import _app
+
+from __app__.lib import result_chunks, result_files
+
+
+class TestResultChunks(unittest.TestCase):
+    def test_verify_chunk_counts_board_tests(self):
+        """ Test that blank lines are skipped when counting a chunk.
+        """
+
+        body = b'{"board_name": "a"}\n\n{"board_name": "b"}\n'
+
+        self.assertEqual(result_chunks.verify_chunk(body), 2)
+
+    def test_verify_chunk_rejects_non_objects(self):
+        """ Test that a chunk line that isn't a JSON object is rejected.
+        """
+
+        with self.assertRaises(result_chunks.ChunkError):
+            result_chunks.verify_chunk(b'{"board_name": "a"}\n[1, 2]\n')
+
+    def test_large_lines_are_split(self):
+        """ Test that a board test larger than a table property is split
+            across ``data_<n>`` properties.
+        """
+
+        line = json.dumps({'log': 'x' * 70000})
+        entity = result_chunks._chunk_entity('1', 'node', 'node|00000000|00001', line)
+
+        self.assertEqual(entity['parts'], 3)
+        self.assertEqual(
+            ''.join(entity[f'data_{part}'] for part in range(entity['parts'])),
+            line
+        )
+
+    def test_merge_board_is_order_independent(self):
+        """ Test that replayed and reordered deltas give the same board
+            as applying each delta once, in order.
+        """
+
+        deltas = [
+            (1, {'board_name': 'a', 'outcome': 'running'}),
+            (2, {'tests': ['t1']}),
+            (3, {'outcome': 'passed'}),
+        ]
+
+        in_order = {}
+        for seq, delta in deltas:
+            result_chunks.merge_board(in_order, dict(delta), seq)
+
+        shuffled = {}
+        for seq, delta in [deltas[2], deltas[0], deltas[2], deltas[1]]:
+            result_chunks.merge_board(shuffled, dict(delta), seq)
+
+        self.assertEqual(shuffled, in_order)
+        self.assertEqual(in_order['outcome'], 'passed')
+        self.assertFalse(result_chunks.merge_board(in_order, {'outcome': 'failed'}, 2))
+
+    def _append(self, lines):
+        body = '\n'.join(json.dumps(line) for line in lines).encode()
+        with mock.patch.dict(os.environ, {'RESULT_OFFLOAD_BYTES': '64',
+                                          'APP_STORAGE_CONN_STR': 'test'}), \
+             mock.patch.object(result_chunks, 'tableservice') as tableservice, \
+             mock.patch.object(result_chunks, 'tablebatch'), \
+             mock.patch.object(result_files, '_ensure_directory'), \
+             mock.patch.object(result_files, '_file_service') as file_service:
+            try:
+                return result_chunks.append_chunk('1234', 'node1', 0, body)
+            finally:
+                self.commits = tableservice.TableService.return_value.commit_batch
+                self.files = file_service.return_value.create_file_from_bytes
+
+    def test_append_offloads_stored_lines(self):
+        """ Test that an appended line's large strings are written to
+            files, and the line is stored with pointers to them.
+        """
+
+        stored = self._append([
+            {'board_name': 'a', 'log': 'x' * 100},
+            {'board_name': 'b', 'log': 'ok'},
+        ])
+
+        self.assertEqual(stored, 2)
+        self.assertEqual(self.commits.call_count, 1)
+        self.assertEqual(
+            [call[0][2] for call in self.files.call_args_list],
+            ['node1-0-1.0.log.txt']
+        )
+
+    def test_append_validates_before_offloading(self):
+        """ Test that no files are written, and nothing is stored, when a
+            line of the chunk is too large to store.
+        """
+
+        with self.assertRaises(result_chunks.ChunkError):
+            self._append([
+                {'board_name': 'a', 'log': 'x' * 100},
+                {'board_name': 'b', 'tests': ['short test'] * 40000},
+            ])
+
+        self.files.assert_not_called()
+        self.commits.assert_not_called()
+
+    def _delta(self, seq, board_tests, stored):
+        """ Applies a delta to node1's results for job 1234, where each
+            board's stored board test is taken from ``stored``.
+        """
+        def get_entity(table_name, partition_key, row_key):
+            board_name = row_key.rsplit('|', 1)[1]
+            line = json.dumps(stored.get(board_name, {}))
+            return dict(
+                result_chunks._chunk_entity('1234', 'node1', row_key, line), etag='etag'
+            )
+
+        calls = mock.Mock()
+        with mock.patch.dict(os.environ, {'RESULT_OFFLOAD_BYTES': '64',
+                                          'APP_STORAGE_CONN_STR': 'test'}), \
+             mock.patch.object(result_chunks, 'tableservice') as tableservice, \
+             mock.patch.object(result_files, '_ensure_directory'), \
+             mock.patch.object(result_files, '_file_service') as file_service:
+            table = tableservice.TableService.return_value
+            table.get_entity.side_effect = get_entity
+            calls.attach_mock(table.update_entity, 'update_entity')
+            calls.attach_mock(file_service.return_value.create_file_from_bytes, 'write_file')
+
+            changed = result_chunks.apply_delta('1234', 'node1', seq, board_tests)
+
+        return changed, [call[0] for call in calls.mock_calls]
+
+    def test_delta_offloads_merged_boards(self):
+        """ Test that a delta only writes the files of boards its merge
+            changes, each right before the board is stored.
+        """
+
+        stored = {'b': {'board_name': 'b', 'log': 'old', '_seq': {'board_name': 5, 'log': 5}}}
+        changed, calls = self._delta(3, [
+            {'board_name': 'a', 'log': 'x' * 100},
+            {'board_name': 'b', 'log': 'y' * 100},
+        ], stored)
+
+        self.assertEqual(changed, 1)
+        self.assertEqual(calls, ['write_file', 'update_entity'])
@@ -0,0 +1,67 @@
+import os
+import unittest
+
+from unittest import mock
+
+import _app
+
+from __app__.lib import result_files
+
+
+class TestParseRange(unittest.TestCase):
+    def test_ranges(self):
+        """ Test explicit, open-ended and suffix ranges.
+        """
+
+        self.assertEqual(result_files.parse_range(None, 100, 1000), (0, 99, False))
+        self.assertEqual(result_files.parse_range('bytes=10-19', 100, 1000), (10, 19, True))
+        self.assertEqual(result_files.parse_range('bytes=90-', 100, 1000), (90, 99, True))
+        self.assertEqual(result_files.parse_range('bytes=-5', 100, 1000), (95, 99, True))
+
+    def test_ranges_are_limited(self):
+        """ Test that responses are shortened to the range limit.
+        """
+
+        self.assertEqual(result_files.parse_range(None, 100, 10), (0, 9, True))
+        self.assertEqual(result_files.parse_range('bytes=50-', 100, 10), (50, 59, True))
+
+    def test_unsatisfiable(self):
+        """ Test that ranges starting past the end of the file are
+            rejected.
+        """
+
+        with self.assertRaises(result_files.RangeNotSatisfiable):
+            result_files.parse_range('bytes=100-', 100, 1000)
+
+
+class TestOffload(unittest.TestCase):
+    @mock.patch.dict(os.environ, {'RESULT_OFFLOAD_BYTES': '64'})
+    @mock.patch.object(result_files, '_ensure_directory')
+    @mock.patch.object(result_files, '_file_service')
+    def test_offload_by_board_name(self, file_service, _):
+        """ Test that large strings are replaced with file pointers, and
+            that files can be named by board instead of by position.
+        """
+
+        board_tests = [
+            {'board_name': 'metro_m4', 'log': 'x' * 100, 'summary': 'ok'},
+            {'board_name': 'feather/m0', 'tests': [{'log': 'y' * 100}]},
+        ]
+
+        written = result_files.offload_board_tests(
+            '1234', 'node1', board_tests, name_prefix='delta-3', name_key='board_name'
+        )
+
+        self.assertEqual(written, 2)
+        directory = '1234'.rjust(50, '0')
+        self.assertEqual(board_tests[0]['log'], {
+            'file': f'{directory}/node1-delta-3.metro_m4.log.txt',
+            'size': 100,
+            'content_type': 'text/plain; charset=utf-8',
+        })
+        self.assertEqual(board_tests[0]['summary'], 'ok')
+        self.assertEqual(
+            board_tests[1]['tests'][0]['log']['file'],
+            f'{directory}/node1-delta-3.feather_m0.tests.0.log.txt'
+        )
+        self.assertEqual(file_service.return_value.create_file_from_bytes.call_count, 2)
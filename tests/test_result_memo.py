@@ -0,0 +1,264 @@
+import json
+import os
+import unittest
+
+from unittest import mock
+
+import _app
+
+from __app__.lib import app_client, check_shards, metrics, node_db, node_registrar, result_memo
+
+
+def _result(check_run_id, conclusion, completed_at, node_name='node-1',
+            boards=('metro_m4_express',), **extra):
+    entity = {
+        'check_run_id': check_run_id,
+        'check_run_status': 'completed',
+        'check_run_conclusion': conclusion,
+        'check_run_completed_at': completed_at,
+        'check_run_external_id': f'ext-{check_run_id}',
+        'node_name': node_name,
+        'node_results': [{'board_name': board} for board in boards],
+    }
+    entity.update(extra)
+
+    return entity
+
+def _registered(node_name, boards):
+    node = node_registrar.NodeItem(node_name=node_name, boards=list(boards))
+    return {'node': node}
+
+
+class TestResultMemo(unittest.TestCase):
+    def setUp(self):
+        metrics.reset()
+        self.addCleanup(metrics.reset)
+        self.registrar = []
+        patcher = mock.patch.object(node_registrar, 'current_registrar',
+                                    side_effect=lambda: self.registrar)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def _find(self, policy, prior_results):
+        with mock.patch.dict(os.environ, {'RESULT_MEMO_POLICY': policy}):
+            with mock.patch.object(node_db, 'find_results',
+                                   return_value=prior_results) as find_results:
+                found = result_memo.find_memoized_result('abc123')
+
+        return found, find_results
+
+    def _outcomes(self):
+        counters = metrics.snapshot()['counters']
+        return {
+            outcome: counters.get(('memo_cache_total', (('outcome', outcome),)), 0)
+            for outcome in ('hit', 'miss')
+        }
+
+    def test_memo_policy(self):
+        """ Test that the policy is read from the app settings, and that
+            unknown policies turn memoization off.
+        """
+
+        with mock.patch.dict(os.environ, {'RESULT_MEMO_POLICY': 'Conclusive'}):
+            self.assertEqual(result_memo.memo_policy(), 'conclusive')
+        with mock.patch.dict(os.environ, {'RESULT_MEMO_POLICY': 'always'}):
+            self.assertEqual(result_memo.memo_policy(), 'off')
+        with mock.patch.dict(os.environ):
+            os.environ.pop('RESULT_MEMO_POLICY', None)
+            self.assertEqual(result_memo.memo_policy(), 'off')
+
+    def test_policy_off(self):
+        """ Test that nothing is looked up when memoization is off.
+        """
+
+        found, find_results = self._find('off', [_result('1', 'success', '2026-01-01')])
+
+        self.assertIsNone(found)
+        find_results.assert_not_called()
+        self.assertEqual(self._outcomes(), {'hit': 0, 'miss': 0})
+
+    def test_policy_success(self):
+        """ Test that only successful results are reused with the
+            ``success`` policy, the latest first.
+        """
+
+        prior_results = [
+            _result('1', 'success', '2026-01-01T00:00:00Z'),
+            _result('2', 'failure', '2026-01-03T00:00:00Z'),
+            _result('3', 'success', '2026-01-02T00:00:00Z'),
+            dict(_result('4', None, '2026-01-04T00:00:00Z'),
+                 check_run_status='in_progress'),
+        ]
+
+        found, _ = self._find('success', prior_results)
+        self.assertEqual(found['check_run_id'], '3')
+
+        found, _ = self._find('success', prior_results[1:2])
+        self.assertIsNone(found)
+        self.assertEqual(self._outcomes(), {'hit': 1, 'miss': 1})
+
+    def test_policy_conclusive(self):
+        """ Test that failures are reused too with the ``conclusive``
+            policy, but not neutral or cancelled results.
+        """
+
+        prior_results = [
+            _result('1', 'success', '2026-01-01T00:00:00Z'),
+            _result('2', 'failure', '2026-01-02T00:00:00Z'),
+            _result('3', 'cancelled', '2026-01-03T00:00:00Z'),
+        ]
+
+        found, _ = self._find('conclusive', prior_results)
+        self.assertEqual(found['check_run_id'], '2')
+
+        found, _ = self._find('conclusive', prior_results[2:])
+        self.assertIsNone(found)
+
+    def test_memoized_results_not_reused(self):
+        """ Test that a copy of a memoized result isn't memoized again.
+        """
+
+        prior_results = [
+            _result('1', 'success', '2026-01-01T00:00:00Z'),
+            _result('2', 'success', '2026-01-02T00:00:00Z', memoized_from='1'),
+        ]
+
+        found, _ = self._find('success', prior_results)
+        self.assertEqual(found['check_run_id'], '1')
+
+    def test_shard_results_not_reused(self):
+        """ Test that a sharded run is only reused through its merged
+            result, not through one of its shards' results.
+        """
+
+        prior_results = [
+            _result('1', 'success', '2026-01-01T00:00:00Z'),
+            _result('2', 'success', '2026-01-02T00:00:00Z',
+                    node_name='node-2', shard_count=2),
+            _result('2', 'success', '2026-01-02T00:00:00Z',
+                    node_name='node-3', shard_boards=['feather_m0']),
+        ]
+        found, _ = self._find('success', prior_results)
+        self.assertEqual(found['check_run_id'], '1')
+
+        prior_results.append(
+            _result('2', 'success', '2026-01-02T01:00:00Z',
+                    node_name=check_shards.MERGED_NODE_NAME, shard_count=2)
+        )
+        found, _ = self._find('success', prior_results)
+        self.assertEqual(found['node_name'], check_shards.MERGED_NODE_NAME)
+
+    def test_board_set_match(self):
+        """ Test that a result is skipped when its node now advertises a
+            different set of boards, and reused when the set matches
+            (in any order) or the node isn't registered.
+        """
+
+        prior_results = [
+            _result('1', 'success', '2026-01-01T00:00:00Z',
+                    node_name='node-1', boards=('feather_m0', 'metro_m4_express')),
+            _result('2', 'success', '2026-01-02T00:00:00Z',
+                    node_name='node-2', boards=('feather_m0',)),
+        ]
+
+        self.registrar = [
+            _registered('node-1', ['metro_m4_express', 'feather_m0']),
+            _registered('node-2', ['feather_m0', 'pyportal']),
+        ]
+        found, _ = self._find('success', prior_results)
+        self.assertEqual(found['check_run_id'], '1')
+
+        self.registrar = [_registered('node-1', ['feather_m0'])]
+        found, _ = self._find('success', prior_results)
+        self.assertEqual(found['check_run_id'], '2')
+
+        self.registrar = [
+            _registered('node-1', ['feather_m0']),
+            _registered('node-2', ['pyportal']),
+        ]
+        found, _ = self._find('success', prior_results)
+        self.assertIsNone(found)
+        self.assertEqual(self._outcomes(), {'hit': 2, 'miss': 1})
+
+    def test_board_set(self):
+        """ Test that malformed board entries are ignored.
+        """
+
+        self.assertEqual(
+            result_memo.board_set([{'board_name': 'feather_m0'}, {}, 'pyportal', None]),
+            frozenset(['feather_m0'])
+        )
+        self.assertEqual(result_memo.board_set(None), frozenset())
+
+
+class TestCreateMemoizedCheckRun(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(app_client, 'generate_jwt_token', return_value='jwt')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.client = app_client.GithubClient()
+        self.client.payload = {
+            'repository': {'full_name': 'adafruit/circuitpython'},
+            'check_suite': {'head_sha': 'abc123'},
+        }
+        self.memoized_result = _result(
+            '1', 'failure', '2026-01-01T00:00:00Z', check_run_head_sha='abc123'
+        )
+
+    def _create(self, ok=True):
+        response = mock.Mock(ok=ok, status_code=201 if ok else 422)
+        response.json.return_value = {
+            'id': 2,
+            'url': 'https://api.github.com/repos/adafruit/circuitpython/check-runs/2',
+            'html_url': 'https://github.com/adafruit/circuitpython/runs/2',
+            'completed_at': '2026-01-05T00:00:00Z',
+            'node_id': 'CR_2',
+        }
+        with mock.patch.object(self.client, 'create_installation_app_token',
+                               return_value='token'), \
+             mock.patch.object(app_client.requests, 'post',
+                               return_value=response) as post, \
+             mock.patch.object(node_db, 'add_result', return_value=True) as add_result:
+            status = self.client.create_check_run(memoized_result=self.memoized_result)
+
+        return status, post, add_result
+
+    def test_create_check_run(self):
+        """ Test that a memoized check run is created already completed,
+            and that a copy of the result is stored under it.
+        """
+
+        status, post, add_result = self._create()
+
+        self.assertEqual(status, 201)
+        params = post.call_args[1]['json']
+        self.assertEqual(params['head_sha'], 'abc123')
+        self.assertEqual(params['status'], 'completed')
+        self.assertEqual(params['conclusion'], 'failure')
+        self.assertEqual(params['external_id'], 'ext-1')
+        self.assertIn('check run 1', params['output']['summary'])
+
+        entity = add_result.call_args[0][0]
+        self.assertEqual(entity.RowKey, '2'.rjust(50, '0'))
+        self.assertEqual(entity.PartitionKey, 'node-1')
+        self.assertEqual(entity.check_run_head_sha, 'abc123')
+        stored = json.loads(entity.json_data)
+        self.assertEqual(stored['check_run_id'], '2')
+        self.assertEqual(stored['memoized_from'], '1')
+        self.assertEqual(stored['check_run_conclusion'], 'failure')
+        self.assertEqual(stored['node_results'], self.memoized_result['node_results'])
+        self.assertEqual(self.memoized_result['check_run_id'], '1')
+
+    def test_create_check_run_failed(self):
+        """ Test that nothing is stored if the check run isn't created.
+        """
+
+        status, _, add_result = self._create(ok=False)
+
+        self.assertEqual(status, 422)
+        add_result.assert_not_called()
+
+
+if __name__ == '__main__':
+    unittest.main()
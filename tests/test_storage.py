@@ -0,0 +1,259 @@
+import json
+import os
+import tempfile
+import time
+import unittest
+
+from unittest import mock
+
+import _app
+
+from __app__.lib import node_db, node_registrar, result, storage
+
+
+class StorageBackendTests():
+    """ Tests run against each non-Azure backend, through ``node_db`` and
+        ``node_registrar``.
+    """
+
+    backend = None
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        settings = {
+            'APP_STORAGE_BACKEND': self.backend,
+            'APP_STORAGE_SQLITE_PATH': os.path.join(self.tmpdir.name, 'physaci.sqlite3'),
+        }
+        patcher = mock.patch.dict(os.environ, settings)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.tmpdir.cleanup)
+        self.addCleanup(storage.reset)
+        storage.reset()
+
+    def test_result_round_trip(self):
+        """ Test that a result can be added, updated, read in full or as
+            a summary, and found by its commit.
+        """
+
+        check_result = result.Result({
+            'node_name': 'node1',
+            'check_run_id': '1234',
+            'check_run_head_sha': 'abc123',
+            'check_run_status': 'queued',
+            'node_results': [{'board_name': 'metro_m4_express'}],
+        })
+        self.assertTrue(node_db.add_result(check_result.results_to_table_entity()))
+        self.assertIsNone(node_db.add_result(check_result.results_to_table_entity()))
+
+        check_result.results['check_run_status'] = 'completed'
+        self.assertTrue(node_db.update_result(check_result.results_to_table_entity()))
+
+        full = node_db.get_result('node1', '1234')
+        self.assertEqual(full['check_run_status'], 'completed')
+        self.assertEqual(full['node_results'], [{'board_name': 'metro_m4_express'}])
+
+        summary = node_db.get_result('node1', '1234', summary=True)
+        self.assertNotIn('node_results', summary)
+        self.assertEqual(summary['node_results_count'], 1)
+
+        found = node_db.find_results('abc123')
+        self.assertEqual([entity['check_run_id'] for entity in found], ['1234'])
+        self.assertEqual(node_db.find_results('def456'), [])
+
+        with self.assertRaises(Exception) as raised:
+            node_db.get_result('node1', '5678')
+        self.assertEqual(raised.exception.status_code, 404)
+
+    def _later(self):
+        """ Moves the clock past the registrar's visibility timeout, so
+            that entries hidden by earlier reads are visible again.
+        """
+        self.offset = getattr(self, 'offset', 0) + 2
+        return mock.patch('time.time', return_value=time.time() + self.offset)
+
+    def _registrar_nodes(self):
+        with self._later():
+            return {
+                entry['node'].node_name: entry['node']
+                for entry in node_registrar.current_registrar()
+            }
+
+    def test_update_registered_node(self):
+        """ Test that an update only changes the entry with the node's
+            name and IP address.
+        """
+
+        for index in (1, 2):
+            response = node_registrar.add_node({
+                'node_name': f'node{index}',
+                'node_ip': f'10.0.0.{index}',
+                'node_sig_key': 'key',
+            }, {'status_code': 200})
+            self.assertEqual(response['status_code'], 200)
+
+        node = node_registrar.NodeItem(
+            node_name='node1', node_ip='10.0.0.1', node_sig_key='key', busy=True
+        )
+        with self._later():
+            response = node_registrar.update_registered_node(node, {'status_code': 200})
+        self.assertEqual(response['status_code'], 200)
+
+        nodes = self._registrar_nodes()
+        self.assertTrue(nodes['node1'].busy)
+        self.assertFalse(nodes['node2'].busy)
+
+    def test_update_unregistered_node(self):
+        """ Test that an update for a node that isn't registered, or
+            that comes from another IP address, is refused.
+        """
+
+        node_registrar.add_node({
+            'node_name': 'node1',
+            'node_ip': '10.0.0.1',
+            'node_sig_key': 'key',
+        }, {'status_code': 200})
+
+        for node_name, node_ip in (('node2', '10.0.0.1'), ('node1', '10.0.0.9')):
+            node = node_registrar.NodeItem(
+                node_name=node_name, node_ip=node_ip, node_sig_key='key', busy=True
+            )
+            with self._later():
+                response = node_registrar.update_registered_node(
+                    node, {'status_code': 200}
+                )
+            self.assertEqual(response['status_code'], 404)
+
+        nodes = self._registrar_nodes()
+        self.assertEqual(list(nodes), ['node1'])
+        self.assertEqual(nodes['node1'].node_ip, '10.0.0.1')
+        self.assertFalse(nodes['node1'].busy)
+
+    def _handle(self, response):
+        return json.loads(response['body'])['handle']
+
+    def test_update_by_handle(self):
+        """ Test that a node's handle stays valid after the registrar is
+            read, and that an update through it doesn't read the
+            registrar.
+        """
+
+        node_params = {
+            'node_name': 'node1',
+            'node_ip': '10.0.0.1',
+            'node_sig_key': 'key',
+        }
+        response = node_registrar.add_node(dict(node_params), {'status_code': 200})
+        handle = self._handle(response)
+        self._registrar_nodes()
+
+        node = node_registrar.NodeItem(**node_params, busy=True)
+        with self._later(), mock.patch.object(
+            node_registrar, 'current_registrar', side_effect=AssertionError
+        ):
+            response = node_registrar.update_registered_node(
+                node, {'status_code': 200}, handle=handle
+            )
+            self.assertEqual(response['status_code'], 200)
+
+            node.busy = False
+            response = node_registrar.update_registered_node(
+                node, {'status_code': 200}, handle=self._handle(response)
+            )
+            self.assertEqual(response['status_code'], 200)
+
+        nodes = self._registrar_nodes()
+        self.assertEqual(list(nodes), ['node1'])
+        self.assertFalse(nodes['node1'].busy)
+
+    def test_update_by_other_handle(self):
+        """ Test that a handle for another node's entry isn't used, and
+            that the node's own entry is found instead.
+        """
+
+        handles = {}
+        for index in (1, 2):
+            response = node_registrar.add_node({
+                'node_name': f'node{index}',
+                'node_ip': f'10.0.0.{index}',
+                'node_sig_key': 'key',
+            }, {'status_code': 200})
+            handles[index] = self._handle(response)
+
+        node = node_registrar.NodeItem(
+            node_name='node1', node_ip='10.0.0.1', node_sig_key='key', busy=True
+        )
+        message_id, pop_receipt, _ = node_registrar.parse_handle(handles[2])
+        forged = node_registrar.make_handle(
+            storage.RegistrarMessage(message_id, pop_receipt, None), node
+        )
+        for handle in (handles[2], forged, 'not a handle'):
+            with self._later():
+                response = node_registrar.update_registered_node(
+                    node, {'status_code': 200}, handle=handle
+                )
+            self.assertEqual(response['status_code'], 200)
+
+        nodes = self._registrar_nodes()
+        self.assertTrue(nodes['node1'].busy)
+        self.assertFalse(nodes['node2'].busy)
+        self.assertEqual(nodes['node2'].node_ip, '10.0.0.2')
+
+    def test_sweep_registrar(self):
+        """ Test that the sweep removes expired and malformed entries.
+        """
+
+        node_params = {
+            'node_name': 'node1',
+            'node_ip': '127.0.0.1',
+            'node_sig_key': 'key',
+            'listen_port': 4812,
+        }
+        node_registrar.add_node(node_params, {'status_code': 200})
+        storage.registrar().send(b'not a node')
+
+        expired = (
+            node_registrar.time.time() + node_registrar.lease_seconds() +
+            node_registrar.lease_grace_seconds() + 1
+        )
+        live, removed = node_registrar.sweep_registrar(now=expired)
+
+        self.assertEqual(live, [])
+        self.assertEqual(removed, 2)
+
+
+class TestStorageConfig(unittest.TestCase):
+    def test_connection_string(self):
+        """ Test that a missing connection string is a clear error with
+            every backend, and that only the memory and SQLite backends
+            fail the startup check without one.
+        """
+
+        for backend in (storage.BACKEND_AZURE, storage.BACKEND_MEMORY):
+            with mock.patch.dict(os.environ, {'APP_STORAGE_BACKEND': backend}):
+                os.environ.pop('APP_STORAGE_CONN_STR', None)
+                with self.assertRaises(storage.StorageConfigError) as raised:
+                    storage.connection_string()
+                self.assertIn(f'"{backend}"', str(raised.exception))
+
+        with mock.patch.dict(os.environ, {'APP_STORAGE_BACKEND': storage.BACKEND_AZURE}):
+            os.environ.pop('APP_STORAGE_CONN_STR', None)
+            storage.check_config()
+
+        for backend in (storage.BACKEND_MEMORY, storage.BACKEND_SQLITE):
+            with mock.patch.dict(os.environ, {'APP_STORAGE_BACKEND': backend}):
+                os.environ.pop('APP_STORAGE_CONN_STR', None)
+                with self.assertRaises(storage.StorageConfigError):
+                    storage.check_config()
+
+                os.environ['APP_STORAGE_CONN_STR'] = 'test'
+                storage.check_config()
+                self.assertEqual(storage.connection_string(), 'test')
+
+
+class TestMemoryStorage(StorageBackendTests, unittest.TestCase):
+    backend = storage.BACKEND_MEMORY
+
+
+class TestSqliteStorage(StorageBackendTests, unittest.TestCase):
+    backend = storage.BACKEND_SQLITE
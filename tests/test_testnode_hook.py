@@ -0,0 +1,80 @@
+import importlib
+import json
+import unittest
+
+from unittest import mock
+
+import _app
+
+import azure.functions as func
+
+from __app__.lib import check_dispatch, node_registrar
+
+testnode_hook = importlib.import_module('__app__.testnode-hook')
+
+
+def node_request(route_func, route_action, body, params=None):
+    if not isinstance(body, bytes):
+        body = json.dumps(body).encode()
+
+    return func.HttpRequest(
+        'POST',
+        f'/api/testnode-hook/{route_func}/{route_action}',
+        headers={'content-type': 'application/json'},
+        params=params or {},
+        route_params={'func': route_func, 'action': route_action},
+        body=body,
+    )
+
+
+class TestTestnodeHook(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(check_dispatch, 'reconcile_report', return_value=True)
+        self.reconcile_report = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_report_missing_job(self):
+        """ Test that a result report that doesn't name its job is
+            refused before it is reconciled.
+        """
+
+        for action in ('add', 'update', 'finalize'):
+            for body in ({}, {'check_run_id': '1234'}, [], b'not json'):
+                response = testnode_hook.main(node_request('testresult', action, body))
+                self.assertEqual(response.status_code, 400, (action, body))
+
+        self.reconcile_report.assert_not_called()
+
+    def test_delta_missing_job(self):
+        """ Test that a delta that isn't a JSON object naming its job is
+            refused, rather than failing.
+        """
+
+        for body in ({}, {'node_name': 'node1'}, [], b'not json'):
+            response = testnode_hook.main(node_request('testresult', 'delta', body))
+            self.assertEqual(response.status_code, 400, body)
+
+        self.reconcile_report.assert_not_called()
+
+    def test_registrar_handle(self):
+        """ Test that a node's handle is passed on to the registrar, and
+            isn't taken for one of the node's parameters.
+        """
+
+        body = {'node_name': 'node1', 'node_sig_key': 'key', 'handle': 'abc'}
+        with mock.patch.object(node_registrar, 'add_node',
+                               side_effect=lambda params, response, handle: response) as add_node, \
+             mock.patch.object(node_registrar, 'update_registered_node',
+                               side_effect=lambda node, response, handle: response) as update:
+            testnode_hook.main(node_request('registrar', 'add', body))
+            testnode_hook.main(node_request('registrar', 'heartbeat', body))
+
+        params, _ = add_node.call_args[0]
+        self.assertNotIn('handle', params)
+        self.assertEqual(add_node.call_args[1], {'handle': 'abc'})
+        self.assertEqual(update.call_args[0][0].node_name, 'node1')
+        self.assertEqual(update.call_args[1], {'handle': 'abc'})
+
+
+if __name__ == '__main__':
+    unittest.main()